@@ -33,14 +33,14 @@ import logging
 import urlparse
 import simplejson as json
 import scrypt
-import httplib
-import socket
-import ssl
 import errno
+import threading
 
 
 from xdg import BaseDirectory
 from hashlib import sha256
+from u1db import errors
+from u1db.vectorclock import VectorClockRev
 from u1db.remote import http_client
 from u1db.remote.ssl_match_hostname import (  # noqa
     CertificateError,
@@ -113,6 +113,10 @@ SOLEDAD_UPLOADING_KEYS = 'Uploading keys...'
 SOLEDAD_DONE_UPLOADING_KEYS = 'Done uploading keys.'
 SOLEDAD_NEW_DATA_TO_SYNC = 'New data available.'
 SOLEDAD_DONE_DATA_SYNC = 'Done data sync.'
+SOLEDAD_BOOTSTRAP_STEP_TIMING = 'Bootstrap step timing.'
+SOLEDAD_DONE_VERIFYING_KEYS = 'Done verifying keys in server.'
+SOLEDAD_VERIFYING_KEYS_FAILED = 'Failed verifying keys in server.'
+SOLEDAD_SYNC_REPORT = 'Sync report.'
 
 # we want to use leap.common.events to emits signals, if it is available.
 try:
@@ -130,18 +134,57 @@ try:
         events.events_pb2.SOLEDAD_DONE_UPLOADING_KEYS
     SOLEDAD_NEW_DATA_TO_SYNC = events.events_pb2.SOLEDAD_NEW_DATA_TO_SYNC
     SOLEDAD_DONE_DATA_SYNC = events.events_pb2.SOLEDAD_DONE_DATA_SYNC
+    # older versions of leap.common do not know about the following signals,
+    # so they are not emitted at all in that case.
+    SOLEDAD_BOOTSTRAP_STEP_TIMING = getattr(
+        events.events_pb2, 'SOLEDAD_BOOTSTRAP_STEP_TIMING', None)
+    SOLEDAD_DONE_VERIFYING_KEYS = getattr(
+        events.events_pb2, 'SOLEDAD_DONE_VERIFYING_KEYS', None)
+    SOLEDAD_VERIFYING_KEYS_FAILED = getattr(
+        events.events_pb2, 'SOLEDAD_VERIFYING_KEYS_FAILED', None)
+    SOLEDAD_SYNC_REPORT = getattr(
+        events.events_pb2, 'SOLEDAD_SYNC_REPORT', None)
 except ImportError:
     pass
 
 
+def signal_if_known(signal_const, content=""):
+    """
+    Emit a signal that may be unknown to the installed leap.common.
+
+    @param signal_const: The signal, or None if it is not known.
+    @param content: The content of the signal.
+    @type content: str
+    """
+    if signal_const is not None:
+        signal(signal_const, content)
+
+
 from leap.soledad.document import SoledadDocument
 from leap.soledad.sqlcipher import (
     open as sqlcipher_open,
     SQLCipherDatabase,
+    ContentPending,
+)
+from leap.soledad.target import (
+    SoledadSyncTarget,
+    SyncReport,
 )
-from leap.soledad.target import SoledadSyncTarget
 from leap.soledad.shared_db import SoledadSharedDatabase
 from leap.soledad.crypto import SoledadCrypto
+from leap.soledad.bootstrap import BootstrapGraph
+from leap.soledad.scheduler import SyncScheduler
+from leap.soledad.sqlstats import StatementStats
+from leap.soledad.coalesce import WriteCoalescer
+from leap.soledad.blobs import (
+    SoledadBlobTarget,
+    BlobNotFound,
+    BLOB_ID_KEY,
+    CHUNK_SIZE,
+)
+from leap.soledad.connection import (
+    VerifiedHTTPSConnection as CertVerifiedHTTPSConnection,
+)
 
 
 logger = logging.getLogger(name=__name__)
@@ -154,7 +197,8 @@ logger = logging.getLogger(name=__name__)
 SOLEDAD_CERT = None
 """
 Path to the certificate file used to certify the SSL connection between
-Soledad client and server.
+Soledad client and server, for connections that were not given a certificate
+of their own.
 """
 
 SECRETS_DOC_ID_HASH_PREFIX = 'uuid-'
@@ -195,6 +239,16 @@ class Soledad(object):
           replica and server's replica.
         SOLEDAD_DONE_DATA_SYNC: emitted inside C{sync()} method when it has
             finished synchronizing with remote replica.
+        SOLEDAD_BOOTSTRAP_STEP_TIMING: emitted once for each bootstrap step
+            when the bootstrap sequence finishes, with a JSON object holding
+            the uuid, the step name and the seconds it took as content.
+        SOLEDAD_DONE_VERIFYING_KEYS: emitted when the background check of
+            the keys in the shared recovery database, started by a lazy
+            bootstrap, finishes.
+        SOLEDAD_VERIFYING_KEYS_FAILED: emitted when the background check of
+            the keys in the shared recovery database gave up retrying.
+        SOLEDAD_SYNC_REPORT: emitted after each sync, with a JSON object
+            holding the uuid and the sync report as content.
     """
 
     LOCAL_DATABASE_FILE_NAME = 'soledad.u1db'
@@ -226,6 +280,24 @@ class Soledad(object):
     key for remote storage.
     """
 
+    SHARED_DB_MAX_ATTEMPTS = 8
+    """
+    How many times a lazy bootstrap tries to verify the secrets stored in the
+    shared recovery database before giving up.
+    """
+
+    SHARED_DB_RETRY_DELAY = 1
+    """
+    Seconds to wait before retrying to verify the secrets stored in the
+    shared recovery database. The delay doubles after each failure.
+    """
+
+    SHARED_DB_MAX_RETRY_DELAY = 300
+    """
+    The maximum number of seconds to wait between two attempts to verify the
+    secrets stored in the shared recovery database.
+    """
+
     SALT_LENGTH = 64
     """
     The length of the salt used to derive the key for the storage secret
@@ -258,7 +330,9 @@ class Soledad(object):
     """
 
     def __init__(self, uuid, passphrase, secrets_path, local_db_path,
-                 server_url, cert_file, auth_token=None, secret_id=None):
+                 server_url, cert_file, auth_token=None, secret_id=None,
+                 document_cache_size=None, lazy_bootstrap=False,
+                 connection_pool=None):
         """
         Initialize configuration, cryptographic keys and dbs.
 
@@ -277,23 +351,62 @@ class Soledad(object):
             database.
         @type server_url: str
         @param cert_file: Path to the SSL certificate to use in the
-            connection to the server_url.
+            connection to the server_url. Each instance uses its own
+            certificate.
         @type cert_file: str
         @param auth_token: Authorization token for accessing remote databases.
         @type auth_token: str
+        @param secret_id: The id of the storage secret to be used.
+        @type secret_id: str
+        @param document_cache_size: The maximum number of documents to keep
+            in an in-process cache in front of the local database, or None to
+            disable the cache.
+        @type document_cache_size: int
+        @param lazy_bootstrap: If secrets are found locally, open the local
+            database without contacting the server, and verify the secrets
+            stored in the shared recovery database in the background.
+        @type lazy_bootstrap: bool
+        @param connection_pool: A pool of connections to the server shared
+            with other instances, or None to use connections of its own.
+        @type connection_pool: leap.soledad.connection.HTTPConnectionPool
         """
         # get config params
         self._uuid = uuid
         self._passphrase = passphrase
+        self._document_cache_size = document_cache_size
+        self._cert_file = cert_file
+        self._connection_pool = connection_pool
+        self._local_db = None
+        self._statement_stats = None
         # init crypto variables
         self._secrets = {}
         self._secret_id = secret_id
+        self._storage_secrets = {}
+        self._local_storage_keys = {}
+        self._shared_db_instance = None
+        # the shared db is used by the main thread and by the background
+        # verification of secrets.
+        self._shared_db_lock = threading.RLock()
+        self._need_sync_targets = {}
+        self._sync_info_cache = {}
+        self._bootstrap_timings = []
+        self._lazy_bootstrap = lazy_bootstrap
+        self._secrets_check = None
+        self._stop_background_tasks = threading.Event()
+        self._sync_lock = threading.Lock()
+        self._sync_scheduler = None
+        self._metadata_fields = None
+        self._lazy_decrypt = False
+        self._delta_sync = False
+        self._upload_connections = 1
+        self._write_coalescer = None
+        self._write_lock = threading.RLock()
+        self._write_flusher = None
+        self._content_prefetch = None
+        self._compaction = None
         # init config (possibly with default values)
         self._init_config(secrets_path, local_db_path, server_url)
         self._set_token(auth_token)
-        # configure SSL certificate
-        global SOLEDAD_CERT
-        SOLEDAD_CERT = cert_file
         # initiate bootstrap sequence
         self._bootstrap()
 
@@ -325,51 +438,119 @@ class Soledad(object):
         """
         Bootstrap local Soledad instance.
 
-        Soledad Client bootstrap is the following sequence of stages:
+        Soledad Client bootstrap is the following graph of steps:
 
-        * stage 0 - local environment setup.
+        * setup - local environment setup.
             - directory initialization.
             - crypto submodule initialization
-        * stage 1 - secret generation/loading:
+        * load_secrets - secret generation/loading:
             - if secrets exist locally, load them.
             - else, if secrets exist in server, download them.
             - else, generate a new secret.
-        * stage 2 - store secrets in server.
-        * stage 3 - database initialization.
+        * unlock_secret - decrypt the storage secret.
+        * derive_local_key - derive the local database key from the storage
+          secret. This runs in the background, while secrets are stored in
+          the server.
+        * store_secrets - store secrets in server, unless the server already
+          has an identical copy of them.
+        * init_db - database initialization.
 
-        This method decides which bootstrap stages have already been performed
-        and performs the missing ones in order.
+        Each scrypt derivation is run once per secret, and the time taken by
+        each step is signaled when the sequence finishes.
+
+        In a lazy bootstrap, if secrets were found locally, no network
+        request is made before the local database is open. Secrets are
+        stored in the server by a background task instead.
         """
         # TODO: make sure key storage always happens (even if this method is
         #       interrupted).
-        # TODO: write tests for bootstrap stages.
-        # TODO: log each bootstrap step.
-        # stage 0  - socal environment setup
-        self._init_dirs()
-        self._crypto = SoledadCrypto(self)
-        # stage 1 - secret generation/loading
-        if not self._has_secret():  # try to load from local storage.
+
+        def _setup():
+            self._init_dirs()
+            self._crypto = SoledadCrypto(self)
+
+        def _store_secrets_in_server():
+            doc = graph.result('load_secrets')
+            if self._lazy_bootstrap and doc is None:
+                # secrets were loaded from local storage, so leave the
+                # server for later.
+                return
+            # reuse the recovery document if it was fetched while loading
+            # secrets, so we do not ask the server for it twice.
+            self._put_secrets_in_shared_db(doc)
+
+        graph = BootstrapGraph()
+        graph.add('setup', _setup)
+        graph.add(
+            'load_secrets', self._load_or_create_secrets,
+            requires=('setup',))
+        graph.add(
+            'unlock_secret', self._get_storage_secret,
+            requires=('load_secrets',))
+        graph.add(
+            'derive_local_key', self._get_local_storage_key,
+            requires=('unlock_secret',), background=True)
+        graph.add(
+            'store_secrets', _store_secrets_in_server,
+            requires=('unlock_secret',))
+        graph.add('init_db', self._init_db, requires=('derive_local_key',))
+        try:
+            self._bootstrap_timings = graph.run()
+        finally:
+            self._close_shared_db()
+        logger.debug('Bootstrap timings: %s' % ', '.join(
+            ['%s: %.4fs' % timing for timing in self._bootstrap_timings]))
+        self._signal_bootstrap_timings()
+        if self._lazy_bootstrap and graph.result('load_secrets') is None:
+            self._secrets_check = threading.Thread(
+                target=self._put_secrets_in_shared_db_with_retry,
+                name='soledad-secrets-check')
+            self._secrets_check.daemon = True
+            self._secrets_check.start()
+
+    def _load_or_create_secrets(self):
+        """
+        Load secrets from local storage, or fetch them from the shared
+        recovery database, or generate a new secret.
+
+        @return: The recovery document if the shared recovery database was
+            queried, or None otherwise. If the server had no recovery
+            document, a new empty one is returned.
+        @rtype: SoledadDocument
+        """
+        if self._has_secret():  # try to load from local storage.
+            return None
+        logger.info(
+            'Trying to fetch cryptographic secrets from shared recovery '
+            'database...')
+        # there are no secrets in local storage, so try to fetch encrypted
+        # secrets from server.
+        doc = self._get_secrets_from_shared_db()
+        if doc:
+            # found secrets in server, so import them.
             logger.info(
-                'Trying to fetch cryptographic secrets from shared recovery '
-                'database...')
-            # there are no secrets in local storage, so try to fetch encrypted
-            # secrets from server.
-            doc = self._get_secrets_from_shared_db()
-            if doc:
-                # found secrets in server, so import them.
-                logger.info(
-                    'Found cryptographic secrets in shared recovery '
-                    'database.')
-                self.import_recovery_document(doc.content)
-            else:
-                # there are no secrets in server also, so generate a secret.
-                logger.info(
-                    'No cryptographic secrets found, creating new secrets...')
-                self._set_secret_id(self._gen_secret())
-        # Stage 2 - storage of encrypted secrets in the server.
-        self._put_secrets_in_shared_db()
-        # Stage 3 - Local database initialization
-        self._init_db()
+                'Found cryptographic secrets in shared recovery '
+                'database.')
+            self.import_recovery_document(doc.content)
+            return doc
+        # there are no secrets in server also, so generate a secret.
+        logger.info(
+            'No cryptographic secrets found, creating new secrets...')
+        self._set_secret_id(self._gen_secret())
+        return SoledadDocument(doc_id=self._uuid_hash())
+
+    def _signal_bootstrap_timings(self):
+        """
+        Signal the time taken by each step of the last bootstrap.
+        """
+        for step, elapsed in self._bootstrap_timings:
+            signal_if_known(
+                SOLEDAD_BOOTSTRAP_STEP_TIMING,
+                json.dumps({
+                    'uuid': self._uuid,
+                    'step': step,
+                    'seconds': elapsed,
+                }))
 
     def _init_dirs(self):
         """
@@ -401,38 +582,70 @@ class Soledad(object):
         The first C{self.REMOTE_STORAGE_SECRET_LENGTH} bytes of the storage
         secret are used for remote storage encryption. We use the next
         C{self.LOCAL_STORAGE_SECRET} bytes to derive a key for local storage.
-        From these bytes, the first C{self.SALT_LENGTH} are used as the salt
-        and the rest as the password for the scrypt hashing.
+        See C{_get_local_storage_key} for details.
         """
-        # salt indexes
-        salt_start = self.REMOTE_STORAGE_SECRET_LENGTH
-        salt_end = salt_start + self.SALT_LENGTH
-        # password indexes
-        pwd_start = salt_end
-        pwd_end = salt_start + self.LOCAL_STORAGE_SECRET_LENGTH
-        # calculate the key for local encryption
-        secret = self._get_storage_secret()
-        key = scrypt.hash(
-            secret[pwd_start:pwd_end],  # the password
-            secret[salt_start:salt_end],  # the salt
-            buflen=32,  # we need a key with 256 bits (32 bytes)
-        )
-        self._db = sqlcipher_open(
+        key = self._get_local_storage_key()
+        self._local_db = sqlcipher_open(
             self._local_db_path,
             binascii.b2a_hex(key),  # sqlcipher only accepts the hex version
             create=True,
             document_factory=SoledadDocument,
             crypto=self._crypto,
             raw_key=True)
+        self._local_db.set_document_cache_size(self._document_cache_size)
+        self._local_db.set_statement_stats(self._statement_stats)
+        self._local_db.set_content_fetcher(self._fetch_content)
+        self._local_db.set_change_listener(self._notify_local_change)
+
+    def _get_db(self):
+        """
+        Return the local database, opening it again if it was suspended.
+        """
+        if self._local_db is None:
+            self._init_db()
+        return self._local_db
+
+    _db = property(_get_db, doc='The local U1DB SQLCipher database.')
+
+    def suspend(self):
+        """
+        Close the local database to free its resources.
+
+        The database is opened again the next time it is used. The local
+        storage key stays in memory, so reopening it does not run scrypt
+        again. Buffered document updates are written before it is closed.
+        """
+        if self._local_db is not None:
+            self.flush_writes()
+        db, self._local_db = self._local_db, None
+        if db is not None:
+            db.close()
+
+    def _get_suspended(self):
+        return self._local_db is None
+
+    suspended = property(
+        _get_suspended,
+        doc='Whether the local database is closed until next used.')
 
     def close(self):
         """
-        Close underlying U1DB database.
+        Close underlying U1DB database and stop background tasks.
+
+        Buffered document updates are written before the database is closed.
         """
-        if hasattr(self, '_db') and isinstance(
-                self._db,
-                SQLCipherDatabase):
-            self._db.close()
+        if hasattr(self, '_stop_background_tasks'):
+            self._stop_background_tasks.set()
+        if getattr(self, '_sync_scheduler', None) is not None:
+            self.stop_sync_scheduler()
+        for target in getattr(self, '_need_sync_targets', {}).values():
+            target.close()
+        db = getattr(self, '_local_db', None)
+        if isinstance(db, SQLCipherDatabase):
+            try:
+                self.flush_writes()
+            finally:
+                db.close()
 
     def __del__(self):
         """
@@ -449,7 +662,22 @@ class Soledad(object):
         Return the storage secret.
 
         Storage secret is encrypted before being stored. This method decrypts
-        and returns the stored secret.
+        and returns the stored secret. Decryption requires running scrypt
+        over the passphrase, so the result is kept in memory and the
+        derivation happens only once for each secret.
+
+        @return: The storage secret.
+        @rtype: str
+        """
+        secret = self._storage_secrets.get(self._secret_id)
+        if secret is None:
+            secret = self._decrypt_storage_secret()
+            self._storage_secrets[self._secret_id] = secret
+        return secret
+
+    def _decrypt_storage_secret(self):
+        """
+        Decrypt the storage secret with a key derived from the passphrase.
 
         @return: The storage secret.
         @rtype: str
@@ -468,6 +696,39 @@ class Soledad(object):
         ciphertext = binascii.a2b_base64(ciphertext)
         return self._crypto.decrypt_sym(ciphertext, key, iv=iv)
 
+    def _get_local_storage_key(self):
+        """
+        Return the key for the local database, derived from the storage
+        secret.
+
+        From the C{self.LOCAL_STORAGE_SECRET} bytes of the storage secret
+        reserved for local storage, the first C{self.SALT_LENGTH} are used as
+        the salt and the rest as the password for the scrypt hashing. The
+        result is kept in memory, so the derivation happens only once for
+        each secret.
+
+        @return: The 256-bit key for the local database.
+        @rtype: str
+        """
+        key = self._local_storage_keys.get(self._secret_id)
+        if key is not None:
+            return key
+        # salt indexes
+        salt_start = self.REMOTE_STORAGE_SECRET_LENGTH
+        salt_end = salt_start + self.SALT_LENGTH
+        # password indexes
+        pwd_start = salt_end
+        pwd_end = salt_start + self.LOCAL_STORAGE_SECRET_LENGTH
+        # calculate the key for local encryption
+        secret = self._get_storage_secret()
+        key = scrypt.hash(
+            secret[pwd_start:pwd_end],  # the password
+            secret[salt_start:salt_end],  # the salt
+            buflen=32,  # we need a key with 256 bits (32 bytes)
+        )
+        self._local_storage_keys[self._secret_id] = key
+        return key
+
     def _set_secret_id(self, secret_id):
         """
         Define the id of the storage secret to be used.
@@ -571,6 +832,8 @@ class Soledad(object):
             self.SECRET_KEY: '%s%s%s' % (
                 str(iv), self.IV_SEPARATOR, binascii.b2a_base64(ciphertext)),
         }
+        # we already know the secret, so there is no need to decrypt it.
+        self._storage_secrets[secret_id] = secret
         self._store_secrets()
         signal(SOLEDAD_DONE_CREATING_KEYS, self._uuid)
         return secret_id
@@ -620,12 +883,33 @@ class Soledad(object):
     def _shared_db(self):
         """
         Return an instance of the shared recovery database object.
+
+        The same instance is returned until C{_close_shared_db} is called,
+        so that consecutive requests reuse its connection to the server.
         """
         if self.server_url:
-            return SoledadSharedDatabase.open_database(
-                urlparse.urljoin(self.server_url, 'shared'),
-                False,  # TODO: eliminate need to create db here.
-                creds=self._creds)
+            with self._shared_db_lock:
+                if self._shared_db_instance is None:
+                    self._shared_db_instance = \
+                        SoledadSharedDatabase.open_database(
+                            urlparse.urljoin(self.server_url, 'shared'),
+                            False,  # TODO: eliminate need to create db here.
+                            creds=self._creds,
+                            cert_file=self._cert_file,
+                            connection_pool=self._connection_pool)
+                return self._shared_db_instance
+
+    def _close_shared_db(self):
+        """
+        Close the connection to the shared recovery database, if any.
+
+        If the secrets are being verified in the background, this waits for
+        the current attempt to finish, as it uses the connection.
+        """
+        with self._shared_db_lock:
+            if self._shared_db_instance is not None:
+                self._shared_db_instance.close()
+                self._shared_db_instance = None
 
     def _get_secrets_from_shared_db(self):
         """
@@ -644,25 +928,49 @@ class Soledad(object):
         signal(SOLEDAD_DONE_DOWNLOADING_KEYS, self._uuid)
         return doc
 
-    def _put_secrets_in_shared_db(self):
+    def _recovery_document_hash(self, content):
+        """
+        Return a hash of the content of a recovery document that does not
+        depend on the order of its keys.
+
+        @param content: The content of the recovery document.
+        @type content: dict
+
+        @return: The hex digest of the hash.
+        @rtype: str
+        """
+        return sha256(json.dumps(content, sort_keys=True)).hexdigest()
+
+    def _put_secrets_in_shared_db(self, doc=None):
         """
         Assert local keys are the same as shared db's ones.
 
         Try to fetch keys from shared recovery database. If they already exist
-        in the remote db, assert that that data is the same as local data.
-        Otherwise, upload keys to shared recovery database.
+        in the remote db and are the same as the local ones, there is nothing
+        to do. Otherwise, upload keys to shared recovery database.
 
+        @param doc: The recovery document as currently stored in the shared
+            recovery database, if it has already been fetched. If None, it
+            is fetched from the server.
+        @type doc: SoledadDocument
         """
         soledad_assert(
             self._has_secret(),
             'Tried to send keys to server but they don\'t exist in local '
             'storage.')
         # try to get secrets doc from server, otherwise create it
-        doc = self._get_secrets_from_shared_db()
+        if doc is None:
+            doc = self._get_secrets_from_shared_db()
         if doc is None:
             doc = SoledadDocument(doc_id=self._uuid_hash())
+        content = self.export_recovery_document(include_uuid=False)
+        if not doc.is_tombstone() and \
+                self._recovery_document_hash(doc.content) == \
+                self._recovery_document_hash(content):
+            logger.info('Shared recovery database is up to date.')
+            return
         # fill doc with encrypted secrets
-        doc.content = self.export_recovery_document(include_uuid=False)
+        doc.content = content
         # upload secrets to server
         signal(SOLEDAD_UPLOADING_KEYS, self._uuid)
         db = self._shared_db()
@@ -672,6 +980,41 @@ class Soledad(object):
         db.put_doc(doc)
         signal(SOLEDAD_DONE_UPLOADING_KEYS, self._uuid)
 
+    def _put_secrets_in_shared_db_with_retry(self):
+        """
+        Verify or store secrets in the shared recovery database, retrying
+        with an exponential backoff on failure.
+
+        This is run in the background after a lazy bootstrap, and stops
+        early if this instance is closed. Completion is reported with the
+        SOLEDAD_DONE_VERIFYING_KEYS signal, and giving up with the
+        SOLEDAD_VERIFYING_KEYS_FAILED signal.
+        """
+        delay = self.SHARED_DB_RETRY_DELAY
+        for attempt in range(1, self.SHARED_DB_MAX_ATTEMPTS + 1):
+            if self._stop_background_tasks.is_set():
+                return
+            try:
+                # the main thread may not close the shared db or change its
+                # credentials while an attempt uses it.
+                with self._shared_db_lock:
+                    try:
+                        self._put_secrets_in_shared_db()
+                    finally:
+                        self._close_shared_db()
+                signal_if_known(SOLEDAD_DONE_VERIFYING_KEYS, self._uuid)
+                return
+            except Exception, e:
+                logger.warning(
+                    'Could not verify secrets in shared recovery database '
+                    '(attempt %d of %d): %s'
+                    % (attempt, self.SHARED_DB_MAX_ATTEMPTS, str(e)))
+            if attempt < self.SHARED_DB_MAX_ATTEMPTS:
+                # waiting on the event lets close() interrupt the backoff.
+                self._stop_background_tasks.wait(delay)
+                delay = min(delay * 2, self.SHARED_DB_MAX_RETRY_DELAY)
+        signal_if_known(SOLEDAD_VERIFYING_KEYS_FAILED, self._uuid)
+
     #
     # Document storage, retrieval and sync.
     #
@@ -680,12 +1023,20 @@ class Soledad(object):
         """
         Update a document in the local encrypted database.
 
+        If write coalescing is enabled, the update is buffered and written
+        later, together with the following updates to the same document, see
+        C{set_write_coalescing}. The revision the document will have once
+        written is returned.
+
         @param doc: the document to update
         @type doc: SoledadDocument
 
         @return: the new revision identifier for the document
         @rtype: str
         """
+        if self._write_coalescer is not None:
+            with self._write_lock:
+                return self._buffer_doc(doc)
         return self._db.put_doc(doc)
 
     def delete_doc(self, doc):
@@ -698,6 +1049,7 @@ class Soledad(object):
         @return: the new revision identifier for the document
         @rtype: str
         """
+        self._flush_doc_writes(doc.doc_id)
         return self._db.delete_doc(doc)
 
     def get_doc(self, doc_id, include_deleted=False):
@@ -714,6 +1066,17 @@ class Soledad(object):
         @return: the document object or None
         @rtype: SoledadDocument
         """
+        if self._write_coalescer is not None:
+            # buffered updates being written by the flush thread are not
+            # read from the buffer nor the database until they are written.
+            with self._write_lock:
+                self._flush_expired_writes()
+                buffered = self._write_coalescer.get(doc_id)
+            if buffered is not None:
+                _, doc = buffered
+                if doc.is_tombstone() and not include_deleted:
+                    return None
+                return doc
         return self._db.get_doc(doc_id, include_deleted=include_deleted)
 
     def get_docs(self, doc_ids, check_for_conflicts=True,
@@ -731,6 +1094,7 @@ class Soledad(object):
             in matching doc_ids order.
         @rtype: generator
         """
+        self.flush_writes()
         return self._db.get_docs(doc_ids,
                                  check_for_conflicts=check_for_conflicts,
                                  include_deleted=include_deleted)
@@ -745,8 +1109,30 @@ class Soledad(object):
             The current generation of the database, followed by a list of all
             the documents in the database.
         """
+        self.flush_writes()
         return self._db.get_all_docs(include_deleted)
 
+    def iter_all_docs(self, include_deleted=False):
+        """
+        Get the JSON content for all documents in the database, one at a
+        time.
+
+        Documents are fetched from the local database in batches and built
+        only when they are reached, so memory use does not depend on the
+        number of documents.
+
+        @param include_deleted: If set to True, deleted documents will be
+            returned with empty content. Otherwise deleted documents will not
+            be included in the results.
+        @type include_deleted: bool
+
+        @return: (generation, docs) - The current generation of the database,
+            followed by an iterator over all the documents in the database.
+        @rtype: tuple
+        """
+        self.flush_writes()
+        return self._db.iter_all_docs(include_deleted=include_deleted)
+
     def create_doc(self, content, doc_id=None):
         """
         Create a new document in the local encrypted database.
@@ -759,6 +1145,8 @@ class Soledad(object):
         @return: the new document
         @rtype: SoledadDocument
         """
+        if doc_id is not None:
+            self._flush_doc_writes(doc_id)
         return self._db.create_doc(content, doc_id=doc_id)
 
     def create_doc_from_json(self, json, doc_id=None):
@@ -778,6 +1166,8 @@ class Soledad(object):
         @return: The new cocument
         @rtype: SoledadDocument
         """
+        if doc_id is not None:
+            self._flush_doc_writes(doc_id)
         return self._db.create_doc_from_json(json, doc_id=doc_id)
 
     def create_index(self, index_name, *index_expressions):
@@ -842,6 +1232,8 @@ class Soledad(object):
         @return: List of [Document]
         @rtype: list
         """
+        # buffered updates are not indexed yet.
+        self.flush_writes()
         return self._db.get_from_index(index_name, *key_values)
 
     def get_range_from_index(self, index_name, start_value, end_value):
@@ -871,9 +1263,112 @@ class Soledad(object):
         @return: List of [Document]
         @rtype: list
         """
+        # buffered updates are not indexed yet.
+        self.flush_writes()
         return self._db.get_range_from_index(
             index_name, start_value, end_value)
 
+    def iter_from_index(self, index_name, *key_values, **kwargs):
+        """
+        Return documents that match the keys supplied, one at a time.
+
+        Key values have the same semantics as in get_from_index(). Documents
+        are ordered by their index values and then by doc_id.
+
+        @param index_name: The index to query
+        @type index_name: str
+        @param key_values: values to match.
+        @type key_values: tuple
+        @param limit: the maximum number of documents to return.
+        @type limit: int
+        @param offset: the number of matching documents to skip.
+        @type offset: int
+        @param page_token: a token returned by get_from_index_page(); only
+            documents after that page will be returned.
+        @type page_token: str
+        @return: an iterator over the matching documents.
+        @rtype: generator
+        """
+        # buffered updates are not indexed yet.
+        self.flush_writes()
+        return self._db.iter_from_index(index_name, *key_values, **kwargs)
+
+    def iter_range_from_index(self, index_name, start_value, end_value,
+                              **kwargs):
+        """
+        Return documents that fall within the specified range, one at a time.
+
+        Range values have the same semantics as in get_range_from_index(),
+        and the keyword arguments are the same as in iter_from_index().
+
+        @param index_name: The index to query
+        @type index_name: str
+        @param start_value: tuples of values that define the lower bound of
+            the range.
+        @type start_value: tuple
+        @param end_value: tuples of values that define the upper bound of the
+            range.
+        @type end_value: tuple
+        @return: an iterator over the matching documents.
+        @rtype: generator
+        """
+        # buffered updates are not indexed yet.
+        self.flush_writes()
+        return self._db.iter_range_from_index(
+            index_name, start_value, end_value, **kwargs)
+
+    def get_from_index_page(self, index_name, key_values, page_size,
+                            page_token=None):
+        """
+        Return one page of the documents that match the keys supplied.
+
+        @param index_name: The index to query
+        @type index_name: str
+        @param key_values: values to match, as in get_from_index().
+        @type key_values: tuple
+        @param page_size: the maximum number of documents in the page.
+        @type page_size: int
+        @param page_token: the token returned with the previous page, or None
+            for the first page.
+        @type page_token: str
+        @return: (docs, next_page_token) where next_page_token is None if
+            there are no more documents.
+        @rtype: tuple
+        """
+        # buffered updates are not indexed yet.
+        self.flush_writes()
+        return self._db.get_from_index_page(
+            index_name, key_values, page_size, page_token=page_token)
+
+    def get_range_from_index_page(self, index_name, start_value, end_value,
+                                  page_size, page_token=None):
+        """
+        Return one page of the documents that fall within the specified
+        range.
+
+        @param index_name: The index to query
+        @type index_name: str
+        @param start_value: the lower bound of the range, as in
+            get_range_from_index().
+        @type start_value: tuple
+        @param end_value: the upper bound of the range, as in
+            get_range_from_index().
+        @type end_value: tuple
+        @param page_size: the maximum number of documents in the page.
+        @type page_size: int
+        @param page_token: the token returned with the previous page, or None
+            for the first page.
+        @type page_token: str
+        @return: (docs, next_page_token) where next_page_token is None if
+            there are no more documents.
+        @rtype: tuple
+        """
+        # buffered updates are not indexed yet.
+        self.flush_writes()
+        return self._db.get_range_from_index_page(
+            index_name, start_value, end_value, page_size,
+            page_token=page_token)
+
     def get_index_keys(self, index_name):
         """
         Return all keys under which documents are indexed in this index.
@@ -883,6 +1378,8 @@ class Soledad(object):
         @return: [] A list of tuples of indexed keys.
         @rtype: list
         """
+        # buffered updates are not indexed yet.
+        self.flush_writes()
         return self._db.get_index_keys(index_name)
 
     def get_doc_conflicts(self, doc_id):
@@ -895,6 +1392,7 @@ class Soledad(object):
         @return: a list of the document entries that are conflicted
         @rtype: list
         """
+        self._flush_doc_writes(doc_id)
         return self._db.get_doc_conflicts(doc_id)
 
     def resolve_doc(self, doc, conflicted_doc_revs):
@@ -907,43 +1405,1041 @@ class Soledad(object):
             supersedes.
         @type conflicted_doc_revs: list
         """
+        self._flush_doc_writes(doc.doc_id)
         return self._db.resolve_doc(doc, conflicted_doc_revs)
 
-    def sync(self):
+    def sync(self, profile_memory=False, metadata_only=False):
         """
         Synchronize the local encrypted replica with a remote replica.
 
-        @param url: the url of the target replica to sync with
-        @type url: str
+        If a sync is already running, in the background or in another
+        thread, this waits for it to finish first.
+
+        In a metadata only sync, new documents are received without their
+        content, if the server supports it. This makes the first sync of a
+        new device fast. Their content is fetched the first time they are
+        read with C{get_doc} or C{get_docs}, and in the background, see
+        C{start_content_prefetch}.
+
+        @param profile_memory: Whether to record the peak memory of each
+            phase of the sync and where it was allocated, in the C{memory}
+            attribute of the report. This traces every allocation, so it
+            makes the sync much slower.
+        @type profile_memory: bool
+        @param metadata_only: Whether to receive only the metadata of new
+            documents, see C{set_metadata_fields}.
+        @type metadata_only: bool
+
+        @return: A report of what the sync transferred and of the time spent
+            in each of its phases. The local generation before the
+            synchronisation was performed is in its C{local_gen} attribute.
+        @rtype: leap.soledad.target.SyncReport
+
+        @raise leap.soledad.profiling.ProfilerNotAvailable: If memory should
+            be profiled but the tracemalloc module is not available.
+        """
+        memory = None
+        if profile_memory:
+            memory = profiling.SyncMemoryProfile()
+        report = SyncReport(memory=memory)
+        self.flush_writes()
+        # blobs are uploaded first so that documents referring to them can
+        # be read by other replicas, but a failed upload does not hold
+        # documents back.
+        self._upload_blobs(self._db)
+        with self._sync_lock:
+            self._db.sync(
+                self._sync_url(), creds=self._creds, autocreate=True,
+                report=report, cert_file=self._cert_file,
+                connection_pool=self._connection_pool,
+                metadata_only=metadata_only,
+                metadata_fields=self._metadata_fields,
+                lazy_decrypt=self._lazy_decrypt, deltas=self._delta_sync,
+                upload_connections=self._upload_connections)
+            self._forget_sync_info()
+        self._signal_sync_report(report)
+        signal(SOLEDAD_DONE_DATA_SYNC, self._uuid)
+        if report.docs_pending:
+            self.start_content_prefetch()
+        return report
+
+    def _signal_sync_report(self, report):
+        """
+        Log a sync report and signal it.
+
+        @param report: The report.
+        @type report: leap.soledad.target.SyncReport
+        """
+        logger.debug('Sync report: %s' % report)
+        signal_if_known(
+            SOLEDAD_SYNC_REPORT,
+            json.dumps({'uuid': self._uuid, 'report': report.as_dict()}))
 
-        @return: the local generation before the synchronisation was
-            performed.
+    def get_sync_reports(self, limit=None):
+        """
+        Return the reports of the most recent syncs, stored in the local
+        database.
+
+        @param limit: The maximum number of reports to return, or None for
+            all stored reports.
+        @type limit: int
+
+        @return: The reports, as returned by C{SyncReport.as_dict}, most
+            recent first.
+        @rtype: list of dict
+        """
+        return self._db.get_sync_reports(limit=limit)
+
+    def set_sync_scope(self, scope):
+        """
+        Restrict the documents this device syncs, e.g. to recent mail.
+
+        Local changes out of the scope are not sent, and incoming documents
+        out of the scope are not stored, unless they are already stored
+        locally. If the scope changes, the next sync downloads all documents
+        in the new scope.
+
+        @param scope: The documents to sync, or None to sync all documents.
+        @type scope: leap.soledad.scope.SyncScope
+        """
+        self._db.set_sync_scope(scope)
+
+    def get_sync_scope(self):
+        """
+        Return the documents this device syncs.
+
+        @return: The sync scope, or None if all documents are synced.
+        @rtype: leap.soledad.scope.SyncScope
+        """
+        return self._db.get_sync_scope()
+
+    def _sync_url(self):
+        """
+        Return the URL of the user's remote replica.
+        """
+        return urlparse.urljoin(self.server_url, 'user-%s' % self._uuid)
+
+    #
+    # Local database statement statistics
+    #
+
+    def enable_statement_stats(self, slow_query_threshold=None):
+        """
+        Start recording the SQL statements run on the local database.
+
+        Statistics are kept per statement shape, and survive the database
+        being suspended. Enabling them again resets them.
+
+        @param slow_query_threshold: The time, in seconds, from which a
+            statement is logged as slow, or None to log no statement.
+        @type slow_query_threshold: float
+        """
+        self._statement_stats = StatementStats(
+            slow_query_threshold=slow_query_threshold)
+        if self._local_db is not None:
+            self._local_db.set_statement_stats(self._statement_stats)
+
+    def disable_statement_stats(self):
+        """
+        Stop recording the SQL statements run on the local database.
+        """
+        self._statement_stats = None
+        if self._local_db is not None:
+            self._local_db.set_statement_stats(None)
+
+    def get_statement_stats(self):
+        """
+        Return the statistics of the SQL statements run on the local
+        database.
+
+        @return: The statistics, as returned by C{StatementStats.stats}, or
+            None if they are not being recorded.
+        @rtype: dict
+        """
+        if self._statement_stats is None:
+            return None
+        return self._statement_stats.stats()
+
+    #
+    # Metadata only syncs and lazy decryption
+    #
+
+    CONTENT_PREFETCH_BATCH_SIZE = 50
+    """
+    How many documents the content prefetch asks the server for at a time.
+    """
+
+    def set_metadata_fields(self, fields):
+        """
+        Set the top level fields of documents that are synced in their
+        metadata, so other devices can use them before fetching the content
+        of the documents, e.g. in indexes.
+
+        They apply to documents sent by the next syncs.
+
+        @param fields: The fields, or None for no metadata.
+        @type fields: list of str
+        """
+        self._metadata_fields = list(fields) if fields else None
+
+    def set_lazy_decrypt(self, lazy_decrypt):
+        """
+        Choose whether synced documents are decrypted when received or when
+        first read.
+
+        When decrypted on read, only the metadata of incoming documents is
+        decrypted, and it is stored as their content, so indexes over
+        metadata fields, see C{set_metadata_fields}, work right away. The
+        rest of the content is decrypted and stored the first time a
+        document is read with C{get_doc} or C{get_docs}. Documents sent
+        without metadata are always decrypted when received.
+
+        @param lazy_decrypt: Whether to decrypt documents when first read.
+        @type lazy_decrypt: bool
+        """
+        self._lazy_decrypt = lazy_decrypt
+
+    def _fetch_content(self, doc_ids):
+        """
+        Fetch the current revision of documents from the server.
+
+        @param doc_ids: The ids of the documents.
+        @type doc_ids: list of str
+
+        @return: The documents, with decrypted content.
+        @rtype: list of SoledadDocument
+        """
+        target = SoledadSyncTarget(
+            self._sync_url(), creds=self._creds, crypto=self._crypto,
+            cert_file=self._cert_file, connection_pool=self._connection_pool)
+        try:
+            return target.get_docs_content(doc_ids)
+        finally:
+            target.close()
+
+    def get_pending_content_count(self):
+        """
+        Return the number of documents whose content was not fetched yet.
+
+        @rtype: int
+        """
+        return self._db.get_pending_content_count()
+
+    def prioritize_content(self, doc_ids):
+        """
+        Prefetch the content of documents before that of other documents,
+        e.g. because they are about to be shown.
+
+        @param doc_ids: The ids of the documents, in decreasing priority.
+        @type doc_ids: list of str
+        """
+        self._db.prioritize_pending_content(doc_ids)
+
+    def start_content_prefetch(self):
+        """
+        Fetch the content of documents synced without it in the background,
+        in priority order, unless it is already being fetched.
+
+        By default, the most recently changed documents are fetched first.
+        See C{prioritize_content}.
+        """
+        if self._content_prefetch is not None \
+                and self._content_prefetch.is_alive():
+            return
+        self._content_prefetch = threading.Thread(
+            target=self._prefetch_content, name='soledad-content-prefetch')
+        self._content_prefetch.daemon = True
+        self._content_prefetch.start()
+
+    def _prefetch_content(self):
+        """
+        Fetch pending content from the content prefetch thread.
+
+        As in C{_scheduled_sync}, a new connection to the local database is
+        opened, as SQLCipher connections can only be used by the thread that
+        created them.
+        """
+        db = sqlcipher_open(
+            self._local_db_path,
+            binascii.b2a_hex(self._get_local_storage_key()),
+            create=False,
+            document_factory=SoledadDocument,
+            crypto=self._crypto,
+            raw_key=True)
+        db.set_content_fetcher(self._fetch_content)
+        local_db = self._local_db
+        if local_db is not None:
+            # each document is invalidated in the cache of the local database
+            # as soon as its content is stored.
+            db.set_foreign_cache(local_db.document_cache)
+        fetched = 0
+        try:
+            while not self._stop_background_tasks.is_set():
+                stored = db.fetch_pending_content(
+                    limit=self.CONTENT_PREFETCH_BATCH_SIZE)
+                if not stored:
+                    break
+                fetched += stored
+        except Exception, e:
+            logger.warning('Failed to prefetch content: %r' % e)
+        finally:
+            db.invalidate_written_docs()
+            db.close()
+        logger.debug('Prefetched the content of %d documents.' % fetched)
+
+    #
+    # Delta syncs
+    #
+
+    def set_delta_sync(self, delta_sync):
+        """
+        Choose whether changes to big documents are sent as deltas.
+
+        A delta holds only the fields that changed since the revision of the
+        document the server is known to hold, so small changes to big
+        documents, e.g. to the flags of a mail, upload little data. The last
+        synced content of such documents is kept in the local database to
+        compute deltas. Servers that do not support deltas receive the full
+        content.
+
+        @param delta_sync: Whether to send changes as deltas.
+        @type delta_sync: bool
+        """
+        self._delta_sync = delta_sync
+
+    #
+    # Parallel uploads
+    #
+
+    def set_upload_connections(self, upload_connections):
+        """
+        Choose how many connections local changes are uploaded through.
+
+        When there is a big backlog of local changes, e.g. after a mail
+        import, they are split in batches that are uploaded concurrently
+        through separate connections, if the server supports it. Servers
+        that do not, or that decline, receive all changes through a single
+        connection.
+
+        @param upload_connections: The number of connections, at least 1.
+        @type upload_connections: int
+        """
+        soledad_assert(upload_connections >= 1,
+                       'At least one connection is needed.')
+        self._upload_connections = upload_connections
+
+    #
+    # Write coalescing
+    #
+
+    WRITE_FLUSH_MIN_INTERVAL = 0.1
+    """
+    The minimum seconds between two checks for expired buffered updates.
+    """
+
+    def set_write_coalescing(self, window):
+        """
+        Choose whether updates to documents are buffered and coalesced.
+
+        Some documents, e.g. read markers, are updated many times per
+        second. Each update written is a new revision and generation, an
+        index update, a disk sync and a change that sync has to consider.
+        When coalescing, updates made with C{put_doc} are buffered per
+        document and written as a single revision once C{window} seconds
+        passed since the first buffered update. C{get_doc} returns the
+        buffered state of documents.
+
+        Expired updates are written by a flush thread, and by the next call
+        to C{put_doc} or C{get_doc}. All buffered updates are written by
+        C{flush_writes}, before syncing, suspending or closing, and before
+        reads that the buffer can not answer, like index queries. An update
+        to a document that was changed by a sync since it was buffered is
+        written as a conflict, so it is not lost.
+
+        @param window: How long updates are buffered, in seconds, or None to
+            write every update immediately.
+        @type window: float
+        """
+        with self._write_lock:
+            self.flush_writes()
+            self._write_coalescer = None
+            if window is not None:
+                self._write_coalescer = WriteCoalescer(
+                    window, SoledadDocument)
+        if window is not None:
+            self._write_flusher = threading.Thread(
+                target=self._flush_writes_periodically,
+                args=(self._write_coalescer,),
+                name='soledad-write-flush')
+            self._write_flusher.daemon = True
+            self._write_flusher.start()
+
+    def flush_writes(self):
+        """
+        Write all buffered updates to documents to the local database.
+
+        @return: The number of documents written.
+        @rtype: int
+        """
+        coalescer = getattr(self, '_write_coalescer', None)
+        if coalescer is None or not len(coalescer):
+            return 0
+        with self._write_lock:
+            return self._write_buffered(self._db, coalescer.pop_all())
+
+    def _flush_expired_writes(self):
+        """
+        Write the buffered updates whose window passed.
+        """
+        coalescer = self._write_coalescer
+        if coalescer is not None and len(coalescer):
+            with self._write_lock:
+                self._write_buffered(self._db, coalescer.pop_expired())
+
+    def _flush_writes_periodically(self, coalescer):
+        """
+        Write expired updates from the flush thread until background tasks
+        are stopped or write coalescing is changed.
+
+        As in C{_scheduled_sync}, a new connection to the local database is
+        opened for each flush, as SQLCipher connections can only be used by
+        the thread that created them.
+
+        @param coalescer: The buffer of updates to flush.
+        @type coalescer: leap.soledad.coalesce.WriteCoalescer
+        """
+        # updates are written at most half a window late.
+        interval = max(coalescer.window / 2.0, self.WRITE_FLUSH_MIN_INTERVAL)
+        while not self._stop_background_tasks.wait(interval) \
+                and self._write_coalescer is coalescer:
+            if not len(coalescer):
+                continue
+            with self._write_lock:
+                buffered = coalescer.pop_expired()
+                if not buffered:
+                    continue
+                try:
+                    db = sqlcipher_open(
+                        self._local_db_path,
+                        binascii.b2a_hex(self._get_local_storage_key()),
+                        create=False,
+                        document_factory=SoledadDocument,
+                        crypto=self._crypto,
+                        raw_key=True)
+                    db.set_content_fetcher(self._fetch_content)
+                    db.set_change_listener(self._notify_local_change)
+                    local_db = self._local_db
+                    if local_db is not None:
+                        # written documents are invalidated in the cache of
+                        # the local database.
+                        db.set_foreign_cache(local_db.document_cache)
+                    try:
+                        self._write_buffered(db, buffered)
+                    finally:
+                        db.invalidate_written_docs()
+                        db.close()
+                except ContentPending, e:
+                    logger.warning('Failed to flush writes: %r' % e)
+                except Exception, e:
+                    logger.warning('Failed to flush writes: %r' % e)
+                    self._rebuffer(buffered)
+
+    def _flush_doc_writes(self, doc_id):
+        """
+        Write the buffered update to a document, if any.
+
+        @param doc_id: The unique document identifier.
+        @type doc_id: str
+        """
+        coalescer = self._write_coalescer
+        if coalescer is not None:
+            with self._write_lock:
+                buffered = coalescer.pop(doc_id)
+                if buffered is not None:
+                    self._write_buffered(self._db, [buffered])
+
+    def _buffer_doc(self, doc):
+        """
+        Buffer an update to a document, after checking it as the local
+        database would.
+
+        @param doc: The document to update.
+        @type doc: SoledadDocument
+
+        @return: The revision the document will have once written.
         @rtype: str
         """
-        local_gen = self._db.sync(
-            urlparse.urljoin(self.server_url, 'user-%s' % self._uuid),
-            creds=self._creds, autocreate=True)
+        self._flush_expired_writes()
+        db = self._db
+        if doc.doc_id is None:
+            raise errors.InvalidDocId()
+        db._check_doc_id(doc.doc_id)
+        doc.validate_json()
+        db._check_doc_size(doc)
+        buffered = self._write_coalescer.get(doc.doc_id)
+        if buffered is not None:
+            base_rev, current = buffered
+        else:
+            if db._pending_doc_ids([doc.doc_id]):
+                raise ContentPending(doc.doc_id)
+            current = db.get_doc(doc.doc_id, include_deleted=True)
+            base_rev = current.rev if current is not None else None
+            if current is not None and current.has_conflicts:
+                raise errors.ConflictedDoc()
+        if current is None:
+            if doc.rev is not None:
+                raise errors.RevisionConflict()
+        elif doc.rev != current.rev \
+                and not (doc.rev is None and current.is_tombstone()):
+            raise errors.RevisionConflict()
+        # the revision the local database will give the document when the
+        # update is written over the base revision.
+        vcr = VectorClockRev(base_rev)
+        vcr.increment(db._replica_uid)
+        doc.rev = vcr.as_str()
+        self._write_coalescer.put(doc, base_rev)
+        return doc.rev
+
+    def _write_buffered(self, db, buffered):
+        """
+        Write buffered updates to documents.
+
+        An update to a document that was changed since it was buffered is
+        written as a conflict with the current revision. If the content of
+        the current revision can not be fetched, the update stays buffered.
+
+        @param db: The local database to write to.
+        @type db: SQLCipherDatabase
+        @param buffered: A list of (base_rev, doc) of buffered documents.
+        @type buffered: list
+
+        @return: The number of documents written.
+        @rtype: int
+
+        @raise ContentPending: If some update was not written because the
+            content of the current revision of its document was not fetched.
+        """
+        written = 0
+        pending = []
+        for base_rev, doc in buffered:
+            rev, doc.rev = doc.rev, base_rev
+            try:
+                db.put_doc(doc)
+            except ContentPending:
+                doc.rev = rev
+                if not self._fetch_current_content(db, doc.doc_id):
+                    pending.append((base_rev, doc))
+                    continue
+                self._write_conflict(db, doc)
+            except (errors.RevisionConflict, errors.ConflictedDoc):
+                doc.rev = rev
+                self._write_conflict(db, doc)
+            except Exception:
+                doc.rev = rev
+                raise
+            written += 1
+        if pending:
+            self._rebuffer(pending)
+            raise ContentPending(', '.join(doc.doc_id for _, doc in pending))
+        return written
+
+    def _fetch_current_content(self, db, doc_id):
+        """
+        Fetch the content of the current revision of a document synced
+        without it.
+
+        @param db: The local database.
+        @type db: SQLCipherDatabase
+        @param doc_id: The unique document identifier.
+        @type doc_id: str
+
+        @return: Whether the content was fetched.
+        @rtype: bool
+        """
+        try:
+            db.fetch_pending_content([doc_id])
+        except Exception, e:
+            logger.warning(
+                'Failed to fetch the content of %s: %r' % (doc_id, e))
+        return not db._pending_doc_ids([doc_id])
+
+    def _write_conflict(self, db, doc):
+        """
+        Write a buffered update as a conflict with the current revision of
+        its document, as if it was received by a sync.
+
+        @param db: The local database to write to.
+        @type db: SQLCipherDatabase
+        @param doc: The document, with the revision it was buffered with.
+        @type doc: SoledadDocument
+        """
+        state, _ = db._put_doc_if_newer(
+            doc, save_conflict=True, replica_gen=0, replica_trans_id='')
+        logger.warning(
+            'Buffered update to %s written as %s.' % (doc.doc_id, state))
+
+    def _rebuffer(self, buffered):
+        """
+        Put back updates that could not be written in the buffer.
+
+        @param buffered: A list of (base_rev, doc) of buffered documents.
+        @type buffered: list
+        """
+        coalescer = self._write_coalescer
+        if coalescer is None:
+            return
+        for base_rev, doc in buffered:
+            if coalescer.get(doc.doc_id) is None:
+                coalescer.put(doc, base_rev)
+
+    #
+    # Compaction
+    #
+
+    COMPACTION_INTERVAL = 24 * 60 * 60
+    """
+    Seconds between two compactions of the local database in the background.
+    """
+
+    def compact(self):
+        """
+        Purge history of the local database that the server does not need
+        anymore, and give the space it used back to the file system.
+
+        See C{SQLCipherDatabase.compact}.
+
+        @return: The report of the compaction.
+        @rtype: dict
+        """
+        with self._sync_lock:
+            return self._db.compact()
+
+    def start_compaction(self, interval=None):
+        """
+        Compact the local database in the background every C{interval}
+        seconds, unless it is already being done.
+
+        @param interval: Seconds between two compactions.
+        @type interval: float
+        """
+        if self._compaction is not None and self._compaction.is_alive():
+            return
+        self._compaction = threading.Thread(
+            target=self._compact_periodically,
+            args=(interval or self.COMPACTION_INTERVAL,),
+            name='soledad-compaction')
+        self._compaction.daemon = True
+        self._compaction.start()
+
+    def _compact_periodically(self, interval):
+        """
+        Compact the local database from the compaction thread until
+        background tasks are stopped.
+
+        As in C{_scheduled_sync}, a new connection to the local database is
+        opened for each compaction, as SQLCipher connections can only be used
+        by the thread that created them.
+
+        @param interval: Seconds between two compactions.
+        @type interval: float
+        """
+        while not self._stop_background_tasks.wait(interval):
+            try:
+                db = sqlcipher_open(
+                    self._local_db_path,
+                    binascii.b2a_hex(self._get_local_storage_key()),
+                    create=False,
+                    document_factory=SoledadDocument,
+                    crypto=self._crypto,
+                    raw_key=True)
+                local_db = self._local_db
+                if local_db is not None:
+                    # purged documents are not served from the cache of the
+                    # local database.
+                    db.set_foreign_cache(local_db.document_cache)
+                try:
+                    # syncs read the history being purged.
+                    with self._sync_lock:
+                        db.compact()
+                finally:
+                    db.invalidate_written_docs()
+                    db.close()
+            except Exception, e:
+                logger.warning('Failed to compact the database: %r' % e)
+
+    #
+    # Full-text search
+    #
+
+    def create_search_index(self, index_name, *fields):
+        """
+        Create a full-text search index over the text of some fields of the
+        documents.
+
+        See C{SQLCipherDatabase.create_search_index}.
+
+        @param index_name: A unique name for the index.
+        @type index_name: str
+        @param fields: The fields whose text is indexed, e.g. 'subject' or
+            'headers.from'.
+        @type fields: tuple of str
+        """
+        self.flush_writes()
+        return self._db.create_search_index(index_name, *fields)
+
+    def delete_search_index(self, index_name):
+        """
+        Remove a full-text search index.
+
+        @param index_name: The name of the index.
+        @type index_name: str
+        """
+        return self._db.delete_search_index(index_name)
+
+    def list_search_indexes(self):
+        """
+        List the full-text search indexes.
+
+        @return: A list of (index_name, [field, ...]).
+        @rtype: list
+        """
+        return self._db.list_search_indexes()
+
+    def search(self, index_name, query, limit=10):
+        """
+        Return the ids of the documents that match a full-text query, the
+        most relevant first.
+
+        See C{SQLCipherDatabase.search}.
+
+        @param index_name: The name of the index.
+        @type index_name: str
+        @param query: The query, in the syntax of SQLite's FTS4 MATCH
+            operator.
+        @type query: str
+        @param limit: The maximum number of ids to return, or None for all.
+        @type limit: int
+
+        @return: The ids of the matching documents.
+        @rtype: list of str
+        """
+        self.flush_writes()
+        return self._db.search(index_name, query, limit=limit)
+
+    #
+    # Blobs
+    #
+
+    def create_blob(self):
+        """
+        Return a file-like object that stores what is written to it as a new
+        blob, for large binary payloads such as mail attachments.
+
+        Closing it returns the reference to the blob, which documents should
+        hold instead of its content. See C{leap.soledad.blobs}.
+
+        @rtype: leap.soledad.blobs.BlobWriter
+        """
+        return self._db.create_blob()
+
+    def put_blob(self, data):
+        """
+        Store a blob.
+
+        @param data: The content of the blob, or a file-like object to read
+            it from.
+        @type data: str or file
+
+        @return: The reference to the blob, see
+            C{leap.soledad.blobs.blob_reference}.
+        @rtype: dict
+        """
+        with self.create_blob() as writer:
+            if isinstance(data, basestring):
+                writer.write(data)
+            else:
+                for chunk in iter(lambda: data.read(CHUNK_SIZE), ''):
+                    writer.write(chunk)
+        return writer.reference
+
+    def open_blob(self, reference):
+        """
+        Return a file-like object that reads a blob.
+
+        If the blob is not stored locally, or only some of its chunks, the
+        missing chunks are downloaded first.
+
+        @param reference: The reference to the blob, or its id.
+        @type reference: dict or str
+
+        @rtype: leap.soledad.blobs.BlobReader
+
+        @raise BlobNotFound: If only the id of a blob that is not stored
+            locally is given, or if the server does not store all of its
+            chunks either, e.g. because the replica that created it did not
+            upload it yet.
+        """
+        if not isinstance(reference, dict):
+            return self._db.open_blob(reference)
+        try:
+            return self._db.open_blob(reference[BLOB_ID_KEY])
+        except BlobNotFound:
+            self.fetch_blob(reference)
+            return self._db.open_blob(reference[BLOB_ID_KEY])
+
+    def fetch_blob(self, reference):
+        """
+        Download the chunks of a blob that are not stored locally.
+
+        An interrupted download resumes from the chunks already received.
+
+        @param reference: The reference to the blob.
+        @type reference: dict
+
+        @return: The number of chunks downloaded.
+        @rtype: int
+
+        @raise BlobNotFound: If the server does not store all the chunks
+            missing locally.
+        """
+        target = SoledadBlobTarget(
+            self._sync_url(), creds=self._creds, crypto=self._crypto,
+            cert_file=self._cert_file, connection_pool=self._connection_pool)
+        try:
+            return target.download_blob(self._db, reference)
+        finally:
+            target.close()
+
+    def delete_blob(self, blob_id):
+        """
+        Remove a blob from the local database.
+
+        @param blob_id: The id of the blob.
+        @type blob_id: str
+        """
+        self._db.delete_blob(blob_id)
+
+    def sync_blobs(self):
+        """
+        Upload the local blobs the server does not store yet.
+
+        This is also done before documents are synced, but documents are
+        synced even if it fails, so other replicas may receive references to
+        blobs they can not download yet. An interrupted upload resumes from
+        the chunks the server already received.
+
+        @return: The number of chunks uploaded.
+        @rtype: int
+        """
+        return self._upload_blobs(self._db, fail=True)
+
+    def _upload_blobs(self, db, fail=False):
+        """
+        Upload the blobs of a connection to the local database the server
+        does not store yet.
+
+        @param db: The connection to the local database.
+        @type db: SQLCipherDatabase
+        @param fail: Whether to raise errors, instead of logging them so
+            that documents are synced anyway.
+        @type fail: bool
+
+        @return: The number of chunks uploaded.
+        @rtype: int
+        """
+        blob_ids = db._get_unsynced_blobs()
+        if not blob_ids:
+            return 0
+        target = SoledadBlobTarget(
+            self._sync_url(), creds=self._creds, crypto=self._crypto,
+            cert_file=self._cert_file, connection_pool=self._connection_pool)
+        sent = 0
+        try:
+            for blob_id in blob_ids:
+                sent += target.upload_blob(db, blob_id)
+        except Exception, e:
+            if fail:
+                raise
+            logger.warning('Failed to upload blobs: %r' % e)
+        finally:
+            target.close()
+        return sent
+
+    #
+    # Sync scheduling
+    #
+
+    def start_sync_scheduler(self, debounce=None, max_debounce=None,
+                             min_poll_interval=None, max_poll_interval=None,
+                             scheduler=None):
+        """
+        Start syncing in the background.
+
+        Local changes made through this instance are synced once they stop
+        arriving for C{debounce} seconds. When idle, the server is polled
+        with an interval that doubles after each sync that transferred no
+        documents. See C{SyncScheduler} for details.
+
+        By default a scheduler thread is started for this instance. If a
+        shared scheduler is given, syncs are run by its workers instead.
+
+        @param debounce: Seconds without local changes to wait before syncing
+            them.
+        @type debounce: float
+        @param max_debounce: Maximum seconds to wait between a local change
+            and the sync that sends it.
+        @type max_debounce: float
+        @param min_poll_interval: Seconds between two polls of the server
+            after documents were transferred.
+        @type min_poll_interval: float
+        @param max_poll_interval: Maximum seconds between two polls of the
+            server.
+        @type max_poll_interval: float
+        @param scheduler: A scheduler shared with other instances.
+        @type scheduler: leap.soledad.scheduler.SharedSyncScheduler
+
+        @return: The running scheduler.
+        @rtype: SyncScheduler or leap.soledad.scheduler.ScheduledReplica
+        """
+        if self._sync_scheduler is None:
+            params = {
+                'debounce': debounce,
+                'max_debounce': max_debounce,
+                'min_poll_interval': min_poll_interval,
+                'max_poll_interval': max_poll_interval,
+            }
+            if scheduler is not None:
+                self._sync_scheduler = scheduler.add(
+                    self._uuid, self._scheduled_sync, **params)
+            else:
+                self._sync_scheduler = SyncScheduler(
+                    self._scheduled_sync, **params)
+                self._sync_scheduler.start()
+        return self._sync_scheduler
+
+    def stop_sync_scheduler(self):
+        """
+        Stop syncing in the background.
+        """
+        if self._sync_scheduler is not None:
+            self._sync_scheduler.stop()
+            self._sync_scheduler = None
+
+    def _notify_local_change(self):
+        """
+        Let the sync scheduler know that the local database has changed.
+
+        This is called by the local database whenever a document is written
+        outside a sync, so writes made through C{_db} or any other write
+        path are synced too.
+        """
+        if self._sync_scheduler is not None:
+            self._sync_scheduler.notify_local_change()
+
+    def _scheduled_sync(self):
+        """
+        Run one sync from the sync scheduler thread.
+
+        SQLCipher connections can only be used by the thread that created
+        them, so a new connection to the local database is opened for each
+        scheduled sync. The local key is already derived, so opening it is
+        cheap.
+
+        @return: The number of documents 'sent' and 'received'.
+        @rtype: dict
+        """
+        report = SyncReport()
+        db = sqlcipher_open(
+            self._local_db_path,
+            binascii.b2a_hex(self._get_local_storage_key()),
+            create=False,
+            document_factory=SoledadDocument,
+            crypto=self._crypto,
+            raw_key=True)
+        local_db = self._local_db
+        if local_db is not None:
+            # documents written through this connection are not served
+            # stale from the cache of the local database.
+            db.set_foreign_cache(local_db.document_cache)
+        try:
+            self._upload_blobs(db)
+            with self._sync_lock:
+                db.sync(
+                    self._sync_url(), creds=self._creds, autocreate=True,
+                    report=report, cert_file=self._cert_file,
+                    connection_pool=self._connection_pool,
+                    metadata_fields=self._metadata_fields,
+                    lazy_decrypt=self._lazy_decrypt,
+                    deltas=self._delta_sync,
+                    upload_connections=self._upload_connections)
+                self._forget_sync_info()
+        finally:
+            db.invalidate_written_docs()
+            db.close()
+        self._signal_sync_report(report)
         signal(SOLEDAD_DONE_DATA_SYNC, self._uuid)
-        return local_gen
+        return {'sent': report.docs_sent, 'received': report.docs_received}
+
+    def _get_sync_scheduler(self):
+        return self._sync_scheduler
+
+    sync_scheduler = property(
+        _get_sync_scheduler,
+        doc='The running sync scheduler, or None.')
 
     def need_sync(self, url):
         """
         Return if local db replica differs from remote url's replica.
 
+        The last sync information received from each target is cached. If
+        the local generation already differs from the one the target knows,
+        no request is made at all. Otherwise, the target is asked for its
+        sync information with a conditional request, which costs a bodyless
+        response when nothing changed on a server that supports it.
+
         @param url: The remote replica to compare with local replica.
         @type url: str
 
         @return: Whether remote replica and local replica differ.
         @rtype: bool
         """
-        target = SoledadSyncTarget(url, creds=self._creds, crypto=self._crypto)
-        info = target.get_sync_info(self._db._get_replica_uid())
-        # compare source generation with target's last known source generation
-        if self._db._get_generation() != info[4]:
+        self.flush_writes()
+        local_gen = self._db._get_generation()
+        cached = self._sync_info_cache.get(url)
+        if cached is None or local_gen == cached['info'][3]:
+            target = self._need_sync_targets.get(url)
+            if target is None:
+                # keep the target, so its connection is reused.
+                target = SoledadSyncTarget(
+                    url, creds=self._creds, crypto=self._crypto,
+                    cert_file=self._cert_file,
+                    connection_pool=self._connection_pool)
+                self._need_sync_targets[url] = target
+            info, etag = target.get_sync_info_if_changed(
+                self._db._get_replica_uid(),
+                etag=cached['etag'] if cached else None)
+            if info is None:
+                info = cached['info']
+            else:
+                cached = {'info': info, 'etag': etag}
+                self._sync_info_cache[url] = cached
+        info = cached['info']
+        # compare source generation with target's last known source
+        # generation, and target generation with our last known target
+        # generation.
+        known_target_gen, _ = self._db._get_replica_gen_and_trans_id(info[0])
+        if local_gen != info[3] or known_target_gen != info[1]:
             signal(SOLEDAD_NEW_DATA_TO_SYNC, self._uuid)
             return True
         return False
 
+    def _forget_sync_info(self):
+        """
+        Forget the cached sync information of all targets, because a sync
+        changed it.
+        """
+        self._sync_info_cache.clear()
+
     def _set_token(self, token):
         """
         Set the authentication token for remote database access.
@@ -959,12 +2455,17 @@ class Soledad(object):
         @param token: The authentication token.
         @type token: str
         """
-        self._creds = {
-            'token': {
-                'uuid': self._uuid,
-                'token': token,
+        with self._shared_db_lock:
+            # the shared db holds the old credentials, so open a new one
+            # later.
+            self._close_shared_db()
+            self._need_sync_targets.clear()
+            self._creds = {
+                'token': {
+                    'uuid': self._uuid,
+                    'token': token,
+                }
             }
-        }
 
     def _get_token(self):
         """
@@ -1067,31 +2568,40 @@ class Soledad(object):
         _get_storage_secret,
         doc='The secret used for symmetric encryption.')
 
+    def _get_bootstrap_timings(self):
+        return self._bootstrap_timings
+
+    bootstrap_timings = property(
+        _get_bootstrap_timings,
+        doc='A list of (step, seconds) for the last bootstrap sequence.')
+
 
 #-----------------------------------------------------------------------------
 # Monkey patching u1db to be able to provide a custom SSL cert
 #-----------------------------------------------------------------------------
 
-class VerifiedHTTPSConnection(httplib.HTTPSConnection):
-    """HTTPSConnection verifying server side certificates."""
-    # derived from httplib.py
+class VerifiedHTTPSConnection(CertVerifiedHTTPSConnection):
+    """
+    HTTPSConnection verifying server side certificates against
+    C{SOLEDAD_CERT}.
+    """
 
     def connect(self):
         "Connect to a host on a given (SSL) port."
-        sock = socket.create_connection((self.host, self.port),
-                                        self.timeout, self.source_address)
-        if self._tunnel_host:
-            self.sock = sock
-            self._tunnel()
-
-        self.sock = ssl.wrap_socket(sock,
-                                    ca_certs=SOLEDAD_CERT,
-                                    cert_reqs=ssl.CERT_REQUIRED)
-        match_hostname(self.sock.getpeercert(), self.host)
+        self.ca_certs = SOLEDAD_CERT
+        CertVerifiedHTTPSConnection.connect(self)
 
 
 old__VerifiedHTTPSConnection = http_client._VerifiedHTTPSConnection
 http_client._VerifiedHTTPSConnection = VerifiedHTTPSConnection
 
 
+#-----------------------------------------------------------------------------
+# Profiling can be enabled for the whole process from the environment
+#-----------------------------------------------------------------------------
+
+from leap.soledad import profiling
+profiling.enable_from_environment()
+
+
 __all__ = ['soledad_assert', 'Soledad']
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# __init__.py
+# Copyright (C) 2013 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Benchmarks for Soledad.
+
+The tests in C{leap.soledad.tests} only check for correctness. The modules
+in this package measure throughput and latency instead, and can be run as
+scripts, e.g.:
+
+    python -m leap.soledad.benchmarks.migration
+
+The storage, crypto, sync, bootstrap and stream benchmarks are run together
+by:
+
+    python -m leap.soledad.benchmarks.run --output results.json \
+        --baseline baseline.json
+
+Results are a flat dictionary from metric names to seconds, or bytes for
+memory and size metrics, so lower is always better, and are compared against
+a baseline with a regression threshold.
+"""
+
+import sys
+import time
+import platform
+import simplejson as json
+
+
+def timed(func, *args, **kwargs):
+    """
+    Call C{func} and return how long it took.
+
+    @param func: The callable to measure.
+    @type func: callable
+
+    @return: The elapsed time in seconds and the value returned by C{func}.
+    @rtype: (float, object)
+    """
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def best_of(repeat, func, *args, **kwargs):
+    """
+    Call C{func} C{repeat} times and return the shortest time it took.
+
+    @param repeat: How many times to call C{func}.
+    @type repeat: int
+    @param func: The callable to measure.
+    @type func: callable
+
+    @return: The shortest elapsed time in seconds.
+    @rtype: float
+    """
+    return min(timed(func, *args, **kwargs)[0] for _ in xrange(repeat))
+
+
+#
+# Results
+#
+
+REGRESSION_THRESHOLD = 0.2
+"""
+How much slower than the baseline a metric may get before it is considered
+a regression.
+"""
+
+NOISE_FLOOR = 0.001
+"""
+Metrics that take less than this many seconds, both in the results and in
+the baseline, are too noisy to be compared.
+"""
+
+
+def write_results(results, path):
+    """
+    Write benchmark results as JSON, along with the environment they were
+    measured in.
+
+    @param results: The time of each metric, in seconds.
+    @type results: dict
+    @param path: Where to write the results.
+    @type path: str
+    """
+    with open(path, 'w') as f:
+        json.dump({
+            'metadata': {
+                'time': time.time(),
+                'python': sys.version.split()[0],
+                'platform': platform.platform(),
+            },
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    """
+    Read benchmark results written by C{write_results}.
+
+    @param path: Where the results were written.
+    @type path: str
+
+    @return: The time of each metric, in seconds.
+    @rtype: dict
+    """
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def compare(results, baseline, threshold=None):
+    """
+    Find the metrics that regressed in relation to a baseline.
+
+    Metrics missing from either side are not compared.
+
+    @param results: The time of each metric, in seconds.
+    @type results: dict
+    @param baseline: The time of each metric in the baseline, in seconds.
+    @type baseline: dict
+    @param threshold: How much slower than the baseline a metric may get,
+        as a fraction of the baseline.
+    @type threshold: float
+
+    @return: The regressions, as (metric, baseline, result) tuples, sorted
+        by metric.
+    @rtype: list
+    """
+    if threshold is None:
+        threshold = REGRESSION_THRESHOLD
+    regressions = []
+    for name in sorted(set(results) & set(baseline)):
+        result, base = results[name], baseline[name]
+        if max(result, base) < NOISE_FLOOR:
+            continue
+        if result > base * (1 + threshold):
+            regressions.append((name, base, result))
+    return regressions
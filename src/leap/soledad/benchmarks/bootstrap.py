@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# bootstrap.py
+# Copyright (C) 2013 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Measure how long Soledad takes to be ready to use.
+
+The following metrics are measured, in seconds, with the best of C{REPEAT}
+runs:
+
+    bootstrap.new: bootstrap a new user, generating and storing secrets.
+    bootstrap.recover: bootstrap a new device, recovering the secrets from
+        the server.
+    bootstrap.existing: bootstrap with secrets and database found locally.
+    bootstrap.lazy: the same, with a lazy bootstrap.
+    bootstrap.<kind>.<step>: the time of each step of a bootstrap.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+
+
+from leap.soledad.benchmarks import timed
+from leap.soledad.benchmarks.server import (
+    running_server,
+    soledad_instance,
+)
+
+
+REPEAT = 3
+"""
+How many times each bootstrap is measured.
+"""
+
+
+def _bootstrap(url, directory, uuid, **kwargs):
+    """
+    Bootstrap and close a Soledad instance.
+
+    @return: The time of the bootstrap and of each of its steps.
+    @rtype: (float, list)
+    """
+    elapsed, sol = timed(soledad_instance, url, directory, uuid, **kwargs)
+    steps = sol.bootstrap_timings
+    sol.close()
+    return elapsed, steps
+
+
+def _keep_best(results, name, elapsed, steps):
+    """
+    Keep the metrics of a bootstrap if it is the fastest so far.
+    """
+    if name in results and results[name] <= elapsed:
+        return
+    results[name] = elapsed
+    for step, step_elapsed in steps:
+        results['%s.%s' % (name, step)] = step_elapsed
+
+
+def run(repeat=REPEAT):
+    """
+    Run the benchmark.
+
+    @param repeat: How many times each bootstrap is measured.
+    @type repeat: int
+
+    @return: The time of each metric, in seconds.
+    @rtype: dict
+    """
+    results = {}
+    with running_server() as (url, _):
+        for i in xrange(repeat):
+            uuid = 'bootstrap-%d' % i
+            tempdir = tempfile.mkdtemp(prefix='soledad-bench-')
+            try:
+                device = os.path.join(tempdir, 'device')
+                _keep_best(
+                    results, 'bootstrap.new',
+                    *_bootstrap(url, device, uuid))
+                _keep_best(
+                    results, 'bootstrap.existing',
+                    *_bootstrap(url, device, uuid))
+                _keep_best(
+                    results, 'bootstrap.lazy',
+                    *_bootstrap(url, device, uuid, lazy_bootstrap=True))
+                _keep_best(
+                    results, 'bootstrap.recover',
+                    *_bootstrap(url, os.path.join(tempdir, 'other'), uuid))
+            finally:
+                shutil.rmtree(tempdir)
+    return results
+
+
+def main(argv):
+    repeat = int(argv[1]) if len(argv) > 1 else REPEAT
+    results = run(repeat)
+    for name in sorted(results):
+        print '%-44s %10.6fs' % (name, results[name])
+
+
+if __name__ == '__main__':
+    main(sys.argv)
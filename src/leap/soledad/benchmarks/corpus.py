@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# corpus.py
+# Copyright (C) 2013 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+A synthetic corpus of mail-like documents.
+
+Mail clients are Soledad's main users, so benchmarks store documents shaped
+like the ones they store: a small set of headers and flags, a body whose size
+follows a long-tailed distribution, and an occasional attachment. The corpus
+is generated from a seed, so every run benchmarks the same documents.
+"""
+
+import math
+import random
+import string
+import base64
+
+
+FOLDERS = [
+    'INBOX', 'INBOX', 'INBOX', 'INBOX', 'Sent', 'Sent', 'Drafts', 'Trash',
+    'Archive', 'Lists/leap', 'Lists/dev', 'Work']
+"""
+The folders messages are filed in, repeated to weight them.
+"""
+
+FLAGS = ['\\Seen', '\\Answered', '\\Flagged', '\\Deleted', '\\Draft']
+
+MEDIAN_BODY_SIZE = 4 * 1024
+"""
+The median size of a message body, in bytes.
+"""
+
+MAX_BODY_SIZE = 1024 * 1024
+"""
+The maximum size of a message body, in bytes.
+"""
+
+ATTACHMENT_RATIO = 0.05
+"""
+The share of messages with an attachment.
+"""
+
+_WORDS = [
+    'soledad', 'leap', 'sync', 'encrypted', 'message', 'meeting', 'report',
+    'please', 'review', 'attached', 'tomorrow', 'thanks', 'the', 'a', 'of',
+    'to', 'and', 'in', 'for', 'is', 'on', 'that', 'with', 'this', 'we',
+    'database', 'server', 'client', 'release', 'bug', 'patch', 'key']
+
+_POOL_SIZE = 64 * 1024
+
+
+class MailCorpus(object):
+    """
+    Generate mail-like document contents.
+    """
+
+    def __init__(self, seed=0, median_body_size=None, max_body_size=None):
+        """
+        Initialize the generator.
+
+        @param seed: The seed of the random generator.
+        @type seed: int
+        @param median_body_size: The median size of a message body.
+        @type median_body_size: int
+        @param max_body_size: The maximum size of a message body.
+        @type max_body_size: int
+        """
+        self._random = random.Random(seed)
+        self._median_body_size = median_body_size or MEDIAN_BODY_SIZE
+        self._max_body_size = max_body_size or MAX_BODY_SIZE
+        self._text_pool = ' '.join(
+            self._random.choice(_WORDS) for _ in xrange(_POOL_SIZE / 4))
+        self._binary_pool = ''.join(
+            chr(self._random.randint(0, 255)) for _ in xrange(_POOL_SIZE))
+        self._addresses = [
+            '%s@%s' % (self._token(8), domain)
+            for domain in ('leap.se', 'example.org', 'riseup.net')
+            for _ in range(20)]
+
+    def _token(self, length):
+        return ''.join(
+            self._random.choice(string.ascii_lowercase)
+            for _ in range(length))
+
+    def text(self, size):
+        """
+        Return text made of words, of C{size} bytes.
+
+        @param size: The size of the text.
+        @type size: int
+
+        @rtype: str
+        """
+        # slice a pool of words generated once, as generating large bodies
+        # word by word would make the corpus slower to build than to store.
+        pool = self._text_pool
+        start = self._random.randint(0, len(pool) - 1)
+        text = pool[start:start + size]
+        while len(text) < size:
+            text += ' ' + pool[:size - len(text) - 1]
+        return text
+
+    def _body_size(self):
+        # log-normal sizes: most messages are small, a few are very large.
+        size = int(self._random.lognormvariate(
+            math.log(self._median_body_size), 1.0))
+        return max(64, min(size, self._max_body_size))
+
+    def message(self, index, body_size=None):
+        """
+        Return the content of a message.
+
+        @param index: The number of the message in the corpus.
+        @type index: int
+        @param body_size: The size of the body, or None to draw it from the
+            corpus distribution.
+        @type body_size: int
+
+        @rtype: dict
+        """
+        if body_size is None:
+            body_size = self._body_size()
+        content = {
+            'type': 'message',
+            'folder': self._random.choice(FOLDERS),
+            'uid': index,
+            'date': 1356998400 + index * 60,
+            'from': self._random.choice(self._addresses),
+            'to': self._random.sample(
+                self._addresses, self._random.randint(1, 3)),
+            'subject': self.text(self._random.randint(10, 80)),
+            'message-id': '<%s@leap.se>' % self._token(16),
+            'flags': self._random.sample(FLAGS, self._random.randint(0, 2)),
+            'size': body_size,
+            'body': self.text(body_size),
+        }
+        if self._random.random() < ATTACHMENT_RATIO:
+            size = self._random.randint(1024, 16 * 1024)
+            start = self._random.randint(0, _POOL_SIZE - size)
+            attachment = self._binary_pool[start:start + size]
+            content['attachments'] = [{
+                'filename': '%s.bin' % self._token(8),
+                'content-type': 'application/octet-stream',
+                'payload': base64.b64encode(attachment),
+            }]
+        return content
+
+    def messages(self, count):
+        """
+        Generate the contents of C{count} messages.
+
+        @param count: The number of messages.
+        @type count: int
+
+        @rtype: generator of dict
+        """
+        for index in xrange(count):
+            yield self.message(index)
+
+
+INDEXES = {
+    'by-folder': ['folder'],
+    'by-folder-date': ['folder', 'number(date, 10)'],
+    'by-flags': ['flags'],
+    'by-subject': ['lower(subject)'],
+}
+"""
+Indexes a mail client creates over the corpus.
+"""
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# crypto.py
+# Copyright (C) 2013 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Measure the encryption and decryption of documents for sync.
+
+For each document body size the following metrics are measured, in seconds
+per document:
+
+    crypto.encrypt_doc.<size>: encrypt a document.
+    crypto.decrypt_doc.<size>: authenticate and decrypt a document.
+"""
+
+import os
+import sys
+import simplejson as json
+
+
+from leap.soledad import Soledad
+from leap.soledad.crypto import SoledadCrypto
+from leap.soledad.document import SoledadDocument
+from leap.soledad.target import (
+    encrypt_doc,
+    decrypt_doc,
+)
+from leap.soledad.benchmarks import timed
+from leap.soledad.benchmarks.corpus import MailCorpus
+
+
+SIZES = (1024, 10 * 1024, 100 * 1024, 1024 * 1024)
+"""
+The sizes of the bodies of the measured documents, in bytes.
+"""
+
+BYTES_PER_SIZE = 16 * 1024 * 1024
+"""
+How many bytes of documents are encrypted for each size, so that small
+documents are measured over enough iterations.
+"""
+
+
+class _StorageSecret(object):
+    """
+    Hold a random storage secret, which is all the document crypto needs from
+    a Soledad instance.
+    """
+
+    REMOTE_STORAGE_SECRET_LENGTH = Soledad.REMOTE_STORAGE_SECRET_LENGTH
+
+    def __init__(self):
+        self.storage_secret = os.urandom(
+            Soledad.REMOTE_STORAGE_SECRET_LENGTH
+            + Soledad.LOCAL_STORAGE_SECRET_LENGTH)
+
+
+def _repeat(iterations, func, *args):
+    for _ in xrange(iterations):
+        func(*args)
+
+
+def run(sizes=SIZES, seed=0):
+    """
+    Run the benchmark.
+
+    @param sizes: The sizes of the bodies of the measured documents.
+    @type sizes: list of int
+    @param seed: The seed of the corpus.
+    @type seed: int
+
+    @return: The time of each metric, in seconds.
+    @rtype: dict
+    """
+    crypto = SoledadCrypto(_StorageSecret())
+    corpus = MailCorpus(seed)
+    results = {}
+    for size in sizes:
+        iterations = max(3, BYTES_PER_SIZE / size)
+        doc = SoledadDocument(
+            'doc-id', 'replica:1',
+            json.dumps(corpus.message(0, body_size=size)))
+        elapsed, _ = timed(_repeat, iterations, encrypt_doc, crypto, doc)
+        results['crypto.encrypt_doc.%d' % size] = elapsed / iterations
+        doc = SoledadDocument(
+            doc.doc_id, doc.rev, encrypt_doc(crypto, doc))
+        elapsed, _ = timed(_repeat, iterations, decrypt_doc, crypto, doc)
+        results['crypto.decrypt_doc.%d' % size] = elapsed / iterations
+    return results
+
+
+def main(argv):
+    sizes = [int(size) for size in argv[1:]] or SIZES
+    results = run(sizes)
+    for name in sorted(results):
+        print '%-36s %10.6fs' % (name, results[name])
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# memory.py
+# Copyright (C) 2013 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Measure the peak memory of syncs against the size of the largest document.
+
+A sync should not need memory in proportion to everything it transfers,
+only to the largest document it handles. The following metrics are
+measured, in bytes above the memory in use before the sync:
+
+    memory.sync.upload.<size>: the peak of sending all documents.
+    memory.sync.download.<size>: the peak of receiving all documents.
+    memory.sync.<upload|download>.<phase>.<size>: the peak of each phase.
+
+The allocation sites of the memory alive at each peak are in the sync
+reports stored in the local databases.
+
+The benchmark fails if a peak is larger than C{MAX_MULTIPLE} times the
+largest document. It needs the C{tracemalloc} module.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import simplejson as json
+
+
+from leap.soledad.benchmarks.corpus import MailCorpus
+from leap.soledad.benchmarks.server import (
+    running_server,
+    soledad_instance,
+)
+
+
+SIZE = 1000
+"""
+The number of synced documents.
+"""
+
+LARGEST_BODY_SIZE = 1024 * 1024
+"""
+The size of the body of the largest document.
+"""
+
+MAX_MULTIPLE = 10
+"""
+How many times the size of the largest document the peak of a sync may be.
+"""
+
+
+def run(size=SIZE, largest_body_size=LARGEST_BODY_SIZE,
+        max_multiple=MAX_MULTIPLE, seed=0):
+    """
+    Run the benchmark.
+
+    @param size: The number of synced documents.
+    @type size: int
+    @param largest_body_size: The size of the body of the largest document.
+    @type largest_body_size: int
+    @param max_multiple: How many times the size of the largest document
+        the peak of a sync may be.
+    @type max_multiple: float
+    @param seed: The seed of the corpus.
+    @type seed: int
+
+    @return: The peak memory of each metric, in bytes, and the failures, as
+        (metric, peak, limit) tuples.
+    @rtype: (dict, list)
+
+    @raise leap.soledad.profiling.ProfilerNotAvailable: If the tracemalloc
+        module is not available.
+    """
+    results = {}
+    failures = []
+    # keep the server out of the traced process.
+    with running_server(separate_process=True) as (url, _):
+        uuid = 'memory-%d' % size
+        tempdir = tempfile.mkdtemp(prefix='soledad-bench-')
+        source = target = None
+        try:
+            source = soledad_instance(
+                url, os.path.join(tempdir, 'source'), uuid)
+            corpus = MailCorpus(seed, max_body_size=largest_body_size)
+            largest = 0
+            for index in xrange(size):
+                body_size = largest_body_size if index == 0 else None
+                content = corpus.message(index, body_size=body_size)
+                largest = max(largest, len(json.dumps(content)))
+                source.create_doc(content)
+            limit = largest * max_multiple
+            reports = [('upload', source.sync(profile_memory=True))]
+            target = soledad_instance(
+                url, os.path.join(tempdir, 'target'), uuid)
+            reports.append(('download', target.sync(profile_memory=True)))
+            for name, report in reports:
+                metric = 'memory.sync.%s.%d' % (name, size)
+                results[metric] = report.memory.peak
+                for phase, peak in report.memory.phases.items():
+                    results['memory.sync.%s.%s.%d' % (name, phase, size)] = \
+                        peak
+                if report.memory.peak > limit:
+                    failures.append((metric, report.memory.peak, limit))
+        finally:
+            for sol in (source, target):
+                if sol is not None:
+                    sol.close()
+            shutil.rmtree(tempdir)
+    return results, failures
+
+
+def main(argv):
+    size = int(argv[1]) if len(argv) > 1 else SIZE
+    max_multiple = float(argv[2]) if len(argv) > 2 else MAX_MULTIPLE
+    results, failures = run(size, max_multiple=max_multiple)
+    for name in sorted(results):
+        print '%-36s %12d bytes' % (name, results[name])
+    for name, peak, limit in failures:
+        print 'FAILED %s: %d bytes > %d bytes' % (name, peak, limit)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
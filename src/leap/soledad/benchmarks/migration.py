@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# migration.py
+# Copyright (C) 2013 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Compare query and sync performance of a SQLCipher database before and after
+migrating it to a larger page size.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+
+
+from u1db.sync import Synchronizer
+
+
+from leap.soledad.sqlcipher import (
+    SQLCipherDatabase,
+    migrate,
+)
+from leap.soledad.benchmarks import timed
+
+
+PASSWORD = '123456'
+
+
+def _fill_database(db, num_docs):
+    """
+    Create C{num_docs} documents and an index over them.
+
+    @param db: The database to fill.
+    @type db: SQLCipherDatabase
+    @param num_docs: The number of documents to create.
+    @type num_docs: int
+    """
+    db.create_index('by-folder', 'folder')
+    for i in xrange(num_docs):
+        db.create_doc({
+            'folder': 'folder-%d' % (i % 10),
+            'subject': 'message %d' % i,
+            'body': 'x' * 512,
+        })
+
+
+def _measure(path, cipher_page_size):
+    """
+    Measure queries and a local sync on the database at C{path}.
+
+    @param path: The path for the SQLCipher file.
+    @type path: str
+    @param cipher_page_size: The page size to open the database with.
+    @type cipher_page_size: int
+
+    @return: The elapsed time of each operation, in seconds.
+    @rtype: dict
+    """
+    results = {}
+    results['open'], db = timed(
+        SQLCipherDatabase.open_database, path, PASSWORD, create=False,
+        cipher_page_size=cipher_page_size)
+    results['get_all_docs'], _ = timed(db.get_all_docs)
+    results['get_from_index'], _ = timed(
+        db.get_from_index, 'by-folder', 'folder-1')
+    results['get_range_from_index'], _ = timed(
+        db.get_range_from_index, 'by-folder', 'folder-2', 'folder-5')
+    # sync to a fresh in-memory replica so only local costs are measured
+    target = SQLCipherDatabase(':memory:', PASSWORD)
+    results['sync'], _ = timed(
+        Synchronizer(db, target.get_sync_target()).sync)
+    target.close()
+    db.close()
+    return results
+
+
+def run(num_docs=5000, old_page_size=1024, new_page_size=4096):
+    """
+    Run the benchmark.
+
+    @param num_docs: The number of documents in the database.
+    @type num_docs: int
+    @param old_page_size: The page size the database is created with.
+    @type old_page_size: int
+    @param new_page_size: The page size the database is migrated to.
+    @type new_page_size: int
+
+    @return: The results before and after the migration, and the time the
+        migration took.
+    @rtype: dict
+    """
+    tempdir = tempfile.mkdtemp(prefix='soledad-bench-')
+    try:
+        path = os.path.join(tempdir, 'bench.u1db')
+        db = SQLCipherDatabase(
+            path, PASSWORD, cipher_page_size=old_page_size)
+        _fill_database(db, num_docs)
+        db.close()
+        before = _measure(path, old_page_size)
+        migration, _ = timed(
+            migrate, path, PASSWORD, cipher_page_size=old_page_size,
+            new_cipher_page_size=new_page_size)
+        after = _measure(path, new_page_size)
+        return {'before': before, 'after': after, 'migration': migration}
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def main(argv):
+    num_docs = int(argv[1]) if len(argv) > 1 else 5000
+    results = run(num_docs)
+    print 'Migration of %d documents took %.3fs.' % (
+        num_docs, results['migration'])
+    print '%-22s %10s %10s' % ('operation', 'before', 'after')
+    for name in sorted(results['before']):
+        print '%-22s %9.3fs %9.3fs' % (
+            name, results['before'][name], results['after'][name])
+
+
+if __name__ == '__main__':
+    main(sys.argv)
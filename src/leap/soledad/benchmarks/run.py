@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# run.py
+# Copyright (C) 2013 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Run the benchmark suite, write its results and compare them to a baseline.
+
+The exit status is 1 if any metric regressed in relation to the baseline, or
+if the peak memory of a sync is over its limit.
+"""
+
+import sys
+import argparse
+
+
+from leap.soledad.benchmarks import (
+    storage,
+    crypto,
+    sync,
+    bootstrap,
+    memory,
+    stream,
+    write_results,
+    load_results,
+    compare,
+    REGRESSION_THRESHOLD,
+)
+
+
+SUITES = ['storage', 'crypto', 'sync', 'bootstrap', 'memory', 'stream']
+
+DEFAULT_SUITES = ['storage', 'crypto', 'sync', 'bootstrap', 'stream']
+"""
+The suites run by default. The memory suite needs the tracemalloc module.
+"""
+
+
+def _sizes(value):
+    return [int(size) for size in value.split(',')]
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Run the Soledad benchmark suite.')
+    parser.add_argument(
+        '--suites', default=','.join(DEFAULT_SUITES),
+        help='comma separated suites to run (default: %(default)s)')
+    parser.add_argument(
+        '--storage-sizes', type=_sizes, default=storage.SIZES,
+        help='comma separated numbers of documents of the storage suite')
+    parser.add_argument(
+        '--crypto-sizes', type=_sizes, default=crypto.SIZES,
+        help='comma separated document sizes of the crypto suite')
+    parser.add_argument(
+        '--sync-sizes', type=_sizes, default=sync.SIZES,
+        help='comma separated numbers of documents of the sync suite')
+    parser.add_argument(
+        '--stream-sizes', type=_sizes, default=stream.SIZES,
+        help='comma separated numbers of documents of the stream suite')
+    parser.add_argument(
+        '--max-memory-multiple', type=float, default=memory.MAX_MULTIPLE,
+        help='how many times the largest document the peak memory of a '
+             'sync may be (default: %(default)s)')
+    parser.add_argument(
+        '--output', help='where to write the results as JSON')
+    parser.add_argument(
+        '--baseline', help='results to compare against')
+    parser.add_argument(
+        '--threshold', type=float, default=REGRESSION_THRESHOLD,
+        help='how much slower than the baseline a metric may get, as a '
+             'fraction (default: %(default)s)')
+    return parser.parse_args(argv)
+
+
+def run(suites, storage_sizes, crypto_sizes, sync_sizes,
+        max_memory_multiple, stream_sizes=stream.SIZES):
+    """
+    Run benchmark suites.
+
+    @param suites: The names of the suites to run.
+    @type suites: list of str
+
+    The other parameters are passed on to the suites.
+
+    @return: The time of each metric, in seconds, or its memory, in bytes,
+        and the metrics over their limit, as (metric, value, limit) tuples.
+    @rtype: (dict, list)
+    """
+    results = {}
+    failures = []
+    if 'storage' in suites:
+        results.update(storage.run(storage_sizes))
+    if 'crypto' in suites:
+        results.update(crypto.run(crypto_sizes))
+    if 'sync' in suites:
+        results.update(sync.run(sync_sizes))
+    if 'bootstrap' in suites:
+        results.update(bootstrap.run())
+    if 'memory' in suites:
+        memory_results, failures = memory.run(max_multiple=max_memory_multiple)
+        results.update(memory_results)
+    if 'stream' in suites:
+        results.update(stream.run(stream_sizes))
+    return results, failures
+
+
+def main(argv):
+    args = _parse_args(argv[1:])
+    suites = args.suites.split(',')
+    unknown = set(suites) - set(SUITES)
+    if unknown:
+        sys.stderr.write('Unknown suites: %s\n' % ', '.join(sorted(unknown)))
+        return 2
+    results, failures = run(
+        suites, args.storage_sizes, args.crypto_sizes, args.sync_sizes,
+        args.max_memory_multiple, stream_sizes=args.stream_sizes)
+    for name in sorted(results):
+        print '%-44s %14.6f' % (name, results[name])
+    if args.output:
+        write_results(results, args.output)
+    for name, value, limit in failures:
+        print 'FAILED %s: %d > %d' % (name, value, limit)
+    if failures:
+        return 1
+    if args.baseline:
+        regressions = compare(
+            results, load_results(args.baseline), threshold=args.threshold)
+        for name, base, result in regressions:
+            print 'REGRESSION %s: %.6fs -> %.6fs' % (name, base, result)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# server.py
+# Copyright (C) 2013 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+An in-process stand-in for Soledad server.
+
+Benchmarks that talk to a server run against a u1db HTTP application that
+keeps its databases in memory, so they measure the client and the protocol
+rather than the disk of the server. Databases, including the shared recovery
+database, are created the first time they are used, and credentials are not
+checked.
+"""
+
+import os
+import threading
+import multiprocessing
+
+
+from contextlib import contextmanager
+from wsgiref import simple_server
+from u1db.backends import inmemory
+from u1db.remote import (
+    http_app,
+    server_state,
+)
+
+
+from leap.soledad import Soledad
+
+
+PASSPHRASE = '123456'
+
+
+class InMemoryServerState(server_state.ServerState):
+    """
+    Server state that keeps databases in memory.
+    """
+
+    def __init__(self):
+        server_state.ServerState.__init__(self)
+        self._lock = threading.Lock()
+        self._dbs = {}
+
+    def open_database(self, path):
+        with self._lock:
+            db = self._dbs.get(path)
+            if db is None:
+                db = self._dbs[path] = inmemory.InMemoryDatabase(path)
+            return db
+
+    def check_database(self, path):
+        self.open_database(path)
+
+    def ensure_database(self, path):
+        db = self.open_database(path)
+        return db, db._replica_uid
+
+    def delete_database(self, path):
+        with self._lock:
+            self._dbs.pop(path, None)
+
+
+class _RequestHandler(simple_server.WSGIRequestHandler):
+
+    def log_request(*args):
+        pass  # suppress
+
+
+def _make_server(state):
+    server = simple_server.WSGIServer(('127.0.0.1', 0), _RequestHandler)
+    server.set_app(http_app.HTTPApp(state))
+    return server
+
+
+def _serve(queue):
+    """
+    Serve requests in a child process, after telling the parent the
+    address of the server.
+    """
+    server = _make_server(InMemoryServerState())
+    queue.put(server.server_address)
+    server.serve_forever(poll_interval=0.01)
+
+
+@contextmanager
+def running_server(separate_process=False):
+    """
+    Run the stand-in server while the wrapped block runs.
+
+    @param separate_process: Whether to run the server in a child process
+        instead of a thread, so that it does not count in the memory and CPU
+        used by the benchmarked process.
+    @type separate_process: bool
+
+    @return: The URL of the server and its state, which is None if the
+        server runs in a child process.
+    @rtype: (str, InMemoryServerState)
+    """
+    if separate_process:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_serve, args=(queue,))
+        process.daemon = True
+        process.start()
+        try:
+            yield 'http://%s:%d/' % queue.get(), None
+        finally:
+            process.terminate()
+            process.join()
+        return
+    state = InMemoryServerState()
+    server = _make_server(state)
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={'poll_interval': 0.01})
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://%s:%d/' % server.server_address, state
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+
+def soledad_instance(server_url, directory, uuid, **kwargs):
+    """
+    Bootstrap a Soledad instance against the stand-in server.
+
+    @param server_url: The URL of the server.
+    @type server_url: str
+    @param directory: Where to keep the secrets and the local database.
+    @type directory: str
+    @param uuid: The uuid of the user.
+    @type uuid: str
+
+    The other parameters are passed on to C{Soledad}.
+
+    @rtype: leap.soledad.Soledad
+    """
+    return Soledad(
+        uuid, PASSPHRASE,
+        secrets_path=os.path.join(directory, 'secrets.json'),
+        local_db_path=os.path.join(directory, 'soledad.u1db'),
+        server_url=server_url, cert_file=None, auth_token='auth-token',
+        **kwargs)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# storage.py
+# Copyright (C) 2013 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Measure the local SQLCipher storage with databases of growing sizes.
+
+For each database size the following metrics are measured, in seconds per
+operation:
+
+    storage.create.<size>: create a document.
+    storage.put.<size>: update a document.
+    storage.get.<size>: get a document by id.
+    storage.get_docs.<size>: get C{SAMPLE} documents at once.
+    storage.index.<query>.<size>: run an index query of the mail corpus.
+    storage.open.<size>: open the database with a raw key.
+"""
+
+import os
+import sys
+import random
+import shutil
+import binascii
+import tempfile
+
+
+from leap.soledad.sqlcipher import SQLCipherDatabase
+from leap.soledad.benchmarks import timed
+from leap.soledad.benchmarks.corpus import (
+    MailCorpus,
+    INDEXES,
+)
+
+
+SIZES = (1000, 100000, 1000000)
+"""
+The numbers of documents in the measured databases.
+"""
+
+SAMPLE = 1000
+"""
+How many documents are updated and read in each database.
+"""
+
+QUERIES = [
+    ('folder', 'get_from_index', ('by-folder', 'Work')),
+    ('prefix', 'get_from_index', ('by-subject', 'sync*')),
+    ('range', 'get_range_from_index', (
+        'by-folder-date', ('INBOX', '1357000000'), ('INBOX', '1357100000'))),
+    ('keys', 'get_index_keys', ('by-folder',)),
+]
+"""
+The measured index queries, as (name, method, arguments) tuples.
+"""
+
+
+def _fill_database(db, corpus, num_docs):
+    """
+    Create the corpus indexes and C{num_docs} documents.
+
+    @return: The time spent creating documents, and their ids.
+    @rtype: (float, list)
+    """
+    for name, expressions in INDEXES.items():
+        db.create_index(name, *expressions)
+    elapsed = 0.0
+    doc_ids = []
+    for content in corpus.messages(num_docs):
+        created, doc = timed(db.create_doc, content)
+        elapsed += created
+        doc_ids.append(doc.doc_id)
+    return elapsed, doc_ids
+
+
+def _measure(db, doc_ids, rand):
+    """
+    Measure updates, reads and queries on a filled database.
+
+    @return: The time per operation of each metric, without the size.
+    @rtype: dict
+    """
+    results = {}
+    sample = rand.sample(doc_ids, min(SAMPLE, len(doc_ids)))
+    elapsed = 0.0
+    for doc_id in sample:
+        doc = db.get_doc(doc_id)
+        doc.content['flags'] = ['\\Seen']
+        elapsed += timed(db.put_doc, doc)[0]
+    results['put'] = elapsed / len(sample)
+    rand.shuffle(sample)
+    elapsed, _ = timed(lambda: [db.get_doc(doc_id) for doc_id in sample])
+    results['get'] = elapsed / len(sample)
+    elapsed, _ = timed(lambda: list(db.get_docs(sample)))
+    results['get_docs'] = elapsed
+    for name, method, args in QUERIES:
+        results['index.%s' % name], _ = timed(getattr(db, method), *args)
+    return results
+
+
+def run(sizes=SIZES, seed=0):
+    """
+    Run the benchmark.
+
+    @param sizes: The numbers of documents in the measured databases.
+    @type sizes: list of int
+    @param seed: The seed of the corpus and of the sampled documents.
+    @type seed: int
+
+    @return: The time of each metric, in seconds.
+    @rtype: dict
+    """
+    key = binascii.b2a_hex(os.urandom(32))
+    results = {}
+    for size in sizes:
+        tempdir = tempfile.mkdtemp(prefix='soledad-bench-')
+        try:
+            path = os.path.join(tempdir, 'storage.u1db')
+            db = SQLCipherDatabase(path, key, raw_key=True)
+            elapsed, doc_ids = _fill_database(db, MailCorpus(seed), size)
+            measured = {'create': elapsed / size}
+            measured.update(_measure(db, doc_ids, random.Random(seed)))
+            db.close()
+            measured['open'], db = timed(
+                SQLCipherDatabase.open_database, path, key, create=False,
+                raw_key=True)
+            db.close()
+        finally:
+            shutil.rmtree(tempdir)
+        for name, elapsed in measured.items():
+            results['storage.%s.%d' % (name, size)] = elapsed
+    return results
+
+
+def main(argv):
+    sizes = [int(size) for size in argv[1:]] or SIZES
+    results = run(sizes)
+    for name in sorted(results):
+        print '%-36s %10.6fs' % (name, results[name])
+
+
+if __name__ == '__main__':
+    main(sys.argv)
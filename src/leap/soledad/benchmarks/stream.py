@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# stream.py
+# Copyright (C) 2013 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Measure the round trip of encrypted documents through JSON and framed sync
+streams.
+
+For each number of documents the following metrics are measured for both
+stream formats, 'json' and 'frames':
+
+    stream.<format>.serialize.<size>: encode the encrypted documents as a
+        stream, in seconds.
+    stream.<format>.parse.<size>: parse the stream back into documents,
+        without decrypting them, in seconds.
+    stream.<format>.bytes.<size>: the size of the stream, in bytes.
+    memory.stream.<format>.<size>: the peak memory of parsing and
+        decrypting the stream, in bytes. It is only measured if the
+        tracemalloc module is available.
+"""
+
+import sys
+import simplejson as json
+
+
+from leap.soledad.crypto import SoledadCrypto
+from leap.soledad.document import SoledadDocument
+from leap.soledad.profiling import (
+    SyncMemoryProfile,
+    ProfilerNotAvailable,
+)
+from leap.soledad.target import (
+    SoledadSyncTarget,
+    SyncReport,
+    encode_frame,
+)
+from leap.soledad.benchmarks.corpus import MailCorpus
+from leap.soledad.benchmarks.crypto import _StorageSecret
+
+
+SIZES = (100, 1000)
+"""
+The numbers of documents in the streams.
+"""
+
+FORMATS = ('json', 'frames')
+
+
+def _target(crypto, report):
+    # the target is never connected.
+    return SoledadSyncTarget(
+        'http://127.0.0.1:0/bench', crypto=crypto, report=report)
+
+
+def _encode(crypto, docs, framed):
+    """
+    Encode documents as a sync stream.
+
+    @return: The chunks of the stream and the report of the encoding.
+    @rtype: (list of str, leap.soledad.target.SyncReport)
+    """
+    report = SyncReport()
+    chunks, _, _, _, _ = _target(crypto, report)._encode_changes(
+        {'last_known_generation': 0, 'last_known_trans_id': ''},
+        docs, False, framed)
+    return chunks, report
+
+
+def _response(chunks, framed, size):
+    """
+    Turn an outgoing stream into the stream a server answers with, which
+    has the same documents.
+    """
+    info = {'new_generation': size, 'new_transaction_id': 'T-%d' % size}
+    chunks = list(chunks)
+    if framed:
+        chunks[1] = encode_frame(info)
+    else:
+        chunks[1] = '\r\n' + json.dumps(info)
+    return ''.join(chunks)
+
+
+def _parse(crypto, data, framed, memory=None):
+    """
+    Parse and decrypt a sync stream.
+
+    @return: The report of the parsing.
+    @rtype: leap.soledad.target.SyncReport
+    """
+    report = SyncReport(memory=memory)
+    target = _target(crypto, report)
+    parse = target._parse_sync_frames if framed \
+        else target._parse_sync_stream
+    if memory is not None:
+        memory.start()
+    try:
+        parse(data, lambda doc, gen, trans_id: None)
+    finally:
+        if memory is not None:
+            memory.stop()
+    return report
+
+
+def run(sizes=SIZES, seed=0):
+    """
+    Run the benchmark.
+
+    @param sizes: The numbers of documents in the streams.
+    @type sizes: list of int
+    @param seed: The seed of the corpus.
+    @type seed: int
+
+    @return: The time of each metric, in seconds, or its size, in bytes.
+    @rtype: dict
+    """
+    crypto = SoledadCrypto(_StorageSecret())
+    results = {}
+    for size in sizes:
+        docs = [
+            (SoledadDocument('doc-%d' % index, 'replica:1',
+                             json.dumps(content)),
+             index + 1, 'T-%d' % index)
+            for index, content in enumerate(MailCorpus(seed).messages(size))]
+        for name in FORMATS:
+            framed = name == 'frames'
+            chunks, report = _encode(crypto, docs, framed)
+            results['stream.%s.serialize.%d' % (name, size)] = \
+                report.timings['serialize']
+            data = _response(chunks, framed, size)
+            chunks = None
+            results['stream.%s.bytes.%d' % (name, size)] = len(data)
+            report = _parse(crypto, data, framed)
+            results['stream.%s.parse.%d' % (name, size)] = \
+                report.timings['parse']
+            try:
+                memory = SyncMemoryProfile()
+            except ProfilerNotAvailable:
+                continue
+            _parse(crypto, data, framed, memory=memory)
+            results['memory.stream.%s.%d' % (name, size)] = memory.peak
+    return results
+
+
+def main(argv):
+    sizes = [int(size) for size in argv[1:]] or SIZES
+    results = run(sizes)
+    for name in sorted(results):
+        print '%-36s %14.6f' % (name, results[name])
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# sync.py
+# Copyright (C) 2013 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Measure full syncs of Soledad against an in-process server.
+
+For each number of documents the following metrics are measured, in seconds
+per sync:
+
+    sync.upload.<size>: send all documents of a replica to the server.
+    sync.noop.<size>: sync a replica that is up to date.
+    sync.download.<size>: receive all documents in a new replica.
+
+The time spent in each phase of the upload and download syncs is also
+measured, as sync.upload.<phase>.<size> and sync.download.<phase>.<size>.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+
+
+from leap.soledad.benchmarks import timed
+from leap.soledad.benchmarks.corpus import MailCorpus
+from leap.soledad.benchmarks.server import (
+    running_server,
+    soledad_instance,
+)
+
+
+SIZES = (100, 1000, 10000)
+"""
+The numbers of synced documents.
+"""
+
+
+def _report_results(name, size, report):
+    """
+    Return the time of a sync and of each of its phases as metrics.
+    """
+    results = {'sync.%s.%d' % (name, size): report.elapsed}
+    for phase, elapsed in report.timings.items():
+        results['sync.%s.%s.%d' % (name, phase, size)] = elapsed
+    return results
+
+
+def run(sizes=SIZES, seed=0):
+    """
+    Run the benchmark.
+
+    @param sizes: The numbers of synced documents.
+    @type sizes: list of int
+    @param seed: The seed of the corpus.
+    @type seed: int
+
+    @return: The time of each metric, in seconds.
+    @rtype: dict
+    """
+    results = {}
+    with running_server() as (url, _):
+        for size in sizes:
+            uuid = 'sync-%d' % size
+            tempdir = tempfile.mkdtemp(prefix='soledad-bench-')
+            source = target = None
+            try:
+                source = soledad_instance(
+                    url, os.path.join(tempdir, 'source'), uuid)
+                for content in MailCorpus(seed).messages(size):
+                    source.create_doc(content)
+                results.update(_report_results('upload', size, source.sync()))
+                results['sync.noop.%d' % size], _ = timed(source.sync)
+                # a new replica of the same user recovers the secrets from
+                # the server and downloads everything.
+                target = soledad_instance(
+                    url, os.path.join(tempdir, 'target'), uuid)
+                results.update(
+                    _report_results('download', size, target.sync()))
+            finally:
+                for sol in (source, target):
+                    if sol is not None:
+                        sol.close()
+                shutil.rmtree(tempdir)
+    return results
+
+
+def main(argv):
+    sizes = [int(size) for size in argv[1:]] or SIZES
+    results = run(sizes)
+    for name in sorted(results):
+        print '%-44s %10.6fs' % (name, results[name])
+
+
+if __name__ == '__main__':
+    main(sys.argv)
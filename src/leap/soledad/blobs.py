@@ -0,0 +1,548 @@
+# -*- coding: utf-8 -*-
+# blobs.py
+# Copyright (C) 2013 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Storage of large binary payloads, such as mail attachments, apart from
+documents.
+
+A blob is stored in fixed-size chunks in the local encrypted database and is
+known by the SHA-256 hash of its content, so storing the same content twice
+keeps a single copy. Chunks are stored once too, keyed by their own hash,
+whichever blobs they belong to. Documents only hold references to blobs, see
+C{blob_reference}.
+
+Blobs are synced separately from documents: each chunk is encrypted and
+authenticated on its own, and transferred with a request of its own, so an
+interrupted transfer resumes from the chunks that were already transferred.
+A document may reach the server before the blobs it refers to, in which
+case other replicas can not download them until they are uploaded.
+"""
+
+import uuid
+import hmac
+import hashlib
+import binascii
+
+
+from u1db.remote.http_client import HTTPClientBase
+
+
+from leap.soledad.auth import TokenBasedAuth
+from leap.soledad.connection import PooledConnection
+from leap.soledad.crypto import EncryptionMethods
+from leap.soledad.target import WrongMac
+
+
+CHUNK_SIZE = 256 * 1024
+"""
+The size of the chunks blobs are stored and transferred in, in bytes.
+"""
+
+BLOB_ID_KEY = '_blob_id'
+BLOB_SIZE_KEY = '_blob_size'
+BLOB_CHUNKS_KEY = '_blob_chunks'
+
+_IV_LENGTH = 8
+_MAC_LENGTH = hashlib.sha256().digest_size
+
+
+#
+# Exceptions
+#
+
+class BlobNotFound(Exception):
+    """
+    Raised when a blob is not stored locally, or only some of its chunks, or
+    when the server does not store the chunks of a blob being downloaded.
+    """
+    pass
+
+
+#
+# References and chunk encryption
+#
+
+def blob_reference(blob_id, size, chunks):
+    """
+    Return the reference to a blob that documents hold instead of its
+    content.
+
+    @param blob_id: The id of the blob.
+    @type blob_id: str
+    @param size: The size of the blob, in bytes.
+    @type size: int
+    @param chunks: The number of chunks of the blob.
+    @type chunks: int
+
+    @return: The reference.
+    @rtype: dict
+    """
+    return {
+        BLOB_ID_KEY: blob_id,
+        BLOB_SIZE_KEY: size,
+        BLOB_CHUNKS_KEY: chunks,
+    }
+
+
+def is_blob_reference(value):
+    """
+    Return whether a value of a document's content is a blob reference.
+
+    @param value: The value.
+    @type value: object
+
+    @rtype: bool
+    """
+    return isinstance(value, dict) and BLOB_ID_KEY in value
+
+
+def remote_blob_id(crypto, blob_id):
+    """
+    Return the id a blob is stored under in the server, which, unlike the
+    hash of its content, tells nothing about the content.
+
+    @param crypto: A SoledadCryto instance.
+    @type crypto: leap.soledad.crypto.SoledadCrypto
+    @param blob_id: The id of the blob.
+    @type blob_id: str
+
+    @rtype: str
+    """
+    return hmac.new(
+        crypto.doc_mac_key(blob_id), blob_id, hashlib.sha256).hexdigest()
+
+
+def _mac_chunk(crypto, blob_id, index, data):
+    """
+    Calculate a MAC for an encrypted chunk that binds it to its position in
+    the blob.
+    """
+    return hmac.new(
+        crypto.doc_mac_key(blob_id),
+        '%s:%d:%s' % (blob_id, index, data),
+        hashlib.sha256).digest()
+
+
+def encrypt_chunk(crypto, blob_id, index, data):
+    """
+    Encrypt a chunk of a blob using AES-256 CTR mode.
+
+    The encrypted chunk is the initial value used to encrypt, followed by
+    the HMAC of the chunk and the ciphertext.
+
+    @param crypto: A SoledadCryto instance used to perform the encryption.
+    @type crypto: leap.soledad.crypto.SoledadCrypto
+    @param blob_id: The id of the blob.
+    @type blob_id: str
+    @param index: The position of the chunk in the blob.
+    @type index: int
+    @param data: The content of the chunk.
+    @type data: str
+
+    @return: The encrypted chunk.
+    @rtype: str
+    """
+    iv, ciphertext = crypto.encrypt_sym(
+        data, crypto.doc_passphrase(blob_id),
+        method=EncryptionMethods.AES_256_CTR)
+    iv = binascii.a2b_base64(iv)
+    mac = _mac_chunk(crypto, blob_id, index, iv + ciphertext)
+    return iv + mac + ciphertext
+
+
+def decrypt_chunk(crypto, blob_id, index, data):
+    """
+    Authenticate and decrypt a chunk encrypted with C{encrypt_chunk}.
+
+    @param crypto: A SoledadCryto instance used to perform the decryption.
+    @type crypto: leap.soledad.crypto.SoledadCrypto
+    @param blob_id: The id of the blob.
+    @type blob_id: str
+    @param index: The position of the chunk in the blob.
+    @type index: int
+    @param data: The encrypted chunk.
+    @type data: str
+
+    @return: The content of the chunk.
+    @rtype: str
+
+    @raise WrongMac: If the chunk could not be authenticated.
+    """
+    iv = data[:_IV_LENGTH]
+    mac = data[_IV_LENGTH:_IV_LENGTH + _MAC_LENGTH]
+    ciphertext = data[_IV_LENGTH + _MAC_LENGTH:]
+    if _mac_chunk(crypto, blob_id, index, iv + ciphertext) != mac:
+        raise WrongMac(
+            'Could not authenticate chunk %d of blob %s.' % (index, blob_id))
+    return crypto.decrypt_sym(
+        ciphertext, crypto.doc_passphrase(blob_id),
+        method=EncryptionMethods.AES_256_CTR,
+        iv=binascii.b2a_base64(iv))
+
+
+#
+# Local storage
+#
+
+class BlobWriter(object):
+    """
+    A file-like object that stores what is written to it as a new blob.
+
+    Chunks are stored as soon as they are complete, so only one chunk is
+    kept in memory. Until the writer is closed they are stored under a
+    temporary id, as the id of the blob is only known at the end. Like the
+    database it writes to, it must be used in the thread that opened the
+    database.
+    """
+
+    def __init__(self, db, chunk_size=CHUNK_SIZE):
+        """
+        Initialize the writer.
+
+        @param db: The database the blob is stored in.
+        @type db: leap.soledad.sqlcipher.SQLCipherDatabase
+        @param chunk_size: The size of the chunks, in bytes.
+        @type chunk_size: int
+        """
+        self._db = db
+        self._chunk_size = chunk_size
+        self._pending_id = 'pending-%s' % uuid.uuid4().hex
+        self._hash = hashlib.sha256()
+        self._buffer = []
+        self._buffered = 0
+        self._size = 0
+        self._chunks = 0
+        self._aborted = False
+        self.reference = None
+
+    def _get_closed(self):
+        return self._aborted or self.reference is not None
+
+    closed = property(
+        _get_closed, doc='Whether the writer was closed or aborted.')
+
+    def write(self, data):
+        """
+        Append data to the blob.
+
+        @param data: The data.
+        @type data: str
+        """
+        if self.closed:
+            raise ValueError('I/O operation on closed blob.')
+        self._hash.update(data)
+        self._size += len(data)
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered < self._chunk_size:
+            return
+        data = ''.join(self._buffer)
+        offset = 0
+        while len(data) - offset >= self._chunk_size:
+            self._store_chunk(data[offset:offset + self._chunk_size])
+            offset += self._chunk_size
+        data = data[offset:]
+        self._buffer = [data] if data else []
+        self._buffered = len(data)
+
+    def _store_chunk(self, data):
+        self._db._put_blob_part(self._pending_id, self._chunks, data)
+        self._chunks += 1
+
+    def close(self):
+        """
+        Store the last chunk and the blob.
+
+        If a blob with the same content is already stored, the new one is
+        discarded.
+
+        @return: The reference to the blob, see C{blob_reference}.
+        @rtype: dict
+        """
+        if self.reference is not None:
+            return self.reference
+        if self._aborted:
+            raise ValueError('I/O operation on aborted blob.')
+        if self._buffered:
+            self._store_chunk(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+        blob_id = self._hash.hexdigest()
+        self._db._put_blob(self._pending_id, blob_id, self._size, self._chunks)
+        self.reference = blob_reference(blob_id, self._size, self._chunks)
+        return self.reference
+
+    def abort(self):
+        """
+        Discard the chunks written so far.
+        """
+        if self.closed:
+            return
+        self._aborted = True
+        self._buffer = []
+        self._db._delete_blob_parts(self._pending_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class BlobReader(object):
+    """
+    A file-like object that reads a blob from the local database, one chunk
+    at a time.
+    """
+
+    def __init__(self, db, blob_id):
+        """
+        Initialize the reader.
+
+        @param db: The database the blob is stored in.
+        @type db: leap.soledad.sqlcipher.SQLCipherDatabase
+        @param blob_id: The id of the blob.
+        @type blob_id: str
+
+        @raise BlobNotFound: If the blob is not completely stored.
+        """
+        info = db.get_blob_info(blob_id)
+        if info is None or info['stored_chunks'] < info['chunks']:
+            raise BlobNotFound(blob_id)
+        self._db = db
+        self.blob_id = blob_id
+        self.size = info['size']
+        self._chunks = info['chunks']
+        self._index = 0
+        self._buffer = ''
+        self.closed = False
+
+    def _next_chunk(self):
+        chunk = self._db._get_blob_part(self.blob_id, self._index)
+        self._index += 1
+        return chunk
+
+    def read(self, size=-1):
+        """
+        Read at most C{size} bytes, or until the end of the blob if
+        C{size} is negative.
+
+        @param size: The number of bytes to read.
+        @type size: int
+
+        @return: The data, or an empty string at the end of the blob.
+        @rtype: str
+        """
+        if self.closed:
+            raise ValueError('I/O operation on closed blob.')
+        parts = [self._buffer]
+        available = len(self._buffer)
+        while (size < 0 or available < size) and self._index < self._chunks:
+            chunk = self._next_chunk()
+            parts.append(chunk)
+            available += len(chunk)
+        data = ''.join(parts)
+        if size < 0:
+            size = len(data)
+        self._buffer = data[size:]
+        return data[:size]
+
+    def __iter__(self):
+        """
+        Iterate over the rest of the blob, one chunk at a time.
+        """
+        if self._buffer:
+            data, self._buffer = self._buffer, ''
+            yield data
+        while self._index < self._chunks:
+            yield self._next_chunk()
+
+    def close(self):
+        self.closed = True
+        self._buffer = ''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+#
+# Sync
+#
+
+class SoledadBlobTarget(PooledConnection, HTTPClientBase, TokenBasedAuth):
+    """
+    Upload blobs to the server and download them, encrypted chunk by chunk.
+
+    The server stores the chunks of the blobs next to the user's database,
+    at the URL of the target, and answers to the following requests:
+
+        GET <url>/blobs/<id>: {"chunks": [<index>, ...]}, the indexes of the
+            chunks of the blob it stores, if any.
+        PUT <url>/blobs/<id>/<index>: store an encrypted chunk.
+        GET <url>/blobs/<id>/<index>: return an encrypted chunk.
+
+    where <id> is the C{remote_blob_id} of the blob.
+    """
+
+    #
+    # Token auth methods.
+    #
+
+    def set_token_credentials(self, uuid, token):
+        """
+        Store given credentials so we can sign the request later.
+
+        @param uuid: The user's uuid.
+        @type uuid: str
+        @param token: The authentication token.
+        @type token: str
+        """
+        TokenBasedAuth.set_token_credentials(self, uuid, token)
+
+    def _sign_request(self, method, url_query, params):
+        """
+        Return an authorization header to be included in the HTTP request.
+
+        @param method: The HTTP method.
+        @type method: str
+        @param url_query: The URL query string.
+        @type url_query: str
+        @param params: A list with encoded query parameters.
+        @type param: list
+
+        @return: The Authorization header.
+        @rtype: list of tuple
+        """
+        return TokenBasedAuth._sign_request(self, method, url_query, params)
+
+    #
+    # Blob transfer.
+    #
+
+    def __init__(self, url, creds=None, crypto=None, cert_file=None,
+                 connection_pool=None):
+        """
+        Initialize the target.
+
+        @param url: The url of the user's remote replica.
+        @type url: str
+        @param creds: optional dictionary giving credentials.
+            to authorize the operation with the server.
+        @type creds: dict
+        @param crypto: The instance used to encrypt and decrypt chunks.
+        @type crypto: leap.soledad.crypto.SoledadCrypto
+        @param cert_file: Path to the certificate used to verify the server.
+        @type cert_file: str
+        @param connection_pool: A pool to take connections from.
+        @type connection_pool: leap.soledad.connection.HTTPConnectionPool
+        """
+        HTTPClientBase.__init__(self, url, creds)
+        self.set_connection_options(cert_file, connection_pool)
+        self._crypto = crypto
+
+    def get_stored_chunks(self, blob_id):
+        """
+        Return the indexes of the chunks of a blob the server stores.
+
+        @param blob_id: The id of the blob.
+        @type blob_id: str
+
+        @rtype: set of int
+        """
+        res, _ = self._request_json(
+            'GET', ['blobs', remote_blob_id(self._crypto, blob_id)])
+        return set(res['chunks'])
+
+    def upload_blob(self, db, blob_id):
+        """
+        Upload the chunks of a local blob the server does not store yet, and
+        mark the blob as synced.
+
+        @param db: The database the blob is stored in.
+        @type db: leap.soledad.sqlcipher.SQLCipherDatabase
+        @param blob_id: The id of the blob.
+        @type blob_id: str
+
+        @return: The number of chunks uploaded.
+        @rtype: int
+
+        @raise BlobNotFound: If the blob is not completely stored.
+        """
+        info = db.get_blob_info(blob_id)
+        if info is None or info['stored_chunks'] < info['chunks']:
+            raise BlobNotFound(blob_id)
+        remote_id = remote_blob_id(self._crypto, blob_id)
+        stored = self.get_stored_chunks(blob_id)
+        sent = 0
+        for index in xrange(info['chunks']):
+            if index in stored:
+                continue
+            data = encrypt_chunk(
+                self._crypto, blob_id, index,
+                db._get_blob_part(blob_id, index))
+            self._request(
+                'PUT', ['blobs', remote_id, str(index)], body=data,
+                content_type='application/octet-stream')
+            sent += 1
+        db._set_blob_synced(blob_id)
+        return sent
+
+    def download_blob(self, db, reference):
+        """
+        Download the chunks of a blob that are not stored locally.
+
+        Each chunk is stored as soon as it is received, so a download that
+        is interrupted resumes where it stopped.
+
+        @param db: The database to store the blob in.
+        @type db: leap.soledad.sqlcipher.SQLCipherDatabase
+        @param reference: The reference to the blob, see C{blob_reference}.
+        @type reference: dict
+
+        @return: The number of chunks downloaded.
+        @rtype: int
+
+        @raise BlobNotFound: If the server does not store all the chunks
+            missing locally, e.g. because the replica that created the blob
+            did not upload it yet.
+        @raise WrongMac: If a chunk could not be authenticated.
+        """
+        blob_id = reference[BLOB_ID_KEY]
+        stored = db._get_blob_part_indexes(blob_id)
+        missing = [index for index in xrange(reference[BLOB_CHUNKS_KEY])
+                   if index not in stored]
+        if missing \
+                and not self.get_stored_chunks(blob_id).issuperset(missing):
+            raise BlobNotFound(blob_id)
+        db._put_blob_definition(
+            blob_id, reference[BLOB_SIZE_KEY], reference[BLOB_CHUNKS_KEY])
+        remote_id = remote_blob_id(self._crypto, blob_id)
+        received = 0
+        for index in missing:
+            data, _ = self._request('GET', ['blobs', remote_id, str(index)])
+            db._put_blob_part(
+                blob_id, index,
+                decrypt_chunk(self._crypto, blob_id, index, data))
+            received += 1
+        return received
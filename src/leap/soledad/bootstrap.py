@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# bootstrap.py
+# Copyright (C) 2013 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+A small dependency graph of steps, used to run Soledad's bootstrap.
+"""
+
+import sys
+import time
+import threading
+
+
+class BootstrapStep(object):
+    """
+    A named unit of work that depends on other steps.
+    """
+
+    def __init__(self, name, func, requires=(), background=False):
+        """
+        Initialize the step.
+
+        @param name: The name of the step.
+        @type name: str
+        @param func: The function that performs the step. It is called with
+            no arguments.
+        @type func: callable
+        @param requires: The names of the steps that must be finished before
+            this one starts.
+        @type requires: tuple
+        @param background: Whether the step should run in its own thread, so
+            that the steps that do not depend on it can run meanwhile.
+        @type background: bool
+        """
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.background = background
+        self.result = None
+        self.elapsed = None
+        self._exc_info = None
+        self._thread = None
+
+    def run(self):
+        """
+        Run the step, recording its result or the exception it raised.
+        """
+        start = time.time()
+        try:
+            self.result = self.func()
+        except Exception:
+            self._exc_info = sys.exc_info()
+        finally:
+            self.elapsed = time.time() - start
+
+    def start(self):
+        """
+        Start running the step, in a new thread if it is a background step.
+
+        Exceptions raised by a foreground step are re-raised right away, and
+        the ones raised by a background step when it is waited for.
+        """
+        if self.background:
+            self._thread = threading.Thread(
+                target=self.run, name='soledad-bootstrap-%s' % self.name)
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self.run()
+            self.wait()
+
+    def wait(self):
+        """
+        Wait for the step to finish and re-raise any exception it raised.
+
+        @return: The value returned by the step function.
+        """
+        if self._thread is not None:
+            self._thread.join()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self.result
+
+
+class BootstrapGraph(object):
+    """
+    Run a set of steps in dependency order.
+
+    Steps are started in the order they were added. Before a step starts,
+    every step it requires is waited for, so a background step overlaps with
+    all steps added after it until one of them requires it.
+    """
+
+    def __init__(self):
+        """
+        Initialize an empty graph.
+        """
+        self._steps = []
+        self._by_name = {}
+
+    def add(self, name, func, requires=(), background=False):
+        """
+        Add a step to the graph.
+
+        @param name: The name of the step.
+        @type name: str
+        @param func: The function that performs the step.
+        @type func: callable
+        @param requires: The names of the steps this one depends on. They
+            must have been added already.
+        @type requires: tuple
+        @param background: Whether the step should run in its own thread.
+        @type background: bool
+        """
+        for required in requires:
+            if required not in self._by_name:
+                raise ValueError(
+                    'Step %s requires unknown step %s.' % (name, required))
+        step = BootstrapStep(
+            name, func, requires=requires, background=background)
+        self._steps.append(step)
+        self._by_name[name] = step
+
+    def result(self, name):
+        """
+        Return the value returned by the step named C{name}.
+
+        @param name: The name of the step.
+        @type name: str
+        """
+        return self._by_name[name].result
+
+    def run(self):
+        """
+        Run all steps and wait for all of them to finish.
+
+        @return: A list of (name, elapsed seconds) for each step, in the
+            order the steps were added.
+        @rtype: list
+
+        @raise Exception: Whatever exception the first failing step raised.
+        """
+        try:
+            for step in self._steps:
+                for required in step.requires:
+                    self._by_name[required].wait()
+                step.start()
+        finally:
+            # never leave background steps running behind our back.
+            for step in self._steps:
+                if step._thread is not None:
+                    step._thread.join()
+        for step in self._steps:
+            step.wait()
+        return [(step.name, step.elapsed) for step in self._steps]
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# cache.py
+# Copyright (C) 2013 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+A bounded in-process cache for documents stored in the local database.
+"""
+
+import threading
+
+
+from collections import OrderedDict
+
+
+class DocumentCache(object):
+    """
+    A least recently used cache of documents keyed by doc_id.
+
+    The cache does not hold document objects. It holds the state needed to
+    build a new document (revision, JSON content, conflict and syncable
+    flags), so every read returns a fresh copy and callers can never change
+    what is cached by mutating the documents they get.
+
+    Every invalidation bumps the version of the cache. A document read from
+    the database on a cache miss is only cached if no invalidation happened
+    since the read started, see C{version}, so a stale document is never
+    cached after it was invalidated.
+    """
+
+    def __init__(self, max_size, factory):
+        """
+        Initialize the cache.
+
+        @param max_size: The maximum number of documents to keep.
+        @type max_size: int
+        @param factory: A function that will be called with the same
+            parameters as SoledadDocument.__init__ to build documents.
+        @type factory: callable
+        """
+        self._max_size = max_size
+        self._factory = factory
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._version = 0
+
+    def get(self, doc_id):
+        """
+        Return a copy of the cached document with id C{doc_id}.
+
+        @param doc_id: The unique document identifier.
+        @type doc_id: str
+
+        @return: A new document, or None if it is not cached.
+        @rtype: SoledadDocument
+        """
+        with self._lock:
+            entry = self._entries.pop(doc_id, None)
+            if entry is None:
+                self._misses += 1
+                return None
+            # re-insert so the entry becomes the most recently used
+            self._entries[doc_id] = entry
+            self._hits += 1
+        rev, json, has_conflicts, syncable = entry
+        return self._factory(
+            doc_id=doc_id, rev=rev, json=json, has_conflicts=has_conflicts,
+            syncable=syncable)
+
+    def version(self):
+        """
+        Return the current version of the cache, to be passed to C{put} for
+        a document read from the database after this call.
+
+        @rtype: int
+        """
+        with self._lock:
+            return self._version
+
+    def put(self, doc, version=None):
+        """
+        Cache the current state of C{doc}.
+
+        @param doc: The document to cache.
+        @type doc: SoledadDocument
+        @param version: The version of the cache when the document was read
+            from the database. If the cache was invalidated since, the
+            document may be stale and is not cached.
+        @type version: int
+        """
+        entry = (doc.rev, doc.get_json(), doc.has_conflicts,
+                 getattr(doc, 'syncable', True))
+        with self._lock:
+            if version is not None and version != self._version:
+                return
+            self._entries.pop(doc.doc_id, None)
+            self._entries[doc.doc_id] = entry
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, doc_id):
+        """
+        Remove the document with id C{doc_id} from the cache.
+
+        @param doc_id: The unique document identifier.
+        @type doc_id: str
+        """
+        with self._lock:
+            self._entries.pop(doc_id, None)
+            self._version += 1
+
+    def clear(self):
+        """
+        Remove all documents from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._version += 1
+
+    def stats(self):
+        """
+        Return usage statistics for the cache.
+
+        @return: A dictionary with the number of hits and misses, the hit
+            rate, the current size and the maximum size of the cache.
+        @rtype: dict
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': float(self._hits) / lookups if lookups else 0.0,
+                'size': len(self._entries),
+                'max_size': self._max_size,
+            }
+
+    def __len__(self):
+        return len(self._entries)
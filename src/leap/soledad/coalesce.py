@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# coalesce.py
+# Copyright (C) 2013 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+A buffer that coalesces rapid updates to the same document.
+"""
+
+import time
+import threading
+
+
+class WriteCoalescer(object):
+    """
+    Buffer updates to documents, keyed by doc_id, so that many updates to a
+    document in a short time are written as a single revision.
+
+    Each buffered document remembers the revision it is based on, which is
+    the revision stored in the database when it was first buffered, and the
+    time it was first buffered. Like C{DocumentCache}, the buffer holds the
+    state needed to build a new document, so every read returns a fresh
+    copy.
+    """
+
+    def __init__(self, window, factory, clock=time.time):
+        """
+        Initialize the buffer.
+
+        @param window: How long a document may stay buffered, in seconds,
+            counted from its first buffered update.
+        @type window: float
+        @param factory: A function that will be called with the same
+            parameters as SoledadDocument.__init__ to build documents.
+        @type factory: callable
+        @param clock: A function that returns the current time, in seconds.
+        @type clock: callable
+        """
+        self.window = window
+        self._factory = factory
+        self._clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, doc_id):
+        """
+        Return a copy of the buffered document with id C{doc_id}.
+
+        @param doc_id: The unique document identifier.
+        @type doc_id: str
+
+        @return: (base_rev, doc) - The revision the buffered document is
+            based on and a new document with its buffered state, or None if
+            it is not buffered.
+        @rtype: tuple
+        """
+        with self._lock:
+            entry = self._entries.get(doc_id)
+        if entry is None:
+            return None
+        return entry[0], self._build(doc_id, entry)
+
+    def put(self, doc, base_rev):
+        """
+        Buffer the current state of C{doc}.
+
+        @param doc: The updated document, with the revision it will have
+            once written.
+        @type doc: SoledadDocument
+        @param base_rev: The revision stored in the database, which the
+            document will be written over. It is only used if the document
+            is not buffered yet.
+        @type base_rev: str
+        """
+        with self._lock:
+            entry = self._entries.get(doc.doc_id)
+            if entry is not None:
+                base_rev, buffered_at = entry[0], entry[4]
+            else:
+                buffered_at = self._clock()
+            self._entries[doc.doc_id] = (
+                base_rev, doc.rev, doc.get_json(),
+                getattr(doc, 'syncable', True), buffered_at)
+
+    def pop(self, doc_id):
+        """
+        Remove the document with id C{doc_id} from the buffer.
+
+        @param doc_id: The unique document identifier.
+        @type doc_id: str
+
+        @return: (base_rev, doc) - See C{get}.
+        @rtype: tuple
+        """
+        with self._lock:
+            entry = self._entries.pop(doc_id, None)
+        if entry is None:
+            return None
+        return entry[0], self._build(doc_id, entry)
+
+    def pop_expired(self):
+        """
+        Remove the documents that were buffered for longer than the window.
+
+        @return: A list of (base_rev, doc), see C{get}, in the order the
+            documents were first buffered.
+        @rtype: list
+        """
+        deadline = self._clock() - self.window
+        with self._lock:
+            expired = sorted(
+                (entry[4], doc_id) for doc_id, entry in self._entries.items()
+                if entry[4] <= deadline)
+            entries = [(doc_id, self._entries.pop(doc_id))
+                       for _, doc_id in expired]
+        return [(entry[0], self._build(doc_id, entry))
+                for doc_id, entry in entries]
+
+    def pop_all(self):
+        """
+        Remove all documents from the buffer.
+
+        @return: A list of (base_rev, doc), see C{get}, in the order the
+            documents were first buffered.
+        @rtype: list
+        """
+        with self._lock:
+            entries, self._entries = self._entries, {}
+        return [(entry[0], self._build(doc_id, entry))
+                for doc_id, entry in sorted(
+                    entries.items(), key=lambda item: item[1][4])]
+
+    def _build(self, doc_id, entry):
+        _, rev, json, syncable, _ = entry
+        return self._factory(
+            doc_id=doc_id, rev=rev, json=json, syncable=syncable)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+# connection.py
+# Copyright (C) 2013 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+HTTP connections to Soledad server with per-instance SSL certificates and an
+optional pool shared by many clients.
+"""
+
+import time
+import socket
+import ssl
+import httplib
+import threading
+
+
+from u1db.remote import http_client
+from u1db.remote.ssl_match_hostname import match_hostname
+
+
+#-----------------------------------------------------------------------------
+# Verified HTTPS connections
+#-----------------------------------------------------------------------------
+
+class VerifiedHTTPSConnection(httplib.HTTPSConnection):
+    """
+    HTTPSConnection verifying server side certificates against a given CA
+    certificate file.
+    """
+    # derived from httplib.py
+
+    def __init__(self, host, port=None, ca_certs=None, **kwargs):
+        """
+        Initialize the connection.
+
+        @param host: The server host.
+        @type host: str
+        @param port: The server port.
+        @type port: int
+        @param ca_certs: Path to the file with the certificates used to
+            verify the server.
+        @type ca_certs: str
+        """
+        httplib.HTTPSConnection.__init__(self, host, port, **kwargs)
+        self.ca_certs = ca_certs
+
+    def connect(self):
+        "Connect to a host on a given (SSL) port."
+        sock = socket.create_connection((self.host, self.port),
+                                        self.timeout, self.source_address)
+        if self._tunnel_host:
+            self.sock = sock
+            self._tunnel()
+
+        self.sock = ssl.wrap_socket(sock,
+                                    ca_certs=self.ca_certs,
+                                    cert_reqs=ssl.CERT_REQUIRED)
+        match_hostname(self.sock.getpeercert(), self.host)
+
+
+def make_connection(url, cert_file=None):
+    """
+    Create a new connection to the server of a parsed url.
+
+    @param url: The parsed url of the server.
+    @type url: urlparse.ParseResult
+    @param cert_file: Path to the certificate used to verify the server, or
+        None to use the certificate configured for the whole process.
+    @type cert_file: str
+
+    @return: A connection that is not connected yet.
+    @rtype: httplib.HTTPConnection
+    """
+    if url.scheme == 'https':
+        if cert_file is None:
+            return http_client._VerifiedHTTPSConnection(url.hostname, url.port)
+        return VerifiedHTTPSConnection(
+            url.hostname, url.port, ca_certs=cert_file)
+    return httplib.HTTPConnection(url.hostname, url.port)
+
+
+#-----------------------------------------------------------------------------
+# Connection pool
+#-----------------------------------------------------------------------------
+
+class HTTPConnectionPool(object):
+    """
+    A pool of idle keep-alive connections shared by many clients.
+
+    Connections are kept per server and certificate. A client takes a
+    connection from the pool when it first needs one and gives it back when
+    it is closed, so many accounts syncing one after the other use a handful
+    of sockets instead of one each.
+    """
+
+    MAX_IDLE_PER_HOST = 8
+    """
+    The maximum number of idle connections kept for each server.
+    """
+
+    MAX_IDLE_TIME = 30.0
+    """
+    Seconds after which an idle connection is closed instead of reused, as
+    the server has probably dropped it.
+    """
+
+    def __init__(self, max_idle_per_host=None, max_idle_time=None):
+        """
+        Initialize the pool.
+
+        @param max_idle_per_host: The maximum number of idle connections kept
+            for each server.
+        @type max_idle_per_host: int
+        @param max_idle_time: Seconds after which an idle connection is
+            closed instead of reused.
+        @type max_idle_time: float
+        """
+        self._max_idle_per_host = max_idle_per_host or self.MAX_IDLE_PER_HOST
+        self._max_idle_time = max_idle_time or self.MAX_IDLE_TIME
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._closed = False
+        self._created = 0
+        self._reused = 0
+
+    def _key(self, url, cert_file):
+        return (url.scheme, url.hostname, url.port, cert_file)
+
+    def get(self, url, cert_file=None):
+        """
+        Take a connection to the server of C{url} from the pool, or create a
+        new one if there is no idle connection to it.
+
+        @param url: The parsed url of the server.
+        @type url: urlparse.ParseResult
+        @param cert_file: Path to the certificate used to verify the server.
+        @type cert_file: str
+
+        @return: The connection.
+        @rtype: httplib.HTTPConnection
+        """
+        now = time.time()
+        stale = []
+        conn = None
+        with self._lock:
+            idle = self._idle.get(self._key(url, cert_file), [])
+            while idle:
+                candidate, released = idle.pop()
+                if now - released < self._max_idle_time:
+                    conn = candidate
+                    self._reused += 1
+                    break
+                stale.append(candidate)
+            if conn is None:
+                self._created += 1
+        for candidate in stale:
+            candidate.close()
+        if conn is None:
+            conn = make_connection(url, cert_file)
+        return conn
+
+    def put(self, url, cert_file, conn):
+        """
+        Give a connection back to the pool.
+
+        Connections that are not ready for a new request, or that exceed the
+        number of idle connections kept for their server, are closed.
+
+        @param url: The parsed url of the server.
+        @type url: urlparse.ParseResult
+        @param cert_file: Path to the certificate used to verify the server.
+        @type cert_file: str
+        @param conn: The connection.
+        @type conn: httplib.HTTPConnection
+        """
+        # httplib does not tell whether a connection is idle, so peek at its
+        # private state: a request interrupted halfway cannot be reused. A
+        # connection closed by the server is fine, httplib opens it again.
+        response = getattr(conn, '_HTTPConnection__response', None)
+        reusable = (
+            getattr(conn, '_HTTPConnection__state', None) == httplib._CS_IDLE
+            and (response is None or response.isclosed()))
+        if reusable:
+            with self._lock:
+                idle = self._idle.setdefault(self._key(url, cert_file), [])
+                if not self._closed and len(idle) < self._max_idle_per_host:
+                    idle.append((conn, time.time()))
+                    return
+        conn.close()
+
+    def close(self):
+        """
+        Close all idle connections. Connections given back afterwards are
+        closed right away.
+        """
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+
+    def stats(self):
+        """
+        Return statistics about the pool.
+
+        @return: The number of connections 'created' and 'reused', and the
+            number of 'idle' connections.
+        @rtype: dict
+        """
+        with self._lock:
+            return {
+                'created': self._created,
+                'reused': self._reused,
+                'idle': sum(len(conns) for conns in self._idle.values()),
+            }
+
+
+#-----------------------------------------------------------------------------
+# Mixin for u1db HTTP clients
+#-----------------------------------------------------------------------------
+
+class PooledConnection(object):
+    """
+    Encapsulate connection handling for classes that inherit from
+    u1db.remote.http_client.HTTPClientBase, so they verify the server with
+    their own certificate and may take connections from a shared pool.
+
+    It must come before the u1db class in the list of base classes.
+    """
+
+    def set_connection_options(self, cert_file=None, connection_pool=None):
+        """
+        Set how connections to the server are made.
+
+        @param cert_file: Path to the certificate used to verify the server,
+            or None to use the certificate configured for the whole process.
+        @type cert_file: str
+        @param connection_pool: A pool to take connections from, or None to
+            open a connection for this client only.
+        @type connection_pool: HTTPConnectionPool
+        """
+        self._cert_file = cert_file
+        self._connection_pool = connection_pool
+
+    def _ensure_connection(self):
+        """
+        Make sure there is a connection to the server.
+        """
+        if self._conn is not None:
+            return
+        pool = getattr(self, '_connection_pool', None)
+        cert_file = getattr(self, '_cert_file', None)
+        if pool is not None:
+            self._conn = pool.get(self._url, cert_file)
+        else:
+            self._conn = make_connection(self._url, cert_file)
+
+    def close(self):
+        """
+        Close the connection to the server, or give it back to the pool.
+        """
+        pool = getattr(self, '_connection_pool', None)
+        if pool is not None and self._conn is not None:
+            conn, self._conn = self._conn, None
+            pool.put(self._url, self._cert_file, conn)
+        else:
+            super(PooledConnection, self).close()
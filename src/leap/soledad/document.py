@@ -21,7 +21,11 @@ A Soledad Document is an u1db.Document with lasers.
 """
 
 
+import simplejson as json
+
+
 from u1db import Document
+from u1db.errors import InvalidJSON
 
 
 #
@@ -34,13 +38,27 @@ class SoledadDocument(Document):
 
     LEAP Documents can be flagged as syncable or not, so the replicas
     might not sync every document.
+
+    Documents keep the JSON string they were built with and only parse it
+    when C{content} is first accessed. Until then, C{get_json()} returns the
+    original string itself, so documents that are just listed, stored or
+    synced are never parsed nor serialized again. All state lives in slots,
+    so no per-instance dictionary is allocated.
     """
 
+    __slots__ = (
+        'doc_id', '_rev', 'has_conflicts', '_syncable', '_json', '_content',
+        'content_pending', 'encrypted_json')
+
     def __init__(self, doc_id=None, rev=None, json='{}', has_conflicts=False,
                  syncable=True):
         """
         Container for handling an encryptable document.
 
+        Only a cheap check that C{json} looks like a JSON object is made
+        here. Errors deeper inside the string are reported when the content
+        is first parsed.
+
         @param doc_id: The unique document identifier.
         @type doc_id: str
         @param rev: The revision identifier of the document.
@@ -51,9 +69,178 @@ class SoledadDocument(Document):
         @type has_conflicts: bool
         @param syncable: Should this document be synced with remote replicas?
         @type syncable: bool
+
+        @raise InvalidJSON: If C{json} is not the serialization of a JSON
+            object.
         """
-        Document.__init__(self, doc_id, rev, json, has_conflicts)
+        if json is not None:
+            self._check_json_object(json)
+        self.doc_id = doc_id
+        self._rev = rev
+        self.has_conflicts = has_conflicts
         self._syncable = syncable
+        self._json = json
+        self._content = None
+        # whether only the metadata of the document was synced or
+        # decrypted, see SQLCipherDatabase.fetch_pending_content.
+        self.content_pending = False
+        # the encrypted content of a document stored without decrypting it.
+        self.encrypted_json = None
+
+    @staticmethod
+    def _check_json_object(json_string):
+        """
+        Check that C{json_string} looks like the serialization of a JSON
+        object without parsing it.
+
+        @param json_string: The JSON string.
+        @type json_string: str
+
+        @raise InvalidJSON: If C{json_string} is not enclosed in braces.
+        """
+        stripped = json_string.strip()
+        if not (stripped.startswith('{') and stripped.endswith('}')):
+            raise InvalidJSON
+
+    def get_json(self):
+        """
+        Return the JSON serialization of this document's content.
+
+        @return: The original JSON string if the content was never accessed,
+            or a new serialization of the current content otherwise.
+        @rtype: str
+        """
+        if self._content is not None:
+            return json.dumps(self._content)
+        return self._json
+
+    def set_json(self, json_string):
+        """
+        Set the content of the document from its JSON serialization.
+
+        @param json_string: The JSON string.
+        @type json_string: str
+
+        @raise InvalidJSON: If C{json_string} is not the serialization of a
+            JSON object.
+        """
+        if json_string is not None:
+            self._parse_json_object(json_string)
+        self._content = None
+        self._json = json_string
+
+    def validate_json(self):
+        """
+        Check that the JSON string of the document, if its content was not
+        parsed yet, is the serialization of a JSON object.
+
+        Documents written locally are checked before they are stored, as
+        u1db does, while documents received by syncs or decrypted are only
+        parsed when their content is first accessed.
+
+        @raise InvalidJSON: If the JSON string is not the serialization of a
+            JSON object.
+        """
+        if self._content is None and self._json is not None:
+            self._parse_json_object(self._json)
+
+    @staticmethod
+    def _parse_json_object(json_string):
+        """
+        Parse the serialization of a JSON object.
+
+        @param json_string: The JSON string.
+        @type json_string: str
+
+        @return: The parsed object.
+        @rtype: dict
+
+        @raise InvalidJSON: If C{json_string} is not the serialization of a
+            JSON object.
+        """
+        try:
+            value = json.loads(json_string)
+        except ValueError:
+            raise InvalidJSON
+        if not isinstance(value, dict):
+            raise InvalidJSON
+        return value
+
+    def make_tombstone(self):
+        """
+        Make this document into a tombstone.
+        """
+        self._content = None
+        self._json = None
+
+    def is_tombstone(self):
+        """
+        Return True if the document is a tombstone, False otherwise.
+
+        @rtype: bool
+        """
+        return self._content is None and self._json is None
+
+    def same_content_as(self, other):
+        """
+        Compare the content of two documents without changing their state.
+
+        @param other: The document to compare to.
+        @type other: u1db.Document
+
+        @rtype: bool
+        """
+        if not isinstance(other, Document):
+            raise TypeError(
+                'other must be a Document, not %s' % type(other))
+        return self._peek_content(self) == self._peek_content(other)
+
+    @staticmethod
+    def _peek_content(doc):
+        """
+        Return the parsed content of C{doc} without caching it in C{doc}.
+        """
+        if isinstance(doc, SoledadDocument) and doc._content is not None:
+            return doc._content
+        doc_json = doc.get_json()
+        if doc_json is None:
+            return None
+        return json.loads(doc_json)
+
+    def _get_content(self):
+        """
+        Return the content of the document, parsing it on first access.
+
+        As the returned dictionary may be changed in place, the content is
+        serialized again by C{get_json()} once it has been accessed.
+
+        @return: The content of the document.
+        @rtype: dict
+
+        @raise InvalidJSON: If the JSON string can not be parsed.
+        """
+        if self._content is None and self._json is not None:
+            try:
+                self._content = json.loads(self._json)
+            except ValueError:
+                raise InvalidJSON
+            self._json = None
+        return self._content
+
+    def _set_content(self, content):
+        """
+        Set the content of the document.
+
+        @param content: The new content.
+        @type content: dict
+        """
+        self._json = None
+        self._content = content
+
+    content = property(
+        _get_content,
+        _set_content,
+        doc="Content of the Document.")
 
     def _get_syncable(self):
         """
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+# manager.py
+# Copyright (C) 2013 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Host the Soledad replicas of many accounts in one process.
+"""
+
+import logging
+import threading
+
+
+from collections import OrderedDict
+
+
+from leap.soledad import Soledad
+from leap.soledad.connection import HTTPConnectionPool
+from leap.soledad.scheduler import SharedSyncScheduler
+
+
+logger = logging.getLogger(name=__name__)
+
+
+class SoledadManager(object):
+    """
+    Host the Soledad replicas of many accounts with shared, bounded
+    resources.
+
+    All accounts share:
+
+        * a pool of keep-alive connections to the servers;
+        * a limit on how many accounts are bootstrapped at the same time, as
+          deriving keys with scrypt is the most expensive cryptographic work
+          Soledad does;
+        * a sync scheduler with a fixed number of worker threads, which
+          serves the accounts that wait longest first.
+
+    At most C{max_open_databases} local databases are kept open. When more
+    accounts are used, the least recently used ones are suspended and opened
+    again when next used, without running scrypt again.
+
+    Accounts should be used through C{get}, so that the manager knows which
+    ones are in use. As SQLCipher connections can only be used by the thread
+    that opened them, an account should be used from a single thread. An
+    idle account used by another thread is suspended by that thread the
+    next time it calls the manager, so it is never closed while in use.
+    """
+
+    MAX_OPEN_DATABASES = 100
+    """
+    The maximum number of local databases kept open.
+    """
+
+    BOOTSTRAP_WORKERS = 2
+    """
+    The maximum number of accounts bootstrapped at the same time.
+    """
+
+    def __init__(self, max_open_databases=None, bootstrap_workers=None,
+                 sync_workers=None, connection_pool=None, scheduler=None):
+        """
+        Initialize the manager and start its sync scheduler.
+
+        @param max_open_databases: The maximum number of local databases kept
+            open.
+        @type max_open_databases: int
+        @param bootstrap_workers: The maximum number of accounts bootstrapped
+            at the same time.
+        @type bootstrap_workers: int
+        @param sync_workers: The maximum number of syncs run at the same
+            time.
+        @type sync_workers: int
+        @param connection_pool: The connection pool shared by all accounts,
+            or None to create a new one.
+        @type connection_pool: leap.soledad.connection.HTTPConnectionPool
+        @param scheduler: The sync scheduler shared by all accounts, or None
+            to create a new one.
+        @type scheduler: leap.soledad.scheduler.SharedSyncScheduler
+        """
+        self._max_open_databases = \
+            max_open_databases or self.MAX_OPEN_DATABASES
+        self._bootstrap_slots = threading.Semaphore(
+            bootstrap_workers or self.BOOTSTRAP_WORKERS)
+        self._connection_pool = connection_pool or HTTPConnectionPool()
+        self._scheduler = scheduler or SharedSyncScheduler(
+            workers=sync_workers)
+        self._scheduler.start()
+        self._lock = threading.Lock()
+        self._accounts = {}
+        # accounts with an open local database, least recently used first.
+        self._open = OrderedDict()
+        # the thread each account was last used from.
+        self._owners = {}
+        # idle accounts to be suspended by the thread that uses them.
+        self._evicted = {}
+
+    #
+    # Accounts
+    #
+
+    def open_account(self, uuid, passphrase, secrets_path, local_db_path,
+                     server_url, cert_file, auth_token=None, sync=True,
+                     **kwargs):
+        """
+        Bootstrap the Soledad replica of an account and start hosting it.
+
+        @param sync: Whether the account should be synced in the background
+            by the shared scheduler.
+        @type sync: bool
+
+        The other parameters are passed on to C{Soledad}.
+
+        @return: The Soledad instance of the account.
+        @rtype: leap.soledad.Soledad
+
+        @raise ValueError: If the account is already hosted.
+        """
+        with self._lock:
+            if uuid in self._accounts:
+                raise ValueError('Account %s is already open.' % uuid)
+            # reserve the account while it is bootstrapped.
+            self._accounts[uuid] = None
+        try:
+            with self._bootstrap_slots:
+                sol = Soledad(
+                    uuid, passphrase, secrets_path, local_db_path,
+                    server_url, cert_file, auth_token=auth_token,
+                    connection_pool=self._connection_pool, **kwargs)
+        except Exception:
+            with self._lock:
+                del self._accounts[uuid]
+            raise
+        with self._lock:
+            self._accounts[uuid] = sol
+        self._touch(uuid, sol)
+        if sync:
+            sol.start_sync_scheduler(scheduler=self._scheduler)
+        return sol
+
+    def get(self, uuid):
+        """
+        Return the Soledad instance of an account, marking it as recently
+        used.
+
+        @param uuid: The uuid of the account.
+        @type uuid: str
+
+        @return: The Soledad instance of the account.
+        @rtype: leap.soledad.Soledad
+
+        @raise KeyError: If the account is not hosted.
+        """
+        with self._lock:
+            sol = self._accounts.get(uuid)
+        if sol is None:
+            raise KeyError(uuid)
+        self._touch(uuid, sol)
+        return sol
+
+    def close_account(self, uuid):
+        """
+        Stop hosting an account and close its Soledad instance.
+
+        @param uuid: The uuid of the account.
+        @type uuid: str
+        """
+        with self._lock:
+            sol = self._accounts.pop(uuid, None)
+            self._open.pop(uuid, None)
+            self._forget_eviction(uuid)
+            self._owners.pop(uuid, None)
+        if sol is not None:
+            sol.close()
+
+    def close(self):
+        """
+        Close all accounts, stop the sync scheduler and close idle
+        connections.
+        """
+        self._scheduler.stop()
+        with self._lock:
+            accounts, self._accounts = self._accounts, {}
+            self._open.clear()
+            self._owners.clear()
+            self._evicted.clear()
+        for sol in accounts.values():
+            if sol is not None:
+                sol.close()
+        self._connection_pool.close()
+
+    def _touch(self, uuid, sol):
+        """
+        Mark an account as recently used by the current thread and evict the
+        least recently used accounts beyond C{max_open_databases}.
+
+        Evicted accounts used by the current thread are suspended right
+        away, as are the ones evicted earlier for this thread. The others are
+        suspended by the thread that uses them, when it next calls the
+        manager.
+        """
+        current = threading.current_thread()
+        with self._lock:
+            self._forget_eviction(uuid)
+            self._owners[uuid] = current
+            self._open.pop(uuid, None)
+            self._open[uuid] = sol
+            while len(self._open) > self._max_open_databases:
+                idle_uuid, idle = self._open.popitem(last=False)
+                owner = self._owners.get(idle_uuid, current)
+                self._evicted.setdefault(owner, OrderedDict())[idle_uuid] = \
+                    idle
+            evicted = self._evicted.pop(current, {}).values()
+        for idle in evicted:
+            logger.debug('Suspending idle database of %s.' % idle.uuid)
+            idle.suspend()
+
+    def _forget_eviction(self, uuid):
+        """
+        Stop waiting to suspend an account. Must be called holding the lock.
+        """
+        owner = self._owners.get(uuid)
+        pending = self._evicted.get(owner)
+        if pending is not None:
+            pending.pop(uuid, None)
+            if not pending:
+                del self._evicted[owner]
+
+    def __contains__(self, uuid):
+        with self._lock:
+            return self._accounts.get(uuid) is not None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._accounts)
+
+    #
+    # Status
+    #
+
+    def _get_connection_pool(self):
+        return self._connection_pool
+
+    connection_pool = property(
+        _get_connection_pool,
+        doc='The connection pool shared by all accounts.')
+
+    def _get_scheduler(self):
+        return self._scheduler
+
+    scheduler = property(
+        _get_scheduler,
+        doc='The sync scheduler shared by all accounts.')
+
+    def stats(self):
+        """
+        Return statistics about the hosted accounts.
+
+        @return: The number of 'accounts' and of 'open_databases', and the
+            statistics of the 'connections' pool and of the 'sync' scheduler.
+        @rtype: dict
+        """
+        with self._lock:
+            accounts = len(self._accounts)
+            opened = self._open.values()
+            for pending in self._evicted.values():
+                opened.extend(pending.values())
+            open_databases = len(
+                [sol for sol in opened if not sol.suspended])
+        return {
+            'accounts': accounts,
+            'open_databases': open_databases,
+            'connections': self._connection_pool.stats(),
+            'sync': self._scheduler.stats(),
+        }
@@ -0,0 +1,663 @@
+# -*- coding: utf-8 -*-
+# profiling.py
+# Copyright (C) 2013 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Opt-in profiling of Soledad's entry points.
+
+When profiling is enabled, the sync, bootstrap, sync exchange, document
+encryption and decryption and index query entry points are wrapped so that
+each invocation is profiled and its profile written to a directory. When it
+is disabled, the original functions are put back, so there is no overhead at
+all.
+
+Profiling can be enabled from code:
+
+    with profiling('/tmp/soledad-profiles', profiler='sampling'):
+        soledad.sync()
+
+or for the whole process, by setting the following environment variables
+before leap.soledad is imported:
+
+    SOLEDAD_PROFILE: the profiler to use, one of 'cprofile', 'sampling' or
+        'tracemalloc'.
+    SOLEDAD_PROFILE_DIR: where to write profiles.
+    SOLEDAD_PROFILE_MAX_BYTES: the maximum size of the profile directory.
+
+The memory used by each phase of a sync can be profiled too, see
+C{SyncMemoryProfile} and C{Soledad.sync}.
+"""
+
+import os
+import sys
+import time
+import thread
+import logging
+import functools
+import threading
+import cProfile
+
+
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(name=__name__)
+
+
+#
+# Profilers
+#
+
+class ProfilerNotAvailable(Exception):
+    """
+    The requested profiler cannot be used in this Python.
+    """
+
+
+class CProfileProfiler(object):
+    """
+    A deterministic profiler that records every function call. Profiles can
+    be read with the C{pstats} module.
+    """
+
+    extension = '.prof'
+
+    def start(self):
+        """
+        Start recording the function calls of the current thread.
+        """
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def stop(self):
+        """
+        Stop recording function calls.
+        """
+        self._profile.disable()
+
+    def dump(self, path):
+        """
+        Write the recorded statistics in the format of C{pstats}.
+
+        @param path: The path of the profile.
+        @type path: str
+        """
+        self._profile.dump_stats(path)
+
+
+class SamplingProfiler(object):
+    """
+    A wall-clock profiler that samples the stack of the profiled thread at a
+    fixed interval, from another thread. It also sees the time spent waiting
+    for the network or the disk.
+
+    Profiles are written in the collapsed stack format used by flame graph
+    tools: one line per distinct stack, with frames separated by semicolons,
+    followed by the number of samples.
+    """
+
+    extension = '.stacks'
+
+    INTERVAL = 0.001
+    """
+    Seconds between two samples.
+    """
+
+    def __init__(self, interval=None):
+        """
+        Initialize the profiler.
+
+        @param interval: Seconds between two samples, by default
+            C{INTERVAL}.
+        @type interval: float
+        """
+        self._interval = interval or self.INTERVAL
+
+    def start(self):
+        """
+        Start sampling the stack of the current thread.
+        """
+        self._thread_id = thread.get_ident()
+        self._samples = {}
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(
+            target=self._sample, name='soledad-profile-sampler')
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    def _sample(self):
+        while not self._stopped.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%d:%s' % (
+                    os.path.basename(code.co_filename), code.co_firstlineno,
+                    code.co_name))
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            self._samples[key] = self._samples.get(key, 0) + 1
+
+    def stop(self):
+        """
+        Stop sampling, once the sampling thread is done.
+        """
+        self._stopped.set()
+        self._sampler.join()
+
+    def dump(self, path):
+        """
+        Write the number of samples of each distinct stack.
+
+        @param path: The path of the profile.
+        @type path: str
+        """
+        with open(path, 'w') as f:
+            for stack, count in sorted(self._samples.items()):
+                f.write('%s %d\n' % (stack, count))
+
+
+class TracemallocProfiler(object):
+    """
+    A memory profiler that records where the memory allocated during the
+    invocation was allocated, and the peak of traced memory.
+
+    It needs the C{tracemalloc} module, which Python 2 only has with the
+    pytracemalloc backport.
+    """
+
+    extension = '.tracemalloc'
+
+    FRAMES = 10
+    """
+    How many frames of each allocation's traceback are stored.
+    """
+
+    TOP = 50
+    """
+    How many allocation sites are written to the profile.
+    """
+
+    def __init__(self):
+        """
+        Initialize the profiler.
+
+        @raise ProfilerNotAvailable: If there is no C{tracemalloc} module.
+        """
+        try:
+            import tracemalloc
+        except ImportError:
+            raise ProfilerNotAvailable(
+                'The tracemalloc module is not available.')
+        self._tracemalloc = tracemalloc
+
+    def start(self):
+        """
+        Start tracing memory allocations, unless they are already traced,
+        and take a snapshot of the traced memory.
+        """
+        tracemalloc = self._tracemalloc
+        self._started = not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start(self.FRAMES)
+        self._before = tracemalloc.take_snapshot()
+
+    def stop(self):
+        """
+        Take a snapshot of the traced memory and record its peak, and stop
+        tracing memory allocations if C{start} started it.
+        """
+        tracemalloc = self._tracemalloc
+        self._after = tracemalloc.take_snapshot()
+        self._peak = tracemalloc.get_traced_memory()[1]
+        if self._started:
+            tracemalloc.stop()
+
+    def dump(self, path):
+        """
+        Write the peak of traced memory and the C{TOP} allocation sites that
+        grew the most between the two snapshots.
+
+        @param path: The path of the profile.
+        @type path: str
+        """
+        stats = self._after.compare_to(self._before, 'lineno')
+        with open(path, 'w') as f:
+            f.write('peak traced memory: %d bytes\n' % self._peak)
+            for stat in stats[:self.TOP]:
+                f.write('%s\n' % stat)
+
+
+PROFILERS = {
+    'cprofile': CProfileProfiler,
+    'sampling': SamplingProfiler,
+    'tracemalloc': TracemallocProfiler,
+}
+"""
+The available profilers, by name.
+"""
+
+
+#
+# Sync memory profiling
+#
+
+class SyncMemoryProfile(object):
+    """
+    Track the peak of traced memory in each phase of a sync, and where the
+    memory alive when the most memory was in use was allocated.
+
+    Memory is measured in bytes above the traced memory when the sync
+    started. The peak of each phase is exact when C{tracemalloc} can reset
+    its peak (C{tracemalloc.reset_peak}). Otherwise only the phases where the
+    sync reached a new peak get it exactly, and the other phases get the
+    memory in use when they started or finished.
+
+    Allocation sites can only be looked up for the memory alive at a given
+    time, not at the peak itself. They are looked up when phases start and
+    finish, and from inside the phases, at the points where the sync holds
+    the most memory, see C{sample}. Short-lived allocations freed between
+    two of these points, e.g. inside a single call to decrypt a document,
+    count in the peak but do not show in C{top}.
+
+    It needs the C{tracemalloc} module, which Python 2 only has with the
+    pytracemalloc backport.
+    """
+
+    FRAMES = 10
+    """
+    How many frames of each allocation's traceback are stored.
+    """
+
+    TOP = 10
+    """
+    How many allocation sites are reported.
+    """
+
+    SNAPSHOT_MIN_BYTES = 1024 * 1024
+    SNAPSHOT_GROWTH = 1.25
+    """
+    Allocation sites are looked up, which is expensive, when the peak first
+    reaches C{SNAPSHOT_MIN_BYTES} and then whenever it grows by
+    C{SNAPSHOT_GROWTH}.
+    """
+
+    OTHER = 'other'
+    """
+    The name under which memory allocated outside of any phase is recorded.
+    """
+
+    def __init__(self):
+        try:
+            import tracemalloc
+        except ImportError:
+            raise ProfilerNotAvailable(
+                'The tracemalloc module is not available.')
+        self._tracemalloc = tracemalloc
+        self._started = False
+        self._stack = []
+        self.peak = 0
+        self.peak_phase = None
+        self.phases = {}
+        self.top = []
+        self._baseline = None
+
+    def start(self):
+        """
+        Start tracing memory, if it is not traced yet.
+        """
+        tracemalloc = self._tracemalloc
+        self._started = not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start(self.FRAMES)
+        self._base = tracemalloc.get_traced_memory()[0]
+        self._reset_peak()
+        self._baseline = tracemalloc.take_snapshot()
+        self._snapshot_peak = 0
+
+    def _reset_peak(self):
+        reset_peak = getattr(self._tracemalloc, 'reset_peak', None)
+        if reset_peak is not None:
+            reset_peak()
+        self._last_peak = self._tracemalloc.get_traced_memory()[1]
+
+    def _check(self, name):
+        """
+        Attribute the memory used since the last check to phase C{name}.
+        """
+        current, peak = self._tracemalloc.get_traced_memory()
+        used = current - self._base
+        if peak > self._last_peak:
+            # the highest peak since the last check was reached in this
+            # phase.
+            used = max(used, peak - self._base)
+        self.phases[name] = max(self.phases.get(name, 0), used)
+        if used > self.peak:
+            self.peak = used
+            self.peak_phase = name
+        self._snapshot(current - self._base)
+        self._reset_peak()
+
+    def sample(self):
+        """
+        Look up where the memory in use now was allocated, if more memory is
+        in use than at any earlier look up.
+
+        This is called from inside the phases, while they hold the data
+        they allocated, such as the ciphertext of a document and the lines
+        of the sync stream, which they free before they finish.
+        """
+        if self._baseline is None:
+            return
+        current = self._tracemalloc.get_traced_memory()[0]
+        self._snapshot(current - self._base)
+
+    def _snapshot(self, used):
+        """
+        Look up the allocation sites of the C{used} memory alive now, if it
+        grew enough since the last look up.
+        """
+        threshold = max(
+            self.SNAPSHOT_MIN_BYTES,
+            self._snapshot_peak * self.SNAPSHOT_GROWTH)
+        if used < threshold:
+            return
+        self._snapshot_peak = used
+        snapshot = self._tracemalloc.take_snapshot()
+        self.top = [
+            str(stat) for stat in
+            snapshot.compare_to(self._baseline, 'lineno')[:self.TOP]]
+
+    def enter(self, name):
+        """
+        Record the start of a phase.
+
+        @param name: The name of the phase.
+        @type name: str
+        """
+        self._check(self._stack[-1] if self._stack else self.OTHER)
+        self._stack.append(name)
+
+    def exit(self, name):
+        """
+        Record the end of a phase.
+
+        @param name: The name of the phase.
+        @type name: str
+        """
+        self._check(name)
+        self._stack.pop()
+
+    def stop(self):
+        """
+        Stop tracing memory, if it was started by C{start}.
+        """
+        self._check(self.OTHER)
+        self._baseline = None
+        if self._started:
+            self._tracemalloc.stop()
+
+    def as_dict(self):
+        """
+        Return the profile as a dictionary that can be serialized to JSON.
+
+        @return: The 'peak' memory in bytes, the 'peak_phase' it was reached
+            in, the peak of each of the 'phases' and the 'top' allocation
+            sites of the memory alive when the most memory was seen in use,
+            which may be less than the peak, see the class documentation.
+        @rtype: dict
+        """
+        return {
+            'peak': self.peak,
+            'peak_phase': self.peak_phase,
+            'phases': dict(self.phases),
+            'top': list(self.top),
+        }
+
+
+#
+# Profile output
+#
+
+class ProfileWriter(object):
+    """
+    Write profiles to a directory, deleting the oldest ones when the
+    directory grows beyond a maximum size.
+    """
+
+    MAX_BYTES = 50 * 1024 * 1024
+    """
+    The default maximum size of the profile directory.
+    """
+
+    def __init__(self, directory, max_bytes=None):
+        """
+        Initialize the writer, creating the directory if needed.
+
+        @param directory: Where to write profiles.
+        @type directory: str
+        @param max_bytes: The maximum total size of the profiles in the
+            directory.
+        @type max_bytes: int
+        """
+        self._directory = directory
+        self._max_bytes = max_bytes or self.MAX_BYTES
+        self._lock = threading.Lock()
+        self._counter = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def write(self, name, profiler):
+        """
+        Write the profile of one invocation.
+
+        @param name: The name of the profiled entry point.
+        @type name: str
+        @param profiler: The profiler that profiled the invocation.
+
+        @return: The path of the profile.
+        @rtype: str
+        """
+        with self._lock:
+            self._counter += 1
+            counter = self._counter
+        path = os.path.join(
+            self._directory, '%s-%d-%06d-%s%s' % (
+                time.strftime('%Y%m%d%H%M%S'), os.getpid(), counter, name,
+                profiler.extension))
+        profiler.dump(path)
+        self._rotate()
+        return path
+
+    def _rotate(self):
+        """
+        Delete the oldest profiles until the directory fits in the maximum
+        size.
+        """
+        with self._lock:
+            profiles = []
+            for filename in os.listdir(self._directory):
+                path = os.path.join(self._directory, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                profiles.append((st.st_mtime, filename, st.st_size))
+            profiles.sort()
+            total = sum(size for _, _, size in profiles)
+            # always keep the latest profile, even if it is too big.
+            for _, filename, size in profiles[:-1]:
+                if total <= self._max_bytes:
+                    break
+                try:
+                    os.unlink(os.path.join(self._directory, filename))
+                except OSError:
+                    continue
+                total -= size
+
+
+#
+# Entry points
+#
+
+def _entry_points():
+    """
+    Return the profiled entry points, as (name, owner, attribute) tuples.
+    """
+    from leap.soledad import Soledad, target
+    return [
+        ('sync', Soledad, 'sync'),
+        ('bootstrap', Soledad, '_bootstrap'),
+        ('get_from_index', Soledad, 'get_from_index'),
+        ('get_range_from_index', Soledad, 'get_range_from_index'),
+        ('sync_exchange', target.SoledadSyncTarget, 'sync_exchange'),
+        # syncs encrypt documents and deltas without calling encrypt_doc.
+        ('encrypt_doc', target, '_encrypt_doc_envelope'),
+        ('encrypt_delta', target, '_encrypt_delta_envelope'),
+        ('decrypt_doc', target, 'decrypt_doc'),
+    ]
+
+
+_local = threading.local()
+
+_lock = threading.Lock()
+
+_originals = []
+"""
+The (owner, attribute, original value) of the wrapped entry points.
+"""
+
+
+def _wrap(name, func, profiler_factory, writer):
+    """
+    Return a function that profiles each call to C{func}.
+
+    Calls made while another entry point is profiled in the same thread are
+    part of that profile, and are not profiled on their own.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, 'profiling', False):
+            return func(*args, **kwargs)
+        profiler = profiler_factory()
+        _local.profiling = True
+        profiler.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.stop()
+            _local.profiling = False
+            try:
+                writer.write(name, profiler)
+            except (IOError, OSError), e:
+                logger.warning('Could not write profile: %s' % str(e))
+    return wrapper
+
+
+def enable_profiling(directory, profiler='cprofile', max_bytes=None):
+    """
+    Start profiling each invocation of Soledad's entry points.
+
+    @param directory: Where to write profiles.
+    @type directory: str
+    @param profiler: The name of the profiler to use, see C{PROFILERS}.
+    @type profiler: str
+    @param max_bytes: The maximum total size of the profiles in the
+        directory. The oldest profiles are deleted to stay below it.
+    @type max_bytes: int
+
+    @raise ValueError: If the profiler is unknown.
+    @raise ProfilerNotAvailable: If the profiler cannot be used.
+    """
+    if profiler not in PROFILERS:
+        raise ValueError('Unknown profiler: %s' % profiler)
+    profiler_factory = PROFILERS[profiler]
+    profiler_factory()  # fail now if the profiler is not available.
+    writer = ProfileWriter(directory, max_bytes=max_bytes)
+    with _lock:
+        _disable()
+        for name, owner, attribute in _entry_points():
+            # take the attribute from the owner's own dictionary, so that
+            # staticmethods and friends are restored as they were.
+            original = owner.__dict__[attribute]
+            _originals.append((owner, attribute, original))
+            setattr(owner, attribute, _wrap(
+                name, getattr(owner, attribute), profiler_factory, writer))
+    logger.info('Profiling Soledad with %s into %s.' % (profiler, directory))
+
+
+def _disable():
+    """
+    Put the original entry points back. Must be called with the lock held.
+    """
+    while _originals:
+        owner, attribute, original = _originals.pop()
+        setattr(owner, attribute, original)
+
+
+def disable_profiling():
+    """
+    Stop profiling Soledad's entry points.
+    """
+    with _lock:
+        _disable()
+
+
+def profiling_enabled():
+    """
+    Return whether Soledad's entry points are being profiled.
+
+    @rtype: bool
+    """
+    return bool(_originals)
+
+
+@contextmanager
+def profiling(directory, profiler='cprofile', max_bytes=None):
+    """
+    Profile Soledad's entry points while the wrapped block runs.
+
+    See C{enable_profiling} for the parameters.
+    """
+    enable_profiling(directory, profiler=profiler, max_bytes=max_bytes)
+    try:
+        yield
+    finally:
+        disable_profiling()
+
+
+def enable_from_environment(environ=os.environ):
+    """
+    Enable profiling if the SOLEDAD_PROFILE environment variable names a
+    profiler.
+
+    @param environ: The environment.
+    @type environ: dict
+    """
+    profiler = environ.get('SOLEDAD_PROFILE')
+    if not profiler:
+        return
+    directory = environ.get(
+        'SOLEDAD_PROFILE_DIR',
+        os.path.join(os.path.expanduser('~'), '.soledad-profiles'))
+    max_bytes = environ.get('SOLEDAD_PROFILE_MAX_BYTES')
+    try:
+        enable_profiling(
+            directory, profiler=profiler,
+            max_bytes=int(max_bytes) if max_bytes else None)
+    except (ValueError, ProfilerNotAvailable, OSError), e:
+        logger.warning('Could not enable profiling: %s' % str(e))
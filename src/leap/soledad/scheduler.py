@@ -0,0 +1,704 @@
+# -*- coding: utf-8 -*-
+# scheduler.py
+# Copyright (C) 2013 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Background schedulers that decide when to sync.
+"""
+
+import time
+import logging
+import threading
+
+
+logger = logging.getLogger(name=__name__)
+
+
+class SyncSchedule(object):
+    """
+    The timing and statistics of the syncs of one replica.
+
+    A sync is due when local changes stopped arriving for C{debounce}
+    seconds (or C{max_debounce} seconds after the first one), or when the
+    next poll of the server is due. The poll interval doubles after each
+    sync that transferred no documents or failed, up to C{max_poll_interval},
+    and goes back to C{min_poll_interval} when documents are transferred.
+
+    Schedules are not thread safe: schedulers use them with their lock held.
+    """
+
+    def __init__(self, debounce, max_debounce, min_poll_interval,
+                 max_poll_interval):
+        """
+        Initialize the schedule. The first poll is due right away.
+
+        @param debounce: Seconds without local changes to wait before syncing
+            them.
+        @type debounce: float
+        @param max_debounce: Maximum seconds to wait between a local change
+            and the sync that sends it.
+        @type max_debounce: float
+        @param min_poll_interval: Seconds between two polls of the server
+            after documents were transferred.
+        @type min_poll_interval: float
+        @param max_poll_interval: Maximum seconds between two polls of the
+            server.
+        @type max_poll_interval: float
+        """
+        self._debounce = debounce
+        self._max_debounce = max_debounce
+        self._min_poll_interval = min_poll_interval
+        self._max_poll_interval = max_poll_interval
+        self.first_change = None
+        self.last_change = None
+        self.interval = min_poll_interval
+        self.next_poll = time.time()
+        self.paused = False
+        self.running = False
+        self.last_started = None
+        self._stats = {
+            'syncs': 0,
+            'failures': 0,
+            'docs_sent': 0,
+            'docs_received': 0,
+            'last_duration': None,
+            'total_duration': 0.0,
+            'last_sync': None,
+        }
+
+    def notify_local_change(self):
+        """
+        Record a change in the local database.
+        """
+        now = time.time()
+        if self.first_change is None:
+            self.first_change = now
+        self.last_change = now
+
+    def next_due(self):
+        """
+        Return the time the next sync is due.
+        """
+        due = self.next_poll
+        if self.last_change is not None:
+            due = min(
+                due,
+                self.last_change + self._debounce,
+                self.first_change + self._max_debounce)
+        return due
+
+    def sync_started(self):
+        """
+        Record that a sync started. It sends all local changes recorded so
+        far.
+        """
+        self.first_change = self.last_change = None
+        self.running = True
+        self.last_started = time.time()
+
+    def sync_finished(self, result, elapsed):
+        """
+        Record the outcome of a sync and schedule the next poll.
+
+        @param result: The number of documents 'sent' and 'received', or
+            None if the sync failed.
+        @type result: dict
+        @param elapsed: The seconds the sync took.
+        @type elapsed: float
+        """
+        self.running = False
+        transferred = False
+        if result is None:
+            self._stats['failures'] += 1
+        else:
+            sent = result.get('sent', 0)
+            received = result.get('received', 0)
+            transferred = bool(sent or received)
+            self._stats['syncs'] += 1
+            self._stats['docs_sent'] += sent
+            self._stats['docs_received'] += received
+            self._stats['last_duration'] = elapsed
+            self._stats['total_duration'] += elapsed
+            self._stats['last_sync'] = time.time()
+        if transferred:
+            self.interval = self._min_poll_interval
+        else:
+            # nothing happened, so be gentler with the server.
+            self.interval = min(self.interval * 2, self._max_poll_interval)
+        self.next_poll = time.time() + self.interval
+
+    def stats(self):
+        """
+        Return statistics about the syncs run on this schedule.
+
+        @return: A dictionary with the number of syncs and failures, the
+            number of documents sent and received, the duration of the last
+            sync and the total and average durations, the time the last sync
+            finished, the current poll interval and whether the schedule is
+            paused.
+        @rtype: dict
+        """
+        stats = dict(self._stats)
+        stats['average_duration'] = (
+            stats['total_duration'] / stats['syncs']
+            if stats['syncs'] else None)
+        stats['poll_interval'] = self.interval
+        stats['paused'] = self.paused
+        return stats
+
+
+def _run_sync(sync_func):
+    """
+    Run one sync, logging its failure.
+
+    @param sync_func: The function that runs the sync.
+    @type sync_func: callable
+
+    @return: The result of the sync, or None if it failed, and the seconds
+        it took.
+    @rtype: tuple
+    """
+    start = time.time()
+    try:
+        result = sync_func() or {}
+    except Exception, e:
+        logger.warning('Scheduled sync failed: %s' % str(e))
+        result = None
+    return result, time.time() - start
+
+
+class SyncScheduler(object):
+    """
+    Run syncs in a background thread.
+
+    A sync is triggered when local changes are reported, once they stop
+    arriving for C{debounce} seconds (or at most C{max_debounce} seconds
+    after the first one). When there are no local changes, the scheduler
+    polls the server by syncing every C{min_poll_interval} seconds, and
+    doubles that interval after each sync that transferred no documents or
+    failed, up to C{max_poll_interval}. Syncs are run one at a time.
+    """
+
+    DEBOUNCE = 2.0
+    """
+    Seconds without local changes to wait before syncing them.
+    """
+
+    MAX_DEBOUNCE = 30.0
+    """
+    Maximum seconds to wait between a local change and the sync that sends it.
+    """
+
+    MIN_POLL_INTERVAL = 60.0
+    """
+    Seconds between two polls of the server after documents were transferred.
+    """
+
+    MAX_POLL_INTERVAL = 3600.0
+    """
+    Maximum seconds between two polls of the server.
+    """
+
+    def __init__(self, sync_func, debounce=None, max_debounce=None,
+                 min_poll_interval=None, max_poll_interval=None):
+        """
+        Initialize the scheduler.
+
+        @param sync_func: A function that runs one sync. It is called with
+            no arguments from the scheduler thread and should return a
+            dictionary with the number of documents 'sent' and 'received'.
+        @type sync_func: callable
+        @param debounce: Seconds without local changes to wait before syncing
+            them.
+        @type debounce: float
+        @param max_debounce: Maximum seconds to wait between a local change
+            and the sync that sends it.
+        @type max_debounce: float
+        @param min_poll_interval: Seconds between two polls of the server
+            after documents were transferred.
+        @type min_poll_interval: float
+        @param max_poll_interval: Maximum seconds between two polls of the
+            server.
+        @type max_poll_interval: float
+        """
+        self._sync_func = sync_func
+        self._schedule = SyncSchedule(
+            debounce or self.DEBOUNCE,
+            max_debounce or self.MAX_DEBOUNCE,
+            min_poll_interval or self.MIN_POLL_INTERVAL,
+            max_poll_interval or self.MAX_POLL_INTERVAL)
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    #
+    # Control
+    #
+
+    def start(self):
+        """
+        Start the scheduler thread. The first poll happens right away.
+        """
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._schedule.next_poll = time.time()
+            self._thread = threading.Thread(
+                target=self._run, name='soledad-sync-scheduler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop the scheduler thread.
+
+        A sync that is already running is not interrupted.
+
+        @param timeout: Seconds to wait for the thread to finish, or None to
+            return without waiting.
+        @type timeout: float
+        """
+        with self._cond:
+            self._stopped = True
+            thread, self._thread = self._thread, None
+            self._cond.notify_all()
+        if thread is not None and timeout is not None:
+            thread.join(timeout)
+
+    def pause(self):
+        """
+        Stop triggering syncs until C{resume} is called. Local changes
+        reported meanwhile are synced after resuming.
+        """
+        with self._cond:
+            self._schedule.paused = True
+            self._cond.notify_all()
+
+    def resume(self):
+        """
+        Resume triggering syncs.
+        """
+        with self._cond:
+            self._schedule.paused = False
+            self._cond.notify_all()
+
+    def notify_local_change(self):
+        """
+        Report that the local database has changed, so that a sync is
+        scheduled after the debounce delay.
+        """
+        with self._cond:
+            self._schedule.notify_local_change()
+            self._cond.notify_all()
+
+    def sync_now(self):
+        """
+        Trigger a sync as soon as possible, unless the scheduler is paused.
+        """
+        with self._cond:
+            self._schedule.next_poll = time.time()
+            self._cond.notify_all()
+
+    #
+    # Status
+    #
+
+    def _get_paused(self):
+        return self._schedule.paused
+
+    paused = property(_get_paused, doc='Whether the scheduler is paused.')
+
+    def _get_running(self):
+        return self._schedule.running
+
+    running = property(_get_running, doc='Whether a sync is running now.')
+
+    def stats(self):
+        """
+        Return statistics about the syncs run by this scheduler.
+
+        @return: See C{SyncSchedule.stats}.
+        @rtype: dict
+        """
+        with self._cond:
+            return self._schedule.stats()
+
+    #
+    # Scheduler thread
+    #
+
+    def _run(self):
+        """
+        Wait for the next sync to be due and run it, until stopped.
+        """
+        schedule = self._schedule
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    delay = None
+                    if not schedule.paused:
+                        delay = schedule.next_due() - time.time()
+                        if delay <= 0:
+                            break
+                    self._cond.wait(delay)
+                schedule.sync_started()
+            result, elapsed = (None, 0.0)
+            try:
+                result, elapsed = _run_sync(self._sync_func)
+            finally:
+                with self._cond:
+                    schedule.sync_finished(result, elapsed)
+
+
+class SharedSyncScheduler(object):
+    """
+    Run the syncs of many replicas with a bounded pool of worker threads.
+
+    Each replica has its own L{SyncSchedule}. When more syncs are due than
+    there are workers, the replica whose last sync started longest ago goes
+    first, so a busy replica cannot starve the others. A replica is never
+    synced by two workers at once.
+    """
+
+    WORKERS = 4
+    """
+    The number of syncs that may run at the same time.
+    """
+
+    def __init__(self, workers=None, debounce=None, max_debounce=None,
+                 min_poll_interval=None, max_poll_interval=None):
+        """
+        Initialize the scheduler.
+
+        @param workers: The number of syncs that may run at the same time.
+        @type workers: int
+        @param debounce: The default for C{SyncSchedule}'s debounce.
+        @type debounce: float
+        @param max_debounce: The default for C{SyncSchedule}'s max_debounce.
+        @type max_debounce: float
+        @param min_poll_interval: The default for C{SyncSchedule}'s
+            min_poll_interval.
+        @type min_poll_interval: float
+        @param max_poll_interval: The default for C{SyncSchedule}'s
+            max_poll_interval.
+        @type max_poll_interval: float
+        """
+        self._workers = workers or self.WORKERS
+        self._defaults = (
+            debounce or SyncScheduler.DEBOUNCE,
+            max_debounce or SyncScheduler.MAX_DEBOUNCE,
+            min_poll_interval or SyncScheduler.MIN_POLL_INTERVAL,
+            max_poll_interval or SyncScheduler.MAX_POLL_INTERVAL)
+        self._cond = threading.Condition()
+        self._replicas = {}
+        self._threads = []
+        self._stopped = False
+        self._paused = False
+
+    #
+    # Control
+    #
+
+    def start(self):
+        """
+        Start the worker threads.
+        """
+        with self._cond:
+            if self._threads:
+                return
+            self._stopped = False
+            for i in range(self._workers):
+                thread = threading.Thread(
+                    target=self._run, name='soledad-sync-worker-%d' % i)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """
+        Stop the worker threads. Running syncs are not interrupted.
+
+        @param timeout: Seconds to wait for each thread to finish, or None to
+            return without waiting.
+        @type timeout: float
+        """
+        with self._cond:
+            self._stopped = True
+            threads, self._threads = self._threads, []
+            self._cond.notify_all()
+        if timeout is not None:
+            for thread in threads:
+                thread.join(timeout)
+
+    def add(self, key, sync_func, debounce=None, max_debounce=None,
+            min_poll_interval=None, max_poll_interval=None):
+        """
+        Start scheduling the syncs of a replica. Its first poll is due right
+        away.
+
+        @param key: A name for the replica, unique in this scheduler.
+        @type key: str
+        @param sync_func: A function that runs one sync of the replica, as
+            for C{SyncScheduler}.
+        @type sync_func: callable
+
+        The other parameters override the scheduler defaults for this
+        replica.
+
+        @return: An object with the interface of C{SyncScheduler} that
+            controls the syncs of this replica only.
+        @rtype: ScheduledReplica
+        """
+        params = [
+            given or default for given, default in zip(
+                (debounce, max_debounce, min_poll_interval,
+                 max_poll_interval),
+                self._defaults)]
+        with self._cond:
+            if key in self._replicas:
+                raise ValueError('Replica %s is already scheduled.' % key)
+            self._replicas[key] = (SyncSchedule(*params), sync_func)
+            self._cond.notify_all()
+        return ScheduledReplica(self, key)
+
+    def remove(self, key):
+        """
+        Stop scheduling the syncs of a replica. A sync that is already
+        running is not interrupted.
+
+        @param key: The name of the replica.
+        @type key: str
+        """
+        with self._cond:
+            self._replicas.pop(key, None)
+
+    def pause(self, key=None):
+        """
+        Stop triggering syncs of a replica, or of all replicas if C{key} is
+        None, until C{resume} is called.
+
+        @param key: The name of the replica.
+        @type key: str
+        """
+        with self._cond:
+            if key is None:
+                self._paused = True
+            else:
+                self._replicas[key][0].paused = True
+            self._cond.notify_all()
+
+    def resume(self, key=None):
+        """
+        Resume triggering syncs of a replica, or of all replicas if C{key} is
+        None.
+
+        @param key: The name of the replica.
+        @type key: str
+        """
+        with self._cond:
+            if key is None:
+                self._paused = False
+            else:
+                self._replicas[key][0].paused = False
+            self._cond.notify_all()
+
+    def notify_local_change(self, key):
+        """
+        Report that the local database of a replica has changed.
+
+        @param key: The name of the replica.
+        @type key: str
+        """
+        with self._cond:
+            self._replicas[key][0].notify_local_change()
+            self._cond.notify_all()
+
+    def sync_now(self, key):
+        """
+        Trigger a sync of a replica as soon as a worker is free.
+
+        @param key: The name of the replica.
+        @type key: str
+        """
+        with self._cond:
+            self._replicas[key][0].next_poll = time.time()
+            self._cond.notify_all()
+
+    #
+    # Status
+    #
+
+    def _get_paused(self):
+        return self._paused
+
+    paused = property(
+        _get_paused, doc='Whether the syncs of all replicas are paused.')
+
+    def is_running(self, key):
+        """
+        Return whether a sync of a replica is running now.
+
+        @param key: The name of the replica.
+        @type key: str
+        """
+        with self._cond:
+            return self._replicas[key][0].running
+
+    def stats(self, key=None):
+        """
+        Return statistics about the syncs run by this scheduler.
+
+        @param key: The name of a replica, or None for all replicas.
+        @type key: str
+
+        @return: The statistics of the replica, as described in
+            C{SyncSchedule.stats}, or for all replicas the totals of syncs,
+            failures and documents, the number of 'replicas' and of syncs
+            'running', and whether the scheduler is 'paused'.
+        @rtype: dict
+        """
+        with self._cond:
+            if key is not None:
+                return self._replicas[key][0].stats()
+            totals = {
+                'syncs': 0,
+                'failures': 0,
+                'docs_sent': 0,
+                'docs_received': 0,
+                'replicas': len(self._replicas),
+                'running': 0,
+                'paused': self._paused,
+            }
+            for schedule, _ in self._replicas.values():
+                stats = schedule.stats()
+                for name in ('syncs', 'failures', 'docs_sent',
+                             'docs_received'):
+                    totals[name] += stats[name]
+                totals['running'] += int(schedule.running)
+            return totals
+
+    #
+    # Worker threads
+    #
+
+    def _next_job(self):
+        """
+        Choose the next replica to sync. Must be called with the lock held.
+
+        @return: The (schedule, sync function) of the replica to sync, or
+            None, and the seconds until the next sync is due, or None.
+        @rtype: tuple
+        """
+        now = time.time()
+        job = None
+        job_order = None
+        next_due = None
+        for schedule, sync_func in self._replicas.itervalues():
+            if schedule.running or schedule.paused:
+                continue
+            due = schedule.next_due()
+            if due > now:
+                if next_due is None or due < next_due:
+                    next_due = due
+                continue
+            # the replica that waited longest since its last sync goes first.
+            order = (schedule.last_started or 0, due)
+            if job_order is None or order < job_order:
+                job, job_order = (schedule, sync_func), order
+        return job, None if next_due is None else next_due - now
+
+    def _run(self):
+        """
+        Run due syncs one after the other, until stopped.
+        """
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    delay = None
+                    if not self._paused:
+                        job, delay = self._next_job()
+                        if job is not None:
+                            break
+                    self._cond.wait(delay)
+                schedule, sync_func = job
+                schedule.sync_started()
+            result, elapsed = (None, 0.0)
+            try:
+                result, elapsed = _run_sync(sync_func)
+            finally:
+                with self._cond:
+                    schedule.sync_finished(result, elapsed)
+                    self._cond.notify_all()
+
+
+class ScheduledReplica(object):
+    """
+    The syncs of one replica in a L{SharedSyncScheduler}, with the same
+    interface as L{SyncScheduler}.
+    """
+
+    def __init__(self, scheduler, key):
+        """
+        Initialize the replica handle.
+
+        @param scheduler: The scheduler that runs the syncs.
+        @type scheduler: SharedSyncScheduler
+        @param key: The name of the replica in the scheduler.
+        @type key: str
+        """
+        self._scheduler = scheduler
+        self._key = key
+
+    def stop(self, timeout=None):
+        """
+        Stop scheduling the syncs of this replica. The scheduler keeps
+        running for the other replicas.
+
+        @param timeout: Ignored, the worker threads are shared.
+        @type timeout: float
+        """
+        self._scheduler.remove(self._key)
+
+    def pause(self):
+        self._scheduler.pause(self._key)
+
+    def resume(self):
+        self._scheduler.resume(self._key)
+
+    def notify_local_change(self):
+        self._scheduler.notify_local_change(self._key)
+
+    def sync_now(self):
+        self._scheduler.sync_now(self._key)
+
+    def _get_paused(self):
+        return self._scheduler.stats(self._key)['paused']
+
+    paused = property(_get_paused, doc='Whether the replica is paused.')
+
+    def _get_running(self):
+        return self._scheduler.is_running(self._key)
+
+    running = property(_get_running, doc='Whether a sync is running now.')
+
+    def stats(self):
+        return self._scheduler.stats(self._key)
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# scope.py
+# Copyright (C) 2013 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Sync scopes, which restrict the documents a replica syncs.
+"""
+
+import itertools
+import simplejson as json
+
+
+from u1db.query_parser import Parser
+
+
+def _index_value(value):
+    """
+    Return a value of an index key as SQLite stores it in the text column
+    of an u1db index, so keys are matched as C{get_from_index} matches them.
+
+    @param value: A value extracted from the content of a document.
+    @type value: basestring, int, float or bool
+
+    @rtype: unicode
+    """
+    if isinstance(value, basestring):
+        return value
+    if isinstance(value, bool):
+        # booleans are bound as integers.
+        value = int(value)
+    return unicode(value)
+
+
+class SyncScope(object):
+    """
+    A filter over the documents a replica uploads and keeps when syncing.
+
+    A document is in scope if any of the following holds:
+
+        * its id starts with one of C{doc_id_prefixes};
+        * its id is one of C{doc_ids};
+        * the keys u1db index expressions C{index_expressions} produce for
+          its content match C{index_values}, or fall between the bounds of
+          C{index_range}.
+
+    Values in C{index_values} and bounds of C{index_range} have one item per
+    index expression. Values ending with '*' match keys by prefix, as in
+    C{get_from_index}, and None bounds are open.
+
+    Deleted documents are always uploaded, and incoming changes to
+    documents the replica already has are always kept, so that the replica
+    stays consistent.
+    """
+
+    def __init__(self, doc_id_prefixes=None, doc_ids=None,
+                 index_expressions=None, index_values=None,
+                 index_range=None):
+        """
+        Initialize the scope.
+
+        @param doc_id_prefixes: Prefixes of the ids of documents in scope.
+        @type doc_id_prefixes: list of str
+        @param doc_ids: Ids of documents in scope.
+        @type doc_ids: list of str
+        @param index_expressions: u1db index expressions, e.g. 'folder' or
+            'number(date, 10)', evaluated over the content of documents.
+        @type index_expressions: list of str
+        @param index_values: The values the keys of documents in scope
+            match.
+        @type index_values: list of str
+        @param index_range: The (start, end) bounds the keys of documents in
+            scope fall between, both inclusive.
+        @type index_range: (list of str, list of str)
+
+        @raise ValueError: If the index values or bounds do not have one item
+            per index expression.
+        """
+        self.doc_id_prefixes = tuple(doc_id_prefixes or ())
+        self.doc_ids = frozenset(doc_ids or ())
+        self.index_expressions = tuple(index_expressions or ())
+        self.index_values = \
+            tuple(index_values) if index_values is not None else None
+        self.index_range = None
+        if index_range is not None:
+            start, end = index_range
+            self.index_range = (
+                tuple(start) if start is not None else None,
+                tuple(end) if end is not None else None)
+        self._getters = None
+        if self.index_expressions:
+            if self.index_values is None and self.index_range is None:
+                raise ValueError('Index expressions need values or a range.')
+            for values in (self.index_values,) + (self.index_range or ()):
+                if values is not None \
+                        and len(values) != len(self.index_expressions):
+                    raise ValueError(
+                        'Need one value per index expression.')
+            self._getters = Parser().parse_all(self.index_expressions)
+
+    def _get_has_index(self):
+        return self._getters is not None
+
+    has_index = property(
+        _get_has_index,
+        doc='Whether documents in scope are selected by their content.')
+
+    def includes_id(self, doc_id):
+        """
+        Return whether a document is in scope because of its id.
+
+        @param doc_id: The id of the document.
+        @type doc_id: str
+
+        @rtype: bool
+        """
+        return doc_id in self.doc_ids \
+            or any(doc_id.startswith(prefix)
+                   for prefix in self.doc_id_prefixes)
+
+    def includes(self, doc):
+        """
+        Return whether a document is in scope.
+
+        Deleted documents are in scope only if their id is.
+
+        @param doc: The document.
+        @type doc: u1db.Document
+
+        @rtype: bool
+        """
+        if self.includes_id(doc.doc_id):
+            return True
+        if not self.has_index or doc.is_tombstone():
+            return False
+        return any(self._matches(key) for key in self._keys(doc.content))
+
+    def _keys(self, content):
+        """
+        Return the index keys of a document's content, as u1db computes them.
+        """
+        values = []
+        for getter in self._getters:
+            value = getter.get(content)
+            if not value:
+                return []
+            values.append([_index_value(item) for item in value])
+        return itertools.product(*values)
+
+    def _matches(self, key):
+        """
+        Return whether an index key matches C{index_values} or falls within
+        C{index_range}.
+        """
+        if self.index_values is not None:
+            matched = True
+            for item, value in zip(key, self.index_values):
+                if value.endswith('*'):
+                    if not item.startswith(value[:-1]):
+                        matched = False
+                        break
+                elif item != value:
+                    matched = False
+                    break
+            if matched:
+                return True
+        if self.index_range is not None:
+            start, end = self.index_range
+            if (start is None or key >= start) and (end is None or key <= end):
+                return True
+        return False
+
+    def as_dict(self):
+        """
+        Return the scope as a dictionary that can be serialized to JSON.
+
+        @rtype: dict
+        """
+        return {
+            'doc_id_prefixes': list(self.doc_id_prefixes),
+            'doc_ids': sorted(self.doc_ids),
+            'index_expressions': list(self.index_expressions),
+            'index_values': list(self.index_values)
+            if self.index_values is not None else None,
+            'index_range': [
+                list(bound) if bound is not None else None
+                for bound in self.index_range]
+            if self.index_range is not None else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Build a scope from a dictionary returned by C{as_dict}.
+
+        @param data: The dictionary.
+        @type data: dict
+
+        @rtype: SyncScope
+        """
+        return cls(**dict((str(key), value) for key, value in data.items()))
+
+    def __eq__(self, other):
+        return isinstance(other, SyncScope) \
+            and self.as_dict() == other.as_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'SyncScope(%s)' % json.dumps(self.as_dict(), sort_keys=True)
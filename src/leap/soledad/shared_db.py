@@ -27,6 +27,7 @@ from u1db.remote import http_database
 
 
 from leap.soledad.auth import TokenBasedAuth
+from leap.soledad.connection import PooledConnection
 
 
 #-----------------------------------------------------------------------------
@@ -45,7 +46,8 @@ class Unauthorized(Exception):
     """
 
 
-class SoledadSharedDatabase(http_database.HTTPDatabase, TokenBasedAuth):
+class SoledadSharedDatabase(PooledConnection, http_database.HTTPDatabase,
+                            TokenBasedAuth):
     """
     This is a shared recovery database that enables users to store their
     encryption secrets in the server and retrieve them afterwards.
@@ -89,7 +91,8 @@ class SoledadSharedDatabase(http_database.HTTPDatabase, TokenBasedAuth):
     #
 
     @staticmethod
-    def open_database(url, create, creds=None):
+    def open_database(url, create, creds=None, cert_file=None,
+                      connection_pool=None):
         # TODO: users should not be able to create the shared database, so we
         # have to remove this from here in the future.
         """
@@ -102,11 +105,17 @@ class SoledadSharedDatabase(http_database.HTTPDatabase, TokenBasedAuth):
         @type create: bool
         @param token: An authentication token for accessing the shared db.
         @type token: str
+        @param cert_file: Path to the certificate used to verify the server.
+        @type cert_file: str
+        @param connection_pool: A pool to take connections from.
+        @type connection_pool: leap.soledad.connection.HTTPConnectionPool
 
         @return: The shared database in the given url.
         @rtype: SoledadSharedDatabase
         """
-        db = SoledadSharedDatabase(url, creds=creds)
+        db = SoledadSharedDatabase(
+            url, creds=creds, cert_file=cert_file,
+            connection_pool=connection_pool)
         db.open(create)
         return db
 
@@ -122,7 +131,8 @@ class SoledadSharedDatabase(http_database.HTTPDatabase, TokenBasedAuth):
         """
         raise Unauthorized("Can't delete shared database.")
 
-    def __init__(self, url, document_factory=None, creds=None):
+    def __init__(self, url, document_factory=None, creds=None,
+                 cert_file=None, connection_pool=None):
         """
         Initialize database with auth token and encryption powers.
 
@@ -133,6 +143,11 @@ class SoledadSharedDatabase(http_database.HTTPDatabase, TokenBasedAuth):
         @param creds: A tuple containing the authentication method and
             credentials.
         @type creds: tuple
+        @param cert_file: Path to the certificate used to verify the server.
+        @type cert_file: str
+        @param connection_pool: A pool to take connections from.
+        @type connection_pool: leap.soledad.connection.HTTPConnectionPool
         """
         http_database.HTTPDatabase.__init__(self, url, document_factory,
                                             creds)
+        self.set_connection_options(cert_file, connection_pool)
@@ -44,23 +44,43 @@ SLCipher 1.1 databases, we do not implement them as all SQLCipher databases
 handled by Soledad should be created by SQLCipher >= 2.0.
 """
 
+import io
 import os
+import array
+import itertools
+import base64
 import time
+import hashlib
 import string
+import logging
+import simplejson as json
 
 
+from contextlib import contextmanager
 from u1db.backends import sqlite_backend
 from pysqlcipher import dbapi2
 from u1db import (
     errors,
 )
 from leap.soledad.document import SoledadDocument
+from leap.soledad.cache import DocumentCache
+from leap.soledad.sqlstats import InstrumentedConnection
+
+
+logger = logging.getLogger(name=__name__)
 
 
 # Monkey-patch u1db.backends.sqlite_backend with pysqlcipher.dbapi2
 sqlite_backend.dbapi2 = dbapi2
 
 
+SQLITE_PLAINTEXT_HEADER = 'SQLite format 3\x00'
+"""
+The first bytes of every unencrypted SQLite database file. SQLCipher
+encrypts the whole first page, so an encrypted file never starts with them.
+"""
+
+
 def open(path, password, create=True, document_factory=None, crypto=None,
          raw_key=False, cipher='aes-256-cbc', kdf_iter=4000,
          cipher_page_size=1024):
@@ -99,266 +119,2685 @@ def open(path, password, create=True, document_factory=None, crypto=None,
         cipher_page_size=cipher_page_size)
 
 
-#
-# Exceptions
-#
+def migrate(path, password, raw_key=False, cipher='aes-256-cbc',
+            kdf_iter=4000, cipher_page_size=1024, new_password=None,
+            new_raw_key=None, new_cipher=None, new_kdf_iter=None,
+            new_cipher_page_size=None, progress_cb=None):
+    """
+    Re-encrypt the database at the given location with new cryptographic
+    parameters.
+
+    Parameters prefixed with C{new_} default to their current values.
+
+    @param path: The filesystem path for the database to migrate.
+    @type path: str
+    @param password: The current password that protects the db.
+    @type password: str
+    @param raw_key: Whether C{password} is a raw 64-char hex string or a
+        passphrase that should be hashed to obtain the encyrption key.
+    @type raw_key: bool
+    @param cipher: The current cipher and mode.
+    @type cipher: str
+    @param kdf_iter: The current number of iterations.
+    @type kdf_iter: int
+    @param cipher_page_size: The current page size.
+    @type cipher_page_size: int
+    @param new_password: The new password.
+    @type new_password: str
+    @param new_raw_key: Whether C{new_password} is a raw key.
+    @type new_raw_key: bool
+    @param new_cipher: The new cipher and mode.
+    @type new_cipher: str
+    @param new_kdf_iter: The new number of iterations.
+    @type new_kdf_iter: int
+    @param new_cipher_page_size: The new page size.
+    @type new_cipher_page_size: int
+    @param progress_cb: A callable that will be called with the name of the
+        current migration stage and the fraction of the work done.
+    @type progress_cb: callable
+    """
+    SQLCipherDatabase.migrate_database(
+        path, password, raw_key=raw_key, cipher=cipher, kdf_iter=kdf_iter,
+        cipher_page_size=cipher_page_size, new_password=new_password,
+        new_raw_key=new_raw_key, new_cipher=new_cipher,
+        new_kdf_iter=new_kdf_iter,
+        new_cipher_page_size=new_cipher_page_size, progress_cb=progress_cb)
+
+
+#
+# Exceptions
+#
+
+class DatabaseIsNotEncrypted(Exception):
+    """
+    Exception raised when trying to open non-encrypted databases.
+    """
+    pass
+
+
+class NotAnHexString(Exception):
+    """
+    Raised when trying to (raw) key the database with a non-hex string.
+    """
+    pass
+
+
+class MigrationFailed(Exception):
+    """
+    Raised when a migrated database does not match the original one.
+    """
+    pass
+
+
+class ContentPending(Exception):
+    """
+    Raised when trying to update a document whose content was not fetched.
+    """
+    pass
+
+
+class InvalidSearchQuery(Exception):
+    """
+    Raised when a full-text search query is malformed.
+    """
+    pass
+
+
+#
+# Migration stages
+#
+
+class MigrationStages(object):
+    """
+    Representation of the stages of a database migration.
+
+    The stage is persisted in a state file next to the database so an
+    interrupted migration can be resumed.
+    """
+
+    EXPORTING = 'exporting'
+    EXPORTED = 'exported'
+    VERIFYING = 'verifying'
+    SWAPPING = 'swapping'
+    DONE = 'done'
+
+
+#
+# Open latency instrumentation
+#
+
+class OpenTimings(object):
+    """
+    Record how long each step of opening a database took.
+
+    Keying a SQLCipher database with a passphrase runs a full PBKDF2
+    derivation, so the time spent in each step of the open path is worth
+    knowing when startup is slow.
+    """
+
+    def __init__(self):
+        """
+        Initialize an empty list of steps.
+        """
+        self.steps = []
+
+    @contextmanager
+    def step(self, name):
+        """
+        Time the execution of the wrapped block and record it as C{name}.
+
+        @param name: The name of the step.
+        @type name: str
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.steps.append((name, time.time() - start))
+
+    def _get_total(self):
+        """
+        Return the time spent in all recorded steps.
+
+        @return: The total time, in seconds.
+        @rtype: float
+        """
+        return sum(elapsed for _, elapsed in self.steps)
+
+    total = property(_get_total, doc='Total time spent opening the db.')
+
+    def __str__(self):
+        return ', '.join(
+            ['%s: %.4fs' % (name, elapsed) for name, elapsed in self.steps]
+            + ['total: %.4fs' % self.total])
+
+
+#
+# The SQLCipher database
+#
+
+class SQLCipherDatabase(sqlite_backend.SQLitePartialExpandDatabase):
+    """A U1DB implementation that uses SQLCipher as its persistence layer."""
+
+    _index_storage_value = 'expand referenced encrypted'
+
+    def __init__(self, sqlcipher_file, password, document_factory=None,
+                 crypto=None, raw_key=False, cipher='aes-256-cbc',
+                 kdf_iter=4000, cipher_page_size=1024, db_handle=None,
+                 open_timings=None):
+        """
+        Create a new sqlcipher file.
+
+        @param sqlcipher_file: The path for the SQLCipher file.
+        @type sqlcipher_file: str
+        @param password: The password that protects the SQLCipher db.
+        @type password: str
+        @param document_factory: A function that will be called with the same
+            parameters as Document.__init__.
+        @type document_factory: callable
+        @param crypto: An instance of SoledadCrypto so we can encrypt/decrypt
+            document contents when syncing.
+        @type crypto: soledad.crypto.SoledadCrypto
+        @param raw_key: Whether C{password} is a raw 64-char hex string or a
+            passphrase that should be hashed to obtain the encyrption key.
+        @type raw_key: bool
+        @param cipher: The cipher and mode to use.
+        @type cipher: str
+        @param kdf_iter: The number of iterations to use.
+        @type kdf_iter: int
+        @param cipher_page_size: The page size.
+        @type cipher_page_size: int
+        @param db_handle: An already keyed and verified connection to
+            C{sqlcipher_file}, as returned by C{_connect}. If given, no new
+            connection is made.
+        @type db_handle: pysqlcipher.Connection
+        @param open_timings: Where to record the time spent in each step of
+            the open path.
+        @type open_timings: OpenTimings
+        """
+        if open_timings is None:
+            open_timings = OpenTimings()
+        self.open_timings = open_timings
+        if db_handle is None:
+            # connect, set SQLCipher cryptographic parameters and ensure the
+            # db is encrypted if the file already exists
+            db_handle = self._connect(
+                sqlcipher_file, password, raw_key, cipher, kdf_iter,
+                cipher_page_size, open_timings)
+        self._db_handle = db_handle
+        self._real_replica_uid = None
+        self._doc_cache = None
+        self._change_listener = None
+        self._foreign_cache = None
+        self._written_doc_ids = set()
+        self._sync_report = None
+        self._content_fetcher = None
+        with open_timings.step('ensure_schema'):
+            self._ensure_schema()
+            self._ensure_pending_content_table()
+            self._ensure_delta_base_table()
+            self._ensure_sync_ack_table()
+            self._ensure_sync_report_table()
+            self._ensure_search_tables()
+            self._ensure_blob_tables()
+        self._crypto = crypto
+
+        def factory(doc_id=None, rev=None, json='{}', has_conflicts=False,
+                    syncable=True):
+            return SoledadDocument(doc_id=doc_id, rev=rev, json=json,
+                                has_conflicts=has_conflicts,
+                                syncable=syncable)
+        self.set_document_factory(factory)
+        logger.debug('Opened %s (%s).' % (sqlcipher_file, open_timings))
+
+    @classmethod
+    def _open_database(cls, sqlcipher_file, password, document_factory=None,
+                       crypto=None, raw_key=False, cipher='aes-256-cbc',
+                       kdf_iter=4000, cipher_page_size=1024):
+        """
+        Open a SQLCipher database.
+
+        @param sqlcipher_file: The path for the SQLCipher file.
+        @type sqlcipher_file: str
+        @param password: The password that protects the SQLCipher db.
+        @type password: str
+        @param document_factory: A function that will be called with the same
+            parameters as Document.__init__.
+        @type document_factory: callable
+        @param crypto: An instance of SoledadCrypto so we can encrypt/decrypt
+            document contents when syncing.
+        @type crypto: soledad.crypto.SoledadCrypto
+        @param raw_key: Whether C{password} is a raw 64-char hex string or a
+            passphrase that should be hashed to obtain the encyrption key.
+        @type raw_key: bool
+        @param cipher: The cipher and mode to use.
+        @type cipher: str
+        @param kdf_iter: The number of iterations to use.
+        @type kdf_iter: int
+        @param cipher_page_size: The page size.
+        @type cipher_page_size: int
+
+        @return: The database object.
+        @rtype: SQLCipherDatabase
+        """
+        if not os.path.isfile(sqlcipher_file):
+            raise errors.DatabaseDoesNotExist()
+        open_timings = OpenTimings()
+        tries = 2
+        while True:
+            # Note: There seems to be a bug in sqlite 3.5.9 (with python2.6)
+            #       where without re-opening the database on Windows, it
+            #       doesn't see the transaction that was just committed
+            db_handle = cls._connect(
+                sqlcipher_file, password, raw_key, cipher, kdf_iter,
+                cipher_page_size, open_timings)
+            c = db_handle.cursor()
+            with open_timings.step('index_storage'):
+                v, err = cls._which_index_storage(c)
+            if v is not None:
+                break
+            db_handle.close()
+            # possibly another process is initializing it, wait for it to be
+            # done
+            if tries == 0:
+                raise err  # go for the richest error?
+            tries -= 1
+            time.sleep(cls.WAIT_FOR_PARALLEL_INIT_HALF_INTERVAL)
+        # hand the keyed and verified connection to the database object so
+        # it does not have to be keyed again
+        return SQLCipherDatabase._sqlite_registry[v](
+            sqlcipher_file, password, document_factory=document_factory,
+            crypto=crypto, raw_key=raw_key, cipher=cipher, kdf_iter=kdf_iter,
+            cipher_page_size=cipher_page_size, db_handle=db_handle,
+            open_timings=open_timings)
+
+    @classmethod
+    def open_database(cls, sqlcipher_file, password, create, backend_cls=None,
+                      document_factory=None, crypto=None, raw_key=False,
+                      cipher='aes-256-cbc', kdf_iter=4000,
+                      cipher_page_size=1024):
+        """
+        Open a SQLCipher database.
+
+        @param sqlcipher_file: The path for the SQLCipher file.
+        @type sqlcipher_file: str
+        @param password: The password that protects the SQLCipher db.
+        @type password: str
+        @param create: Should the datbase be created if it does not already
+            exist?
+        @type: bool
+        @param backend_cls: A class to use as backend.
+        @type backend_cls: type
+        @param document_factory: A function that will be called with the same
+            parameters as Document.__init__.
+        @type document_factory: callable
+        @param crypto: An instance of SoledadCrypto so we can encrypt/decrypt
+            document contents when syncing.
+        @type crypto: soledad.crypto.SoledadCrypto
+        @param raw_key: Whether C{password} is a raw 64-char hex string or a
+            passphrase that should be hashed to obtain the encyrption key.
+        @type raw_key: bool
+        @param cipher: The cipher and mode to use.
+        @type cipher: str
+        @param kdf_iter: The number of iterations to use.
+        @type kdf_iter: int
+        @param cipher_page_size: The page size.
+        @type cipher_page_size: int
+
+        @return: The database object.
+        @rtype: SQLCipherDatabase
+        """
+        try:
+            return cls._open_database(
+                sqlcipher_file, password, document_factory=document_factory,
+                crypto=crypto, raw_key=raw_key, cipher=cipher,
+                kdf_iter=kdf_iter, cipher_page_size=cipher_page_size)
+        except errors.DatabaseDoesNotExist:
+            if not create:
+                raise
+            # TODO: remove backend class from here.
+            if backend_cls is None:
+                # default is SQLCipherPartialExpandDatabase
+                backend_cls = SQLCipherDatabase
+            return backend_cls(
+                sqlcipher_file, password, document_factory=document_factory,
+                crypto=crypto, raw_key=raw_key, cipher=cipher,
+                kdf_iter=kdf_iter, cipher_page_size=cipher_page_size)
+
+    SYNC_REPORT_HISTORY = 100
+    """
+    How many sync reports are kept in the local database.
+    """
+
+    def sync(self, url, creds=None, autocreate=True, report=None,
+             cert_file=None, connection_pool=None, metadata_only=False,
+             metadata_fields=None, lazy_decrypt=False, deltas=False,
+             upload_connections=1):
+        """
+        Synchronize documents with remote replica exposed at url.
+
+        @param url: The url of the target replica to sync with.
+        @type url: str
+        @param creds: optional dictionary giving credentials.
+            to authorize the operation with the server.
+        @type creds: dict
+        @param autocreate: Ask the target to create the db if non-existent.
+        @type autocreate: bool
+        @param report: Where to record what the sync transferred and how
+            long each phase took. The report is also stored in the local
+            database, see C{get_sync_reports}.
+        @type report: leap.soledad.target.SyncReport
+        @param cert_file: Path to the certificate used to verify the server.
+        @type cert_file: str
+        @param connection_pool: A pool to take connections from. The
+            connection is given back when the sync finishes.
+        @type connection_pool: leap.soledad.connection.HTTPConnectionPool
+        @param metadata_only: Whether to receive only the metadata of new
+            documents, if the server supports it. Their content is fetched
+            when first read, see C{fetch_pending_content}.
+        @type metadata_only: bool
+        @param metadata_fields: The top level fields of outgoing documents
+            that are sent in their metadata.
+        @type metadata_fields: list of str
+        @param lazy_decrypt: Whether to store incoming documents that have
+            metadata without decrypting them. Their metadata is stored as
+            their content until they are first read, see
+            C{fetch_pending_content}.
+        @type lazy_decrypt: bool
+        @param deltas: Whether to send changes to big documents as deltas
+            to the revision the server holds, if the server supports it.
+        @type deltas: bool
+        @param upload_connections: How many connections a big backlog of
+            local changes may be uploaded through concurrently, if the
+            server supports it.
+        @type upload_connections: int
+
+        @return: The local generation before the synchronisation was performed.
+        @rtype: int
+        """
+        from u1db.sync import Synchronizer
+        from leap.soledad.target import SoledadSyncTarget, SyncReport
+        if report is None:
+            report = SyncReport()
+        scope, resend = self._get_sync_scope_state()
+        target = SoledadSyncTarget(
+            url, creds=creds, crypto=self._crypto, cert_file=cert_file,
+            connection_pool=connection_pool, report=report, scope=scope,
+            local_doc_exists=self._local_doc_exists, resend=resend,
+            metadata_only=metadata_only, metadata_fields=metadata_fields,
+            content_needed=self._content_needed, lazy_decrypt=lazy_decrypt,
+            delta_store=self if deltas else None,
+            upload_connections=upload_connections)
+        # let local reads and writes made by the synchronizer be timed.
+        self._sync_report = report
+        if report.memory is not None:
+            report.memory.start()
+        synchronizer = Synchronizer(self, target)
+        try:
+            local_gen = synchronizer.sync(autocreate=autocreate)
+        finally:
+            self._sync_report = None
+            target.close()
+            if report.memory is not None:
+                report.memory.stop()
+        report.finish(local_gen)
+        self._store_sync_report(report)
+        if target._source_gen_info is not None:
+            self._set_sync_ack(
+                synchronizer.target_replica_uid, *target._source_gen_info)
+        if resend:
+            self._clear_sync_scope_resend()
+        return local_gen
+
+    def set_change_listener(self, listener):
+        """
+        Set a function to call whenever a document is written outside a
+        sync, whatever the write path: local updates, deletions, conflict
+        resolutions and documents fetched or merged later.
+
+        @param listener: A function called with no arguments, or None.
+        @type listener: callable
+        """
+        self._change_listener = listener
+
+    #
+    # Sync reports
+    #
+
+    def _ensure_sync_report_table(self):
+        """
+        Create the table that holds sync reports, if needed.
+        """
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute(
+                'CREATE TABLE IF NOT EXISTS sync_report ('
+                ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+                ' started REAL NOT NULL,'
+                ' report TEXT NOT NULL)')
+
+    def _store_sync_report(self, report):
+        """
+        Store a sync report, keeping only the C{SYNC_REPORT_HISTORY} most
+        recent ones.
+
+        @param report: The report.
+        @type report: leap.soledad.target.SyncReport
+        """
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute(
+                'INSERT INTO sync_report (started, report) VALUES (?, ?)',
+                (report.started, json.dumps(report.as_dict())))
+            c.execute(
+                'DELETE FROM sync_report WHERE id <= ('
+                ' SELECT max(id) FROM sync_report) - ?',
+                (self.SYNC_REPORT_HISTORY,))
+
+    def get_sync_reports(self, limit=None):
+        """
+        Return the reports of the most recent syncs.
+
+        @param limit: The maximum number of reports to return, or None for
+            all stored reports.
+        @type limit: int
+
+        @return: The reports, as returned by C{SyncReport.as_dict}, most
+            recent first.
+        @rtype: list of dict
+        """
+        c = self._db_handle.cursor()
+        c.execute(
+            'SELECT report FROM sync_report ORDER BY id DESC LIMIT ?',
+            (-1 if limit is None else limit,))
+        return [json.loads(row[0]) for row in c.fetchall()]
+
+    #
+    # Sync scope
+    #
+
+    def _ensure_sync_scope_table(self, c):
+        """
+        Create the table that holds the sync scope, if needed.
+
+        @param c: The cursor for querying the database.
+        @type c: dbapi2.cursor
+        """
+        c.execute(
+            'CREATE TABLE IF NOT EXISTS sync_scope ('
+            ' id INTEGER PRIMARY KEY CHECK (id = 0),'
+            ' scope TEXT,'
+            ' resend INTEGER NOT NULL)')
+
+    def _get_sync_scope_state(self):
+        """
+        Return the sync scope and whether all local changes have to be sent
+        again because it changed.
+
+        @rtype: (leap.soledad.scope.SyncScope, bool)
+        """
+        from leap.soledad.scope import SyncScope
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            self._ensure_sync_scope_table(c)
+            c.execute('SELECT scope, resend FROM sync_scope')
+            row = c.fetchone()
+        if row is None:
+            return None, False
+        scope, resend = row
+        if scope is not None:
+            scope = SyncScope.from_dict(json.loads(scope))
+        return scope, bool(resend)
+
+    def get_sync_scope(self):
+        """
+        Return the documents this replica syncs.
+
+        @return: The sync scope, or None if all documents are synced.
+        @rtype: leap.soledad.scope.SyncScope
+        """
+        return self._get_sync_scope_state()[0]
+
+    def set_sync_scope(self, scope):
+        """
+        Restrict the documents this replica syncs.
+
+        If the scope changes, the next sync downloads all documents in the
+        new scope and sends all local changes in it again.
+
+        @param scope: The documents to sync, or None to sync all documents.
+        @type scope: leap.soledad.scope.SyncScope
+        """
+        if scope == self.get_sync_scope():
+            return
+        data = json.dumps(scope.as_dict()) if scope is not None else None
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            self._ensure_sync_scope_table(c)
+            c.execute(
+                'INSERT OR REPLACE INTO sync_scope (id, scope, resend)'
+                ' VALUES (0, ?, 1)', (data,))
+            # forget what is known of other replicas, so that documents that
+            # were out of scope are sent by them again.
+            c.execute('DELETE FROM sync_log')
+
+    def _clear_sync_scope_resend(self):
+        """
+        Record that the local changes in the sync scope were sent again.
+        """
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute('UPDATE sync_scope SET resend = 0')
+
+    def _local_doc_exists(self, doc_id):
+        """
+        Return whether a document exists in this replica, even if deleted.
+
+        @param doc_id: The id of the document.
+        @type doc_id: str
+
+        @rtype: bool
+        """
+        return self._get_doc(doc_id) is not None
+
+    #
+    # Pending content
+    #
+
+    def _ensure_pending_content_table(self):
+        """
+        Create the table of documents whose content was not fetched or
+        decrypted, if needed.
+
+        The encrypted content of documents stored without decrypting it is
+        kept in the envelope column, which is NULL for documents whose
+        content has to be fetched.
+        """
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute(
+                'CREATE TABLE IF NOT EXISTS pending_content ('
+                ' doc_id TEXT PRIMARY KEY,'
+                ' priority INTEGER NOT NULL,'
+                ' envelope TEXT)')
+            c.execute(
+                'CREATE INDEX IF NOT EXISTS pending_content_priority'
+                ' ON pending_content (priority)')
+
+    def set_content_fetcher(self, fetcher):
+        """
+        Set how the content of documents synced without it is fetched.
+
+        @param fetcher: A function that takes a list of doc ids and returns
+            the current revision of the documents, with decrypted content,
+            or None to not fetch content.
+        @type fetcher: callable
+        """
+        self._content_fetcher = fetcher
+
+    def _pending_doc_ids(self, doc_ids):
+        """
+        Return which of C{doc_ids} are of documents with pending content.
+
+        @rtype: set of str
+        """
+        pending = set()
+        c = self._db_handle.cursor()
+        doc_ids = list(doc_ids)
+        for start in xrange(0, len(doc_ids), self.FETCH_BATCH_SIZE):
+            batch = doc_ids[start:start + self.FETCH_BATCH_SIZE]
+            c.execute(
+                'SELECT doc_id FROM pending_content WHERE doc_id IN (%s)'
+                % ','.join('?' * len(batch)), tuple(batch))
+            pending.update(row[0] for row in c.fetchall())
+        return pending
+
+    def _content_needed(self, doc_id):
+        """
+        Return whether this replica has the content of a document, so an
+        incoming revision of it should come with its content.
+
+        @param doc_id: The id of the document.
+        @type doc_id: str
+
+        @rtype: bool
+        """
+        return self._local_doc_exists(doc_id) \
+            and not self._pending_doc_ids([doc_id])
+
+    def get_pending_content_count(self):
+        """
+        Return the number of documents whose content was not fetched.
+
+        @rtype: int
+        """
+        c = self._db_handle.cursor()
+        c.execute(
+            'SELECT count(*) FROM pending_content WHERE envelope IS NULL')
+        return c.fetchone()[0]
+
+    def prioritize_pending_content(self, doc_ids):
+        """
+        Fetch the content of documents before that of any other document,
+        the next time pending content is fetched without giving doc ids.
+
+        By default, the most recently changed documents are fetched first.
+
+        @param doc_ids: The ids of the documents, in decreasing priority.
+        @type doc_ids: list of str
+        """
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute('SELECT max(priority) FROM pending_content')
+            top = (c.fetchone()[0] or 0) + len(doc_ids)
+            c.executemany(
+                'UPDATE pending_content SET priority = ? WHERE doc_id = ?',
+                [(top - i, doc_id) for i, doc_id in enumerate(doc_ids)])
+
+    def fetch_pending_content(self, doc_ids=None, limit=None):
+        """
+        Fetch and store the content of documents synced without it.
+
+        If a document changed in the server since it was synced, its
+        current revision is stored instead, as if it had been synced.
+
+        Documents whose content is stored encrypted are decrypted instead,
+        but only if their ids are given, so they are decrypted when read.
+
+        @param doc_ids: The ids of the documents, or None for the C{limit}
+            documents to fetch with the highest priority.
+        @type doc_ids: list of str
+        @param limit: How many documents to fetch if no ids are given, by
+            default C{FETCH_BATCH_SIZE}.
+        @type limit: int
+
+        @return: The number of documents whose content was stored.
+        @rtype: int
+        """
+        c = self._db_handle.cursor()
+        stored = 0
+        if doc_ids is None:
+            c.execute(
+                'SELECT doc_id FROM pending_content WHERE envelope IS NULL'
+                ' ORDER BY priority DESC LIMIT ?',
+                (limit or self.FETCH_BATCH_SIZE,))
+            doc_ids = [row[0] for row in c.fetchall()]
+        else:
+            stored = self._decrypt_stored_content(doc_ids)
+            doc_ids = list(self._pending_doc_ids(doc_ids))
+        if not doc_ids or self._content_fetcher is None:
+            return stored
+        for doc in self._content_fetcher(doc_ids):
+            old_doc = self._get_doc(doc.doc_id)
+            if old_doc is None or not self._pending_doc_ids([doc.doc_id]):
+                continue
+            if doc.rev == old_doc.rev:
+                # the generation of the document does not change, so it is
+                # not sent back to the server.
+                doc.syncable = old_doc.syncable
+                with self._db_handle:
+                    self._replace_content(doc)
+            else:
+                # the document does not come from a sync, so no source
+                # replica generation is validated or recorded.
+                with self._db_handle:
+                    self._put_doc_if_newer(
+                        doc, save_conflict=True, replica_gen=0,
+                        replica_trans_id='')
+            # readers may have cached the document before it was committed.
+            self._invalidate_cached_doc(doc.doc_id)
+            stored += 1
+        return stored
+
+    def _decrypt_stored_content(self, doc_ids):
+        """
+        Decrypt and store the content of documents stored encrypted.
+
+        The decrypted content replaces the stored metadata, so it is indexed
+        and later reads do not decrypt it again.
+
+        @param doc_ids: The ids of the documents.
+        @type doc_ids: list of str
+
+        @return: The number of documents whose content was decrypted.
+        @rtype: int
+        """
+        from leap.soledad.target import decrypt_doc
+        c = self._db_handle.cursor()
+        doc_ids = list(doc_ids)
+        envelopes = []
+        for start in xrange(0, len(doc_ids), self.FETCH_BATCH_SIZE):
+            batch = doc_ids[start:start + self.FETCH_BATCH_SIZE]
+            c.execute(
+                'SELECT doc_id, envelope FROM pending_content'
+                ' WHERE envelope IS NOT NULL AND doc_id IN (%s)'
+                % ','.join('?' * len(batch)), tuple(batch))
+            envelopes.extend(c.fetchall())
+        for doc_id, envelope in envelopes:
+            old_doc = self._get_doc(doc_id)
+            # the envelope was stored with the current revision.
+            doc = self._factory(
+                doc_id, old_doc.rev,
+                decrypt_doc(self._crypto, SoledadDocument(
+                    doc_id, old_doc.rev, envelope)))
+            doc.syncable = old_doc.syncable
+            with self._db_handle:
+                self._replace_content(doc)
+            self._invalidate_cached_doc(doc_id)
+        return len(envelopes)
+
+    def _with_content(self, docs, pending_ids, check_for_conflicts,
+                      include_deleted):
+        """
+        Yield C{docs}, fetching the content of the ones with pending content
+        first. Documents whose content could not be fetched are flagged as
+        C{content_pending}.
+
+        Documents whose content was pending before they were read may have
+        been read without it, so they are read again if their content was
+        stored meanwhile.
+
+        @param docs: The documents.
+        @type docs: iterable
+        @param pending_ids: The ids of the documents whose content was
+            pending before they were read.
+        @type pending_ids: set of str
+        """
+        docs = iter(docs)
+        while True:
+            batch = list(itertools.islice(docs, self.FETCH_BATCH_SIZE))
+            if not batch:
+                return
+            batch_ids = set(doc.doc_id for doc in batch)
+            pending = self._pending_doc_ids(batch_ids)
+            pending |= batch_ids & pending_ids
+            fetched = set()
+            if pending:
+                self.fetch_pending_content(pending)
+                fetched = pending - self._pending_doc_ids(pending)
+                pending -= fetched
+            for doc in batch:
+                if doc.doc_id in fetched:
+                    doc = self._get_doc(
+                        doc.doc_id, check_for_conflicts=check_for_conflicts)
+                    if doc.is_tombstone() and not include_deleted:
+                        continue
+                doc.content_pending = doc.doc_id in pending
+                yield doc
+
+    #
+    # Delta bases
+    #
+
+    def _ensure_delta_base_table(self):
+        """
+        Create the table of the revisions of documents the server is known
+        to hold, if needed.
+        """
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute(
+                'CREATE TABLE IF NOT EXISTS delta_base ('
+                ' doc_id TEXT PRIMARY KEY,'
+                ' doc_rev TEXT NOT NULL,'
+                ' depth INTEGER NOT NULL,'
+                ' content TEXT NOT NULL)')
+
+    def get_delta_base(self, doc_id):
+        """
+        Return the revision of a document the server is known to hold, which
+        changes to the document can be sent as deltas to.
+
+        @param doc_id: The id of the document.
+        @type doc_id: str
+
+        @return: (rev, depth, content) - The revision, the number of deltas
+            the server stores it as and the JSON serialization of its
+            content, or None if it is not known.
+        @rtype: tuple
+        """
+        c = self._db_handle.cursor()
+        c.execute(
+            'SELECT doc_rev, depth, content FROM delta_base WHERE doc_id = ?',
+            (doc_id,))
+        return c.fetchone()
+
+    def set_delta_base(self, doc_id, rev, depth, content):
+        """
+        Record the revision of a document the server holds.
+
+        @param doc_id: The id of the document.
+        @type doc_id: str
+        @param rev: The revision.
+        @type rev: str
+        @param depth: The number of deltas the server stores it as.
+        @type depth: int
+        @param content: The JSON serialization of its content, or None to
+            forget the document, so its next change is sent in full.
+        @type content: str
+        """
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            if content is None:
+                c.execute(
+                    'DELETE FROM delta_base WHERE doc_id = ?', (doc_id,))
+            else:
+                c.execute(
+                    'INSERT OR REPLACE INTO delta_base'
+                    ' (doc_id, doc_rev, depth, content) VALUES (?, ?, ?, ?)',
+                    (doc_id, rev, depth, content))
+
+    #
+    # Compaction
+    #
+
+    def _ensure_sync_ack_table(self):
+        """
+        Create the table of the generations of this replica that other
+        replicas acknowledged, if needed.
+        """
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute(
+                'CREATE TABLE IF NOT EXISTS sync_ack ('
+                ' replica_uid TEXT PRIMARY KEY,'
+                ' known_generation INTEGER NOT NULL,'
+                ' known_transaction_id TEXT NOT NULL)')
+
+    def _set_sync_ack(self, replica_uid, generation, trans_id):
+        """
+        Record the generation of this replica another replica knows.
+
+        @param replica_uid: The uid of the other replica.
+        @type replica_uid: str
+        @param generation: The generation of this replica it knows.
+        @type generation: int
+        @param trans_id: The transaction id of that generation.
+        @type trans_id: str
+        """
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute(
+                'INSERT OR REPLACE INTO sync_ack'
+                ' (replica_uid, known_generation, known_transaction_id)'
+                ' VALUES (?, ?, ?)', (replica_uid, generation, trans_id))
+
+    def compact(self):
+        """
+        Purge the tombstones and transaction log entries that no replica
+        this one syncs with can need anymore, and give the space they used
+        back to the file system.
+
+        The sync log holds the generations of other replicas this one knows,
+        so the generations of this replica that other replicas know are
+        recorded separately, by C{sync}. Only history older than the oldest
+        of them is purged, and only if this replica already synced:
+
+            * transaction log entries superseded by a later change to the
+              same document. The latest change to each document is kept, so
+              all documents are still enumerated when changes are sent
+              again from the start, and so is the entry of each generation
+              another replica knows, which is validated on every sync.
+            * tombstones of documents deleted before that generation, which
+              all replicas already know of, together with the log entries
+              of those documents.
+
+        The database is then vacuumed incrementally. The first compaction of
+        a database that was not created for incremental vacuuming rebuilds
+        it with a full vacuum.
+
+        @return: The number of 'tombstones' and 'transactions' purged, the
+            size of the database in 'bytes_before' and 'bytes_after' the
+            compaction, and the time enumerating all changes, as when they
+            are sent again from the start, took 'enumerate_before' and
+            'enumerate_after' the compaction, in seconds.
+        @rtype: dict
+        """
+        report = {
+            'tombstones': 0,
+            'transactions': 0,
+            'bytes_before': self._get_database_size(),
+            'enumerate_before': self._time_enumeration(),
+        }
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute('SELECT min(known_generation) FROM sync_ack')
+            acked_gen = c.fetchone()[0]
+            purged = []
+            if acked_gen is not None:
+                c.execute(
+                    'SELECT d.doc_id FROM document d'
+                    ' WHERE d.content IS NULL'
+                    ' AND NOT EXISTS (SELECT 1 FROM conflicts'
+                    '  WHERE conflicts.doc_id = d.doc_id)'
+                    ' AND (SELECT max(generation) FROM transaction_log t'
+                    '  WHERE t.doc_id = d.doc_id) < ?', (acked_gen,))
+                purged = [row[0] for row in c.fetchall()]
+                for doc_id in purged:
+                    c.execute(
+                        'DELETE FROM transaction_log WHERE doc_id = ?',
+                        (doc_id,))
+                    report['transactions'] += c.rowcount
+                    for table in ('document', 'document_fields',
+                                  'pending_content', 'delta_base'):
+                        c.execute(
+                            'DELETE FROM %s WHERE doc_id = ?' % table,
+                            (doc_id,))
+                c.execute(
+                    'DELETE FROM transaction_log WHERE generation < ?'
+                    ' AND generation NOT IN ('
+                    '  SELECT max(generation) FROM transaction_log'
+                    '  GROUP BY doc_id)', (acked_gen,))
+                report['transactions'] += c.rowcount
+        report['tombstones'] = len(purged)
+        for doc_id in purged:
+            self._invalidate_cached_doc(doc_id)
+        self._vacuum()
+        report['bytes_after'] = self._get_database_size()
+        report['enumerate_after'] = self._time_enumeration()
+        logger.debug('Compacted the database: %r' % report)
+        return report
+
+    def _vacuum(self):
+        """
+        Give free pages back to the file system.
+        """
+        c = self._db_handle.cursor()
+        c.execute('PRAGMA auto_vacuum')
+        if c.fetchone()[0] != 2:
+            # databases can only switch to incremental vacuuming when they
+            # are rebuilt.
+            c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            c.execute('VACUUM')
+        else:
+            c.execute('PRAGMA incremental_vacuum')
+            c.fetchall()
+
+    def _get_database_size(self):
+        """
+        Return the size of the database, in bytes.
+
+        @rtype: int
+        """
+        c = self._db_handle.cursor()
+        c.execute('PRAGMA page_count')
+        page_count = c.fetchone()[0]
+        c.execute('PRAGMA page_size')
+        return page_count * c.fetchone()[0]
+
+    def _time_enumeration(self):
+        """
+        Return how long enumerating all changes takes, in seconds.
+
+        @rtype: float
+        """
+        start = time.time()
+        self.whats_changed(0)
+        return time.time() - start
+
+    #
+    # Statement statistics
+    #
+
+    def set_statement_stats(self, stats):
+        """
+        Start or stop recording the SQL statements run on the database.
+
+        @param stats: Where to record statements, or None to stop recording.
+        @type stats: leap.soledad.sqlstats.StatementStats
+        """
+        if not isinstance(self._db_handle, InstrumentedConnection):
+            if stats is not None:
+                logger.warning(
+                    'Cannot record statements of a plain connection.')
+            return
+        self._db_handle.statement_stats = stats
+
+    def _get_statement_stats(self):
+        return getattr(self._db_handle, 'statement_stats', None)
+
+    statement_stats = property(
+        _get_statement_stats,
+        doc='Where SQL statements are recorded, or None if they are not.')
+
+    #
+    # Document cache
+    #
+
+    def set_document_cache_size(self, max_size):
+        """
+        Enable, resize or disable the in-process document cache.
+
+        When enabled, C{get_doc} and C{get_docs} are served from a bounded
+        least recently used cache keyed by doc_id. The cache is invalidated
+        by every write path, including documents inserted during sync and
+        conflict resolution, so reads never return stale revisions.
+
+        @param max_size: The maximum number of cached documents, or None (or
+            0) to disable the cache.
+        @type max_size: int
+        """
+        if not max_size:
+            self._doc_cache = None
+        else:
+            self._doc_cache = DocumentCache(max_size, self._factory)
+
+    def _get_document_cache(self):
+        return self._doc_cache
+
+    document_cache = property(
+        _get_document_cache,
+        doc='The document cache, or None if caching is disabled.')
+
+    def set_document_factory(self, factory):
+        """
+        Set the document factory and drop cached documents, as they would
+        otherwise be built with the old factory.
+
+        @param factory: A function that will be called with the same
+            parameters as Document.__init__.
+        @type factory: callable
+        """
+        sqlite_backend.SQLitePartialExpandDatabase.set_document_factory(
+            self, factory)
+        if getattr(self, '_doc_cache', None) is not None:
+            self._doc_cache = DocumentCache(
+                self._doc_cache.stats()['max_size'], factory)
+
+    def set_foreign_cache(self, cache):
+        """
+        Invalidate the documents written through this connection in the
+        document cache of another connection to the same database, e.g. when
+        this one is used by a background task.
+
+        Documents are invalidated as they are written and again by
+        C{invalidate_written_docs}, which should be called once the writes
+        are committed, as the other connection may read and cache the
+        previous revision until then.
+
+        @param cache: The document cache of the other connection, or None.
+        @type cache: leap.soledad.cache.DocumentCache
+        """
+        self._foreign_cache = cache
+        self._written_doc_ids = set()
+
+    def invalidate_written_docs(self):
+        """
+        Invalidate the documents written so far in the cache given to
+        C{set_foreign_cache}.
+        """
+        cache = self._foreign_cache
+        written, self._written_doc_ids = self._written_doc_ids, set()
+        if cache is not None:
+            for doc_id in written:
+                cache.invalidate(doc_id)
+
+    def _invalidate_cached_doc(self, doc_id):
+        """
+        Remove a document from the document cache, if it is enabled, and
+        from the cache given to C{set_foreign_cache}.
+
+        @param doc_id: The unique document identifier.
+        @type doc_id: str
+        """
+        if self._doc_cache is not None:
+            self._doc_cache.invalidate(doc_id)
+        if self._foreign_cache is not None:
+            self._foreign_cache.invalidate(doc_id)
+            self._written_doc_ids.add(doc_id)
+
+    def get_doc(self, doc_id, include_deleted=False):
+        """
+        Get the JSON string for the given document.
+
+        @param doc_id: The unique document identifier
+        @type doc_id: str
+        @param include_deleted: If set to True, deleted documents will be
+            returned with empty content. Otherwise asking for a deleted
+            document will return None.
+        @type include_deleted: bool
+
+        @return: a Document object.
+        @rtype: SoledadDocument
+        """
+        pending = self._pending_doc_ids([doc_id])
+        doc = self._get_cached_doc(doc_id, include_deleted)
+        if doc is None:
+            return None
+        for doc in self._with_content([doc], pending, True, include_deleted):
+            return doc
+        return None
+
+    def _get_cached_doc(self, doc_id, include_deleted):
+        """
+        Get a document from the document cache, if it is enabled, or from
+        the database.
+
+        Documents whose content is pending are not cached, as their content
+        may be stored by another connection at any time.
+        """
+        if self._doc_cache is None:
+            return sqlite_backend.SQLitePartialExpandDatabase.get_doc(
+                self, doc_id, include_deleted=include_deleted)
+        doc = self._doc_cache.get(doc_id)
+        if doc is None:
+            # the document is not cached if it is invalidated meanwhile.
+            version = self._doc_cache.version()
+            doc = self._get_doc(doc_id, check_for_conflicts=True)
+            if doc is None:
+                return None
+            if not self._pending_doc_ids([doc_id]):
+                self._doc_cache.put(doc, version)
+        if doc.is_tombstone() and not include_deleted:
+            return None
+        return doc
+
+    def get_docs(self, doc_ids, check_for_conflicts=True,
+                 include_deleted=False):
+        """
+        Get the JSON content for many documents.
+
+        @param doc_ids: A list of document identifiers.
+        @type doc_ids: list
+        @param check_for_conflicts: If set to False, then the conflict check
+            will be skipped.
+        @type check_for_conflicts: bool
+        @param include_deleted: If set to True, deleted documents will be
+            returned with empty content. Otherwise deleted documents will not
+            be included in the results.
+        @type include_deleted: bool
+
+        @return: iterable giving the Document object for each document id
+            in matching doc_ids order.
+        @rtype: generator
+        """
+        if self._sync_report is None:
+            doc_ids = list(doc_ids)
+            pending = self._pending_doc_ids(doc_ids)
+            docs = self._get_docs(
+                doc_ids, check_for_conflicts=check_for_conflicts,
+                include_deleted=include_deleted)
+            return self._with_content(
+                docs, pending, check_for_conflicts, include_deleted)
+        docs = self._get_docs(
+            doc_ids, check_for_conflicts=check_for_conflicts,
+            include_deleted=include_deleted)
+        # documents being synced are sent as stored.
+        return self._timed_iter(docs, 'enumerate_changes')
+
+    def _timed_iter(self, iterable, phase):
+        """
+        Yield the items of C{iterable}, adding the time spent producing them
+        to C{phase} of the current sync report.
+        """
+        report = self._sync_report
+        iterator = iter(iterable)
+        while True:
+            with report.phase(phase):
+                try:
+                    item = iterator.next()
+                except StopIteration:
+                    return
+            yield item
+
+    def _get_docs(self, doc_ids, check_for_conflicts, include_deleted):
+        """
+        Yield the documents for C{get_docs}.
+        """
+        if self._doc_cache is None:
+            for doc in sqlite_backend.SQLitePartialExpandDatabase.get_docs(
+                    self, doc_ids, check_for_conflicts=check_for_conflicts,
+                    include_deleted=include_deleted):
+                yield doc
+            return
+        for doc_id in doc_ids:
+            doc = self._get_cached_doc(doc_id, include_deleted=True)
+            if doc is None or (doc.is_tombstone() and not include_deleted):
+                continue
+            if not check_for_conflicts:
+                doc.has_conflicts = False
+            yield doc
+
+    def put_doc(self, doc):
+        """
+        Update a document.
+
+        @param doc: The document to update.
+        @type doc: SoledadDocument
+
+        @return: The new revision identifier for the document.
+        @rtype: str
+
+        @raise ContentPending: If the content of the stored revision of the
+            document was not fetched, so C{doc} can not be based on it.
+        @raise InvalidJSON: If the content of C{doc} is not a JSON object.
+        """
+        if isinstance(doc, SoledadDocument):
+            # documents parse their content lazily.
+            doc.validate_json()
+        if self._pending_doc_ids([doc.doc_id]):
+            raise ContentPending(doc.doc_id)
+        try:
+            return sqlite_backend.SQLitePartialExpandDatabase.put_doc(
+                self, doc)
+        finally:
+            self._invalidate_cached_doc(doc.doc_id)
+
+    def delete_doc(self, doc):
+        """
+        Mark a document as deleted.
+
+        @param doc: The document to delete.
+        @type doc: SoledadDocument
+
+        @return: The new revision identifier for the document.
+        @rtype: str
+        """
+        try:
+            return sqlite_backend.SQLitePartialExpandDatabase.delete_doc(
+                self, doc)
+        finally:
+            self._invalidate_cached_doc(doc.doc_id)
+
+    def resolve_doc(self, doc, conflicted_doc_revs):
+        """
+        Mark a document as no longer conflicted.
+
+        @param doc: A document with the new content to be inserted.
+        @type doc: SoledadDocument
+        @param conflicted_doc_revs: A list of revisions that the new content
+            supersedes.
+        @type conflicted_doc_revs: list
+
+        @raise InvalidJSON: If the content of C{doc} is not a JSON object.
+        """
+        if isinstance(doc, SoledadDocument):
+            doc.validate_json()
+        try:
+            return sqlite_backend.SQLitePartialExpandDatabase.resolve_doc(
+                self, doc, conflicted_doc_revs)
+        finally:
+            self._invalidate_cached_doc(doc.doc_id)
+
+    def _put_doc_if_newer(self, doc, save_conflict, replica_uid=None,
+                          replica_gen=None, replica_trans_id=None):
+        """
+        Insert/update document into the database with a given revision, as
+        done during sync.
+
+        @return: (state, at_gen) - If we don't have doc_id already, or if
+            doc_rev supersedes the existing document revision, then the
+            content will be inserted, and state is 'inserted'.
+        @rtype: tuple
+        """
+        put_doc_if_newer = \
+            sqlite_backend.SQLitePartialExpandDatabase._put_doc_if_newer
+        # u1db replaces the revision of documents it merges locally.
+        rev = doc.rev
+        try:
+            state, at_gen = put_doc_if_newer(
+                self, doc, save_conflict, replica_uid=replica_uid,
+                replica_gen=replica_gen, replica_trans_id=replica_trans_id)
+        finally:
+            self._invalidate_cached_doc(doc.doc_id)
+        if state == 'conflicted' and self._sync_report is not None:
+            self._sync_report.conflicts += 1
+        if getattr(doc, 'content_pending', False):
+            self._record_pending_content(doc, rev, state, replica_gen)
+        return state, at_gen
+
+    def _record_pending_content(self, doc, rev, state, replica_gen):
+        """
+        Record that a document stored during sync has pending content.
+
+        A document is stored as the current revision when it is 'inserted',
+        when it is 'conflicted' and the conflict is saved, and when it is
+        'superseded' by a new local revision merging it. In the last case the
+        stored revision no longer matches the one its envelope was encrypted
+        with, so the envelope is decrypted right away.
+
+        @param doc: The document received without its content.
+        @type doc: SoledadDocument
+        @param rev: The revision the document was received with.
+        @type rev: str
+        @param state: The state returned by C{_put_doc_if_newer}.
+        @type state: str
+        @param replica_gen: The generation of the document in the source
+            replica.
+        @type replica_gen: int
+        """
+        cur_doc = self._get_doc(doc.doc_id)
+        if cur_doc is None or cur_doc.rev != doc.rev:
+            # the document was not stored.
+            return
+        if state not in ('inserted', 'conflicted', 'superseded'):
+            return
+        envelope = getattr(doc, 'encrypted_json', None)
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            # the most recent changes are fetched first.
+            c.execute(
+                'INSERT OR REPLACE INTO pending_content'
+                ' (doc_id, priority, envelope) VALUES (?, ?, ?)',
+                (doc.doc_id, replica_gen or 0, envelope))
+            if envelope is not None and doc.rev != rev:
+                from leap.soledad.target import decrypt_doc
+                new_doc = self._factory(
+                    doc.doc_id, doc.rev,
+                    decrypt_doc(self._crypto, SoledadDocument(
+                        doc.doc_id, rev, envelope)))
+                new_doc.syncable = cur_doc.syncable
+                self._replace_content(new_doc)
+
+    def whats_changed(self, old_generation=0):
+        """
+        Return a list of documents that have changed since old_generation.
+
+        @param old_generation: The generation of the database in the old
+            state.
+        @type old_generation: int
+
+        @return: (generation, trans_id, [(doc_id, generation, trans_id),...])
+        @rtype: tuple
+        """
+        whats_changed = \
+            sqlite_backend.SQLitePartialExpandDatabase.whats_changed
+        if self._sync_report is None:
+            return whats_changed(self, old_generation)
+        with self._sync_report.phase('enumerate_changes'):
+            return whats_changed(self, old_generation)
+
+    def _add_conflict(self, c, doc_id, my_doc_rev, my_content):
+        """
+        Store a conflicted revision of a document.
+        """
+        self._invalidate_cached_doc(doc_id)
+        sqlite_backend.SQLitePartialExpandDatabase._add_conflict(
+            self, c, doc_id, my_doc_rev, my_content)
+
+    def _delete_conflicts(self, c, doc, conflict_revs):
+        """
+        Delete conflicted revisions of a document.
+        """
+        self._invalidate_cached_doc(doc.doc_id)
+        sqlite_backend.SQLitePartialExpandDatabase._delete_conflicts(
+            self, c, doc, conflict_revs)
+
+    def _extra_schema_init(self, c):
+        """
+        Add any extra fields, etc to the basic table definitions.
+
+        @param c: The cursor for querying the database.
+        @type c: dbapi2.cursor
+        """
+        c.execute(
+            'ALTER TABLE document '
+            'ADD COLUMN syncable BOOL NOT NULL DEFAULT TRUE')
+
+    def _put_and_update_indexes(self, old_doc, doc):
+        """
+        Update a document and all indexes related to it.
+
+        @param old_doc: The old version of the document.
+        @type old_doc: u1db.Document
+        @param doc: The new version of the document.
+        @type doc: u1db.Document
+        """
+        self._invalidate_cached_doc(doc.doc_id)
+        sqlite_backend.SQLitePartialExpandDatabase._put_and_update_indexes(
+            self, old_doc, doc)
+        c = self._db_handle.cursor()
+        c.execute('UPDATE document SET syncable=? '
+                  'WHERE doc_id=?',
+                  (doc.syncable, doc.doc_id))
+        c.execute('DELETE FROM pending_content WHERE doc_id=?', (doc.doc_id,))
+        self._update_search_indexes(c, doc)
+        # the changes received by a sync need not be synced again.
+        if self._change_listener is not None and self._sync_report is None:
+            self._change_listener()
+
+    def _replace_content(self, doc):
+        """
+        Replace the stored content of a document with the full content of
+        the same revision, and update all indexes related to it.
+
+        Unlike C{_put_and_update_indexes}, no transaction is logged, so the
+        generation does not change and the document is not sent back to the
+        server by the next sync.
+
+        @param doc: The document, with the stored revision.
+        @type doc: u1db.Document
+        """
+        self._invalidate_cached_doc(doc.doc_id)
+        c = self._db_handle.cursor()
+        c.execute(
+            'UPDATE document SET content=?, syncable=? WHERE doc_id=?',
+            (doc.get_json(), doc.syncable, doc.doc_id))
+        c.execute(
+            'DELETE FROM document_fields WHERE doc_id=?', (doc.doc_id,))
+        indexed_fields = self._get_indexed_fields()
+        if indexed_fields:
+            getters = [(field, self._parse_index_definition(field))
+                       for field in indexed_fields]
+            self._update_indexes(
+                doc.doc_id, json.loads(doc.get_json()), getters, c)
+        c.execute('DELETE FROM pending_content WHERE doc_id=?', (doc.doc_id,))
+        self._update_search_indexes(c, doc)
+
+    def _get_doc(self, doc_id, check_for_conflicts=False):
+        """
+        Get just the document content, without fancy handling.
+
+        @param doc_id: The unique document identifier
+        @type doc_id: str
+        @param include_deleted: If set to True, deleted documents will be
+            returned with empty content. Otherwise asking for a deleted
+            document will return None.
+        @type include_deleted: bool
+
+        @return: a Document object.
+        @type: u1db.Document
+        """
+        doc = sqlite_backend.SQLitePartialExpandDatabase._get_doc(
+            self, doc_id, check_for_conflicts)
+        if doc:
+            c = self._db_handle.cursor()
+            c.execute('SELECT syncable FROM document '
+                      'WHERE doc_id=?',
+                      (doc.doc_id,))
+            result = c.fetchone()
+            doc.syncable = bool(result[0])
+        return doc
+
+    #
+    # Streaming queries
+    #
+
+    FETCH_BATCH_SIZE = 100
+    """
+    Number of rows fetched from the cursor at a time by the iter_* methods.
+    """
+
+    def _iter_docs(self, statement, args=(), batch_size=None):
+        """
+        Run C{statement} and lazily build a document for each resulting row.
+
+        Rows must start with (doc_id, doc_rev, content, conflict count,
+        syncable). Any further columns are ignored.
+
+        @param statement: The SQL statement to run.
+        @type statement: str
+        @param args: The arguments for C{statement}.
+        @type args: tuple
+        @param batch_size: The number of rows to fetch at a time.
+        @type batch_size: int
+
+        @return: An iterator over the resulting documents and their rows.
+        @rtype: generator
+        """
+        c = self._db_handle.cursor()
+        try:
+            c.execute(statement, tuple(args))
+        except dbapi2.OperationalError, e:
+            raise dbapi2.OperationalError(
+                str(e) + '\nstatement: %s\nargs: %s\n' % (statement, args))
+        batch_size = batch_size or self.FETCH_BATCH_SIZE
+        try:
+            while True:
+                rows = c.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    doc = self._factory(row[0], row[1], row[2])
+                    doc.has_conflicts = row[3] > 0
+                    doc.syncable = bool(row[4])
+                    yield doc, row
+        finally:
+            c.close()
+
+    def iter_all_docs(self, include_deleted=False, batch_size=None):
+        """
+        Get the JSON content for all documents in the database, one at a
+        time.
+
+        Unlike C{get_all_docs}, documents are fetched from the database in
+        batches and built only when the iterator reaches them, so memory use
+        does not grow with the number of documents. The database should not
+        be changed while the iterator is being consumed.
+
+        @param include_deleted: If set to True, deleted documents will be
+            returned with empty content. Otherwise deleted documents will not
+            be included in the results.
+        @type include_deleted: bool
+        @param batch_size: The number of rows to fetch at a time.
+        @type batch_size: int
+
+        @return: (generation, docs) - The current generation of the database,
+            followed by an iterator over all of the documents in the
+            database.
+        @rtype: tuple
+        """
+        generation = self._get_generation()
+        where = '' if include_deleted else 'WHERE d.content IS NOT NULL '
+        statement = (
+            'SELECT d.doc_id, d.doc_rev, d.content, count(c.doc_rev), '
+            'd.syncable FROM document d LEFT OUTER JOIN conflicts c '
+            'ON c.doc_id = d.doc_id %s'
+            'GROUP BY d.doc_id, d.doc_rev, d.content, d.syncable' % where)
+        docs = (doc for doc, _ in self._iter_docs(
+            statement, batch_size=batch_size))
+        return generation, docs
+
+    def iter_from_index(self, index_name, *key_values, **kwargs):
+        """
+        Return documents that match the keys supplied, one at a time.
+
+        Documents are ordered by their index values and then by doc_id. They
+        are fetched from the database in batches and built only when the
+        iterator reaches them.
+
+        @param index_name: The index to query.
+        @type index_name: str
+        @param key_values: Values to match, with the same semantics as
+            C{get_from_index}.
+        @type key_values: tuple
+        @param limit: The maximum number of documents to return.
+        @type limit: int
+        @param offset: The number of matching documents to skip.
+        @type offset: int
+        @param page_token: A token returned by C{get_from_index_page}. Only
+            documents after the ones in that page will be returned.
+        @type page_token: str
+        @param batch_size: The number of rows to fetch at a time.
+        @type batch_size: int
+
+        @return: An iterator over the matching documents.
+        @rtype: generator
+
+        @raise InvalidValueForIndex: If the number of values does not match
+            the index definition.
+        @raise InvalidGlobbing: If a non-wildcard value follows a wildcard.
+        """
+        definition = self._get_index_definition(index_name)
+        if len(key_values) != len(definition):
+            raise errors.InvalidValueForIndex()
+        where, args = self._index_match_terms(definition, key_values)
+        return (doc for doc, _ in self._iter_index_query(
+            definition, where, args, **kwargs))
+
+    def iter_range_from_index(self, index_name, start_value=None,
+                              end_value=None, **kwargs):
+        """
+        Return documents that fall within the specified range, one at a
+        time.
+
+        Documents are ordered and paginated as in C{iter_from_index}, which
+        also accepts the same keyword arguments.
+
+        @param index_name: The index to query.
+        @type index_name: str
+        @param start_value: Tuples of values that define the lower bound of
+            the range, with the same semantics as C{get_range_from_index}.
+        @type start_value: tuple
+        @param end_value: Tuples of values that define the upper bound of the
+            range, with the same semantics as C{get_range_from_index}.
+        @type end_value: tuple
+
+        @return: An iterator over the matching documents.
+        @rtype: generator
+        """
+        definition = self._get_index_definition(index_name)
+        where, args = self._index_range_terms(
+            definition, start_value, end_value)
+        return (doc for doc, _ in self._iter_index_query(
+            definition, where, args, **kwargs))
+
+    def get_from_index_page(self, index_name, key_values, page_size,
+                            page_token=None):
+        """
+        Return one page of the documents that match the keys supplied.
+
+        Pages are delimited by the index values of their last document
+        rather than by an offset, so fetching a page costs the same no
+        matter how far into the results it is.
+
+        @param index_name: The index to query.
+        @type index_name: str
+        @param key_values: Values to match, as in C{get_from_index}.
+        @type key_values: tuple
+        @param page_size: The maximum number of documents in the page.
+        @type page_size: int
+        @param page_token: The token returned with the previous page, or
+            None to get the first page.
+        @type page_token: str
+
+        @return: (docs, next_page_token) - The documents in the page and a
+            token for the next one, which is None if this is the last page.
+        @rtype: tuple
+        """
+        definition = self._get_index_definition(index_name)
+        if len(key_values) != len(definition):
+            raise errors.InvalidValueForIndex()
+        where, args = self._index_match_terms(definition, key_values)
+        return self._index_page(
+            definition, where, args, page_size, page_token)
+
+    def get_range_from_index_page(self, index_name, start_value=None,
+                                  end_value=None, page_size=100,
+                                  page_token=None):
+        """
+        Return one page of the documents that fall within the specified
+        range.
+
+        @param index_name: The index to query.
+        @type index_name: str
+        @param start_value: The lower bound of the range, as in
+            C{get_range_from_index}.
+        @type start_value: tuple
+        @param end_value: The upper bound of the range, as in
+            C{get_range_from_index}.
+        @type end_value: tuple
+        @param page_size: The maximum number of documents in the page.
+        @type page_size: int
+        @param page_token: The token returned with the previous page, or
+            None to get the first page.
+        @type page_token: str
+
+        @return: (docs, next_page_token) - The documents in the page and a
+            token for the next one, which is None if this is the last page.
+        @rtype: tuple
+        """
+        definition = self._get_index_definition(index_name)
+        where, args = self._index_range_terms(
+            definition, start_value, end_value)
+        return self._index_page(
+            definition, where, args, page_size, page_token)
+
+    def _index_page(self, definition, where, args, page_size, page_token):
+        """
+        Return one page of the results of an index query and the token for
+        the next page.
+        """
+        docs = []
+        last_row = None
+        for doc, row in self._iter_index_query(
+                definition, where, args, limit=page_size + 1,
+                page_token=page_token):
+            if len(docs) == page_size:
+                # there is at least one more document after this page.
+                return docs, self._encode_page_token(last_row[5:])
+            docs.append(doc)
+            last_row = row
+        return docs, None
+
+    def _iter_index_query(self, definition, where, args, limit=None,
+                          offset=0, page_token=None, batch_size=None):
+        """
+        Build and run a query over the document_fields table.
+
+        Each document is ordered by the smallest of its values that matched
+        each field of the index, and then by its doc_id. Those sort keys are
+        returned after the usual columns so that they can be used to build
+        page tokens.
+
+        @param definition: The index definition.
+        @type definition: list
+        @param where: The conditions over the joined document_fields tables.
+        @type where: list
+        @param args: The arguments for C{where}.
+        @type args: list
+
+        @return: An iterator over (document, row) pairs.
+        @rtype: generator
+        """
+        args = list(args)
+        tables = ['document_fields d%d' % i for i in range(len(definition))]
+        sort_keys = ['min(d%d.value)' % i for i in range(len(definition))]
+        sort_keys.append('d.doc_id')
+        having = ''
+        if page_token is not None:
+            last_keys = self._decode_page_token(page_token)
+            if len(last_keys) != len(sort_keys):
+                raise errors.InvalidValueForIndex()
+            # keyset pagination: select only the rows that sort after the
+            # last row of the previous page.
+            terms = []
+            for idx in range(len(sort_keys)):
+                terms.append('(%s)' % ' AND '.join(
+                    ['%s = ?' % key for key in sort_keys[:idx]] +
+                    ['%s > ?' % sort_keys[idx]]))
+                args.extend(last_keys[:idx + 1])
+            having = ' HAVING %s' % ' OR '.join(terms)
+        statement = (
+            'SELECT d.doc_id, d.doc_rev, d.content, count(c.doc_rev), '
+            'd.syncable, %s FROM document d, %s '
+            'LEFT OUTER JOIN conflicts c ON c.doc_id = d.doc_id '
+            'WHERE %s GROUP BY d.doc_id, d.doc_rev, d.content, d.syncable'
+            '%s ORDER BY %s' % (
+                ', '.join(sort_keys), ', '.join(tables),
+                ' AND '.join(where), having, ', '.join(sort_keys)))
+        if limit is not None or offset:
+            statement += ' LIMIT ? OFFSET ?'
+            args.extend([-1 if limit is None else limit, offset])
+        return self._iter_docs(statement, args, batch_size=batch_size)
+
+    def _index_match_terms(self, definition, key_values):
+        """
+        Return the conditions for an exact or prefix match of an index.
+
+        @param definition: The index definition.
+        @type definition: list
+        @param key_values: The values to match, where a trailing '*' matches
+            any value with that prefix.
+        @type key_values: tuple
+
+        @return: (where, args) - The conditions and their arguments.
+        @rtype: tuple
+        """
+        where = []
+        args = []
+        is_wildcard = False
+        for idx, (field, value) in enumerate(zip(definition, key_values)):
+            where.append(
+                'd.doc_id = d%d.doc_id AND d%d.field_name = ?' % (idx, idx))
+            args.append(field)
+            if value.endswith('*'):
+                if value != '*':
+                    if is_wildcard:
+                        raise errors.InvalidGlobbing
+                    where.append('d%d.value GLOB ?' % idx)
+                    args.append(self._glob_prefix(value[:-1]))
+                is_wildcard = True
+            else:
+                if is_wildcard:
+                    raise errors.InvalidGlobbing
+                where.append('d%d.value = ?' % idx)
+                args.append(value)
+        return where, args
+
+    def _index_range_terms(self, definition, start_value, end_value):
+        """
+        Return the conditions for a range query over an index.
+
+        @param definition: The index definition.
+        @type definition: list
+        @param start_value: The lower bound of the range.
+        @type start_value: tuple
+        @param end_value: The upper bound of the range.
+        @type end_value: tuple
+
+        @return: (where, args) - The conditions and their arguments.
+        @rtype: tuple
+        """
+        where = ['d.doc_id = d%d.doc_id AND d%d.field_name = ?' % (i, i)
+                 for i in range(len(definition))]
+        args = list(definition)
+        for bound, op in ((start_value, '>='), (end_value, '<=')):
+            if not bound:
+                continue
+            if isinstance(bound, basestring):
+                bound = (bound,)
+            if len(bound) != len(definition):
+                raise errors.InvalidValueForIndex()
+            is_wildcard = False
+            for idx, value in enumerate(bound):
+                if value.endswith('*'):
+                    if value != '*':
+                        if is_wildcard:
+                            raise errors.InvalidGlobbing
+                        prefix = value[:-1]
+                        if op == '>=':
+                            where.append('d%d.value >= ?' % idx)
+                            args.append(prefix)
+                        else:
+                            # anything starting with the prefix is still
+                            # within the upper bound.
+                            where.append(
+                                '(d%d.value <= ? OR d%d.value GLOB ?)'
+                                % (idx, idx))
+                            args.extend([prefix, self._glob_prefix(prefix)])
+                    is_wildcard = True
+                else:
+                    if is_wildcard:
+                        raise errors.InvalidGlobbing
+                    where.append('d%d.value %s ?' % (idx, op))
+                    args.append(value)
+        return where, args
+
+    @staticmethod
+    def _glob_prefix(prefix):
+        """
+        Return a GLOB pattern that matches any value starting with C{prefix}.
+        """
+        for char in '[*?':
+            prefix = prefix.replace(char, '[%s]' % char)
+        return prefix + '*'
+
+    @staticmethod
+    def _encode_page_token(sort_keys):
+        """
+        Encode the sort keys of the last document in a page as an opaque
+        token.
+        """
+        return base64.urlsafe_b64encode(json.dumps(list(sort_keys)))
+
+    @staticmethod
+    def _decode_page_token(page_token):
+        """
+        Decode a token built by C{_encode_page_token}.
+        """
+        try:
+            return json.loads(base64.urlsafe_b64decode(str(page_token)))
+        except (TypeError, ValueError):
+            raise errors.InvalidValueForIndex()
+
+    #
+    # Full-text search
+    #
+
+    def _ensure_search_tables(self):
+        """
+        Create the tables that define full-text search indexes, if needed,
+        and register the function that ranks their matches.
+
+        Each search index is an FTS4 table with the text of the indexed
+        fields of each document, whose rows are mapped to documents by the
+        search_doc table.
+        """
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute(
+                'CREATE TABLE IF NOT EXISTS search_index ('
+                ' name TEXT PRIMARY KEY,'
+                ' id INTEGER NOT NULL UNIQUE,'
+                ' fields TEXT NOT NULL)')
+            c.execute(
+                'CREATE TABLE IF NOT EXISTS search_doc ('
+                ' docid INTEGER PRIMARY KEY AUTOINCREMENT,'
+                ' doc_id TEXT NOT NULL UNIQUE)')
+        self._db_handle.create_function(
+            'soledad_search_rank', 1, self._search_rank)
+
+    def create_search_index(self, index_name, *fields):
+        """
+        Create a full-text search index over the text of some fields of the
+        documents.
+
+        Fields are given as dotted paths to string values, or to lists of
+        them. The index is kept up to date by every write, including the
+        documents inserted by syncs, in the same transaction. It is stored in
+        the encrypted database like the documents themselves.
+
+        @param index_name: A unique name for the index.
+        @type index_name: str
+        @param fields: The fields whose text is indexed, e.g. 'subject' or
+            'headers.from'.
+        @type fields: tuple of str
+
+        @raise IndexNameTakenError: If an index with the same name but
+            different fields exists.
+        @raise dbapi2.OperationalError: If SQLCipher was built without FTS4.
+        """
+        fields = list(fields)
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute(
+                'SELECT fields FROM search_index WHERE name = ?',
+                (index_name,))
+            row = c.fetchone()
+            if row is not None:
+                if json.loads(row[0]) == fields:
+                    return
+                raise errors.IndexNameTakenError
+            c.execute('SELECT coalesce(max(id), 0) + 1 FROM search_index')
+            index_id = c.fetchone()[0]
+            c.execute(
+                'INSERT INTO search_index (name, id, fields) VALUES (?, ?, ?)',
+                (index_name, index_id, json.dumps(fields)))
+            c.execute(
+                'CREATE VIRTUAL TABLE search_index_%d USING fts4(text)'
+                % index_id)
+            # index the documents already stored.
+            docs = self._db_handle.cursor()
+            docs.execute(
+                'SELECT doc_id, content FROM document'
+                ' WHERE content IS NOT NULL')
+            for doc_id, content in docs:
+                text = self._search_text(json.loads(content), fields)
+                if text:
+                    c.execute(
+                        'INSERT INTO search_index_%d (docid, text)'
+                        ' VALUES (?, ?)' % index_id,
+                        (self._search_docid(c, doc_id), text))
+
+    def delete_search_index(self, index_name):
+        """
+        Remove a full-text search index.
+
+        @param index_name: The name of the index.
+        @type index_name: str
+        """
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute(
+                'SELECT id FROM search_index WHERE name = ?', (index_name,))
+            row = c.fetchone()
+            if row is None:
+                return
+            c.execute('DROP TABLE search_index_%d' % row[0])
+            c.execute(
+                'DELETE FROM search_index WHERE name = ?', (index_name,))
+            c.execute('SELECT count(*) FROM search_index')
+            if not c.fetchone()[0]:
+                c.execute('DELETE FROM search_doc')
+
+    def list_search_indexes(self):
+        """
+        List the full-text search indexes.
+
+        @return: A list of (index_name, [field, ...]).
+        @rtype: list
+        """
+        c = self._db_handle.cursor()
+        c.execute('SELECT name, fields FROM search_index ORDER BY name')
+        return [(name, json.loads(fields)) for name, fields in c.fetchall()]
+
+    def search(self, index_name, query, limit=10):
+        """
+        Return the ids of the documents that match a full-text query, the
+        most relevant first.
+
+        Documents rank higher the more often the terms of the query appear
+        in them, with rare terms weighting more than common ones.
+
+        @param index_name: The name of the index.
+        @type index_name: str
+        @param query: The query, in the syntax of SQLite's FTS4 MATCH
+            operator, e.g. 'soledad sync*' or '"exact phrase" OR other'.
+        @type query: str
+        @param limit: The maximum number of ids to return, or None for all.
+        @type limit: int
+
+        @return: The ids of the matching documents.
+        @rtype: list of str
+
+        @raise IndexDoesNotExist: If there is no index with that name.
+        @raise InvalidSearchQuery: If the query is malformed.
+        """
+        c = self._db_handle.cursor()
+        c.execute(
+            'SELECT id FROM search_index WHERE name = ?', (index_name,))
+        row = c.fetchone()
+        if row is None:
+            raise errors.IndexDoesNotExist
+        table = 'search_index_%d' % row[0]
+        try:
+            c.execute(
+                'SELECT s.doc_id FROM search_doc s JOIN ('
+                ' SELECT docid, soledad_search_rank(matchinfo(%s, \'pcx\'))'
+                '  AS rank FROM %s WHERE %s MATCH ?'
+                '  ORDER BY rank DESC LIMIT ?) r'
+                ' ON s.docid = r.docid ORDER BY r.rank DESC, s.doc_id'
+                % (table, table, table),
+                (query, -1 if limit is None else limit))
+            return [doc_id for doc_id, in c.fetchall()]
+        except dbapi2.OperationalError, e:
+            raise InvalidSearchQuery(str(e))
+
+    def _update_search_indexes(self, c, doc):
+        """
+        Update the full-text search indexes with a new version of a
+        document.
+
+        @param c: The cursor for querying the database.
+        @type c: dbapi2.cursor
+        @param doc: The new version of the document.
+        @type doc: u1db.Document
+        """
+        c.execute('SELECT id, fields FROM search_index')
+        indexes = c.fetchall()
+        if not indexes:
+            return
+        content = None if doc.is_tombstone() else doc.content
+        if content is None:
+            c.execute(
+                'SELECT docid FROM search_doc WHERE doc_id = ?',
+                (doc.doc_id,))
+            row = c.fetchone()
+            if row is None:
+                return
+            docid = row[0]
+            c.execute('DELETE FROM search_doc WHERE docid = ?', (docid,))
+        else:
+            docid = self._search_docid(c, doc.doc_id)
+        for index_id, fields in indexes:
+            c.execute(
+                'DELETE FROM search_index_%d WHERE docid = ?' % index_id,
+                (docid,))
+            if content is None:
+                continue
+            text = self._search_text(content, json.loads(fields))
+            if text:
+                c.execute(
+                    'INSERT INTO search_index_%d (docid, text) VALUES (?, ?)'
+                    % index_id, (docid, text))
+
+    @staticmethod
+    def _search_docid(c, doc_id):
+        """
+        Return the integer id the search indexes know a document by.
+        """
+        c.execute('SELECT docid FROM search_doc WHERE doc_id = ?', (doc_id,))
+        row = c.fetchone()
+        if row is not None:
+            return row[0]
+        c.execute('INSERT INTO search_doc (doc_id) VALUES (?)', (doc_id,))
+        return c.lastrowid
+
+    @staticmethod
+    def _search_text(content, fields):
+        """
+        Return the text of the indexed fields of a document's content.
+        """
+        values = []
+        for field in fields:
+            value = content
+            for key in field.split('.'):
+                value = value.get(key) if isinstance(value, dict) else None
+            if not isinstance(value, list):
+                value = [value]
+            values.extend(item for item in value
+                          if isinstance(item, basestring))
+        return '\n'.join(values)
+
+    @staticmethod
+    def _search_rank(matchinfo):
+        """
+        Score a full-text match from the output of FTS4's matchinfo() with
+        the 'pcx' format: each hit of a phrase counts as its share of all
+        hits of that phrase, so rare phrases weigh more.
+        """
+        info = array.array('I', str(matchinfo))
+        phrases, columns = info[0], info[1]
+        score = 0.0
+        for offset in xrange(2, 2 + 3 * phrases * columns, 3):
+            hits, all_hits = info[offset], info[offset + 1]
+            if hits:
+                score += float(hits) / all_hits
+        return score
+
+    #
+    # Blobs
+    #
+
+    def _ensure_blob_tables(self):
+        """
+        Create the tables blobs are stored in, if needed.
+
+        The blob table holds the size and the number of chunks of each blob,
+        the blob_part table which chunk is at each position of a blob, and
+        the blob_chunk table the content of each distinct chunk.
+        """
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute(
+                'CREATE TABLE IF NOT EXISTS blob ('
+                ' blob_id TEXT PRIMARY KEY,'
+                ' size INTEGER NOT NULL,'
+                ' chunks INTEGER NOT NULL,'
+                ' synced BOOLEAN NOT NULL DEFAULT 0)')
+            c.execute(
+                'CREATE TABLE IF NOT EXISTS blob_part ('
+                ' blob_id TEXT NOT NULL,'
+                ' chunk_index INTEGER NOT NULL,'
+                ' hash TEXT NOT NULL,'
+                ' PRIMARY KEY (blob_id, chunk_index))')
+            c.execute(
+                'CREATE INDEX IF NOT EXISTS blob_part_hash'
+                ' ON blob_part (hash)')
+            c.execute(
+                'CREATE TABLE IF NOT EXISTS blob_chunk ('
+                ' hash TEXT PRIMARY KEY,'
+                ' data BLOB NOT NULL)')
+
+    def create_blob(self, chunk_size=None):
+        """
+        Return a file-like object that stores what is written to it as a new
+        blob, see C{leap.soledad.blobs.BlobWriter}.
+
+        @param chunk_size: The size of the chunks, in bytes, or None for
+            the default size.
+        @type chunk_size: int
+
+        @rtype: leap.soledad.blobs.BlobWriter
+        """
+        from leap.soledad.blobs import BlobWriter, CHUNK_SIZE
+        return BlobWriter(self, chunk_size=chunk_size or CHUNK_SIZE)
+
+    def open_blob(self, blob_id):
+        """
+        Return a file-like object that reads a blob.
+
+        @param blob_id: The id of the blob.
+        @type blob_id: str
+
+        @rtype: leap.soledad.blobs.BlobReader
+
+        @raise BlobNotFound: If the blob is not completely stored.
+        """
+        from leap.soledad.blobs import BlobReader
+        return BlobReader(self, blob_id)
+
+    def get_blob_info(self, blob_id):
+        """
+        Return what is known about a blob.
+
+        @param blob_id: The id of the blob.
+        @type blob_id: str
+
+        @return: The 'size' of the blob, its number of 'chunks', the number
+            of them stored locally, in 'stored_chunks', and whether it was
+            'synced', or None if the blob is unknown.
+        @rtype: dict
+        """
+        c = self._db_handle.cursor()
+        c.execute(
+            'SELECT size, chunks, synced,'
+            ' (SELECT count(*) FROM blob_part p'
+            '  WHERE p.blob_id = blob.blob_id)'
+            ' FROM blob WHERE blob_id = ?', (blob_id,))
+        row = c.fetchone()
+        if row is None:
+            return None
+        size, chunks, synced, stored_chunks = row
+        return {
+            'size': size,
+            'chunks': chunks,
+            'stored_chunks': stored_chunks,
+            'synced': bool(synced),
+        }
+
+    def list_blobs(self):
+        """
+        Return the ids of the blobs completely stored locally.
+
+        @rtype: list of str
+        """
+        c = self._db_handle.cursor()
+        c.execute(
+            'SELECT blob_id FROM blob WHERE chunks ='
+            ' (SELECT count(*) FROM blob_part p'
+            '  WHERE p.blob_id = blob.blob_id)'
+            ' ORDER BY blob_id')
+        return [blob_id for blob_id, in c.fetchall()]
+
+    def delete_blob(self, blob_id):
+        """
+        Remove a blob from the local database.
+
+        The chunks it shares with other blobs are kept.
+
+        @param blob_id: The id of the blob.
+        @type blob_id: str
+        """
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute('DELETE FROM blob WHERE blob_id = ?', (blob_id,))
+            self._delete_blob_parts(blob_id, c=c)
+
+    def _get_unsynced_blobs(self):
+        """
+        Return the ids of the local blobs that were not uploaded yet.
+
+        @rtype: list of str
+        """
+        c = self._db_handle.cursor()
+        c.execute(
+            'SELECT blob_id FROM blob WHERE NOT synced AND chunks ='
+            ' (SELECT count(*) FROM blob_part p'
+            '  WHERE p.blob_id = blob.blob_id)'
+            ' ORDER BY blob_id')
+        return [blob_id for blob_id, in c.fetchall()]
+
+    def _set_blob_synced(self, blob_id):
+        """
+        Record that the server stores a blob.
+
+        @param blob_id: The id of the blob.
+        @type blob_id: str
+        """
+        with self._db_handle:
+            self._db_handle.cursor().execute(
+                'UPDATE blob SET synced = 1 WHERE blob_id = ?', (blob_id,))
+
+    def _put_blob_definition(self, blob_id, size, chunks):
+        """
+        Record a blob the server stores, before its chunks are downloaded.
+
+        @param blob_id: The id of the blob.
+        @type blob_id: str
+        @param size: The size of the blob, in bytes.
+        @type size: int
+        @param chunks: The number of chunks of the blob.
+        @type chunks: int
+        """
+        with self._db_handle:
+            self._db_handle.cursor().execute(
+                'INSERT OR IGNORE INTO blob (blob_id, size, chunks, synced)'
+                ' VALUES (?, ?, ?, 1)', (blob_id, size, chunks))
+
+    def _put_blob(self, pending_id, blob_id, size, chunks):
+        """
+        Store a blob whose chunks were stored under a temporary id.
+
+        If the blob is already completely stored, the new chunks are
+        discarded. Otherwise they replace the ones stored.
+
+        @param pending_id: The id the chunks were stored under.
+        @type pending_id: str
+        @param blob_id: The id of the blob.
+        @type blob_id: str
+        @param size: The size of the blob, in bytes.
+        @type size: int
+        @param chunks: The number of chunks of the blob.
+        @type chunks: int
+        """
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute(
+                'SELECT count(*) FROM blob_part WHERE blob_id = ?',
+                (blob_id,))
+            stored_chunks = c.fetchone()[0]
+            c.execute(
+                'INSERT OR IGNORE INTO blob (blob_id, size, chunks)'
+                ' VALUES (?, ?, ?)', (blob_id, size, chunks))
+            if stored_chunks == chunks:
+                self._delete_blob_parts(pending_id, c=c)
+                return
+            c.execute('DELETE FROM blob_part WHERE blob_id = ?', (blob_id,))
+            c.execute(
+                'UPDATE blob_part SET blob_id = ? WHERE blob_id = ?',
+                (blob_id, pending_id))
+
+    def _delete_blob_parts(self, blob_id, c=None):
+        """
+        Remove the chunks of a blob, except those other blobs hold.
+
+        @param blob_id: The id of the blob.
+        @type blob_id: str
+        @param c: A cursor to run in the current transaction, or None to run
+            in a new one.
+        @type c: dbapi2.cursor
+        """
+        if c is None:
+            with self._db_handle:
+                return self._delete_blob_parts(
+                    blob_id, c=self._db_handle.cursor())
+        c.execute('DELETE FROM blob_part WHERE blob_id = ?', (blob_id,))
+        c.execute(
+            'DELETE FROM blob_chunk WHERE NOT EXISTS ('
+            ' SELECT 1 FROM blob_part p WHERE p.hash = blob_chunk.hash)')
+
+    def _put_blob_part(self, blob_id, index, data):
+        """
+        Store a chunk of a blob.
+
+        @param blob_id: The id of the blob.
+        @type blob_id: str
+        @param index: The position of the chunk in the blob.
+        @type index: int
+        @param data: The content of the chunk.
+        @type data: str
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute(
+                'INSERT OR IGNORE INTO blob_chunk (hash, data) VALUES (?, ?)',
+                (digest, dbapi2.Binary(data)))
+            c.execute(
+                'INSERT OR REPLACE INTO blob_part'
+                ' (blob_id, chunk_index, hash) VALUES (?, ?, ?)',
+                (blob_id, index, digest))
+
+    def _get_blob_part(self, blob_id, index):
+        """
+        Return a chunk of a blob.
+
+        @param blob_id: The id of the blob.
+        @type blob_id: str
+        @param index: The position of the chunk in the blob.
+        @type index: int
+
+        @return: The content of the chunk.
+        @rtype: str
+
+        @raise BlobNotFound: If the chunk is not stored.
+        """
+        c = self._db_handle.cursor()
+        c.execute(
+            'SELECT c.data FROM blob_part p JOIN blob_chunk c'
+            ' ON c.hash = p.hash'
+            ' WHERE p.blob_id = ? AND p.chunk_index = ?', (blob_id, index))
+        row = c.fetchone()
+        if row is None:
+            from leap.soledad.blobs import BlobNotFound
+            raise BlobNotFound(blob_id)
+        return str(row[0])
+
+    def _get_blob_part_indexes(self, blob_id):
+        """
+        Return the positions of the chunks of a blob stored locally.
+
+        @param blob_id: The id of the blob.
+        @type blob_id: str
+
+        @rtype: set of int
+        """
+        c = self._db_handle.cursor()
+        c.execute(
+            'SELECT chunk_index FROM blob_part WHERE blob_id = ?',
+            (blob_id,))
+        return set(index for index, in c.fetchall())
 
-class DatabaseIsNotEncrypted(Exception):
+    #
+    # Migration of cryptographic parameters
+    #
+
+    MIGRATION_TARGET_SUFFIX = '.migrating'
     """
-    Exception raised when trying to open non-encrypted databases.
+    The suffix of the file the database is exported to during migration.
     """
-    pass
-
 
-class NotAnHexString(Exception):
+    MIGRATION_STATE_SUFFIX = '.migration'
     """
-    Raised when trying to (raw) key the database with a non-hex string.
+    The suffix of the file that records the stage of an ongoing migration.
     """
-    pass
-
 
-#
-# The SQLCipher database
-#
+    MIGRATION_PROGRESS_INTERVAL = 1000
+    """
+    Number of SQLite virtual machine instructions between progress reports.
+    """
 
-class SQLCipherDatabase(sqlite_backend.SQLitePartialExpandDatabase):
-    """A U1DB implementation that uses SQLCipher as its persistence layer."""
+    @classmethod
+    def migrate_database(cls, sqlcipher_file, password, raw_key=False,
+                         cipher='aes-256-cbc', kdf_iter=4000,
+                         cipher_page_size=1024, new_password=None,
+                         new_raw_key=None, new_cipher=None, new_kdf_iter=None,
+                         new_cipher_page_size=None, progress_cb=None):
+        """
+        Re-encrypt C{sqlcipher_file} with new cryptographic parameters.
 
-    _index_storage_value = 'expand referenced encrypted'
+        The database is exported with sqlcipher_export() to a new file that
+        is keyed with the new parameters. The new file is then verified and
+        atomically renamed over the original one. The current stage is
+        recorded in a state file, so calling this method again after an
+        interruption resumes the migration instead of starting it over. No
+        key material is ever written to the state file.
 
-    def __init__(self, sqlcipher_file, password, document_factory=None,
-                 crypto=None, raw_key=False, cipher='aes-256-cbc',
-                 kdf_iter=4000, cipher_page_size=1024):
-        """
-        Create a new sqlcipher file.
+        The database must not be opened by anyone else while it is migrated.
 
         @param sqlcipher_file: The path for the SQLCipher file.
         @type sqlcipher_file: str
-        @param password: The password that protects the SQLCipher db.
+        @param password: The current password that protects the db.
         @type password: str
-        @param document_factory: A function that will be called with the same
-            parameters as Document.__init__.
-        @type document_factory: callable
-        @param crypto: An instance of SoledadCrypto so we can encrypt/decrypt
-            document contents when syncing.
-        @type crypto: soledad.crypto.SoledadCrypto
         @param raw_key: Whether C{password} is a raw 64-char hex string or a
             passphrase that should be hashed to obtain the encyrption key.
         @type raw_key: bool
-        @param cipher: The cipher and mode to use.
+        @param cipher: The current cipher and mode.
         @type cipher: str
-        @param kdf_iter: The number of iterations to use.
+        @param kdf_iter: The current number of iterations.
         @type kdf_iter: int
-        @param cipher_page_size: The page size.
+        @param cipher_page_size: The current page size.
         @type cipher_page_size: int
+        @param new_password: The new password.
+        @type new_password: str
+        @param new_raw_key: Whether C{new_password} is a raw key.
+        @type new_raw_key: bool
+        @param new_cipher: The new cipher and mode.
+        @type new_cipher: str
+        @param new_kdf_iter: The new number of iterations.
+        @type new_kdf_iter: int
+        @param new_cipher_page_size: The new page size.
+        @type new_cipher_page_size: int
+        @param progress_cb: A callable that will be called with the name of
+            the current migration stage and the fraction of the work done.
+        @type progress_cb: callable
+
+        @raise MigrationFailed: If the exported database does not match the
+            original one.
         """
-        # ensure the db is encrypted if the file already exists
-        if os.path.exists(sqlcipher_file):
-            self.assert_db_is_encrypted(
-                sqlcipher_file, password, raw_key, cipher, kdf_iter,
-                cipher_page_size)
-        # connect to the database
-        self._db_handle = dbapi2.connect(sqlcipher_file)
-        # set SQLCipher cryptographic parameters
-        self._set_crypto_pragmas(
-            self._db_handle, password, raw_key, cipher, kdf_iter,
-            cipher_page_size)
-        self._real_replica_uid = None
-        self._ensure_schema()
-        self._crypto = crypto
-
-        def factory(doc_id=None, rev=None, json='{}', has_conflicts=False,
-                    syncable=True):
-            return SoledadDocument(doc_id=doc_id, rev=rev, json=json,
-                                has_conflicts=has_conflicts,
-                                syncable=syncable)
-        self.set_document_factory(factory)
+        if new_password is None:
+            new_password, new_raw_key = password, raw_key
+        elif new_raw_key is None:
+            new_raw_key = raw_key
+        new_params = (
+            new_password, new_raw_key,
+            new_cipher or cipher,
+            new_kdf_iter or kdf_iter,
+            new_cipher_page_size or cipher_page_size)
+        if progress_cb is None:
+            progress_cb = lambda stage, fraction: None
+        target_file = sqlcipher_file + cls.MIGRATION_TARGET_SUFFIX
+        state_file = sqlcipher_file + cls.MIGRATION_STATE_SUFFIX
+        state = cls._load_migration_state(state_file)
+        if state.get('stage') == MigrationStages.EXPORTED:
+            if not os.path.exists(target_file):
+                # we were interrupted after the files were swapped.
+                cls._verify_migration(
+                    sqlcipher_file, new_params, state['doc_count'])
+                os.unlink(state_file)
+                progress_cb(MigrationStages.DONE, 1.0)
+                return
+            logger.info('Resuming migration of %s.' % sqlcipher_file)
+            progress_cb(MigrationStages.VERIFYING, 0.0)
+            try:
+                cls._verify_migration(
+                    target_file, new_params, state['doc_count'])
+            except (MigrationFailed, dbapi2.DatabaseError):
+                # the exported file is unusable, so start it over.
+                state = {}
+        if state.get('stage') != MigrationStages.EXPORTED:
+            if os.path.exists(target_file):
+                # a previous export was interrupted, so start it over.
+                os.unlink(target_file)
+            state = cls._export_database(
+                sqlcipher_file, target_file, state_file,
+                (password, raw_key, cipher, kdf_iter, cipher_page_size),
+                new_params, progress_cb)
+            progress_cb(MigrationStages.VERIFYING, 0.0)
+            cls._verify_migration(
+                target_file, new_params, state['doc_count'])
+        progress_cb(MigrationStages.SWAPPING, 0.0)
+        cls._swap_files(target_file, sqlcipher_file)
+        os.unlink(state_file)
+        progress_cb(MigrationStages.DONE, 1.0)
 
     @classmethod
-    def _open_database(cls, sqlcipher_file, password, document_factory=None,
-                       crypto=None, raw_key=False, cipher='aes-256-cbc',
-                       kdf_iter=4000, cipher_page_size=1024):
+    def _load_migration_state(cls, state_file):
         """
-        Open a SQLCipher database.
+        Load the state of an interrupted migration.
 
-        @param sqlcipher_file: The path for the SQLCipher file.
-        @type sqlcipher_file: str
-        @param password: The password that protects the SQLCipher db.
-        @type password: str
-        @param document_factory: A function that will be called with the same
-            parameters as Document.__init__.
-        @type document_factory: callable
-        @param crypto: An instance of SoledadCrypto so we can encrypt/decrypt
-            document contents when syncing.
-        @type crypto: soledad.crypto.SoledadCrypto
-        @param raw_key: Whether C{password} is a raw 64-char hex string or a
-            passphrase that should be hashed to obtain the encyrption key.
-        @type raw_key: bool
-        @param cipher: The cipher and mode to use.
-        @type cipher: str
-        @param kdf_iter: The number of iterations to use.
-        @type kdf_iter: int
-        @param cipher_page_size: The page size.
-        @type cipher_page_size: int
+        @param state_file: The path for the migration state file.
+        @type state_file: str
 
-        @return: The database object.
-        @rtype: SQLCipherDatabase
+        @return: The migration state, or an empty dict if there is none.
+        @rtype: dict
         """
-        if not os.path.isfile(sqlcipher_file):
-            raise errors.DatabaseDoesNotExist()
-        tries = 2
-        while True:
-            # Note: There seems to be a bug in sqlite 3.5.9 (with python2.6)
-            #       where without re-opening the database on Windows, it
-            #       doesn't see the transaction that was just committed
-            db_handle = dbapi2.connect(sqlcipher_file)
-            # set cryptographic params
-            cls._set_crypto_pragmas(
-                db_handle, password, raw_key, cipher, kdf_iter,
-                cipher_page_size)
-            c = db_handle.cursor()
-            v, err = cls._which_index_storage(c)
-            db_handle.close()
-            if v is not None:
-                break
-            # possibly another process is initializing it, wait for it to be
-            # done
-            if tries == 0:
-                raise err  # go for the richest error?
-            tries -= 1
-            time.sleep(cls.WAIT_FOR_PARALLEL_INIT_HALF_INTERVAL)
-        return SQLCipherDatabase._sqlite_registry[v](
-            sqlcipher_file, password, document_factory=document_factory,
-            crypto=crypto, raw_key=raw_key, cipher=cipher, kdf_iter=kdf_iter,
-            cipher_page_size=cipher_page_size)
+        if not os.path.isfile(state_file):
+            return {}
+        with io.open(state_file, 'rb') as f:
+            try:
+                return json.loads(f.read())
+            except ValueError:
+                # the state file itself was not completely written.
+                return {}
 
     @classmethod
-    def open_database(cls, sqlcipher_file, password, create, backend_cls=None,
-                      document_factory=None, crypto=None, raw_key=False,
-                      cipher='aes-256-cbc', kdf_iter=4000,
-                      cipher_page_size=1024):
+    def _store_migration_state(cls, state_file, state):
         """
-        Open a SQLCipher database.
-
-        @param sqlcipher_file: The path for the SQLCipher file.
-        @type sqlcipher_file: str
-        @param password: The password that protects the SQLCipher db.
-        @type password: str
-        @param create: Should the datbase be created if it does not already
-            exist?
-        @type: bool
-        @param backend_cls: A class to use as backend.
-        @type backend_cls: type
-        @param document_factory: A function that will be called with the same
-            parameters as Document.__init__.
-        @type document_factory: callable
-        @param crypto: An instance of SoledadCrypto so we can encrypt/decrypt
-            document contents when syncing.
-        @type crypto: soledad.crypto.SoledadCrypto
-        @param raw_key: Whether C{password} is a raw 64-char hex string or a
-            passphrase that should be hashed to obtain the encyrption key.
-        @type raw_key: bool
-        @param cipher: The cipher and mode to use.
-        @type cipher: str
-        @param kdf_iter: The number of iterations to use.
-        @type kdf_iter: int
-        @param cipher_page_size: The page size.
-        @type cipher_page_size: int
+        Durably store the state of a migration.
 
-        @return: The database object.
-        @rtype: SQLCipherDatabase
+        @param state_file: The path for the migration state file.
+        @type state_file: str
+        @param state: The migration state.
+        @type state: dict
         """
-        try:
-            return cls._open_database(
-                sqlcipher_file, password, document_factory=document_factory,
-                crypto=crypto, raw_key=raw_key, cipher=cipher,
-                kdf_iter=kdf_iter, cipher_page_size=cipher_page_size)
-        except errors.DatabaseDoesNotExist:
-            if not create:
-                raise
-            # TODO: remove backend class from here.
-            if backend_cls is None:
-                # default is SQLCipherPartialExpandDatabase
-                backend_cls = SQLCipherDatabase
-            return backend_cls(
-                sqlcipher_file, password, document_factory=document_factory,
-                crypto=crypto, raw_key=raw_key, cipher=cipher,
-                kdf_iter=kdf_iter, cipher_page_size=cipher_page_size)
+        with io.open(state_file, 'wb') as f:
+            f.write(json.dumps(state))
+            f.flush()
+            os.fsync(f.fileno())
 
-    def sync(self, url, creds=None, autocreate=True):
+    @classmethod
+    def _key_literal(cls, key, raw_key):
         """
-        Synchronize documents with remote replica exposed at url.
+        Return C{key} formatted for use in an ATTACH statement.
 
-        @param url: The url of the target replica to sync with.
-        @type url: str
-        @param creds: optional dictionary giving credentials.
-            to authorize the operation with the server.
-        @type creds: dict
-        @param autocreate: Ask the target to create the db if non-existent.
-        @type autocreate: bool
+        The format must match the one used by C{_pragma_key_raw} and
+        C{_pragma_key_passphrase}, or the exported database would not be
+        readable with the same key afterwards.
 
-        @return: The local generation before the synchronisation was performed.
-        @rtype: int
-        """
-        from u1db.sync import Synchronizer
-        from leap.soledad.target import SoledadSyncTarget
-        return Synchronizer(
-            self,
-            SoledadSyncTarget(url,
-                           creds=creds,
-                           crypto=self._crypto)).sync(autocreate=autocreate)
+        @param key: The key.
+        @type key: str
+        @param raw_key: Whether C{key} is a raw 64-char hex string.
+        @type raw_key: bool
 
-    def _extra_schema_init(self, c):
+        @return: The key literal.
+        @rtype: str
         """
-        Add any extra fields, etc to the basic table definitions.
+        if raw_key:
+            if not all(c in string.hexdigits for c in key):
+                raise NotAnHexString(key)
+            return '"x\'%s"' % key
+        return "'%s'" % key.replace("'", "''")
 
-        @param c: The cursor for querying the database.
-        @type c: dbapi2.cursor
+    @classmethod
+    def _export_database(cls, sqlcipher_file, target_file, state_file,
+                         params, new_params, progress_cb):
         """
-        c.execute(
-            'ALTER TABLE document '
-            'ADD COLUMN syncable BOOL NOT NULL DEFAULT TRUE')
+        Export the contents of C{sqlcipher_file} to a new database keyed with
+        C{new_params}.
 
-    def _put_and_update_indexes(self, old_doc, doc):
+        @param sqlcipher_file: The path for the SQLCipher file.
+        @type sqlcipher_file: str
+        @param target_file: The path for the new SQLCipher file.
+        @type target_file: str
+        @param state_file: The path for the migration state file.
+        @type state_file: str
+        @param params: The current (key, raw_key, cipher, kdf_iter,
+            cipher_page_size).
+        @type params: tuple
+        @param new_params: The new (key, raw_key, cipher, kdf_iter,
+            cipher_page_size).
+        @type new_params: tuple
+        @param progress_cb: A callable that will be called with the name of
+            the current migration stage and the fraction of the work done.
+        @type progress_cb: callable
+
+        @return: The migration state after the export.
+        @rtype: dict
         """
-        Update a document and all indexes related to it.
+        key, raw_key, cipher, kdf_iter, cipher_page_size = new_params
+        state = {'stage': MigrationStages.EXPORTING}
+        cls._store_migration_state(state_file, state)
+        progress_cb(MigrationStages.EXPORTING, 0.0)
+        db_handle = cls._connect(sqlcipher_file, *params)
+        try:
+            c = db_handle.cursor()
+            c.execute('SELECT count(*) FROM document')
+            state['doc_count'] = c.fetchone()[0]
+            c.execute(
+                "ATTACH DATABASE '%s' AS migrated KEY %s"
+                % (target_file.replace("'", "''"),
+                   cls._key_literal(key, raw_key)))
+            c.execute("PRAGMA migrated.cipher = '%s'" % cipher)
+            c.execute("PRAGMA migrated.kdf_iter = '%d'" % kdf_iter)
+            c.execute(
+                "PRAGMA migrated.cipher_page_size = '%d'" % cipher_page_size)
+            # sqlcipher_export() is a single statement, so estimate its
+            # progress by the size of the exported file.
+            total_size = float(max(os.path.getsize(sqlcipher_file), 1))
+
+            def _report_progress():
+                if os.path.exists(target_file):
+                    progress_cb(
+                        MigrationStages.EXPORTING,
+                        min(os.path.getsize(target_file) / total_size, 1.0))
+                return 0  # returning non-zero would abort the export
+
+            db_handle.set_progress_handler(
+                _report_progress, cls.MIGRATION_PROGRESS_INTERVAL)
+            c.execute("SELECT sqlcipher_export('migrated')")
+            db_handle.set_progress_handler(None, 0)
+            c.execute('DETACH DATABASE migrated')
+        finally:
+            db_handle.close()
+        with io.open(target_file, 'rb') as f:
+            os.fsync(f.fileno())
+        progress_cb(MigrationStages.EXPORTING, 1.0)
+        state['stage'] = MigrationStages.EXPORTED
+        cls._store_migration_state(state_file, state)
+        return state
 
-        @param old_doc: The old version of the document.
-        @type old_doc: u1db.Document
-        @param doc: The new version of the document.
-        @type doc: u1db.Document
+    @classmethod
+    def _verify_migration(cls, sqlcipher_file, params, doc_count):
         """
-        sqlite_backend.SQLitePartialExpandDatabase._put_and_update_indexes(
-            self, old_doc, doc)
-        c = self._db_handle.cursor()
-        c.execute('UPDATE document SET syncable=? '
-                  'WHERE doc_id=?',
-                  (doc.syncable, doc.doc_id))
+        Assert that C{sqlcipher_file} can be opened with C{params} and holds
+        the expected number of documents.
 
-    def _get_doc(self, doc_id, check_for_conflicts=False):
+        @param sqlcipher_file: The path for the SQLCipher file.
+        @type sqlcipher_file: str
+        @param params: The (key, raw_key, cipher, kdf_iter, cipher_page_size)
+            to open the file with.
+        @type params: tuple
+        @param doc_count: The expected number of documents.
+        @type doc_count: int
+
+        @raise MigrationFailed: If the database does not match.
         """
-        Get just the document content, without fancy handling.
+        db_handle = cls._connect(sqlcipher_file, *params)
+        try:
+            c = db_handle.cursor()
+            v, _ = cls._which_index_storage(c)
+            if v is None:
+                raise MigrationFailed('Migrated database is not initialized.')
+            c.execute('SELECT count(*) FROM document')
+            migrated_count = c.fetchone()[0]
+            if migrated_count != doc_count:
+                raise MigrationFailed(
+                    'Migrated database has %d documents instead of %d.'
+                    % (migrated_count, doc_count))
+        finally:
+            db_handle.close()
 
-        @param doc_id: The unique document identifier
-        @type doc_id: str
-        @param include_deleted: If set to True, deleted documents will be
-            returned with empty content. Otherwise asking for a deleted
-            document will return None.
-        @type include_deleted: bool
+    @classmethod
+    def _swap_files(cls, target_file, sqlcipher_file):
+        """
+        Atomically replace C{sqlcipher_file} with C{target_file}.
 
-        @return: a Document object.
-        @type: u1db.Document
+        @param target_file: The path for the migrated SQLCipher file.
+        @type target_file: str
+        @param sqlcipher_file: The path for the original SQLCipher file.
+        @type sqlcipher_file: str
         """
-        doc = sqlite_backend.SQLitePartialExpandDatabase._get_doc(
-            self, doc_id, check_for_conflicts)
-        if doc:
-            c = self._db_handle.cursor()
-            c.execute('SELECT syncable FROM document '
-                      'WHERE doc_id=?',
-                      (doc.doc_id,))
-            result = c.fetchone()
-            doc.syncable = bool(result[0])
-        return doc
+        try:
+            os.rename(target_file, sqlcipher_file)
+        except OSError:
+            # rename does not overwrite existing files on Windows, so the
+            # swap can not be atomic there.
+            if os.name != 'nt':
+                raise
+            os.unlink(sqlcipher_file)
+            os.rename(target_file, sqlcipher_file)
+        if hasattr(os, 'O_DIRECTORY'):
+            # make sure the rename itself hits the disk
+            dir_fd = os.open(
+                os.path.dirname(os.path.abspath(sqlcipher_file)),
+                os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
 
     #
     # SQLCipher API methods
@@ -393,19 +2832,89 @@ class SQLCipherDatabase(sqlite_backend.SQLitePartialExpandDatabase):
         @type kdf_iter: int
         @param cipher_page_size: The page size.
         @type cipher_page_size: int
+
+        @raise DatabaseIsNotEncrypted: If the file is a plain SQLite database.
         """
-        try:
-            # try to open an encrypted database with the regular u1db
-            # backend should raise a DatabaseError exception.
-            sqlite_backend.SQLitePartialExpandDatabase(sqlcipher_file)
+        cls._connect(
+            sqlcipher_file, key, raw_key, cipher, kdf_iter,
+            cipher_page_size).close()
+
+    @classmethod
+    def _assert_file_is_encrypted(cls, sqlcipher_file):
+        """
+        Assert that C{sqlcipher_file} does not start with the plaintext SQLite
+        header.
+
+        This is much cheaper than trying to open the file with the regular
+        u1db backend, as no connection has to be made.
+
+        @param sqlcipher_file: The path for the SQLCipher file.
+        @type sqlcipher_file: str
+
+        @raise DatabaseIsNotEncrypted: If the file is a plain SQLite database.
+        """
+        with io.open(sqlcipher_file, 'rb') as f:
+            header = f.read(len(SQLITE_PLAINTEXT_HEADER))
+        if header == SQLITE_PLAINTEXT_HEADER:
             raise DatabaseIsNotEncrypted()
-        except dbapi2.DatabaseError:
-            # assert that we can access it using SQLCipher with the given
-            # key
-            db_handle = dbapi2.connect(sqlcipher_file)
-            cls._set_crypto_pragmas(
-                db_handle, key, raw_key, cipher, kdf_iter, cipher_page_size)
-            db_handle.cursor().execute('SELECT count(*) FROM sqlite_master')
+
+    @classmethod
+    def _connect(cls, sqlcipher_file, key, raw_key, cipher, kdf_iter,
+                 cipher_page_size, open_timings=None):
+        """
+        Return a connection to C{sqlcipher_file} with the cryptographic params
+        set.
+
+        If the file already exists, assert that it is encrypted and that it
+        can be read with the given key, using the same connection that is
+        returned. This way the (possibly expensive) key derivation is run
+        only once per open.
+
+        @param sqlcipher_file: The path for the SQLCipher file.
+        @type sqlcipher_file: str
+        @param key: The key that protects the SQLCipher db.
+        @type key: str
+        @param raw_key: Whether C{key} is a raw 64-char hex string or a
+            passphrase that should be hashed to obtain the encyrption key.
+        @type raw_key: bool
+        @param cipher: The cipher and mode to use.
+        @type cipher: str
+        @param kdf_iter: The number of iterations to use.
+        @type kdf_iter: int
+        @param cipher_page_size: The page size.
+        @type cipher_page_size: int
+        @param open_timings: Where to record the time spent in each step.
+        @type open_timings: OpenTimings
+
+        @return: A keyed connection to the database.
+        @rtype: pysqlcipher.Connection
+
+        @raise DatabaseIsNotEncrypted: If the file is a plain SQLite database.
+        """
+        if open_timings is None:
+            open_timings = OpenTimings()
+        exists = os.path.isfile(sqlcipher_file)
+        if exists:
+            with open_timings.step('check_header'):
+                cls._assert_file_is_encrypted(sqlcipher_file)
+        with open_timings.step('connect'):
+            db_handle = dbapi2.connect(
+                sqlcipher_file, factory=InstrumentedConnection)
+        try:
+            with open_timings.step('set_crypto_pragmas'):
+                cls._set_crypto_pragmas(
+                    db_handle, key, raw_key, cipher, kdf_iter,
+                    cipher_page_size)
+            if exists:
+                # key derivation happens just in time, so this is where the
+                # KDF actually runs.
+                with open_timings.step('verify_key'):
+                    db_handle.cursor().execute(
+                        'SELECT count(*) FROM sqlite_master')
+        except:
+            db_handle.close()
+            raise
+        return db_handle
 
     @classmethod
     def _set_crypto_pragmas(cls, db_handle, key, raw_key, cipher, kdf_iter,
@@ -464,7 +2973,8 @@ class SQLCipherDatabase(sqlite_backend.SQLitePartialExpandDatabase):
         @param passphrase: The passphrase used to derive the encryption key.
         @type passphrase: str
         """
-        db_handle.cursor().execute("PRAGMA key = '%s'" % passphrase)
+        db_handle.cursor().execute(
+            "PRAGMA key = '%s'" % passphrase.replace("'", "''"))
 
     @classmethod
     def _pragma_key_raw(cls, db_handle, key):
@@ -610,9 +3120,9 @@ class SQLCipherDatabase(sqlite_backend.SQLitePartialExpandDatabase):
         @type raw_key: bool
         """
         if raw_key:
-            cls._pragma_rekey_raw(db_handle, key)
+            cls._pragma_rekey_raw(db_handle, new_key)
         else:
-            cls._pragma_rekey_passphrase(db_handle, key)
+            cls._pragma_rekey_passphrase(db_handle, new_key)
 
     @classmethod
     def _pragma_rekey_passphrase(cls, db_handle, passphrase):
@@ -628,7 +3138,8 @@ class SQLCipherDatabase(sqlite_backend.SQLitePartialExpandDatabase):
         @param passphrase: The passphrase used to derive the encryption key.
         @type passphrase: str
         """
-        db_handle.cursor().execute("PRAGMA rekey = '%s'" % passphrase)
+        db_handle.cursor().execute(
+            "PRAGMA rekey = '%s'" % passphrase.replace("'", "''"))
 
     @classmethod
     def _pragma_rekey_raw(cls, db_handle, key):
@@ -647,7 +3158,7 @@ class SQLCipherDatabase(sqlite_backend.SQLitePartialExpandDatabase):
         """
         if not all(c in string.hexdigits for c in key):
             raise NotAnHexString(key)
-        db_handle.cursor().execute('PRAGMA rekey = "x\'%s"' % passphrase)
+        db_handle.cursor().execute('PRAGMA rekey = "x\'%s"' % key)
 
 
 sqlite_backend.SQLiteDatabase.register_implementation(SQLCipherDatabase)
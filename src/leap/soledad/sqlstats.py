@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+# sqlstats.py
+# Copyright (C) 2013 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Timing of the SQL statements run on a local database.
+
+Connections made with C{InstrumentedConnection} hand out cursors that time
+every statement they run and count the rows it returns, while a
+C{StatementStats} is attached to the connection. Statements are grouped by
+shape, that is, with literals and lists of parameters collapsed, so the many
+variants of the same u1db query add up together.
+"""
+
+import re
+import time
+import logging
+import threading
+
+
+from collections import deque
+from pysqlcipher import dbapi2
+
+
+logger = logging.getLogger(name=__name__)
+
+
+#
+# Statement shapes
+#
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SPACE_RE = re.compile(r'\s+')
+
+
+def statement_shape(sql):
+    """
+    Return the shape of a SQL statement: the statement with literals replaced
+    by placeholders, lists of placeholders collapsed and whitespace
+    normalized.
+
+    @param sql: The SQL statement.
+    @type sql: str
+
+    @return: The shape of the statement.
+    @rtype: str
+    """
+    shape = _STRING_RE.sub('?', sql)
+    shape = _NUMBER_RE.sub('?', shape)
+    shape = _LIST_RE.sub('(?, ...)', shape)
+    return _SPACE_RE.sub(' ', shape).strip()
+
+
+#
+# Statistics
+#
+
+class StatementStats(object):
+    """
+    Per-shape statistics of SQL statements and a log of the slow ones.
+
+    The time of a statement includes the time spent fetching its rows.
+    """
+
+    SLOW_QUERY_LOG_SIZE = 100
+    """
+    How many slow statements are remembered.
+    """
+
+    MAX_SHAPES = 1000
+    """
+    How many statement texts have their shape remembered, so that it is not
+    computed again for every execution.
+    """
+
+    def __init__(self, slow_query_threshold=None):
+        """
+        Initialize empty statistics.
+
+        @param slow_query_threshold: The time, in seconds, from which a
+            statement is logged as slow, or None to log no statement.
+        @type slow_query_threshold: float
+        """
+        self._slow_query_threshold = slow_query_threshold
+        self._lock = threading.Lock()
+        self._shapes = {}
+        self._statements = {}
+        self._slow_queries = deque(maxlen=self.SLOW_QUERY_LOG_SIZE)
+
+    def _get_slow_query_threshold(self):
+        return self._slow_query_threshold
+
+    def _set_slow_query_threshold(self, slow_query_threshold):
+        self._slow_query_threshold = slow_query_threshold
+
+    slow_query_threshold = property(
+        _get_slow_query_threshold, _set_slow_query_threshold,
+        doc='The time from which a statement is logged as slow, or None.')
+
+    def shape(self, sql):
+        """
+        Return the shape of a SQL statement, see C{statement_shape}.
+
+        @param sql: The SQL statement.
+        @type sql: str
+
+        @rtype: str
+        """
+        shape = self._shapes.get(sql)
+        if shape is None:
+            shape = statement_shape(sql)
+            if len(self._shapes) >= self.MAX_SHAPES:
+                self._shapes.clear()
+            self._shapes[sql] = shape
+        return shape
+
+    def record(self, shape, elapsed, rows, execution_elapsed, executed=False):
+        """
+        Record time spent running a statement or fetching its rows.
+
+        @param shape: The shape of the statement.
+        @type shape: str
+        @param elapsed: The time spent, in seconds.
+        @type elapsed: float
+        @param rows: The number of rows fetched.
+        @type rows: int
+        @param execution_elapsed: The time spent in this execution of the
+            statement so far, including C{elapsed}.
+        @type execution_elapsed: float
+        @param executed: Whether the time was spent executing the statement,
+            as opposed to fetching its rows.
+        @type executed: bool
+
+        @return: Whether this execution has just become slow.
+        @rtype: bool
+        """
+        with self._lock:
+            entry = self._statements.get(shape)
+            if entry is None:
+                entry = self._statements[shape] = {
+                    'count': 0,
+                    'total_time': 0.0,
+                    'max_time': 0.0,
+                    'rows': 0,
+                }
+            if executed:
+                entry['count'] += 1
+            entry['total_time'] += elapsed
+            entry['rows'] += rows
+            if execution_elapsed > entry['max_time']:
+                entry['max_time'] = execution_elapsed
+        threshold = self._slow_query_threshold
+        return threshold is not None \
+            and execution_elapsed >= threshold \
+            and (executed or execution_elapsed - elapsed < threshold)
+
+    def slow_query(self, shape, elapsed, rows):
+        """
+        Log a slow statement.
+
+        @param shape: The shape of the statement.
+        @type shape: str
+        @param elapsed: The time spent in the statement, in seconds.
+        @type elapsed: float
+        @param rows: The number of rows fetched so far.
+        @type rows: int
+        """
+        logger.warning(
+            'Slow SQL statement (%.4fs, %d rows): %s' % (elapsed, rows, shape))
+        with self._lock:
+            self._slow_queries.append({
+                'time': time.time(),
+                'statement': shape,
+                'elapsed': elapsed,
+                'rows': rows,
+            })
+
+    def stats(self):
+        """
+        Return the statistics.
+
+        @return: A dictionary with the 'statements', a list of dictionaries
+            with the 'statement' shape, the execution 'count', the
+            'total_time' and 'max_time' in seconds and the number of 'rows'
+            returned, sorted by total time, and the 'slow_queries', a list of
+            dictionaries with the 'time' they ran at, the 'statement' shape,
+            the 'elapsed' time and the number of 'rows' returned, oldest
+            first.
+        @rtype: dict
+        """
+        with self._lock:
+            statements = []
+            for shape, entry in self._statements.items():
+                entry = dict(entry)
+                entry['statement'] = shape
+                statements.append(entry)
+            slow_queries = [dict(query) for query in self._slow_queries]
+        statements.sort(key=lambda entry: entry['total_time'], reverse=True)
+        return {
+            'statements': statements,
+            'slow_queries': slow_queries,
+        }
+
+    def reset(self):
+        """
+        Forget all statistics and slow statements.
+        """
+        with self._lock:
+            self._statements.clear()
+            self._slow_queries.clear()
+
+
+#
+# Instrumented connections
+#
+
+class InstrumentedCursor(dbapi2.Cursor):
+    """
+    A cursor that records its statements in a C{StatementStats}.
+    """
+
+    _stats = None
+    _shape = None
+    _elapsed = 0.0
+    _rows = 0
+
+    def _run(self, method, sql, *args):
+        stats = self._stats
+        if stats is None:
+            return method(self, sql, *args)
+        self._shape = stats.shape(sql)
+        self._elapsed = 0.0
+        self._rows = 0
+        start = time.time()
+        try:
+            return method(self, sql, *args)
+        finally:
+            self._record(time.time() - start, 0, executed=True)
+
+    def _fetch(self, method, *args):
+        if self._shape is None:
+            return method(self, *args)
+        start = time.time()
+        rows = None
+        try:
+            rows = method(self, *args)
+            return rows
+        finally:
+            if rows is None:
+                count = 0
+            elif isinstance(rows, list):
+                count = len(rows)
+            else:
+                count = 1
+            self._record(time.time() - start, count)
+
+    def _record(self, elapsed, rows, executed=False):
+        self._elapsed += elapsed
+        self._rows += rows
+        if self._stats.record(
+                self._shape, elapsed, rows, self._elapsed, executed=executed):
+            self._stats.slow_query(self._shape, self._elapsed, self._rows)
+
+    def execute(self, sql, *args):
+        return self._run(dbapi2.Cursor.execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return self._run(dbapi2.Cursor.executemany, sql, *args)
+
+    def executescript(self, sql):
+        return self._run(dbapi2.Cursor.executescript, sql)
+
+    def fetchone(self):
+        return self._fetch(dbapi2.Cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self._fetch(dbapi2.Cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self._fetch(dbapi2.Cursor.fetchall)
+
+    def next(self):
+        return self._fetch(dbapi2.Cursor.next)
+
+
+class InstrumentedConnection(dbapi2.Connection):
+    """
+    A connection whose cursors record their statements in
+    C{statement_stats}, when it is set.
+
+    While it is None, plain cursors are handed out, so there is no overhead.
+    """
+
+    statement_stats = None
+
+    def cursor(self, factory=None):
+        stats = self.statement_stats
+        if stats is None:
+            if factory is None:
+                return dbapi2.Connection.cursor(self)
+            return dbapi2.Connection.cursor(self, factory)
+        cursor = dbapi2.Connection.cursor(
+            self, factory or InstrumentedCursor)
+        if isinstance(cursor, InstrumentedCursor):
+            cursor._stats = stats
+        return cursor
@@ -25,10 +25,18 @@ import simplejson as json
 import hashlib
 import hmac
 import binascii
+import time
+import struct
+import socket
+import httplib
+import threading
+
+
+from contextlib import contextmanager
 
 
 from u1db.remote import utils
-from u1db.errors import BrokenSyncStream
+from u1db.errors import BrokenSyncStream, HTTPError, U1DBError
 from u1db.remote.http_target import HTTPSyncTarget
 
 
@@ -39,6 +47,7 @@ from leap.soledad.crypto import (
     UnknownEncryptionMethod,
 )
 from leap.soledad.auth import TokenBasedAuth
+from leap.soledad.connection import PooledConnection
 
 
 #
@@ -105,6 +114,15 @@ ENC_METHOD_KEY = '_enc_method'
 ENC_IV_KEY = '_enc_iv'
 MAC_KEY = '_mac'
 MAC_METHOD_KEY = '_mac_method'
+ENC_META_KEY = '_enc_meta'
+ENC_DELTA_BASE_KEY = '_delta_base'
+ENC_CHAIN_KEY = '_enc_chain'
+
+DELTA_BASE_MISSING = 'delta_base_missing'
+"""
+The error a server answers with when a delta is not based on the revision
+of the document it holds.
+"""
 
 
 def mac_doc(crypto, doc_id, doc_rev, ciphertext, mac_method):
@@ -140,7 +158,121 @@ def mac_doc(crypto, doc_id, doc_rev, ciphertext, mac_method):
     raise UnknownMacMethod('Unknown MAC method: %s.' % mac_method)
 
 
-def encrypt_doc(crypto, doc):
+def mac_doc_metadata(crypto, doc_id, doc_rev, ciphertext):
+    """
+    Calculate a MAC for the metadata header of a document.
+
+    It is calculated as the MAC of the content, with ENC_META_KEY prepended
+    to the message, so a header can not be passed off as the content.
+
+    @param crypto: A SoledadCryto instance used to perform the encryption.
+    @type crypto: leap.soledad.crypto.SoledadCrypto
+    @param doc_id: The id of the document.
+    @type doc_id: str
+    @param doc_rev: The revision of the document.
+    @type doc_rev: str
+    @param ciphertext: The encrypted metadata of the document.
+    @type ciphertext: str
+
+    @return: The calculated MAC.
+    @rtype: str
+    """
+    return hmac.new(
+        crypto.doc_mac_key(doc_id),
+        ENC_META_KEY + str(doc_id) + str(doc_rev) + ciphertext,
+        hashlib.sha256).digest()
+
+
+def mac_doc_delta(crypto, doc_id, doc_rev, base_rev, ciphertext):
+    """
+    Calculate a MAC for a delta between two revisions of a document.
+
+    It is calculated as the MAC of the content, with ENC_DELTA_BASE_KEY and
+    the revision the delta is based on added to the message, so a delta can
+    not be applied to another revision nor passed off as the content.
+
+    @param crypto: A SoledadCryto instance used to perform the encryption.
+    @type crypto: leap.soledad.crypto.SoledadCrypto
+    @param doc_id: The id of the document.
+    @type doc_id: str
+    @param doc_rev: The revision the delta leads to.
+    @type doc_rev: str
+    @param base_rev: The revision the delta is based on.
+    @type base_rev: str
+    @param ciphertext: The encrypted delta.
+    @type ciphertext: str
+
+    @return: The calculated MAC.
+    @rtype: str
+    """
+    return hmac.new(
+        crypto.doc_mac_key(doc_id),
+        ENC_DELTA_BASE_KEY + str(doc_id) + str(doc_rev) + str(base_rev)
+        + ciphertext,
+        hashlib.sha256).digest()
+
+
+def json_diff(old, new):
+    """
+    Return the changes that turn the content C{old} into C{new}.
+
+    Objects are compared field by field, and any other value that differs
+    is replaced as a whole. Each change is a list with the path of the
+    field, as a list of keys, followed by its new value, if it was not
+    removed.
+
+    @param old: The old content.
+    @type old: dict
+    @param new: The new content.
+    @type new: dict
+
+    @return: The changes, to be applied with C{json_patch}.
+    @rtype: list
+    """
+    changes = []
+    _json_diff(old, new, [], changes)
+    return changes
+
+
+def _json_diff(old, new, path, changes):
+    for key, value in new.iteritems():
+        if key not in old:
+            changes.append([path + [key], value])
+        elif old[key] != value:
+            if isinstance(value, dict) and isinstance(old[key], dict):
+                _json_diff(old[key], value, path + [key], changes)
+            else:
+                changes.append([path + [key], value])
+    for key in old:
+        if key not in new:
+            changes.append([path + [key]])
+
+
+def json_patch(content, changes):
+    """
+    Apply changes returned by C{json_diff} to C{content}, in place.
+
+    @param content: The content to change.
+    @type content: dict
+    @param changes: The changes.
+    @type changes: list
+
+    @return: The changed content.
+    @rtype: dict
+    """
+    for change in changes:
+        path = change[0]
+        parent = content
+        for key in path[:-1]:
+            parent = parent[key]
+        if len(change) > 1:
+            parent[path[-1]] = change[1]
+        else:
+            del parent[path[-1]]
+    return content
+
+
+def encrypt_doc(crypto, doc, metadata_fields=None):
     """
     Encrypt C{doc}'s content.
 
@@ -156,27 +288,49 @@ def encrypt_doc(crypto, doc):
             MAC_METHOD_KEY: 'hmac'
         }
 
+    If C{metadata_fields} are given, the values of these fields are also
+    encrypted on their own, as a small header that can be synced without
+    the content:
+
+            ENC_META_KEY: {
+                ENC_JSON_KEY: '<encrypted metadata JSON string>',
+                ENC_IV_KEY: '<the initial value used to encrypt>',
+                MAC_KEY: '<mac>'
+            }
+
     @param crypto: A SoledadCryto instance used to perform the encryption.
     @type crypto: leap.soledad.crypto.SoledadCrypto
     @param doc: The document with contents to be encrypted.
     @type doc: SoledadDocument
+    @param metadata_fields: The top level fields of the content to put in
+        the metadata header.
+    @type metadata_fields: list of str
 
     @return: The JSON serialization of the dict representing the encrypted
         content.
     @rtype: str
     """
+    envelope, ciphertext = _encrypt_doc_envelope(
+        crypto, doc, metadata_fields=metadata_fields)
+    # Return a representation for the encrypted content. In the following, we
+    # convert binary data to hexadecimal representation so the JSON
+    # serialization does not complain about what it tries to serialize.
+    envelope[ENC_JSON_KEY] = binascii.b2a_hex(ciphertext)
+    return json.dumps(envelope)
+
+
+def _encrypt_doc_envelope(crypto, doc, metadata_fields=None):
+    """
+    Encrypt C{doc}'s content and return the envelope built by C{encrypt_doc}
+    without the encrypted content, and the encrypted content.
+    """
     soledad_assert(doc.is_tombstone() is False)
     # encrypt content using AES-256 CTR mode
     iv, ciphertext = crypto.encrypt_sym(
         doc.get_json(),
         crypto.doc_passphrase(doc.doc_id),
         method=EncryptionMethods.AES_256_CTR)
-    # Return a representation for the encrypted content. In the following, we
-    # convert binary data to hexadecimal representation so the JSON
-    # serialization does not complain about what it tries to serialize.
-    hex_ciphertext = binascii.b2a_hex(ciphertext)
-    return json.dumps({
-        ENC_JSON_KEY: hex_ciphertext,
+    envelope = {
         ENC_SCHEME_KEY: EncryptionSchemes.SYMKEY,
         ENC_METHOD_KEY: EncryptionMethods.AES_256_CTR,
         ENC_IV_KEY: iv,
@@ -185,10 +339,88 @@ def encrypt_doc(crypto, doc):
             ciphertext,
             MacMethods.HMAC)),
         MAC_METHOD_KEY: MacMethods.HMAC,
-    })
+    }
+    if metadata_fields:
+        content = doc.content
+        metadata = dict(
+            (field, content[field]) for field in metadata_fields
+            if field in content)
+        meta_iv, meta_ciphertext = crypto.encrypt_sym(
+            json.dumps(metadata),
+            crypto.doc_passphrase(doc.doc_id),
+            method=EncryptionMethods.AES_256_CTR)
+        envelope[ENC_META_KEY] = {
+            ENC_JSON_KEY: binascii.b2a_hex(meta_ciphertext),
+            ENC_IV_KEY: meta_iv,
+            MAC_KEY: binascii.b2a_hex(mac_doc_metadata(
+                crypto, doc.doc_id, doc.rev, meta_ciphertext)),
+        }
+    return envelope, ciphertext
+
+
+def encrypt_delta(crypto, doc, base_rev, changes_json):
+    """
+    Encrypt the changes from a previous revision of C{doc} to it.
+
+    The changes are encrypted as the content is by C{encrypt_doc}, and the
+    revision they are based on is left in plaintext, so the server can tell
+    whether it holds it:
+
+        {
+            ENC_JSON_KEY: '<encrypted changes JSON string>',
+            ENC_SCHEME_KEY: 'symkey',
+            ENC_METHOD_KEY: EncryptionMethods.AES_256_CTR,
+            ENC_IV_KEY: '<the initial value used to encrypt>',
+            ENC_DELTA_BASE_KEY: '<the revision the changes are based on>',
+            MAC_KEY: '<mac>'
+            MAC_METHOD_KEY: 'hmac'
+        }
+
+    As the server can not apply the changes, it stores them after the
+    revision they are based on, see C{decrypt_doc}.
+
+    @param crypto: A SoledadCryto instance used to perform the encryption.
+    @type crypto: leap.soledad.crypto.SoledadCrypto
+    @param doc: The document the changes lead to.
+    @type doc: SoledadDocument
+    @param base_rev: The revision the changes are based on.
+    @type base_rev: str
+    @param changes_json: The JSON serialization of the changes, as returned
+        by C{json_diff}.
+    @type changes_json: str
+
+    @return: The JSON serialization of the dict representing the encrypted
+        changes.
+    @rtype: str
+    """
+    envelope, ciphertext = _encrypt_delta_envelope(
+        crypto, doc, base_rev, changes_json)
+    envelope[ENC_JSON_KEY] = binascii.b2a_hex(ciphertext)
+    return json.dumps(envelope)
+
+
+def _encrypt_delta_envelope(crypto, doc, base_rev, changes_json):
+    """
+    Encrypt changes to C{doc} and return the envelope built by
+    C{encrypt_delta} without the encrypted changes, and the encrypted
+    changes.
+    """
+    iv, ciphertext = crypto.encrypt_sym(
+        changes_json,
+        crypto.doc_passphrase(doc.doc_id),
+        method=EncryptionMethods.AES_256_CTR)
+    return {
+        ENC_SCHEME_KEY: EncryptionSchemes.SYMKEY,
+        ENC_METHOD_KEY: EncryptionMethods.AES_256_CTR,
+        ENC_IV_KEY: iv,
+        ENC_DELTA_BASE_KEY: base_rev,
+        MAC_KEY: binascii.b2a_hex(mac_doc_delta(
+            crypto, doc.doc_id, doc.rev, base_rev, ciphertext)),
+        MAC_METHOD_KEY: MacMethods.HMAC,
+    }, ciphertext
 
 
-def decrypt_doc(crypto, doc):
+def decrypt_doc(crypto, doc, ciphertext=None):
     """
     Decrypt C{doc}'s content.
 
@@ -210,23 +442,38 @@ def decrypt_doc(crypto, doc):
     EncryptionSchemes.SYMKEY and C{enc_method} is
     EncryptionMethods.AES_256_CTR.
 
+    Documents updated with deltas are stored by the server as a chain of
+    the last full content it received and the deltas sent after it, see
+    C{encrypt_delta}:
+
+        {
+            ENC_SCHEME_KEY: 'symkey',
+            ENC_CHAIN_KEY: [<encrypted content>, <encrypted delta>, ...]
+        }
+
     @param crypto: A SoledadCryto instance to perform the encryption.
     @type crypto: leap.soledad.crypto.SoledadCrypto
     @param doc: The document to be decrypted.
     @type doc: SoledadDocument
+    @param ciphertext: The encrypted content, if it is not in the content of
+        the document, as received in a framed sync stream.
+    @type ciphertext: str
 
     @return: The JSON serialization of the decrypted content.
     @rtype: str
     """
     soledad_assert(doc.is_tombstone() is False)
-    soledad_assert(ENC_JSON_KEY in doc.content)
+    if ENC_CHAIN_KEY in doc.content:
+        return _decrypt_chain(crypto, doc)
+    if ciphertext is None:
+        soledad_assert(ENC_JSON_KEY in doc.content)
+        ciphertext = binascii.a2b_hex(  # content is stored as hex.
+            doc.content[ENC_JSON_KEY])
     soledad_assert(ENC_SCHEME_KEY in doc.content)
     soledad_assert(ENC_METHOD_KEY in doc.content)
     soledad_assert(MAC_KEY in doc.content)
     soledad_assert(MAC_METHOD_KEY in doc.content)
     # verify MAC
-    ciphertext = binascii.a2b_hex(  # content is stored as hex.
-        doc.content[ENC_JSON_KEY])
     mac = mac_doc(
         crypto, doc.doc_id, doc.rev,
         ciphertext,
@@ -252,11 +499,368 @@ def decrypt_doc(crypto, doc):
     return plainjson
 
 
+def _decrypt_chain(crypto, doc):
+    """
+    Decrypt the content of a document stored as a chain of deltas.
+
+    Each delta leads to the revision the next one is based on, and the last
+    one to the revision of the document, so the MACs authenticate the whole
+    chain.
+    """
+    chain = doc.content[ENC_CHAIN_KEY]
+    revs = [delta[ENC_DELTA_BASE_KEY] for delta in chain[1:]] + [doc.rev]
+    base = SoledadDocument(doc.doc_id, revs[0])
+    base.content = chain[0]
+    content = json.loads(decrypt_doc(crypto, base))
+    for delta, rev in zip(chain[1:], revs[1:]):
+        ciphertext = binascii.a2b_hex(delta[ENC_JSON_KEY])
+        mac = mac_doc_delta(
+            crypto, doc.doc_id, rev, delta[ENC_DELTA_BASE_KEY], ciphertext)
+        if binascii.a2b_hex(delta[MAC_KEY]) != mac:
+            raise WrongMac('Could not authenticate document\'s changes.')
+        json_patch(content, json.loads(crypto.decrypt_sym(
+            ciphertext,
+            crypto.doc_passphrase(doc.doc_id),
+            method=delta[ENC_METHOD_KEY],
+            iv=delta[ENC_IV_KEY])))
+    return json.dumps(content)
+
+
+def decrypt_doc_metadata(crypto, doc):
+    """
+    Decrypt the metadata header of C{doc}'s content.
+
+    The content is an envelope built by C{encrypt_doc}, possibly without
+    the encrypted document itself.
+
+    @param crypto: A SoledadCryto instance to perform the encryption.
+    @type crypto: leap.soledad.crypto.SoledadCrypto
+    @param doc: The document whose metadata should be decrypted.
+    @type doc: SoledadDocument
+
+    @return: The JSON serialization of the metadata, or of an empty object if
+        the document has no metadata header.
+    @rtype: str
+
+    @raise WrongMac: If the metadata can not be authenticated.
+    """
+    header = doc.content.get(ENC_META_KEY)
+    if header is None:
+        return '{}'
+    ciphertext = binascii.a2b_hex(header[ENC_JSON_KEY])
+    mac = mac_doc_metadata(crypto, doc.doc_id, doc.rev, ciphertext)
+    if binascii.a2b_hex(header[MAC_KEY]) != mac:
+        raise WrongMac('Could not authenticate document\'s metadata.')
+    return crypto.decrypt_sym(
+        ciphertext,
+        crypto.doc_passphrase(doc.doc_id),
+        method=doc.content[ENC_METHOD_KEY],
+        iv=header[ENC_IV_KEY])
+
+
+def _decrypted_doc(crypto, doc):
+    """
+    Return C{doc}, with its content decrypted if it is encrypted.
+    """
+    if doc.is_tombstone() or ENC_SCHEME_KEY not in doc.content \
+            or doc.content[ENC_SCHEME_KEY] != EncryptionSchemes.SYMKEY:
+        return doc
+    return SoledadDocument(doc.doc_id, doc.rev, decrypt_doc(crypto, doc))
+
+
+#
+# Framed sync streams
+#
+
+FRAMED_CONTENT_TYPE = 'application/x-soledad-sync-frames'
+"""
+The content type of framed sync streams, which servers that list the
+'frames' feature in their sync information accept and answer with.
+"""
+
+FRAMES_MAGIC = 'SOLEDAD-FRAMES-1'
+
+_FRAME_LENGTHS = struct.Struct('>II')
+
+FRAMES_END = _FRAME_LENGTHS.pack(0, 0)
+
+
+def encode_frame(header, payload=''):
+    """
+    Encode a frame of a framed sync stream.
+
+    A framed sync stream is FRAMES_MAGIC followed by frames and FRAMES_END.
+    Each frame is the length of its header and of its payload, as 32 bit
+    big endian integers, the header, as compact JSON, and the payload, as
+    raw bytes. The header of the first frame holds what the first line of a
+    JSON sync stream does, and the following frames hold one document each,
+    see C{encode_doc_frame}.
+
+    @param header: The header.
+    @type header: dict
+    @param payload: The payload.
+    @type payload: str
+
+    @return: The frame.
+    @rtype: str
+    """
+    header = json.dumps(header, separators=(',', ':'))
+    return _FRAME_LENGTHS.pack(len(header), len(payload)) + header + payload
+
+
+def iter_frames(data):
+    """
+    Yield the frames of a framed sync stream.
+
+    @param data: The framed sync stream.
+    @type data: str
+
+    @return: An iterator over (header, payload) tuples.
+    @rtype: iterator
+
+    @raise BrokenSyncStream: If C{data} is malformed.
+    """
+    if not data.startswith(FRAMES_MAGIC):
+        raise BrokenSyncStream
+    offset = len(FRAMES_MAGIC)
+    while True:
+        if offset + _FRAME_LENGTHS.size > len(data):
+            raise BrokenSyncStream
+        header_size, payload_size = _FRAME_LENGTHS.unpack_from(data, offset)
+        offset += _FRAME_LENGTHS.size
+        if header_size == 0:
+            if offset != len(data):
+                raise BrokenSyncStream
+            return
+        end = offset + header_size + payload_size
+        if end > len(data):
+            raise BrokenSyncStream
+        try:
+            header = json.loads(data[offset:offset + header_size])
+        except ValueError:
+            raise BrokenSyncStream
+        yield header, data[offset + header_size:end]
+        offset = end
+
+
+def encode_doc_frame(doc_id, rev, content, gen, trans_id):
+    """
+    Encode the frame of a document of a framed sync stream.
+
+    The header has the id, revision, generation and transaction id of the
+    document. The content of encrypted documents is sent as the envelope,
+    without the encrypted content, in the header, and the encrypted content,
+    as raw bytes, in the payload. The content of other documents is sent as
+    JSON in the payload, and deleted documents are flagged in the header.
+
+    @param doc_id: The id of the document.
+    @type doc_id: str
+    @param rev: The revision of the document.
+    @type rev: str
+    @param content: The JSON serialization of the content, or None if the
+        document is deleted.
+    @type content: str
+    @param gen: The generation of the document.
+    @type gen: int
+    @param trans_id: The transaction id of the document.
+    @type trans_id: str
+
+    @return: The frame.
+    @rtype: str
+    """
+    header = {'id': doc_id, 'rev': rev, 'gen': gen, 'trans_id': trans_id}
+    if content is None:
+        header['deleted'] = True
+        return encode_frame(header)
+    envelope = json.loads(content)
+    if ENC_JSON_KEY not in envelope:
+        return encode_frame(header, content)
+    header['envelope'] = envelope
+    return encode_frame(
+        header, binascii.a2b_hex(envelope.pop(ENC_JSON_KEY)))
+
+
+def decode_doc_frame(header, payload):
+    """
+    Decode the frame of a document encoded by C{encode_doc_frame}.
+
+    @param header: The header of the frame.
+    @type header: dict
+    @param payload: The payload of the frame.
+    @type payload: str
+
+    @return: The id, revision, JSON serialization of the content, or None
+        if the document is deleted, generation and transaction id of the
+        document.
+    @rtype: tuple
+    """
+    content = payload
+    if header.get('deleted'):
+        content = None
+    elif 'envelope' in header:
+        envelope = dict(header['envelope'])
+        envelope[ENC_JSON_KEY] = binascii.b2a_hex(payload)
+        content = json.dumps(envelope)
+    return (header['id'], header['rev'], content, header['gen'],
+            header['trans_id'])
+
+
+#
+# Sync instrumentation
+#
+
+class SyncReport(object):
+    """
+    Record what one sync transferred and where its time went.
+
+    The time spent in each phase of the sync is accumulated over all
+    documents, so it tells whether a slow sync is bound by crypto, network
+    or disk.
+    """
+
+    PHASES = (
+        'sync_info',          # asking the target for its sync information
+        'enumerate_changes',  # finding and reading local changes
+        'encrypt',            # encrypting outgoing documents
+        'serialize',          # building the outgoing sync stream
+        'send',               # sending the request
+        'wait_response',      # waiting for and reading the response
+        'parse',              # parsing the incoming sync stream
+        'decrypt',            # decrypting incoming documents
+        'insert',             # inserting incoming documents locally
+    )
+    """
+    The phases of a sync, in the order they happen.
+    """
+
+    def __init__(self, memory=None):
+        """
+        Initialize an empty report.
+
+        @param memory: Where to record the memory used by each phase, or
+            None to not profile memory.
+        @type memory: leap.soledad.profiling.SyncMemoryProfile
+        """
+        self.started = time.time()
+        self.memory = memory
+        self.elapsed = None
+        self.local_gen = None
+        self.docs_sent = 0
+        self.deltas_sent = 0
+        self.docs_received = 0
+        self.docs_skipped = 0
+        self.docs_pending = 0
+        self.docs_encrypted = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.conflicts = 0
+        self.timings = dict((phase, 0.0) for phase in self.PHASES)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time the execution of the wrapped block and add it to phase C{name}.
+
+        @param name: The name of the phase.
+        @type name: str
+        """
+        memory = self.memory
+        if memory is not None:
+            memory.enter(name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] += time.time() - start
+            if memory is not None:
+                memory.exit(name)
+
+    def sample_memory(self):
+        """
+        Look up where the memory in use now was allocated, if memory is
+        profiled, see C{SyncMemoryProfile.sample}.
+        """
+        if self.memory is not None:
+            self.memory.sample()
+
+    def finish(self, local_gen):
+        """
+        Record the end of the sync.
+
+        @param local_gen: The local generation before the sync.
+        @type local_gen: int
+        """
+        self.local_gen = local_gen
+        self.elapsed = time.time() - self.started
+
+    def as_dict(self):
+        """
+        Return the report as a dictionary that can be serialized to JSON.
+
+        @rtype: dict
+        """
+        report = {
+            'started': self.started,
+            'elapsed': self.elapsed,
+            'local_gen': self.local_gen,
+            'docs_sent': self.docs_sent,
+            'deltas_sent': self.deltas_sent,
+            'docs_received': self.docs_received,
+            'docs_skipped': self.docs_skipped,
+            'docs_pending': self.docs_pending,
+            'docs_encrypted': self.docs_encrypted,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'conflicts': self.conflicts,
+            'timings': dict(self.timings),
+        }
+        if self.memory is not None:
+            report['memory'] = self.memory.as_dict()
+        return report
+
+    def __str__(self):
+        memory = []
+        if self.memory is not None:
+            memory = ['peak memory: %d bytes (%s)' % (
+                self.memory.peak, self.memory.peak_phase)]
+        return ', '.join(
+            ['sent: %d docs (%d bytes)' % (self.docs_sent, self.bytes_sent),
+             'sent as deltas: %d docs' % self.deltas_sent,
+             'received: %d docs (%d bytes)' % (
+                 self.docs_received, self.bytes_received),
+             'out of scope: %d docs' % self.docs_skipped,
+             'content pending: %d docs' % self.docs_pending,
+             'stored encrypted: %d docs' % self.docs_encrypted,
+             'conflicts: %d' % self.conflicts]
+            + ['%s: %.4fs' % (phase, self.timings[phase])
+               for phase in self.PHASES]
+            + ['total: %.4fs' % (self.elapsed or 0.0)]
+            + memory)
+
+    def merge(self, other):
+        """
+        Add what another report recorded to this one, e.g. the report of an
+        upload made through another connection during the same sync.
+
+        The time spent in each phase is added up, so it may be longer than
+        the sync if connections were used concurrently.
+
+        @param other: The report to add.
+        @type other: SyncReport
+        """
+        for name in ('docs_sent', 'deltas_sent', 'docs_received',
+                     'docs_skipped', 'docs_pending', 'docs_encrypted',
+                     'bytes_sent', 'bytes_received', 'conflicts'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for phase in self.PHASES:
+            self.timings[phase] += other.timings[phase]
+
+
 #
 # SoledadSyncTarget
 #
 
-class SoledadSyncTarget(HTTPSyncTarget, TokenBasedAuth):
+class SoledadSyncTarget(PooledConnection, HTTPSyncTarget, TokenBasedAuth):
     """
     A SyncTarget that encrypts data before sending and decrypts data after
     receiving.
@@ -301,7 +905,12 @@ class SoledadSyncTarget(HTTPSyncTarget, TokenBasedAuth):
     def connect(url, crypto=None):
         return SoledadSyncTarget(url, crypto=crypto)
 
-    def __init__(self, url, creds=None, crypto=None):
+    def __init__(self, url, creds=None, crypto=None, cert_file=None,
+                 connection_pool=None, report=None, scope=None,
+                 local_doc_exists=None, resend=False, metadata_only=False,
+                 metadata_fields=None, content_needed=None,
+                 lazy_decrypt=False, delta_store=None, framed=True,
+                 upload_connections=1):
         """
         Initialize the SoledadSyncTarget.
 
@@ -313,9 +922,137 @@ class SoledadSyncTarget(HTTPSyncTarget, TokenBasedAuth):
         @param soledad: An instance of Soledad so we can encrypt/decrypt
             document contents when syncing.
         @type soledad: soledad.Soledad
+        @param cert_file: Path to the certificate used to verify the server.
+        @type cert_file: str
+        @param connection_pool: A pool to take connections from.
+        @type connection_pool: leap.soledad.connection.HTTPConnectionPool
+        @param report: Where to record what the syncs through this target
+            transfer and how long each phase takes. A new report is created
+            if not given.
+        @type report: SyncReport
+        @param scope: The documents to sync, or None to sync all documents.
+            Local changes out of scope are not sent, and incoming documents
+            out of scope are not inserted, unless they exist locally.
+        @type scope: leap.soledad.scope.SyncScope
+        @param local_doc_exists: A function that tells whether a document id
+            exists in the local replica.
+        @type local_doc_exists: callable
+        @param resend: Whether to send all local changes again, as if the
+            target knew none of them, e.g. because the scope widened.
+        @type resend: bool
+        @param metadata_only: Whether to receive only the metadata of
+            incoming documents, if the server supports it. Their content is
+            marked as pending, see C{SoledadDocument.content_pending}.
+        @type metadata_only: bool
+        @param metadata_fields: The top level fields of outgoing documents
+            to put in their metadata header.
+        @type metadata_fields: list of str
+        @param content_needed: A function that tells whether the full
+            content of an incoming document is needed even if only metadata
+            is received, because the local replica has its content.
+        @type content_needed: callable
+        @param lazy_decrypt: Whether to leave incoming documents that have
+            metadata encrypted. Only their metadata is decrypted and they
+            are marked as pending, with their encrypted content in
+            C{SoledadDocument.encrypted_json}.
+        @type lazy_decrypt: bool
+        @param delta_store: Where the revisions of documents the server is
+            known to hold are stored, so that changes to them are sent as
+            deltas, if the server supports it. It has the methods
+            C{get_delta_base(doc_id)}, which returns a (rev, depth, content)
+            tuple or None, and C{set_delta_base(doc_id, rev, depth, content)},
+            which forgets the document if C{content} is None.
+        @type delta_store: leap.soledad.sqlcipher.SQLCipherDatabase
+        @param framed: Whether to exchange framed sync streams, with the
+            encrypted content of documents as raw bytes, with servers that
+            support them, instead of JSON sync streams.
+        @type framed: bool
+        @param upload_connections: How many connections local changes may
+            be uploaded through concurrently, if the server supports it.
+        @type upload_connections: int
         """
         HTTPSyncTarget.__init__(self, url, creds)
+        self.set_connection_options(cert_file, connection_pool)
         self._crypto = crypto
+        self.report = report or SyncReport()
+        self._scope = scope
+        self._local_doc_exists = local_doc_exists or (lambda doc_id: False)
+        self._resend = resend
+        self._metadata_only = metadata_only
+        self._metadata_fields = metadata_fields
+        self._content_needed = content_needed or (lambda doc_id: False)
+        self._lazy_decrypt = lazy_decrypt
+        self._delta_store = delta_store
+        self._framed = framed
+        self._upload_connections = upload_connections
+        self._features = frozenset()
+        self._source_gen_info = None
+
+    def get_sync_info(self, source_replica_uid):
+        """
+        Return information about known state of the target replica.
+
+        @param source_replica_uid: The uid of the source replica.
+        @type source_replica_uid: str
+
+        @return: (target_replica_uid, target_replica_generation,
+            target_trans_id, source_replica_last_known_generation,
+            source_replica_last_known_transaction_id)
+        @rtype: tuple
+        """
+        with self.report.phase('sync_info'):
+            res, _ = self._request_json(
+                'GET', ['sync-from', source_replica_uid])
+        info = (res['target_replica_uid'], res['target_replica_generation'],
+                res['target_replica_transaction_id'],
+                res['source_replica_generation'], res['source_transaction_id'])
+        # the optional sync protocol extensions the server supports.
+        self._features = frozenset(res.get('features', ()))
+        self._source_gen_info = info[3:]
+        if self._resend:
+            # pretend the target knows nothing of the source, so that all
+            # local changes are enumerated, see sync_exchange.
+            info = info[:3] + (0, '')
+        return info
+
+    def get_sync_info_if_changed(self, source_replica_uid, etag=None):
+        """
+        Return the sync information of the target replica, unless it did not
+        change since it was last returned together with C{etag}.
+
+        This sends a conditional request with an If-None-Match header, so a
+        server that supports it can answer with a bodyless 304 response.
+        Servers that do not support it always send the full information.
+
+        @param source_replica_uid: The uid of the source replica.
+        @type source_replica_uid: str
+        @param etag: The entity tag returned with the last known sync
+            information, or None to ask for it unconditionally.
+        @type etag: str
+
+        @return: (info, etag) - The sync information in the same format
+            returned by C{get_sync_info}, or None if it did not change, and
+            the entity tag of the current information, if the server sent
+            one.
+        @rtype: tuple
+        """
+        self._ensure_connection()
+        url = '%s/sync-from/%s' % (self._url.path, source_replica_uid)
+        headers = dict(self._sign_request('GET', url, {}))
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        self._conn.request('GET', url, None, headers)
+        try:
+            data, headers = self._response()
+        except HTTPError, e:
+            if e.status != 304:
+                raise
+            return None, etag
+        res = json.loads(data)
+        info = (res['target_replica_uid'], res['target_replica_generation'],
+                res['target_replica_transaction_id'],
+                res['source_replica_generation'], res['source_transaction_id'])
+        return info, dict(headers).get('etag')
 
     def _parse_sync_stream(self, data, return_doc_cb, ensure_callback=None):
         """
@@ -340,7 +1077,9 @@ class SoledadSyncTarget(HTTPSyncTarget, TokenBasedAuth):
             from remote replica.
         @rtype: list of str
         """
-        parts = data.splitlines()  # one at a time
+        report = self.report
+        with report.phase('parse'):
+            parts = data.splitlines()  # one at a time
         if not parts or parts[0] != '[':
             raise BrokenSyncStream
         data = parts[1:-1]
@@ -353,22 +1092,14 @@ class SoledadSyncTarget(HTTPSyncTarget, TokenBasedAuth):
             for entry in data[1:]:
                 if not comma:  # missing in between comma
                     raise BrokenSyncStream
-                line, comma = utils.check_and_strip_comma(entry)
-                entry = json.loads(line)
-                #-------------------------------------------------------------
-                # symmetric decryption of document's contents
-                #-------------------------------------------------------------
-                # if arriving content was symmetrically encrypted, we decrypt
-                # it.
-                doc = SoledadDocument(entry['id'], entry['rev'], entry['content'])
-                if doc.content and ENC_SCHEME_KEY in doc.content:
-                    if doc.content[ENC_SCHEME_KEY] == \
-                            EncryptionSchemes.SYMKEY:
-                        doc.set_json(decrypt_doc(self._crypto, doc))
-                #-------------------------------------------------------------
-                # end of symmetric decryption
-                #-------------------------------------------------------------
-                return_doc_cb(doc, entry['gen'], entry['trans_id'])
+                with report.phase('parse'):
+                    line, comma = utils.check_and_strip_comma(entry)
+                    entry = json.loads(line)
+                    doc = SoledadDocument(
+                        entry['id'], entry['rev'], entry['content'])
+                self._receive_doc(
+                    doc, entry['gen'], entry['trans_id'], return_doc_cb,
+                    envelope=entry['content'])
         if parts[-1] != ']':
             try:
                 partdic = json.loads(parts[-1])
@@ -382,6 +1113,224 @@ class SoledadSyncTarget(HTTPSyncTarget, TokenBasedAuth):
             raise BrokenSyncStream
         return res
 
+    def _parse_sync_frames(self, data, return_doc_cb, ensure_callback=None):
+        """
+        Parse an incoming framed synchronization stream and insert documents
+        in the local database.
+
+        This does the same as C{_parse_sync_stream}, for streams encoded as
+        described in C{encode_frame}. The encrypted content of documents is
+        received as raw bytes, so it is neither escaped nor hex encoded.
+
+        @param data: The body of the HTTP response.
+        @type data: str
+        @param return_doc_cb: A callback to insert docs from target.
+        @type return_doc_cb: function
+        @param ensure_callback: A callback to ensure we have the correct
+            target_replica_uid, if it was just created.
+        @type ensure_callback: function
+
+        @raise BrokenSyncStream: If C{data} is malformed.
+
+        @return: A dictionary representing the first frame of the response
+            got from remote replica.
+        @rtype: dict
+        """
+        report = self.report
+        frames = iter_frames(data)
+        res = None
+        while True:
+            with report.phase('parse'):
+                try:
+                    header, payload = frames.next()
+                except StopIteration:
+                    break
+                if 'error' in header:
+                    self._error(header)
+                    raise BrokenSyncStream
+                if res is not None:
+                    ciphertext = None
+                    if header.get('deleted'):
+                        doc = SoledadDocument(
+                            header['id'], header['rev'], None)
+                    elif 'envelope' in header:
+                        doc = SoledadDocument(header['id'], header['rev'])
+                        doc.content = header['envelope']
+                        ciphertext = payload
+                    else:
+                        doc = SoledadDocument(
+                            header['id'], header['rev'], payload)
+            if res is None:
+                res = header
+                if ensure_callback and 'replica_uid' in res:
+                    ensure_callback(res['replica_uid'])
+                continue
+            self._receive_doc(
+                doc, header['gen'], header['trans_id'], return_doc_cb,
+                ciphertext=ciphertext)
+        if res is None:
+            raise BrokenSyncStream
+        return res
+
+    def _receive_doc(self, doc, gen, trans_id, return_doc_cb, envelope=None,
+                     ciphertext=None):
+        """
+        Decrypt an incoming document and insert it in the local database,
+        unless it is out of the sync scope.
+
+        @param doc: The incoming document, with the envelope of its encrypted
+            content as content, if it is encrypted.
+        @type doc: SoledadDocument
+        @param gen: The generation of the document in the target.
+        @type gen: int
+        @param trans_id: The transaction id of the document in the target.
+        @type trans_id: str
+        @param return_doc_cb: A callback to insert docs from target.
+        @type return_doc_cb: function
+        @param envelope: The JSON serialization of the envelope, if known.
+        @type envelope: str
+        @param ciphertext: The encrypted content, if it is not in the
+            envelope, as received in a framed sync stream.
+        @type ciphertext: str
+        """
+        report = self.report
+        with report.phase('parse'):
+            encrypted = doc.content and ENC_SCHEME_KEY in doc.content
+            # how many deltas the revision is stored as.
+            depth = 0
+            if encrypted and ENC_CHAIN_KEY in doc.content:
+                depth = len(doc.content[ENC_CHAIN_KEY]) - 1
+        report.docs_received += 1
+        # documents out of scope are not inserted, unless the local replica
+        # has them. If the scope depends on the content, this is only known
+        # once it is decrypted.
+        check_scope = False
+        scope = self._scope
+        if scope is not None and not scope.includes_id(doc.doc_id) \
+                and not self._local_doc_exists(doc.doc_id):
+            if not scope.has_index or doc.is_tombstone():
+                report.docs_skipped += 1
+                return
+            check_scope = True
+        if encrypted and ciphertext is None \
+                and ENC_JSON_KEY not in doc.content \
+                and ENC_CHAIN_KEY not in doc.content:
+            # only the metadata of the document was sent.
+            encrypted = False
+            doc = self._pending_doc(doc)
+        #---------------------------------------------------------------------
+        # symmetric decryption of document's contents
+        #---------------------------------------------------------------------
+        # if arriving content was symmetrically encrypted, we decrypt it, or
+        # just its metadata if it is decrypted when read. Changes to
+        # documents the local replica has the content of are decrypted right
+        # away, as they may conflict with it.
+        if encrypted and self._lazy_decrypt \
+                and ENC_META_KEY in doc.content \
+                and not self._content_needed(doc.doc_id):
+            if envelope is None:
+                envelope = dict(doc.content)
+                envelope[ENC_JSON_KEY] = binascii.b2a_hex(ciphertext)
+                envelope = json.dumps(envelope)
+            doc = self._encrypted_doc(doc, envelope)
+        elif encrypted:
+            if doc.content[ENC_SCHEME_KEY] == EncryptionSchemes.SYMKEY:
+                # the plaintext is authenticated by the MAC, so build the
+                # document from it without parsing it.
+                with report.phase('decrypt'):
+                    doc = SoledadDocument(
+                        doc.doc_id, doc.rev,
+                        decrypt_doc(self._crypto, doc, ciphertext))
+        #---------------------------------------------------------------------
+        # end of symmetric decryption
+        #---------------------------------------------------------------------
+        if check_scope and not scope.includes(doc):
+            report.docs_skipped += 1
+            return
+        if self._delta_store is not None:
+            self._set_delta_base(doc, depth)
+        # the encrypted and the decrypted content are both alive here.
+        report.sample_memory()
+        with report.phase('insert'):
+            return_doc_cb(doc, gen, trans_id)
+
+    def _pending_doc(self, doc):
+        """
+        Return the document to insert for an incoming document of which only
+        the metadata was sent.
+
+        Its content is the decrypted metadata and is marked as pending,
+        unless the local replica has the content of the document, in which
+        case the content is fetched right away so it is not lost.
+
+        @param doc: The incoming document, with its metadata envelope as
+            content.
+        @type doc: SoledadDocument
+
+        @rtype: SoledadDocument
+        """
+        report = self.report
+        if self._content_needed(doc.doc_id):
+            with report.phase('wait_response'):
+                docs = self.get_docs_content([doc.doc_id])
+            if docs:
+                return docs[0]
+        with report.phase('decrypt'):
+            metadata = decrypt_doc_metadata(self._crypto, doc)
+        pending = SoledadDocument(doc.doc_id, doc.rev, metadata)
+        pending.content_pending = True
+        report.docs_pending += 1
+        return pending
+
+    def _encrypted_doc(self, doc, envelope):
+        """
+        Return the document to insert for an incoming document that is
+        stored without decrypting its content.
+
+        Its content is the decrypted metadata, so it can be indexed, and the
+        envelope is kept for decrypting it when it is first read.
+
+        @param doc: The incoming document, with the envelope as content.
+        @type doc: SoledadDocument
+        @param envelope: The JSON serialization of the envelope.
+        @type envelope: str
+
+        @rtype: SoledadDocument
+        """
+        with self.report.phase('decrypt'):
+            metadata = decrypt_doc_metadata(self._crypto, doc)
+        lazy = SoledadDocument(doc.doc_id, doc.rev, metadata)
+        lazy.content_pending = True
+        lazy.encrypted_json = envelope
+        self.report.docs_encrypted += 1
+        return lazy
+
+    def get_docs_content(self, doc_ids):
+        """
+        Fetch and decrypt the current revision of documents.
+
+        @param doc_ids: The ids of the documents.
+        @type doc_ids: list of str
+
+        @return: The documents the target has, including deleted ones, with
+            their decrypted content.
+        @rtype: list of SoledadDocument
+        """
+        if not doc_ids:
+            return []
+        res, _ = self._request(
+            'GET', ['docs'], {
+                'doc_ids': ','.join(doc_ids),
+                'check_for_conflicts': False,
+                'include_deleted': True,
+            })
+        docs = []
+        for entry in json.loads(res):
+            doc = SoledadDocument(
+                entry['doc_id'], entry['doc_rev'], entry['content'])
+            docs.append(_decrypted_doc(self._crypto, doc))
+        return docs
+
     def sync_exchange(self, docs_by_generations, source_replica_uid,
                       last_known_generation, last_known_trans_id,
                       return_doc_cb, ensure_callback=None):
@@ -412,52 +1361,390 @@ class SoledadSyncTarget(HTTPSyncTarget, TokenBasedAuth):
         @return: The new generation and transaction id of the target replica.
         @rtype: tuple
         """
-        self._ensure_connection()
         if self._trace_hook:  # for tests
             self._trace_hook('sync_exchange')
+        report = self.report
+        args = {
+            'last_known_generation': last_known_generation,
+            'last_known_trans_id': last_known_trans_id,
+            'ensure': ensure_callback is not None,
+        }
+        # servers that do not support metadata only syncs send everything.
+        if self._metadata_only and 'metadata_only' in self._features:
+            args['metadata_only'] = True
+        if self._resend and docs_by_generations:
+            # the target knows of later generations of the source than the
+            # ones the changes were made at, so send them all at the last
+            # generation, which it accepts.
+            last_gen, last_trans_id = docs_by_generations[-1][1:]
+            docs_by_generations = [
+                (doc, last_gen, last_trans_id)
+                for doc, gen, trans_id in docs_by_generations]
+        deltas = self._delta_store is not None and 'delta' in self._features
+        # servers that do not support framed streams get JSON streams.
+        framed = self._framed and 'frames' in self._features
+        if self._upload_connections > 1 and ensure_callback is None \
+                and 'parallel_upload' in self._features:
+            docs_by_generations, uploaded = self._upload_in_parallel(
+                source_replica_uid, args, docs_by_generations, framed)
+            if uploaded:
+                # the server does not send back the documents it stored.
+                args['uploaded'] = uploaded
+        try:
+            data, framed_response, sent = self._send_changes(
+                source_replica_uid, args, docs_by_generations, deltas, framed)
+        except HTTPError, e:
+            if not deltas or e.status != 409 \
+                    or DELTA_BASE_MISSING not in (e.message or ''):
+                raise
+            # the server does not hold a revision a delta was based on, e.g.
+            # because another replica changed the document, so send the full
+            # content of all documents instead.
+            data, framed_response, sent = self._send_changes(
+                source_replica_uid, args, docs_by_generations, False, framed)
+        report.bytes_received += len(data)
+        if self._delta_store is not None:
+            # the revisions received next replace the ones sent.
+            for doc, depth in sent:
+                self._set_delta_base(doc, depth)
+        if framed_response:
+            res = self._parse_sync_frames(data, return_doc_cb, ensure_callback)
+        else:
+            res = self._parse_sync_stream(data, return_doc_cb, ensure_callback)
+        data = None
+        return res['new_generation'], res['new_transaction_id']
+
+    def _send_changes(self, source_replica_uid, args, docs_by_generations,
+                      deltas, framed):
+        """
+        Encrypt and send local changes, and return the response.
+
+        The documents sent are only counted in the report if the server
+        accepts them.
+
+        @param source_replica_uid: The uid of the source replica.
+        @type source_replica_uid: str
+        @param args: The arguments sent in the first line of the stream.
+        @type args: dict
+        @param docs_by_generations: A list of (doc, generation, trans_id) of
+            local changes.
+        @type docs_by_generations: list of tuples
+        @param deltas: Whether changes may be sent as deltas.
+        @type deltas: bool
+        @param framed: Whether to send a framed stream instead of JSON.
+        @type framed: bool
+
+        @return: (data, framed_response, sent) - The body of the response,
+            whether it is a framed stream, and the documents sent together
+            with the number of deltas each is stored as.
+        @rtype: tuple
+        """
+        self._ensure_connection()
+        report = self.report
+        chunks, size, sent, skipped, deltas_sent = self._encode_changes(
+            args, docs_by_generations, deltas, framed)
         url = '%s/sync-from/%s' % (self._url.path, source_replica_uid)
         self._conn.putrequest('POST', url)
-        self._conn.putheader('content-type', 'application/x-u1db-sync-stream')
+        self._conn.putheader(
+            'content-type',
+            FRAMED_CONTENT_TYPE if framed
+            else 'application/x-u1db-sync-stream')
         for header_name, header_value in self._sign_request('POST', url, {}):
             self._conn.putheader(header_name, header_value)
-        entries = ['[']
-        size = 1
-
-        def prepare(**dic):
-            entry = comma + '\r\n' + json.dumps(dic)
-            entries.append(entry)
-            return len(entry)
-
-        comma = ''
-        size += prepare(
-            last_known_generation=last_known_generation,
-            last_known_trans_id=last_known_trans_id,
-            ensure=ensure_callback is not None)
-        comma = ','
+        self._conn.putheader('content-length', str(size))
+        with report.phase('send'):
+            self._conn.endheaders()
+            for chunk in chunks:
+                self._conn.send(chunk)
+        report.bytes_sent += size
+        chunks = None
+        with report.phase('wait_response'):
+            data, headers = self._response()
+        report.docs_sent += len(sent)
+        report.deltas_sent += deltas_sent
+        report.docs_skipped += skipped
+        framed_response = \
+            dict(headers).get('content-type') == FRAMED_CONTENT_TYPE
+        return data, framed_response, sent
+
+    def _encode_changes(self, args, docs_by_generations, deltas, framed):
+        """
+        Encrypt local changes and encode them as a sync stream.
+
+        @param args: The arguments sent in the first line of the stream.
+        @type args: dict
+        @param docs_by_generations: A list of (doc, generation, trans_id) of
+            local changes.
+        @type docs_by_generations: list of tuples
+        @param deltas: Whether changes may be sent as deltas.
+        @type deltas: bool
+        @param framed: Whether to encode a framed stream instead of JSON.
+        @type framed: bool
+
+        @return: (chunks, size, sent, skipped, deltas_sent) - The chunks of
+            the stream and its size, the documents in the stream together
+            with the number of deltas each is stored as, the number of
+            documents out of the sync scope and of documents sent as deltas.
+        @rtype: tuple
+        """
+        report = self.report
+        if framed:
+            chunks = [FRAMES_MAGIC, encode_frame(args)]
+        else:
+            chunks = ['[', '\r\n' + json.dumps(args)]
+        size = sum(len(chunk) for chunk in chunks)
+        sent = []
+        skipped = 0
+        deltas_sent = 0
         for doc, gen, trans_id in docs_by_generations:
             # skip non-syncable docs
             if isinstance(doc, SoledadDocument) and not doc.syncable:
                 continue
+            # skip changes out of the sync scope, except deletions.
+            if self._scope is not None and not doc.is_tombstone() \
+                    and not self._scope.includes(doc):
+                skipped += 1
+                continue
+            header = {'id': doc.doc_id, 'rev': doc.rev, 'gen': gen,
+                      'trans_id': trans_id}
             #-------------------------------------------------------------
             # symmetric encryption of document's contents
             #-------------------------------------------------------------
-            doc_json = doc.get_json()
+            envelope = None
+            ciphertext = ''
+            depth = 0
             if not doc.is_tombstone():
-                doc_json = encrypt_doc(self._crypto, doc)
+                with report.phase('encrypt'):
+                    envelope, ciphertext, depth = self._encrypt_change(
+                        doc, deltas)
+                if depth:
+                    deltas_sent += 1
             #-------------------------------------------------------------
             # end of symmetric encryption
             #-------------------------------------------------------------
-            size += prepare(id=doc.doc_id, rev=doc.rev,
-                            content=doc_json,
-                            gen=gen, trans_id=trans_id)
-        entries.append('\r\n]')
-        size += len(entries[-1])
-        self._conn.putheader('content-length', str(size))
-        self._conn.endheaders()
-        for entry in entries:
-            self._conn.send(entry)
-        entries = None
-        data, _ = self._response()
-        res = self._parse_sync_stream(data, return_doc_cb, ensure_callback)
-        data = None
-        return res['new_generation'], res['new_transaction_id']
+            with report.phase('serialize'):
+                if framed:
+                    if envelope is None:
+                        header['deleted'] = True
+                    else:
+                        header['envelope'] = envelope
+                    chunk = encode_frame(header, ciphertext)
+                else:
+                    header['content'] = None
+                    if envelope is not None:
+                        envelope[ENC_JSON_KEY] = binascii.b2a_hex(ciphertext)
+                        header['content'] = json.dumps(envelope)
+                    chunk = ',\r\n' + json.dumps(header)
+            # the ciphertext and its serialization are both alive here.
+            report.sample_memory()
+            chunks.append(chunk)
+            size += len(chunk)
+            sent.append((doc, depth))
+        chunks.append(FRAMES_END if framed else '\r\n]')
+        size += len(chunks[-1])
+        return chunks, size, sent, skipped, deltas_sent
+
+    #
+    # Delta encoding.
+    #
+
+    DELTA_MIN_SIZE = 4096
+    """
+    The size of the content of a document, in bytes, from which changes to
+    it are sent as deltas. Smaller documents are always sent in full.
+    """
+
+    MAX_DELTA_CHAIN = 10
+    """
+    How many deltas the server may store a document as before its full
+    content is sent again, so that decrypting it stays cheap.
+    """
+
+    MAX_DELTA_RATIO = 0.5
+    """
+    How big the changes to a document may be in relation to its content for
+    them to be sent as a delta.
+    """
+
+    def _encrypt_change(self, doc, deltas):
+        """
+        Encrypt a local change, as a delta to the revision of the document
+        the server holds, if possible.
+
+        @param doc: The changed document.
+        @type doc: SoledadDocument
+        @param deltas: Whether the change may be sent as a delta.
+        @type deltas: bool
+
+        @return: (envelope, ciphertext, depth) - The envelope of the
+            encrypted content or delta, without the encrypted content or
+            delta, which is returned on its own, and the number of deltas
+            the server will store the document as.
+        @rtype: tuple
+        """
+        base = None
+        if deltas:
+            base = self._delta_store.get_delta_base(doc.doc_id)
+        if base is not None:
+            base_rev, depth, base_json = base
+            content_json = doc.get_json()
+            if depth < self.MAX_DELTA_CHAIN \
+                    and len(content_json) >= self.DELTA_MIN_SIZE:
+                changes_json = json.dumps(
+                    json_diff(json.loads(base_json), doc.content))
+                if len(changes_json) <= \
+                        len(content_json) * self.MAX_DELTA_RATIO:
+                    envelope, ciphertext = _encrypt_delta_envelope(
+                        self._crypto, doc, base_rev, changes_json)
+                    return envelope, ciphertext, depth + 1
+        envelope, ciphertext = _encrypt_doc_envelope(
+            self._crypto, doc, metadata_fields=self._metadata_fields)
+        return envelope, ciphertext, 0
+
+    def _set_delta_base(self, doc, depth):
+        """
+        Record that the server holds a revision of a document.
+
+        Only the content of documents big enough to be sent as deltas is
+        kept.
+
+        @param doc: The revision of the document.
+        @type doc: SoledadDocument
+        @param depth: The number of deltas the server stores it as.
+        @type depth: int
+        """
+        content = None
+        if not doc.is_tombstone() \
+                and not getattr(doc, 'content_pending', False):
+            content = doc.get_json()
+            if len(content) < self.DELTA_MIN_SIZE:
+                content = None
+        self._delta_store.set_delta_base(doc.doc_id, doc.rev, depth, content)
+
+    #
+    # Parallel uploads.
+    #
+
+    MIN_UPLOAD_BATCH = 100
+    """
+    The minimum number of local changes uploaded through each connection
+    when they are uploaded in parallel.
+    """
+
+    def _upload_in_parallel(self, source_replica_uid, args,
+                            docs_by_generations, framed):
+        """
+        Upload all but the last local change in disjoint batches, sent
+        concurrently through separate connections.
+
+        The batches are sent at the generation of the source the server
+        already knows, so it stores the documents without changing what it
+        knows of the source and the batches may arrive in any order. The
+        last change is then sent at its own generation in the exchange that
+        receives the changes of the server, together with the documents the
+        server acknowledged storing, so that they are not sent back. The
+        changes in batches that the server declines or that fail to upload
+        are sent in that exchange too, through a single connection.
+
+        @param source_replica_uid: The uid of the source replica.
+        @type source_replica_uid: str
+        @param args: The arguments of the exchange.
+        @type args: dict
+        @param docs_by_generations: A list of (doc, generation, trans_id) of
+            local changes.
+        @type docs_by_generations: list of tuples
+        @param framed: Whether to send framed streams instead of JSON.
+        @type framed: bool
+
+        @return: (docs_by_generations, uploaded) - The local changes still to
+            be sent, and a list of [doc_id, generation] of the documents the
+            server stored, with the generation of the server they were
+            stored at.
+        @rtype: tuple
+        """
+        pending = docs_by_generations[:-1]
+        count = min(self._upload_connections,
+                    len(pending) // self.MIN_UPLOAD_BATCH)
+        if count < 2 or self._source_gen_info is None:
+            return docs_by_generations, []
+        source_gen, source_trans_id = self._source_gen_info
+        size = -(-len(pending) // count)
+        batches = [pending[start:start + size]
+                   for start in xrange(0, len(pending), size)]
+        batch_args = {
+            'last_known_generation': args['last_known_generation'],
+            'last_known_trans_id': args['last_known_trans_id'],
+            'upload_only': True,
+        }
+        results = [None] * len(batches)
+
+        def upload(index):
+            batch = [(doc, source_gen, source_trans_id)
+                     for doc, _, _ in batches[index]]
+            try:
+                results[index] = self._upload_batch(
+                    source_replica_uid, batch_args, batch, framed)
+            except (U1DBError, socket.error, httplib.HTTPException):
+                # the changes are sent again through the main connection.
+                pass
+
+        threads = [threading.Thread(target=upload, args=(index,))
+                   for index in xrange(len(batches))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        remaining = []
+        uploaded = []
+        for batch, result in zip(batches, results):
+            if result is None:
+                remaining.extend(batch)
+                continue
+            acked, sent, report = result
+            self.report.merge(report)
+            uploaded.extend(acked)
+            if self._delta_store is not None:
+                for doc, depth in sent:
+                    self._set_delta_base(doc, depth)
+        remaining.append(docs_by_generations[-1])
+        return remaining, uploaded
+
+    def _upload_batch(self, source_replica_uid, args, batch, framed):
+        """
+        Upload a batch of local changes through a connection of its own.
+
+        The changes are sent in full, because the delta store can only be
+        used from the thread of the sync.
+
+        @param source_replica_uid: The uid of the source replica.
+        @type source_replica_uid: str
+        @param args: The arguments sent in the first line of the stream.
+        @type args: dict
+        @param batch: A list of (doc, generation, trans_id) of local changes.
+        @type batch: list of tuples
+        @param framed: Whether to send a framed stream instead of JSON.
+        @type framed: bool
+
+        @return: (uploaded, sent, report) - A list of [doc_id, generation]
+            of the documents the server stored, the documents sent together
+            with the number of deltas each is stored as, and the report of
+            the upload.
+        @rtype: tuple
+        """
+        target = SoledadSyncTarget(
+            self._url.geturl(), crypto=self._crypto,
+            cert_file=self._cert_file,
+            connection_pool=self._connection_pool, scope=self._scope,
+            metadata_fields=self._metadata_fields)
+        target._creds = self._creds
+        try:
+            data, framed_response, sent = target._send_changes(
+                source_replica_uid, args, batch, False, framed)
+            target.report.bytes_received += len(data)
+            parse = target._parse_sync_frames if framed_response \
+                else target._parse_sync_stream
+            # the changes of the server are received by the main exchange.
+            res = parse(data, lambda doc, gen, trans_id: None)
+        finally:
+            target.close()
+        return res.get('uploaded', []), sent, target.report
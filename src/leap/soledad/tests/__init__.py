@@ -55,7 +55,8 @@ class BaseSoledadTest(BaseLeapTest):
                           prefix='',
                           secrets_path=Soledad.STORAGE_SECRETS_FILE_NAME,
                           local_db_path='soledad.u1db', server_url='',
-                          cert_file=None, secret_id=None):
+                          cert_file=None, secret_id=None,
+                          lazy_bootstrap=False):
 
         def _put_doc_side_effect(doc):
             self._doc_put = doc
@@ -77,7 +78,8 @@ class BaseSoledadTest(BaseLeapTest):
                 self.tempdir, prefix, local_db_path),
             server_url=server_url,  # Soledad will fail if not given an url.
             cert_file=cert_file,
-            secret_id=secret_id)
+            secret_id=secret_id,
+            lazy_bootstrap=lazy_bootstrap)
 
     def assertGetEncryptedDoc(
             self, db, doc_id, doc_rev, content, has_conflicts):
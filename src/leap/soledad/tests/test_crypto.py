@@ -188,6 +188,62 @@ class MacAuthTestCase(BaseSoledadTest):
             target.UnknownMacMethod,
             target.decrypt_doc, self._soledad._crypto, doc)
 
+    def test_decrypt_metadata(self):
+        """
+        Test that the metadata header holds the chosen fields and is
+        authenticated.
+        """
+        doc = SoledadDocument(doc_id='id', rev='rev')
+        doc.content = {'subject': 'hi', 'date': 1, 'body': 'long'}
+        doc.set_json(target.encrypt_doc(
+            self._soledad._crypto, doc,
+            metadata_fields=['subject', 'date', 'missing']))
+        self.assertEqual(
+            {'subject': 'hi', 'date': 1},
+            json.loads(target.decrypt_doc_metadata(
+                self._soledad._crypto, doc)))
+        # without the encrypted content, the metadata is still readable.
+        del doc.content[target.ENC_JSON_KEY]
+        self.assertEqual(
+            {'subject': 'hi', 'date': 1},
+            json.loads(target.decrypt_doc_metadata(
+                self._soledad._crypto, doc)))
+        doc.content[target.ENC_META_KEY][target.MAC_KEY] = '1234567890ABCDEF'
+        self.assertRaises(
+            target.WrongMac,
+            target.decrypt_doc_metadata, self._soledad._crypto, doc)
+
+    def test_decrypt_delta_chain(self):
+        """
+        Test that a document stored as a chain of deltas is decrypted to its
+        last revision, and that the chain is authenticated.
+        """
+        crypto = self._soledad._crypto
+        doc = SoledadDocument(doc_id='id', rev='rev1')
+        doc.content = {'flags': [], 'body': 'long', 'size': 4}
+        chain = [json.loads(target.encrypt_doc(crypto, doc))]
+        for rev, content in (
+                ('rev2', {'flags': ['seen'], 'body': 'long', 'size': 4}),
+                ('rev3', {'flags': ['seen'], 'body': 'long'})):
+            changes = target.json_diff(doc.content, content)
+            base_rev = doc.rev
+            doc = SoledadDocument(doc_id='id', rev=rev)
+            doc.content = content
+            chain.append(json.loads(target.encrypt_delta(
+                crypto, doc, base_rev, json.dumps(changes))))
+        stored = SoledadDocument(doc_id='id', rev='rev3')
+        stored.content = {
+            target.ENC_SCHEME_KEY: target.EncryptionSchemes.SYMKEY,
+            target.ENC_CHAIN_KEY: chain,
+        }
+        self.assertEqual(
+            {'flags': ['seen'], 'body': 'long'},
+            json.loads(target.decrypt_doc(crypto, stored)))
+        # a delta can not be applied to another revision.
+        stored.rev = 'rev4'
+        self.assertRaises(
+            target.WrongMac, target.decrypt_doc, crypto, stored)
+
 
 class SoledadCryptoTestCase(BaseSoledadTest):
 
@@ -23,9 +23,15 @@ Tests for general Soledad functionality.
 
 import os
 import re
+import sys
+import time
+import threading
 import tempfile
+import scrypt
 import simplejson as json
-from mock import Mock
+from mock import Mock, patch
+from u1db import errors
+from u1db.vectorclock import VectorClockRev
 
 
 from leap.common.testing.basetest import BaseLeapTest
@@ -35,11 +41,21 @@ from leap.soledad.tests import (
     ADDRESS,
 )
 from leap import soledad
-from leap.soledad import Soledad
+from leap.soledad import Soledad, profiling, target
 from leap.soledad.document import SoledadDocument
 from leap.soledad.crypto import SoledadCrypto
 from leap.soledad.shared_db import SoledadSharedDatabase
-from leap.soledad.target import SoledadSyncTarget
+from leap.soledad.target import (
+    SoledadSyncTarget,
+    SyncReport,
+)
+from leap.soledad.bootstrap import BootstrapGraph
+from leap.soledad.scheduler import (
+    SyncScheduler,
+    SharedSyncScheduler,
+)
+from leap.soledad.manager import SoledadManager
+from leap.soledad.sqlcipher import SQLCipherDatabase
 
 
 class AuxMethodsTestCase(BaseSoledadTest):
@@ -106,6 +122,21 @@ class AuxMethodsTestCase(BaseSoledadTest):
             sol.local_db_path)
         self.assertEqual('value_1', sol.server_url)
 
+    def test_statement_stats(self):
+        sol = self._soledad_instance(prefix='statement_stats')
+        self.assertIs(None, sol.get_statement_stats())
+        sol.enable_statement_stats(slow_query_threshold=10)
+        sol.create_doc({'key': 'value'})
+        self.assertTrue(sol.get_statement_stats()['statements'])
+        # statistics are kept when the database is opened again.
+        sol.suspend()
+        sol.get_all_docs()
+        self.assertIs(sol._statement_stats, sol._db.statement_stats)
+        sol.disable_statement_stats()
+        self.assertIs(None, sol.get_statement_stats())
+        self.assertIs(None, sol._db.statement_stats)
+        sol.close()
+
 
 class SoledadSharedDBTestCase(BaseSoledadTest):
     """
@@ -146,6 +177,325 @@ class SoledadSharedDBTestCase(BaseSoledadTest):
             self._doc_put.doc_id == doc_id,
             'Wrong doc_id when putting recovery document.')
 
+    def test__put_secrets_in_shared_db_skips_unchanged(self):
+        """
+        Ensure recovery document is not uploaded if the server already has
+        the same content.
+        """
+        doc = SoledadDocument(
+            doc_id=self._soledad._uuid_hash(),
+            json=json.dumps(
+                self._soledad.export_recovery_document(include_uuid=False)))
+        shared_db = self._soledad._shared_db()
+        shared_db.get_doc = Mock(return_value=doc)
+        shared_db.put_doc.reset_mock()
+        self._soledad._put_secrets_in_shared_db()
+        self.assertFalse(shared_db.put_doc.called)
+
+
+class SoledadBootstrapTestCase(BaseSoledadTest):
+    """
+    Tests for the bootstrap sequence.
+    """
+
+    def test_scrypt_runs_once_per_secret(self):
+        """
+        Ensure each key is derived only once during and after bootstrap.
+        """
+        with patch.object(scrypt, 'hash', wraps=scrypt.hash) as mocked:
+            sol = self._soledad_instance(
+                secrets_path='bootstrap.json',
+                local_db_path='bootstrap.u1db')
+            # one derivation to encrypt the new secret, and one for the
+            # local database key.
+            self.assertEqual(2, mocked.call_count)
+            sol.storage_secret
+            sol._crypto.doc_passphrase('some-doc')
+            self.assertEqual(2, mocked.call_count)
+            sol.close()
+            # an existing secret must be decrypted once.
+            mocked.reset_mock()
+            sol = self._soledad_instance(
+                secrets_path='bootstrap.json',
+                local_db_path='bootstrap.u1db')
+            sol.storage_secret
+            self.assertEqual(2, mocked.call_count)
+            sol.close()
+
+    def test_bootstrap_timings(self):
+        """
+        Ensure the time taken by each bootstrap step is recorded.
+        """
+        self.assertEqual(
+            ['setup', 'load_secrets', 'unlock_secret', 'derive_local_key',
+             'store_secrets', 'init_db'],
+            [step for step, _ in self._soledad.bootstrap_timings])
+        for _, elapsed in self._soledad.bootstrap_timings:
+            self.assertTrue(elapsed >= 0)
+
+
+class SoledadNeedSyncTestCase(BaseSoledadTest):
+    """
+    Tests for the cheap check for changes to sync.
+    """
+
+    URL = 'http://provider/userdb'
+
+    def _mock_target(self, *results):
+        mocked = Mock(side_effect=list(results))
+        patcher = patch.object(
+            SoledadSyncTarget, 'get_sync_info_if_changed', mocked)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return mocked
+
+    def test_local_changes_need_no_request(self):
+        gen = self._soledad._db._get_generation()
+        mocked = self._mock_target((('target', 0, '', gen, ''), '"etag"'))
+        self.assertFalse(self._soledad.need_sync(self.URL))
+        self._soledad.create_doc({})
+        self.assertTrue(self._soledad.need_sync(self.URL))
+        self.assertEqual(1, mocked.call_count)
+
+    def test_unchanged_target_uses_cached_info(self):
+        gen = self._soledad._db._get_generation()
+        mocked = self._mock_target(
+            (('target', 0, '', gen, ''), '"etag"'),
+            (None, '"etag"'))
+        self.assertFalse(self._soledad.need_sync(self.URL))
+        self.assertFalse(self._soledad.need_sync(self.URL))
+        mocked.assert_called_with(
+            self._soledad._db._get_replica_uid(), etag='"etag"')
+
+    def test_remote_changes(self):
+        gen = self._soledad._db._get_generation()
+        self._mock_target((('target', 3, 'T-new', gen, ''), '"etag"'))
+        # we have never synced with the target, which is now at generation 3
+        self.assertTrue(self._soledad.need_sync(self.URL))
+
+
+class WriteCoalescingTestCase(BaseSoledadTest):
+    """
+    Tests for buffering and coalescing updates to documents.
+    """
+
+    def _update(self, doc, times):
+        for count in xrange(times):
+            doc.content = {'count': str(count)}
+            self._soledad.put_doc(doc)
+
+    def test_updates_are_coalesced(self):
+        self._soledad.set_write_coalescing(60)
+        doc = self._soledad.create_doc({'count': None})
+        gen = self._soledad._db._get_generation()
+        self._update(doc, 10)
+        # the buffered state is read back, but nothing was written.
+        buffered = self._soledad.get_doc(doc.doc_id)
+        self.assertEqual({'count': '9'}, buffered.content)
+        self.assertEqual(doc.rev, buffered.rev)
+        self.assertEqual(gen, self._soledad._db._get_generation())
+        self.assertEqual(1, self._soledad.flush_writes())
+        self.assertEqual(gen + 1, self._soledad._db._get_generation())
+        stored = self._soledad._db.get_doc(doc.doc_id)
+        self.assertEqual(doc.rev, stored.rev)
+        self.assertEqual({'count': '9'}, stored.content)
+
+    def test_expired_updates_are_written(self):
+        self._soledad.set_write_coalescing(1)
+        now = [0]
+        self._soledad._write_coalescer._clock = lambda: now[0]
+        doc = self._soledad.create_doc({'count': None})
+        self._update(doc, 3)
+        now[0] = 2
+        self._soledad.get_doc(doc.doc_id)
+        self.assertEqual(0, len(self._soledad._write_coalescer))
+        self.assertEqual(
+            {'count': '2'}, self._soledad._db.get_doc(doc.doc_id).content)
+
+    def test_stale_revision_is_refused(self):
+        self._soledad.set_write_coalescing(60)
+        doc = self._soledad.create_doc({'count': None})
+        stale = self._soledad.get_doc(doc.doc_id)
+        self._update(doc, 1)
+        self.assertRaises(
+            errors.RevisionConflict, self._soledad.put_doc, stale)
+
+    def test_conflicting_update_is_written_as_conflict(self):
+        self._soledad.set_write_coalescing(60)
+        doc = self._soledad.create_doc({'count': None})
+        self._update(doc, 2)
+        # a sync changes the document while the update is buffered.
+        vcr = VectorClockRev(self._soledad._db.get_doc(doc.doc_id).rev)
+        vcr.increment('other')
+        synced = SoledadDocument(
+            doc.doc_id, vcr.as_str(), json.dumps({'count': 'synced'}))
+        self._soledad._db._put_doc_if_newer(
+            synced, save_conflict=True, replica_uid='other', replica_gen=1,
+            replica_trans_id='T-1')
+        self.assertEqual(1, self._soledad.flush_writes())
+        stored = self._soledad._db.get_doc(doc.doc_id)
+        self.assertEqual(doc.rev, stored.rev)
+        self.assertEqual({'count': '1'}, stored.content)
+        self.assertTrue(stored.has_conflicts)
+        self.assertEqual(
+            [{'count': '1'}, {'count': 'synced'}],
+            [conflict.content for conflict in
+             self._soledad.get_doc_conflicts(doc.doc_id)])
+
+    def test_expired_updates_are_flushed_in_background(self):
+        self._soledad.set_write_coalescing(0.2)
+        doc = self._soledad.create_doc({'count': None})
+        scheduler = self._soledad._sync_scheduler = Mock()
+        self._update(doc, 3)
+        # the update is written without using the instance.
+        for _ in xrange(50):
+            stored = self._soledad._db.get_doc(doc.doc_id)
+            if stored.rev == doc.rev:
+                break
+            time.sleep(0.1)
+        self._soledad._sync_scheduler = None
+        self.assertEqual(doc.rev, stored.rev)
+        self.assertEqual({'count': '2'}, stored.content)
+        self.assertEqual(0, len(self._soledad._write_coalescer))
+        # the written update is synced.
+        self.assertEqual(1, scheduler.notify_local_change.call_count)
+
+    def test_index_queries_see_buffered_updates(self):
+        self._soledad.create_index('by-count', 'count')
+        self._soledad.set_write_coalescing(60)
+        doc = self._soledad.create_doc({'count': None})
+        self._update(doc, 5)
+        self.assertEqual(
+            [doc.doc_id],
+            [d.doc_id for d in self._soledad.get_from_index('by-count', '4')])
+
+
+class SoledadLazyBootstrapTestCase(BaseSoledadTest):
+    """
+    Tests for the bootstrap that does not wait for the server.
+    """
+
+    def _lazy_instance(self, put_side_effect):
+        """
+        Return a lazily bootstrapped instance whose secrets already exist
+        locally, and the mock used to store secrets in the server.
+        """
+        # create local secrets first
+        self._soledad_instance(
+            secrets_path='lazy.json', local_db_path='lazy.u1db').close()
+        put = Mock(side_effect=put_side_effect)
+        with patch.object(Soledad, 'SHARED_DB_RETRY_DELAY', 0.01):
+            with patch.object(Soledad, '_put_secrets_in_shared_db', put):
+                sol = self._soledad_instance(
+                    secrets_path='lazy.json', local_db_path='lazy.u1db',
+                    lazy_bootstrap=True)
+                # the local database is usable right away
+                sol.create_doc({'key': 'value'})
+                sol._secrets_check.join(5)
+        return sol, put
+
+    def test_secrets_are_verified_in_background(self):
+        with patch.object(soledad, 'signal') as mocked_signal:
+            sol, put = self._lazy_instance([IOError('no network'), None])
+            self.assertEqual(2, put.call_count)
+            if soledad.SOLEDAD_DONE_VERIFYING_KEYS is not None:
+                mocked_signal.assert_called_with(
+                    soledad.SOLEDAD_DONE_VERIFYING_KEYS, ADDRESS)
+        sol.close()
+
+    def test_background_verification_gives_up(self):
+        with patch.object(Soledad, 'SHARED_DB_MAX_ATTEMPTS', 3):
+            with patch.object(soledad, 'signal') as mocked_signal:
+                sol, put = self._lazy_instance(IOError('no network'))
+                self.assertEqual(3, put.call_count)
+                if soledad.SOLEDAD_VERIFYING_KEYS_FAILED is not None:
+                    mocked_signal.assert_called_with(
+                        soledad.SOLEDAD_VERIFYING_KEYS_FAILED, ADDRESS)
+        sol.close()
+
+    def test_token_change_waits_for_verification(self):
+        self._soledad_instance(
+            secrets_path='lazy.json', local_db_path='lazy.u1db').close()
+        verifying = threading.Event()
+        events = []
+
+        def put():
+            verifying.set()
+            time.sleep(0.1)
+            events.append('verified')
+
+        with patch.object(Soledad, '_put_secrets_in_shared_db',
+                          Mock(side_effect=put)):
+            sol = self._soledad_instance(
+                secrets_path='lazy.json', local_db_path='lazy.u1db',
+                lazy_bootstrap=True)
+            self.assertTrue(verifying.wait(5))
+            # the shared db is not closed while it is used.
+            sol._set_token('new-token')
+            events.append('token set')
+            sol._secrets_check.join(5)
+        self.assertEqual(['verified', 'token set'], events)
+        self.assertEqual('new-token', sol._get_token())
+        sol.close()
+
+    def test_fresh_instance_does_not_defer(self):
+        """
+        Without local secrets, bootstrap must ask the server before
+        creating new ones.
+        """
+        sol = self._soledad_instance(
+            secrets_path='fresh.json', local_db_path='fresh.u1db',
+            lazy_bootstrap=True)
+        self.assertIsNone(sol._secrets_check)
+        self.assertTrue(sol._shared_db().put_doc.called)
+        sol.close()
+
+
+class BootstrapGraphTestCase(BaseLeapTest):
+    """
+    Tests for the graph of bootstrap steps.
+    """
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_steps_run_in_order(self):
+        calls = []
+        graph = BootstrapGraph()
+        graph.add('a', lambda: calls.append('a'))
+        graph.add('b', lambda: calls.append('b') or 'b', requires=('a',))
+        timings = graph.run()
+        self.assertEqual(['a', 'b'], calls)
+        self.assertEqual('b', graph.result('b'))
+        self.assertEqual(['a', 'b'], [step for step, _ in timings])
+
+    def test_background_step_overlaps(self):
+        import threading
+        started = threading.Event()
+        graph = BootstrapGraph()
+        graph.add('bg', lambda: started.wait(5) or 'done', background=True)
+        # the background step only finishes after this one runs.
+        graph.add('fg', started.set)
+        graph.add('after', lambda: None, requires=('bg',))
+        graph.run()
+        self.assertEqual('done', graph.result('bg'))
+
+    def test_background_exception_is_raised(self):
+        def _fail():
+            raise ValueError('failed')
+
+        graph = BootstrapGraph()
+        graph.add('bg', _fail, background=True)
+        self.assertRaises(ValueError, graph.run)
+
+    def test_unknown_requirement(self):
+        graph = BootstrapGraph()
+        self.assertRaises(
+            ValueError, graph.add, 'a', lambda: None, requires=('b',))
+
 
 class SoledadSignalingTestCase(BaseSoledadTest):
     """
@@ -202,16 +552,8 @@ class SoledadSignalingTestCase(BaseSoledadTest):
             proto.SOLEDAD_DONE_CREATING_KEYS,
             ADDRESS,
         )
-        self._pop_mock_call(soledad.signal)
-        soledad.signal.assert_called_with(
-            proto.SOLEDAD_DOWNLOADING_KEYS,
-            ADDRESS,
-        )
-        self._pop_mock_call(soledad.signal)
-        soledad.signal.assert_called_with(
-            proto.SOLEDAD_DONE_DOWNLOADING_KEYS,
-            ADDRESS,
-        )
+        # the recovery document was already fetched, so it is not downloaded
+        # again before uploading.
         self._pop_mock_call(soledad.signal)
         soledad.signal.assert_called_with(
             proto.SOLEDAD_UPLOADING_KEYS,
@@ -257,6 +599,23 @@ class SoledadSignalingTestCase(BaseSoledadTest):
             ADDRESS,
         )
 
+    def test_bootstrap_timing_signals(self):
+        """
+        Test that a bootstrap signals the time taken by each step.
+        """
+        if soledad.SOLEDAD_BOOTSTRAP_STEP_TIMING is None:
+            self.skipTest('leap.common does not know the timing signal.')
+        soledad.signal.reset_mock()
+        self._soledad_instance()
+        steps = [
+            json.loads(args[1])['step']
+            for args, _ in soledad.signal.call_args_list
+            if args[0] == soledad.SOLEDAD_BOOTSTRAP_STEP_TIMING]
+        self.assertEqual(
+            ['setup', 'load_secrets', 'unlock_secret', 'derive_local_key',
+             'store_secrets', 'init_db'],
+            steps)
+
     def test_sync_signals(self):
         """
         Test Soledad emits SOLEDAD_CREATING_KEYS signal.
@@ -268,7 +627,8 @@ class SoledadSignalingTestCase(BaseSoledadTest):
         # server
         sol._db.sync = Mock()
         # do the sync
-        sol.sync()
+        report = sol.sync()
+        self.assertIsInstance(report, SyncReport)
         # assert the signal has been emitted
         soledad.signal.assert_called_with(
             proto.SOLEDAD_DONE_DATA_SYNC,
@@ -282,7 +642,8 @@ class SoledadSignalingTestCase(BaseSoledadTest):
         soledad.signal.reset_mock()
         sol = self._soledad_instance()
         # mock the sync target
-        SoledadSyncTarget.get_sync_info = Mock(return_value=[0, 0, 0, 0, 2])
+        SoledadSyncTarget.get_sync_info_if_changed = Mock(
+            return_value=(('target', 0, '', 2, 'T-id'), None))
         # mock our generation so soledad thinks there's new data to sync
         sol._db._get_generation = Mock(return_value=1)
         # check for new data to sync
@@ -292,3 +653,392 @@ class SoledadSignalingTestCase(BaseSoledadTest):
             proto.SOLEDAD_NEW_DATA_TO_SYNC,
             ADDRESS,
         )
+
+
+class SyncSchedulerTestCase(BaseLeapTest):
+    """
+    Tests for the background sync scheduler.
+    """
+
+    def setUp(self):
+        self.calls = []
+        self.result = {'sent': 0, 'received': 0}
+        self.synced = threading.Event()
+        self.scheduler = None
+
+    def tearDown(self):
+        if self.scheduler is not None:
+            self.scheduler.stop(timeout=5)
+
+    def _sync(self):
+        self.calls.append(time.time())
+        self.synced.set()
+        return self.result
+
+    def _start(self, **kwargs):
+        params = {
+            'debounce': 0.05,
+            'max_debounce': 1,
+            'min_poll_interval': 60,
+            'max_poll_interval': 120,
+        }
+        params.update(kwargs)
+        self.scheduler = SyncScheduler(self._sync, **params)
+        self.scheduler.start()
+        # the first poll happens right away
+        self.assertTrue(self.synced.wait(5))
+        self.synced.clear()
+
+    def test_local_changes_are_debounced(self):
+        self._start()
+        for i in range(5):
+            self.scheduler.notify_local_change()
+        self.assertTrue(self.synced.wait(5))
+        time.sleep(0.2)
+        self.assertEqual(2, len(self.calls))
+
+    def test_pause_and_resume(self):
+        self._start()
+        self.scheduler.pause()
+        self.scheduler.notify_local_change()
+        self.assertFalse(self.synced.wait(0.2))
+        self.assertTrue(self.scheduler.stats()['paused'])
+        self.scheduler.resume()
+        self.assertTrue(self.synced.wait(5))
+
+    def test_idle_polls_back_off(self):
+        self._start()
+        self.assertEqual(120, self.scheduler.stats()['poll_interval'])
+        self.result = {'sent': 1, 'received': 2}
+        self.scheduler.sync_now()
+        self.assertTrue(self.synced.wait(5))
+        time.sleep(0.1)
+        stats = self.scheduler.stats()
+        self.assertEqual(60, stats['poll_interval'])
+        self.assertEqual(2, stats['syncs'])
+        self.assertEqual(1, stats['docs_sent'])
+        self.assertEqual(2, stats['docs_received'])
+        self.assertIsNotNone(stats['average_duration'])
+
+    def test_failures_are_counted(self):
+        def _failing_sync():
+            self.synced.set()
+            raise IOError('no network')
+
+        self._sync = _failing_sync
+        self._start()
+        time.sleep(0.1)
+        self.assertEqual(1, self.scheduler.stats()['failures'])
+        self.assertEqual(0, self.scheduler.stats()['syncs'])
+
+
+class SoledadScheduledSyncTestCase(BaseSoledadTest):
+    """
+    Tests for syncing a Soledad instance in the background.
+    """
+
+    def test_syncs_never_overlap(self):
+        calls = []
+        running = []
+        overlaps = []
+        started = threading.Event()
+
+        def _slow_sync(db, *args, **kwargs):
+            calls.append(threading.current_thread().name)
+            if running:
+                overlaps.append(True)
+            running.append(True)
+            started.set()
+            time.sleep(0.2)
+            running.pop()
+            return 0
+
+        with patch.object(SQLCipherDatabase, 'sync', _slow_sync):
+            with patch.object(soledad, 'signal'):
+                self._soledad.start_sync_scheduler()
+                # the first scheduled sync happens right away.
+                self.assertTrue(started.wait(5))
+                # a manual sync while the scheduled one is running waits
+                # for it.
+                self._soledad.sync()
+                self._soledad.stop_sync_scheduler()
+        self.assertEqual(
+            ['soledad-sync-scheduler', threading.current_thread().name],
+            calls)
+        self.assertEqual([], overlaps)
+
+    def test_local_writes_are_scheduled(self):
+        scheduler = self._soledad._sync_scheduler = Mock()
+        doc = self._soledad.create_doc({'key': 'value'})
+        self.assertEqual(1, scheduler.notify_local_change.call_count)
+        # writes that bypass the wrapper methods are noticed too.
+        doc.content = {'key': 'other'}
+        self._soledad._db.put_doc(doc)
+        self.assertEqual(2, scheduler.notify_local_change.call_count)
+        # but not the documents received by a sync.
+        self._soledad._db._sync_report = SyncReport()
+        try:
+            self._soledad._db._put_doc_if_newer(
+                SoledadDocument('other', 'other:1', '{}'),
+                save_conflict=True, replica_uid='other', replica_gen=1,
+                replica_trans_id='T-1')
+        finally:
+            self._soledad._db._sync_report = None
+        self.assertEqual(2, scheduler.notify_local_change.call_count)
+        self._soledad._sync_scheduler = None
+
+
+class SharedSyncSchedulerTestCase(BaseLeapTest):
+    """
+    Tests for the sync scheduler shared by many replicas.
+    """
+
+    def setUp(self):
+        self.calls = []
+        self.scheduler = SharedSyncScheduler(
+            workers=1, debounce=0.01, max_debounce=0.05,
+            min_poll_interval=60, max_poll_interval=120)
+
+    def tearDown(self):
+        self.scheduler.stop(timeout=5)
+
+    def _sync_func(self, key):
+        def _sync():
+            self.calls.append(key)
+            time.sleep(0.01)
+            return {'sent': 1}
+        return _sync
+
+    def test_busy_replica_does_not_starve_others(self):
+        busy = self.scheduler.add('busy', self._sync_func('busy'))
+        self.scheduler.add('quiet', self._sync_func('quiet'))
+        self.scheduler.start()
+        for i in range(20):
+            busy.notify_local_change()
+            time.sleep(0.01)
+        time.sleep(0.2)
+        self.assertIn('quiet', self.calls)
+        self.assertEqual(2, self.scheduler.stats()['replicas'])
+        self.assertEqual(
+            len(self.calls), self.scheduler.stats()['docs_sent'])
+
+    def test_removed_replica_is_not_synced(self):
+        replica = self.scheduler.add('gone', self._sync_func('gone'))
+        replica.stop()
+        self.scheduler.start()
+        time.sleep(0.1)
+        self.assertEqual([], self.calls)
+        self.assertEqual(0, self.scheduler.stats()['replicas'])
+
+
+class SoledadManagerTestCase(BaseSoledadTest):
+    """
+    Tests for hosting many accounts in one process.
+    """
+
+    def setUp(self):
+        BaseSoledadTest.setUp(self)
+        self.manager = SoledadManager(max_open_databases=1)
+
+    def tearDown(self):
+        self.manager.close()
+        BaseSoledadTest.tearDown(self)
+
+    def _open(self, uuid, cert_file=None):
+        return self.manager.open_account(
+            uuid, '123',
+            os.path.join(self.tempdir, uuid, 'secrets.json'),
+            os.path.join(self.tempdir, uuid, 'soledad.u1db'),
+            '', cert_file, sync=False)
+
+    def test_idle_databases_are_suspended(self):
+        sol1 = self._open('user-1')
+        doc = sol1.create_doc({'key': 'value'})
+        sol2 = self._open('user-2')
+        self.assertTrue(sol1.suspended)
+        self.assertFalse(sol2.suspended)
+        # using an account opens its database again.
+        with patch.object(scrypt, 'hash', wraps=scrypt.hash) as hash_mock:
+            self.assertEqual(
+                {'key': 'value'},
+                self.manager.get('user-1').get_doc(doc.doc_id).content)
+            self.assertEqual(0, hash_mock.call_count)
+        self.assertTrue(sol2.suspended)
+        stats = self.manager.stats()
+        self.assertEqual(2, stats['accounts'])
+        self.assertEqual(1, stats['open_databases'])
+
+    def test_idle_databases_are_suspended_by_their_thread(self):
+        errors = []
+        accounts = []
+        used = threading.Event()
+        evicted = threading.Event()
+
+        def use_accounts():
+            try:
+                sol1 = self._open('user-1')
+                accounts.append(sol1)
+                doc = sol1.create_doc({'key': 'value'})
+                used.set()
+                evicted.wait(10)
+                # the account is still usable from this thread.
+                self.assertEqual(
+                    {'key': 'value'}, sol1.get_doc(doc.doc_id).content)
+                self._open('user-3')
+                self.assertTrue(sol1.suspended)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                used.set()
+
+        thread = threading.Thread(target=use_accounts)
+        thread.start()
+        used.wait(10)
+        sol2 = self._open('user-2')
+        [sol1] = accounts
+        # the database of an account is not closed by another thread.
+        self.assertFalse(sol1.suspended)
+        self.assertEqual(2, self.manager.stats()['open_databases'])
+        evicted.set()
+        thread.join(10)
+        self.assertEqual([], errors)
+        self.assertTrue(sol1.suspended)
+        # the account evicted for this thread is suspended when it next
+        # calls the manager.
+        self.assertFalse(sol2.suspended)
+        self._open('user-4')
+        self.assertTrue(sol2.suspended)
+
+    def test_accounts_share_connection_pool(self):
+        sol1 = self._open('user-1')
+        sol2 = self._open('user-2')
+        self.assertIs(self.manager.connection_pool, sol1._connection_pool)
+        self.assertIs(sol1._connection_pool, sol2._connection_pool)
+        self.assertRaises(ValueError, self._open, 'user-1')
+
+    def test_certificates_are_per_instance(self):
+        global_cert = soledad.SOLEDAD_CERT
+        sol1 = self._open('user-1', cert_file='/path/to/cert1')
+        sol2 = self._open('user-2', cert_file='/path/to/cert2')
+        self.assertEqual('/path/to/cert1', sol1._cert_file)
+        self.assertEqual('/path/to/cert2', sol2._cert_file)
+        self.assertEqual(global_cert, soledad.SOLEDAD_CERT)
+
+    def test_close_account(self):
+        self._open('user-1')
+        self.assertIn('user-1', self.manager)
+        self.manager.close_account('user-1')
+        self.assertNotIn('user-1', self.manager)
+        self.assertRaises(KeyError, self.manager.get, 'user-1')
+        self.assertEqual(0, len(self.manager))
+
+
+class ProfilingTestCase(BaseSoledadTest):
+    """
+    Tests for profiling Soledad's entry points.
+    """
+
+    def setUp(self):
+        BaseSoledadTest.setUp(self)
+        self.profile_dir = os.path.join(self.tempdir, 'profiles')
+
+    def tearDown(self):
+        profiling.disable_profiling()
+        BaseSoledadTest.tearDown(self)
+
+    def _profiles(self, suffix):
+        return [name for name in os.listdir(self.profile_dir)
+                if name.endswith(suffix)]
+
+    def test_bootstrap_is_profiled(self):
+        original = Soledad.__dict__['_bootstrap']
+        with profiling.profiling(self.profile_dir):
+            self.assertTrue(profiling.profiling_enabled())
+            sol = self._soledad_instance(prefix='profiled')
+            sol.close()
+        self.assertEqual(1, len(self._profiles('-bootstrap.prof')))
+        self.assertFalse(profiling.profiling_enabled())
+        self.assertIs(original, Soledad.__dict__['_bootstrap'])
+
+    def test_profiles_are_rotated(self):
+        doc = SoledadDocument('id', 'rev', json.dumps({'key': 'value'}))
+        with profiling.profiling(self.profile_dir, max_bytes=1):
+            for _ in range(3):
+                target.encrypt_doc(self._soledad._crypto, doc)
+        # only the latest profile is kept.
+        profiles = os.listdir(self.profile_dir)
+        self.assertEqual(1, len(profiles))
+        self.assertIn('-000003-', profiles[0])
+
+    def test_unknown_profiler(self):
+        self.assertRaises(
+            ValueError, profiling.enable_profiling, self.profile_dir,
+            profiler='unknown')
+        self.assertFalse(profiling.profiling_enabled())
+
+    def test_sync_memory_profile(self):
+
+        class FakeTracemalloc(object):
+
+            def __init__(self):
+                self.current = self.peak = 1000
+                self.tracing = False
+                self.snapshots = []
+
+            def is_tracing(self):
+                return self.tracing
+
+            def start(self, frames):
+                self.tracing = True
+
+            def stop(self):
+                self.tracing = False
+
+            def get_traced_memory(self):
+                return self.current, self.peak
+
+            def allocate(self, size):
+                self.current += size
+                self.peak = max(self.peak, self.current)
+
+            def take_snapshot(self):
+                self.snapshots.append(self.current)
+                return Mock(compare_to=Mock(return_value=['site']))
+
+        tracemalloc = FakeTracemalloc()
+        with patch.dict(sys.modules, {'tracemalloc': tracemalloc}):
+            memory = profiling.SyncMemoryProfile()
+        report = SyncReport(memory=memory)
+        memory.start()
+        self.assertTrue(tracemalloc.tracing)
+        with report.phase('encrypt'):
+            tracemalloc.allocate(2 * 1024 * 1024)
+            # allocation sites are looked up while the memory is alive.
+            report.sample_memory()
+            tracemalloc.allocate(-2 * 1024 * 1024)
+        with report.phase('parse'):
+            tracemalloc.allocate(1024)
+        memory.stop()
+        self.assertFalse(tracemalloc.tracing)
+        self.assertEqual(2 * 1024 * 1024, memory.peak)
+        self.assertEqual('encrypt', memory.peak_phase)
+        self.assertEqual(1024, memory.phases['parse'])
+        self.assertEqual(['site'], memory.top)
+        self.assertEqual([1000, 1000 + 2 * 1024 * 1024], tracemalloc.snapshots)
+        self.assertEqual(memory.as_dict(), report.as_dict()['memory'])
+
+    def test_sync_memory_profile_not_available(self):
+        with patch.dict(sys.modules, {'tracemalloc': None}):
+            self.assertRaises(
+                profiling.ProfilerNotAvailable, self._soledad.sync,
+                profile_memory=True)
+
+    def test_enable_from_environment(self):
+        profiling.enable_from_environment({})
+        self.assertFalse(profiling.profiling_enabled())
+        profiling.enable_from_environment({
+            'SOLEDAD_PROFILE': 'sampling',
+            'SOLEDAD_PROFILE_DIR': self.profile_dir,
+        })
+        self.assertTrue(profiling.profiling_enabled())
+        self.assertTrue(os.path.isdir(self.profile_dir))
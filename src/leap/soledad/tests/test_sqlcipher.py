@@ -23,6 +23,7 @@ Test sqlcipher backend internals.
 
 import os
 import time
+import hashlib
 import unittest
 import simplejson as json
 import threading
@@ -47,7 +48,11 @@ from leap.soledad.document import SoledadDocument
 from leap.soledad.sqlcipher import (
     SQLCipherDatabase,
     DatabaseIsNotEncrypted,
+    ContentPending,
+    InvalidSearchQuery,
+    MigrationStages,
     open as u1db_open,
+    migrate,
 )
 from leap.soledad.target import (
     EncryptionSchemes,
@@ -55,9 +60,18 @@ from leap.soledad.target import (
     ENC_JSON_KEY,
     ENC_SCHEME_KEY,
 )
+from leap.soledad.blobs import (
+    BlobNotFound,
+    blob_reference,
+    BLOB_ID_KEY,
+)
 
 
 # u1db tests stuff.
+from leap.soledad.sqlstats import (
+    StatementStats,
+    statement_shape,
+)
 from leap.soledad.tests import u1db_tests as tests, BaseSoledadTest
 from leap.soledad.tests.u1db_tests import test_sqlite_backend
 from leap.soledad.tests.u1db_tests import test_backends
@@ -152,6 +166,29 @@ class SQLCipherIndexTests(test_backends.DatabaseIndexTests):
     scenarios = SQLCIPHER_SCENARIOS
 
 
+def make_cached_sqlcipher_database_for_test(test, replica_uid):
+    db = make_sqlcipher_database_for_test(test, replica_uid)
+    db.set_document_cache_size(100)
+    return db
+
+
+SQLCIPHER_CACHED_SCENARIOS = [
+    ('sqlcipher-cached', {
+        'make_database_for_test': make_cached_sqlcipher_database_for_test,
+        'copy_database_for_test': copy_sqlcipher_database_for_test,
+        'make_document_for_test': make_document_for_test, }),
+]
+
+
+class SQLCipherCachedDatabaseTests(test_backends.LocalDatabaseTests):
+    scenarios = SQLCIPHER_CACHED_SCENARIOS
+
+
+class SQLCipherCachedWithConflictsTests(
+        test_backends.LocalDatabaseWithConflictsTests):
+    scenarios = SQLCIPHER_CACHED_SCENARIOS
+
+
 load_tests = tests.load_with_scenarios
 
 
@@ -343,6 +380,36 @@ class TestSQLCipherPartialExpandDatabase(
         doc = db2.create_doc({})
         self.assertTrue(isinstance(doc, SoledadDocument))
 
+    def test_open_database_keys_once(self):
+        temp_dir = self.createTempDir(prefix='u1db-test-')
+        path = temp_dir + '/existing.sqlite'
+        SQLCipherDatabase(path, PASSWORD).close()
+        calls = []
+        set_crypto_pragmas = SQLCipherDatabase._set_crypto_pragmas
+
+        def _set_crypto_pragmas(cls, *args):
+            calls.append(args)
+            return set_crypto_pragmas.__func__(cls, *args)
+
+        self.patch(SQLCipherDatabase, '_set_crypto_pragmas',
+                   classmethod(_set_crypto_pragmas))
+        db2 = SQLCipherDatabase.open_database(path, PASSWORD, create=False)
+        self.addCleanup(db2.close)
+        self.assertEqual(1, len(calls))
+        steps = [name for name, _ in db2.open_timings.steps]
+        self.assertEqual(
+            ['check_header', 'connect', 'set_crypto_pragmas', 'verify_key',
+             'index_storage', 'ensure_schema'],
+            steps)
+
+    def test_open_database_wrong_key(self):
+        temp_dir = self.createTempDir(prefix='u1db-test-')
+        path = temp_dir + '/existing.sqlite'
+        SQLCipherDatabase(path, PASSWORD).close()
+        self.assertRaises(
+            dbapi2.DatabaseError,
+            SQLCipherDatabase.open_database, path, 'wrong', create=False)
+
     def test_open_database_create(self):
         temp_dir = self.createTempDir(prefix='u1db-test-')
         path = temp_dir + '/new.sqlite'
@@ -821,4 +888,712 @@ class SQLCipherEncryptionTest(BaseLeapTest):
             pass
 
 
+#-----------------------------------------------------------------------------
+# Tests for the document cache
+#-----------------------------------------------------------------------------
+
+class SQLCipherDocumentCacheTest(tests.TestCase):
+    """
+    Tests to guarantee the document cache never returns stale documents.
+    """
+
+    scenarios = [
+        ('sqlcipher', {'make_document_for_test': make_document_for_test}),
+    ]
+
+    def setUp(self):
+        tests.TestCase.setUp(self)
+        self.db = SQLCipherDatabase(':memory:', PASSWORD)
+        self.db.set_document_cache_size(2)
+        self.doc = self.db.create_doc_from_json(tests.simple_doc)
+
+    def tearDown(self):
+        self.db.close()
+        tests.TestCase.tearDown(self)
+
+    def test_get_doc_hits_cache(self):
+        self.db.get_doc(self.doc.doc_id)
+        self.db.get_doc(self.doc.doc_id)
+        stats = self.db.document_cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(0.5, stats['hit_rate'])
+        self.assertEqual(1, stats['size'])
+
+    def test_mutations_do_not_leak_into_cache(self):
+        doc = self.db.get_doc(self.doc.doc_id)
+        doc.content['key'] = 'changed'
+        doc.syncable = False
+        cached = self.db.get_doc(self.doc.doc_id)
+        self.assertEqual(tests.simple_doc, cached.get_json())
+        self.assertTrue(cached.syncable)
+
+    def test_cache_is_bounded(self):
+        docs = [self.db.create_doc({}) for i in range(3)]
+        for doc in docs:
+            self.db.get_doc(doc.doc_id)
+        self.assertEqual(2, len(self.db.document_cache))
+
+    def test_put_doc_invalidates(self):
+        doc = self.db.get_doc(self.doc.doc_id)
+        doc.set_json(tests.nested_doc)
+        new_rev = self.db.put_doc(doc)
+        self.assertGetDoc(
+            self.db, self.doc.doc_id, new_rev, tests.nested_doc, False)
+
+    def test_delete_doc_invalidates(self):
+        doc = self.db.get_doc(self.doc.doc_id)
+        self.db.delete_doc(doc)
+        self.assertIs(None, self.db.get_doc(self.doc.doc_id))
+        self.assertTrue(
+            self.db.get_doc(self.doc.doc_id, include_deleted=True)
+            .is_tombstone())
+
+    def test_put_doc_if_newer_invalidates(self):
+        self.db.get_doc(self.doc.doc_id)
+        doc = self.make_document(
+            self.doc.doc_id, self.doc.rev + '|other:1', tests.nested_doc)
+        self.db._put_doc_if_newer(
+            doc, save_conflict=False, replica_uid='other', replica_gen=1,
+            replica_trans_id='T-sid')
+        self.assertGetDoc(
+            self.db, self.doc.doc_id, doc.rev, tests.nested_doc, False)
+
+    def test_conflicts_and_resolution_invalidate(self):
+        self.db.get_doc(self.doc.doc_id)
+        doc = self.make_document(self.doc.doc_id, 'other:1', tests.nested_doc)
+        self.db._put_doc_if_newer(
+            doc, save_conflict=True, replica_uid='other', replica_gen=1,
+            replica_trans_id='T-sid')
+        conflicted = self.db.get_doc(self.doc.doc_id)
+        self.assertTrue(conflicted.has_conflicts)
+        self.db.resolve_doc(conflicted, [self.doc.rev, 'other:1'])
+        resolved = self.db.get_doc(self.doc.doc_id)
+        self.assertFalse(resolved.has_conflicts)
+        self.assertEqual(conflicted.rev, resolved.rev)
+
+    def test_read_invalidated_meanwhile_is_not_cached(self):
+        get_doc = self.db._get_doc
+
+        def _racing_get_doc(doc_id, check_for_conflicts=False):
+            doc = get_doc(doc_id, check_for_conflicts=check_for_conflicts)
+            # another connection writes the document after it was read.
+            self.db.document_cache.invalidate(doc_id)
+            return doc
+
+        self.db._get_doc = _racing_get_doc
+        self.db.get_doc(self.doc.doc_id)
+        self.assertEqual(0, len(self.db.document_cache))
+        del self.db._get_doc
+        self.db.get_doc(self.doc.doc_id)
+        self.assertEqual(1, len(self.db.document_cache))
+
+    def test_writes_invalidate_foreign_cache(self):
+        self.db.get_doc(self.doc.doc_id)
+        other = SQLCipherDatabase(':memory:', PASSWORD)
+        self.addCleanup(other.close)
+        other.set_foreign_cache(self.db.document_cache)
+        doc = other.create_doc_from_json(
+            tests.simple_doc, doc_id=self.doc.doc_id)
+        self.assertIs(None, self.db.document_cache.get(doc.doc_id))
+        # the document is read again before the write is committed.
+        self.db.get_doc(self.doc.doc_id)
+        other.invalidate_written_docs()
+        self.assertIs(None, self.db.document_cache.get(doc.doc_id))
+
+
+class SQLCipherStreamingQueriesTest(tests.TestCase):
+    """
+    Tests for the iterator and paginated variants of the query methods.
+    """
+
+    scenarios = [
+        ('sqlcipher', {'make_document_for_test': make_document_for_test}),
+    ]
+
+    def setUp(self):
+        tests.TestCase.setUp(self)
+        self.db = SQLCipherDatabase(':memory:', PASSWORD)
+        self.db.FETCH_BATCH_SIZE = 2
+        self.db.create_index('by-key', 'key')
+        self.docs = [
+            self.db.create_doc({'key': 'value%d' % i}, doc_id='doc%d' % i)
+            for i in range(5)]
+
+    def tearDown(self):
+        self.db.close()
+        tests.TestCase.tearDown(self)
+
+    def test_iter_all_docs(self):
+        self.db.delete_doc(self.docs[0])
+        gen, docs = self.db.iter_all_docs()
+        self.assertEqual(self.db._get_generation(), gen)
+        _, expected = self.db.get_all_docs()
+        self.assertEqual(
+            sorted(expected, key=lambda doc: doc.doc_id),
+            sorted(docs, key=lambda doc: doc.doc_id))
+        _, docs = self.db.iter_all_docs(include_deleted=True)
+        self.assertEqual(5, len(list(docs)))
+
+    def test_iter_all_docs_is_lazy(self):
+        _, docs = self.db.iter_all_docs()
+        self.assertTrue(hasattr(docs, 'next'))
+        self.assertFalse(isinstance(docs, list))
+
+    def test_iter_from_index(self):
+        self.assertEqual(
+            self.db.get_from_index('by-key', 'value*'),
+            list(self.db.iter_from_index('by-key', 'value*')))
+        self.assertEqual(
+            [self.docs[2]],
+            list(self.db.iter_from_index('by-key', 'value2')))
+
+    def test_iter_from_index_limit_and_offset(self):
+        self.assertEqual(
+            self.docs[1:3],
+            list(self.db.iter_from_index(
+                'by-key', '*', limit=2, offset=1)))
+        self.assertEqual(
+            self.docs[3:],
+            list(self.db.iter_from_index('by-key', '*', offset=3)))
+
+    def test_iter_from_index_invalid_values(self):
+        self.assertRaises(
+            errors.InvalidValueForIndex,
+            self.db.iter_from_index, 'by-key', 'value1', 'value2')
+
+    def test_iter_range_from_index(self):
+        self.assertEqual(
+            self.db.get_range_from_index('by-key', 'value1', 'value3'),
+            list(self.db.iter_range_from_index(
+                'by-key', 'value1', 'value3')))
+        self.assertEqual(
+            self.docs[2:],
+            list(self.db.iter_range_from_index('by-key', 'value2')))
+        self.assertEqual(
+            self.docs[:2],
+            list(self.db.iter_range_from_index(
+                'by-key', end_value='value1', limit=2)))
+
+    def test_get_from_index_page(self):
+        pages = []
+        token = None
+        while True:
+            docs, token = self.db.get_from_index_page(
+                'by-key', ('*',), 2, page_token=token)
+            pages.append(docs)
+            if token is None:
+                break
+        self.assertEqual(
+            [self.docs[:2], self.docs[2:4], self.docs[4:]], pages)
+
+    def test_page_token_survives_new_documents(self):
+        docs, token = self.db.get_from_index_page('by-key', ('*',), 2)
+        self.assertEqual(self.docs[:2], docs)
+        # a document that sorts before the current page does not shift the
+        # following ones.
+        self.db.create_doc({'key': 'value0'}, doc_id='doc00')
+        docs, token = self.db.get_range_from_index_page(
+            'by-key', None, None, 2, page_token=token)
+        self.assertEqual(self.docs[2:4], docs)
+
+    def test_invalid_page_token(self):
+        self.assertRaises(
+            errors.InvalidValueForIndex,
+            self.db.get_from_index_page, 'by-key', ('*',), 2,
+            page_token='invalid')
+
+
+#-----------------------------------------------------------------------------
+# Tests for migration of cryptographic parameters
+#-----------------------------------------------------------------------------
+
+class SQLCipherStatementStatsTest(tests.TestCase):
+    """
+    Tests for recording the SQL statements run on the database.
+    """
+
+    scenarios = [
+        ('sqlcipher', {'make_document_for_test': make_document_for_test}),
+    ]
+
+    def setUp(self):
+        tests.TestCase.setUp(self)
+        self.db = SQLCipherDatabase(':memory:', PASSWORD)
+        self.db.create_index('by-key', 'key')
+        for i in range(3):
+            self.db.create_doc({'key': 'value%d' % i})
+
+    def tearDown(self):
+        self.db.close()
+        tests.TestCase.tearDown(self)
+
+    def _statements(self, stats):
+        return dict(
+            (entry['statement'], entry)
+            for entry in stats.stats()['statements'])
+
+    def test_statement_shape(self):
+        self.assertEqual(
+            'SELECT * FROM t WHERE a IN (?, ...) AND b = ? LIMIT ?',
+            statement_shape(
+                "SELECT *\n  FROM t WHERE a IN (?, ?, ?) "
+                "AND b = 'it''s' LIMIT 10"))
+        self.assertEqual(
+            'SELECT d0.value FROM document_fields d0',
+            statement_shape('SELECT d0.value FROM document_fields d0'))
+
+    def test_disabled_by_default(self):
+        self.assertIs(None, self.db.statement_stats)
+        self.assertFalse(hasattr(self.db._db_handle.cursor(), '_record'))
+
+    def test_records_statements(self):
+        stats = StatementStats()
+        self.db.set_statement_stats(stats)
+        self.assertIs(stats, self.db.statement_stats)
+        self.assertEqual(3, len(self.db.get_from_index('by-key', 'value*')))
+        self.db.whats_changed()
+        statements = self._statements(stats)
+        self.assertTrue(statements)
+        for entry in statements.values():
+            self.assertTrue(entry['count'] >= 1)
+            self.assertTrue(entry['max_time'] <= entry['total_time'])
+        # the index query returned one row per document.
+        index_queries = [
+            entry for shape, entry in statements.items()
+            if 'document_fields' in shape]
+        self.assertEqual(3, sum(entry['rows'] for entry in index_queries))
+        # stop recording.
+        self.db.set_statement_stats(None)
+        self.db.get_from_index('by-key', 'value*')
+        self.assertEqual(statements, self._statements(stats))
+        stats.reset()
+        self.assertEqual([], stats.stats()['statements'])
+
+    def test_slow_query_log(self):
+        stats = StatementStats(slow_query_threshold=0)
+        self.db.set_statement_stats(stats)
+        self.db.get_from_index('by-key', 'value*')
+        slow_queries = stats.stats()['slow_queries']
+        self.assertTrue(slow_queries)
+        self.assertEqual(
+            set(['time', 'statement', 'elapsed', 'rows']),
+            set(slow_queries[0].keys()))
+        # slow statements are only logged once per execution.
+        executions = sum(
+            entry['count'] for entry in stats.stats()['statements'])
+        self.assertEqual(executions, len(slow_queries))
+        stats.slow_query_threshold = None
+        self.db.get_from_index('by-key', 'value*')
+        self.assertEqual(len(slow_queries), len(stats.stats()['slow_queries']))
+
+
+class SQLCipherPendingContentTest(tests.TestCase):
+    """
+    Tests for documents synced without their content.
+    """
+
+    scenarios = [
+        ('sqlcipher', {'make_document_for_test': make_document_for_test}),
+    ]
+
+    def setUp(self):
+        tests.TestCase.setUp(self)
+        self.db = SQLCipherDatabase(':memory:', PASSWORD)
+        self.db.create_index('by-folder', 'folder')
+        self.server = {}
+        self.fetched = []
+
+    def tearDown(self):
+        self.db.close()
+        tests.TestCase.tearDown(self)
+
+    def _fetch(self, doc_ids):
+        self.fetched.append(sorted(doc_ids))
+        return [self.make_document(doc_id, *self.server[doc_id])
+                for doc_id in doc_ids if doc_id in self.server]
+
+    def _sync_pending(self, doc_id, gen):
+        content = json.dumps({'folder': 'INBOX', 'body': doc_id})
+        self.server[doc_id] = ('other:%d' % gen, content)
+        doc = self.make_document(
+            doc_id, 'other:%d' % gen, '{"folder": "INBOX"}')
+        doc.content_pending = True
+        self.db._put_doc_if_newer(
+            doc, save_conflict=True, replica_uid='other', replica_gen=gen,
+            replica_trans_id='T-%d' % gen)
+
+    def test_pending_content_without_fetcher(self):
+        self._sync_pending('doc', 1)
+        self.assertEqual(1, self.db.get_pending_content_count())
+        doc = self.db.get_doc('doc')
+        self.assertTrue(doc.content_pending)
+        self.assertEqual({'folder': 'INBOX'}, doc.content)
+        # the metadata is indexed.
+        self.assertEqual(
+            ['doc'],
+            [d.doc_id for d in self.db.get_from_index('by-folder', 'INBOX')])
+        doc.content = {'folder': 'Trash'}
+        self.assertRaises(ContentPending, self.db.put_doc, doc)
+
+    def test_get_doc_fetches_content(self):
+        self._sync_pending('doc', 1)
+        gen = self.db._get_generation()
+        self.db.set_content_fetcher(self._fetch)
+        doc = self.db.get_doc('doc')
+        self.assertFalse(doc.content_pending)
+        self.assertEqual('other:1', doc.rev)
+        self.assertEqual({'folder': 'INBOX', 'body': 'doc'}, doc.content)
+        self.assertEqual(0, self.db.get_pending_content_count())
+        # filling in the content is not a change to sync.
+        self.assertEqual(gen, self.db._get_generation())
+        # so the next sync sends nothing.
+        self.assertEqual([], self.db.whats_changed(gen)[2])
+        self.db.get_doc('doc')
+        self.assertEqual([['doc']], self.fetched)
+        # the fetched content is indexed.
+        self.assertEqual(
+            {'folder': 'INBOX', 'body': 'doc'},
+            self.db.get_from_index('by-folder', 'INBOX')[0].content)
+
+    def test_pending_docs_are_not_cached(self):
+        self.db.set_document_cache_size(10)
+        self._sync_pending('doc', 1)
+        self.assertTrue(self.db.get_doc('doc').content_pending)
+        self.assertIs(None, self.db.document_cache.get('doc'))
+        # the content is then stored by another connection.
+        doc = self.make_document('doc', *self.server['doc'])
+        with self.db._db_handle:
+            self.db._replace_content(doc)
+        doc = self.db.get_doc('doc')
+        self.assertFalse(doc.content_pending)
+        self.assertEqual({'folder': 'INBOX', 'body': 'doc'}, doc.content)
+        doc.content = {'folder': 'Trash', 'body': 'doc'}
+        self.db.put_doc(doc)
+        self.assertEqual(
+            {'folder': 'Trash', 'body': 'doc'},
+            self.db.get_doc('doc').content)
+
+    def test_content_stored_while_reading(self):
+        self.db.set_document_cache_size(10)
+        self._sync_pending('doc', 1)
+        get_cached_doc = self.db._get_cached_doc
+
+        def read_then_store(doc_id, include_deleted):
+            doc = get_cached_doc(doc_id, include_deleted)
+            # the content is stored by another connection meanwhile.
+            with self.db._db_handle:
+                self.db._replace_content(
+                    self.make_document('doc', *self.server['doc']))
+            return doc
+
+        self.db._get_cached_doc = read_then_store
+        doc = self.db.get_doc('doc')
+        self.assertFalse(doc.content_pending)
+        self.assertEqual({'folder': 'INBOX', 'body': 'doc'}, doc.content)
+
+    def test_fetch_newer_revision(self):
+        self._sync_pending('doc', 1)
+        self.server['doc'] = ('other:2', '{"folder": "Trash"}')
+        self.db.set_content_fetcher(self._fetch)
+        self.assertGetDoc(self.db, 'doc', 'other:2', '{"folder": "Trash"}',
+                          False)
+        self.assertEqual(0, self.db.get_pending_content_count())
+
+    def test_get_docs_fetches_in_batch(self):
+        for gen, doc_id in enumerate(['doc1', 'doc2', 'doc3']):
+            self._sync_pending(doc_id, gen + 1)
+        self.db.set_content_fetcher(self._fetch)
+        docs = list(self.db.get_docs(['doc1', 'doc2']))
+        self.assertEqual([['doc1', 'doc2']], self.fetched)
+        self.assertEqual(
+            ['doc1', 'doc2'], [doc.content['body'] for doc in docs])
+        self.assertEqual(1, self.db.get_pending_content_count())
+
+    def test_fetch_by_priority(self):
+        for gen, doc_id in enumerate(['doc1', 'doc2', 'doc3']):
+            self._sync_pending(doc_id, gen + 1)
+        self.db.set_content_fetcher(self._fetch)
+        # the most recent changes come first.
+        self.assertEqual(1, self.db.fetch_pending_content(limit=1))
+        self.db.prioritize_pending_content(['doc1'])
+        self.assertEqual(1, self.db.fetch_pending_content(limit=1))
+        self.assertEqual([['doc3'], ['doc1']], self.fetched)
+        self.assertEqual(1, self.db.fetch_pending_content())
+        self.assertEqual(0, self.db.fetch_pending_content())
+        self.assertEqual([['doc3'], ['doc1'], ['doc2']], self.fetched)
+
+
+class SQLCipherCompactionTest(tests.TestCase):
+    """
+    Tests for purging history other replicas do not need anymore.
+    """
+
+    def setUp(self):
+        tests.TestCase.setUp(self)
+        self.db = SQLCipherDatabase(':memory:', PASSWORD)
+
+    def tearDown(self):
+        self.db.close()
+        tests.TestCase.tearDown(self)
+
+    def test_nothing_is_purged_before_syncing(self):
+        doc = self.db.create_doc_from_json('{}')
+        self.db.delete_doc(doc)
+        report = self.db.compact()
+        self.assertEqual(0, report['tombstones'])
+        self.assertEqual(0, report['transactions'])
+        self.assertEqual(2, len(self.db._get_transaction_log()))
+
+    def test_compact(self):
+        keep = self.db.create_doc_from_json('{"count": 0}')
+        for count in xrange(3):
+            keep.content = {'count': count + 1}
+            self.db.put_doc(keep)
+        gone = self.db.create_doc_from_json('{}')
+        self.db.delete_doc(gone)
+        later = self.db.create_doc_from_json('{}')
+        gen, trans_id = self.db._get_generation_info()
+        self.db._set_sync_ack('server', gen, trans_id)
+        # changes after the acknowledged generation are kept.
+        self.db.put_doc(keep)
+        report = self.db.compact()
+        self.assertEqual(1, report['tombstones'])
+        self.assertEqual(6, report['transactions'])
+        self.assertTrue(report['bytes_after'] <= report['bytes_before'])
+        self.assertEqual(
+            None, self.db.get_doc(gone.doc_id, include_deleted=True))
+        self.assertEqual(2, len(self.db._get_transaction_log()))
+        self.assertEqual(gen + 1, self.db._get_generation())
+        # the generation the server knows is still valid.
+        self.db.validate_gen_and_trans_id(gen, trans_id)
+        # all documents are still enumerated when sending everything again.
+        _, _, changes = self.db.whats_changed(0)
+        self.assertEqual(
+            sorted([keep.doc_id, later.doc_id]),
+            sorted(doc_id for doc_id, _, _ in changes))
+
+    def test_compact_invalidates_foreign_cache(self):
+        other = SQLCipherDatabase(':memory:', PASSWORD)
+        self.addCleanup(other.close)
+        other.set_document_cache_size(2)
+        gone = self.db.create_doc_from_json('{}')
+        self.db.delete_doc(gone)
+        other.document_cache.put(
+            self.db.get_doc(gone.doc_id, include_deleted=True))
+        gen, trans_id = self.db._get_generation_info()
+        self.db._set_sync_ack('server', gen, trans_id)
+        self.db.set_foreign_cache(other.document_cache)
+        self.assertEqual(1, self.db.compact()['tombstones'])
+        self.assertIs(None, other.document_cache.get(gone.doc_id))
+
+
+class SQLCipherSearchTest(tests.TestCase):
+    """
+    Tests for full-text search indexes.
+    """
+
+    def setUp(self):
+        tests.TestCase.setUp(self)
+        self.db = SQLCipherDatabase(':memory:', PASSWORD)
+
+    def tearDown(self):
+        self.db.close()
+        tests.TestCase.tearDown(self)
+
+    def test_search_ranks_matches(self):
+        self.db.create_search_index('mail', 'subject', 'tags')
+        once = self.db.create_doc(
+            {'subject': 'lunch on friday', 'tags': ['work']})
+        twice = self.db.create_doc(
+            {'subject': 'lunch, lunch!', 'tags': ['lunch']})
+        self.db.create_doc({'subject': 'meeting', 'body': 'lunch'})
+        self.assertEqual(
+            [twice.doc_id, once.doc_id], self.db.search('mail', 'lunch'))
+        self.assertEqual(
+            [twice.doc_id], self.db.search('mail', 'lunch', limit=1))
+        self.assertEqual([once.doc_id], self.db.search('mail', 'fri*'))
+        self.assertEqual(
+            [('mail', ['subject', 'tags'])], self.db.list_search_indexes())
+
+    def test_index_is_maintained(self):
+        doc = self.db.create_doc({'headers': {'subject': 'old news'}})
+        # documents stored before the index is created are indexed.
+        self.db.create_search_index('mail', 'headers.subject')
+        self.assertEqual([doc.doc_id], self.db.search('mail', 'old'))
+        doc.content = {'headers': {'subject': 'new news'}}
+        self.db.put_doc(doc)
+        self.assertEqual([], self.db.search('mail', 'old'))
+        self.assertEqual([doc.doc_id], self.db.search('mail', 'new'))
+        self.db.delete_doc(doc)
+        self.assertEqual([], self.db.search('mail', 'news'))
+        # documents inserted by syncs are indexed.
+        synced = self.make_document(
+            'synced', 'other:1', '{"headers": {"subject": "synced news"}}')
+        self.db._put_doc_if_newer(
+            synced, save_conflict=False, replica_uid='other', replica_gen=1,
+            replica_trans_id='T-sid')
+        self.assertEqual(['synced'], self.db.search('mail', 'news'))
+        self.db.delete_search_index('mail')
+        self.assertEqual([], self.db.list_search_indexes())
+
+    def test_search_errors(self):
+        self.assertRaises(
+            errors.IndexDoesNotExist, self.db.search, 'mail', 'lunch')
+        self.db.create_search_index('mail', 'subject')
+        # creating the same index again does nothing.
+        self.db.create_search_index('mail', 'subject')
+        self.assertRaises(
+            errors.IndexNameTakenError,
+            self.db.create_search_index, 'mail', 'body')
+        self.assertRaises(
+            InvalidSearchQuery, self.db.search, 'mail', '"unbalanced')
+
+
+class SQLCipherBlobTest(tests.TestCase):
+    """
+    Tests for storing blobs in chunks.
+    """
+
+    def setUp(self):
+        tests.TestCase.setUp(self)
+        self.db = SQLCipherDatabase(':memory:', PASSWORD)
+
+    def tearDown(self):
+        self.db.close()
+        tests.TestCase.tearDown(self)
+
+    def _chunk_count(self):
+        c = self.db._db_handle.cursor()
+        c.execute('SELECT count(*) FROM blob_chunk')
+        return c.fetchone()[0]
+
+    def test_write_and_read_in_chunks(self):
+        writer = self.db.create_blob(chunk_size=4)
+        for data in ('ab', 'cdefghij', 'k'):
+            writer.write(data)
+        reference = writer.close()
+        blob_id = reference[BLOB_ID_KEY]
+        self.assertEqual(
+            blob_reference(hashlib.sha256('abcdefghijk').hexdigest(), 11, 3),
+            reference)
+        self.assertEqual(
+            {'size': 11, 'chunks': 3, 'stored_chunks': 3, 'synced': False},
+            self.db.get_blob_info(blob_id))
+        reader = self.db.open_blob(blob_id)
+        self.assertEqual('abc', reader.read(3))
+        self.assertEqual('defgh', reader.read(5))
+        self.assertEqual('ijk', reader.read())
+        self.assertEqual('', reader.read())
+        self.assertEqual(
+            ['abcd', 'efgh', 'ijk'], list(self.db.open_blob(blob_id)))
+        self.assertEqual([blob_id], self.db._get_unsynced_blobs())
+
+    def test_deduplication(self):
+        with self.db.create_blob(chunk_size=4) as writer:
+            writer.write('abcdefghijk')
+        with self.db.create_blob(chunk_size=4) as again:
+            again.write('abcdefghijk')
+        self.assertEqual(writer.reference, again.reference)
+        with self.db.create_blob(chunk_size=4) as other:
+            other.write('abcdXYZ')
+        # the first chunk is shared.
+        self.assertEqual(4, self._chunk_count())
+        self.assertEqual(
+            sorted([writer.reference[BLOB_ID_KEY],
+                    other.reference[BLOB_ID_KEY]]),
+            self.db.list_blobs())
+        self.db.delete_blob(writer.reference[BLOB_ID_KEY])
+        self.assertEqual(2, self._chunk_count())
+        self.assertRaises(
+            BlobNotFound, self.db.open_blob, writer.reference[BLOB_ID_KEY])
+        self.assertEqual(
+            'abcdXYZ', self.db.open_blob(other.reference[BLOB_ID_KEY]).read())
+
+    def test_aborted_blob_is_discarded(self):
+        try:
+            with self.db.create_blob(chunk_size=4) as writer:
+                writer.write('abcdefghijk')
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertTrue(writer.closed)
+        self.assertEqual(None, writer.reference)
+        self.assertEqual([], self.db.list_blobs())
+        self.assertEqual(0, self._chunk_count())
+
+
+class SQLCipherMigrationTest(BaseLeapTest):
+    """
+    Tests to guarantee databases can be re-encrypted with new parameters.
+    """
+
+    def setUp(self):
+        self.DB_FILE = os.path.join(self.tempdir, 'migrate.db')
+        self.STATE_FILE = \
+            self.DB_FILE + SQLCipherDatabase.MIGRATION_STATE_SUFFIX
+        self.TARGET_FILE = \
+            self.DB_FILE + SQLCipherDatabase.MIGRATION_TARGET_SUFFIX
+        db = SQLCipherDatabase(self.DB_FILE, PASSWORD)
+        self.doc = db.create_doc_from_json(tests.simple_doc)
+        db.close()
+
+    def tearDown(self):
+        for f in [self.DB_FILE, self.STATE_FILE, self.TARGET_FILE]:
+            if os.path.exists(f):
+                os.unlink(f)
+
+    def _assert_migrated(self, **kwargs):
+        db = SQLCipherDatabase.open_database(
+            self.DB_FILE, kwargs.pop('password', PASSWORD), create=False,
+            **kwargs)
+        self.assertEqual(
+            tests.simple_doc, db.get_doc(self.doc.doc_id).get_json())
+        db.close()
+        self.assertFalse(os.path.exists(self.STATE_FILE))
+        self.assertFalse(os.path.exists(self.TARGET_FILE))
+
+    def test_migrate_page_size(self):
+        progress = []
+        migrate(self.DB_FILE, PASSWORD, new_cipher_page_size=4096,
+                progress_cb=lambda stage, done: progress.append(stage))
+        self._assert_migrated(cipher_page_size=4096)
+        self.assertEqual(MigrationStages.EXPORTING, progress[0])
+        self.assertEqual(MigrationStages.DONE, progress[-1])
+        self.assertRaises(
+            dbapi2.DatabaseError,
+            SQLCipherDatabase.open_database, self.DB_FILE, PASSWORD,
+            create=False)
+
+    def test_migrate_key_and_kdf_iter(self):
+        migrate(self.DB_FILE, PASSWORD, new_password='654321',
+                new_kdf_iter=8000)
+        self._assert_migrated(password='654321', kdf_iter=8000)
+
+    def test_migrate_to_password_with_quotes(self):
+        migrate(self.DB_FILE, PASSWORD, new_password="it's")
+        self._assert_migrated(password="it's")
+        migrate(self.DB_FILE, "it's", new_password=PASSWORD)
+        self._assert_migrated()
+
+    def test_resume_interrupted_export(self):
+        # an export that was interrupted leaves garbage behind
+        with open(self.TARGET_FILE, 'w') as f:
+            f.write('garbage')
+        SQLCipherDatabase._store_migration_state(
+            self.STATE_FILE, {'stage': MigrationStages.EXPORTING})
+        migrate(self.DB_FILE, PASSWORD, new_cipher_page_size=4096)
+        self._assert_migrated(cipher_page_size=4096)
+
+    def test_resume_after_export(self):
+        state = SQLCipherDatabase._export_database(
+            self.DB_FILE, self.TARGET_FILE, self.STATE_FILE,
+            (PASSWORD, False, 'aes-256-cbc', 4000, 1024),
+            (PASSWORD, False, 'aes-256-cbc', 4000, 4096),
+            lambda stage, done: None)
+        self.assertEqual(MigrationStages.EXPORTED, state['stage'])
+        migrate(self.DB_FILE, PASSWORD, new_cipher_page_size=4096)
+        self._assert_migrated(cipher_page_size=4096)
+
+
 load_tests = tests.load_with_scenarios
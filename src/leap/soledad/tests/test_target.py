@@ -25,10 +25,17 @@ import os
 import ssl
 import simplejson as json
 import cStringIO
+import hashlib
+import pstats
+import threading
+import time
+import SocketServer
 
 
-from u1db.sync import Synchronizer
+from wsgiref import simple_server
+from u1db.sync import Synchronizer, SyncExchange
 from u1db.remote import (
+    http_app,
     http_client,
     http_database,
     http_target,
@@ -38,7 +45,12 @@ from leap import soledad
 from leap.soledad import (
     target,
     auth,
+    connection,
+    sqlcipher,
+    blobs,
+    profiling,
 )
+from leap.soledad.scope import SyncScope
 from leap.soledad.document import SoledadDocument
 from leap.soledad.server import (
     SoledadApp,
@@ -244,6 +256,53 @@ class TestSoledadPyDocument(test_document.TestPyDocument, BaseSoledadTest):
         'leap', {'make_document_for_test': make_leap_document_for_test})])
 
 
+class TestSoledadDocumentLazyContent(tests.TestCase):
+    """
+    Tests for the lazy parsing of the content of Soledad documents.
+    """
+
+    def test_get_json_returns_original_string(self):
+        doc_json = '{"key":  "value"}'
+        doc = SoledadDocument('id', 'rev', doc_json)
+        self.assertIs(doc_json, doc.get_json())
+        self.assertIsNone(doc._content)
+
+    def test_content_is_parsed_on_first_access(self):
+        doc = SoledadDocument('id', 'rev', '{"key": "value"}')
+        self.assertEqual({'key': 'value'}, doc.content)
+        doc.content['key'] = 'other'
+        self.assertEqual({'key': 'other'}, json.loads(doc.get_json()))
+
+    def test_invalid_json_is_reported_on_access(self):
+        doc = SoledadDocument('id', 'rev', '{not json}')
+        self.assertRaises(u1db.errors.InvalidJSON, getattr, doc, 'content')
+
+    def test_same_content_does_not_parse(self):
+        doc1 = SoledadDocument('id', 'rev', '{"key": "value"}')
+        doc2 = SoledadDocument('id', 'rev', '{"key":"value"}')
+        self.assertTrue(doc1.same_content_as(doc2))
+        self.assertIsNone(doc1._content)
+        self.assertIsNone(doc2._content)
+
+    def test_invalid_json_is_refused_when_stored(self):
+        db = sqlcipher.SQLCipherDatabase(':memory:', 'secret')
+        self.addCleanup(db.close)
+        self.assertRaises(
+            u1db.errors.InvalidJSON, db.create_doc_from_json, '{not json}')
+        doc = db.create_doc_from_json('{}')
+        self.assertRaises(
+            u1db.errors.InvalidJSON, db.put_doc,
+            SoledadDocument(doc.doc_id, doc.rev, '{"key": value}'))
+        self.assertEqual('{}', db.get_doc(doc.doc_id).get_json())
+
+    def test_no_instance_dict(self):
+        doc = SoledadDocument('id', 'rev', '{}')
+        doc.syncable = False
+        doc.has_conflicts = True
+        doc.content = {'key': 'value'}
+        self.assertEqual({}, doc.__dict__)
+
+
 #-----------------------------------------------------------------------------
 # The following tests come from `u1db.tests.test_remote_sync_target`.
 #-----------------------------------------------------------------------------
@@ -349,6 +408,52 @@ class TestSoledadParsingSyncStream(
                           tgt._parse_sync_stream,
                           '[\r\n{"error": "?"}\r\n', None)
 
+    def test_framed_stream(self):
+        doc = SoledadDocument('i', rev='r')
+        doc.content = {'key': 'value'}
+        enc_json = target.encrypt_doc(self._soledad._crypto, doc)
+        tgt = target.SoledadSyncTarget(
+            "http://foo/foo", crypto=self._soledad._crypto)
+        received = []
+        data = (target.FRAMES_MAGIC
+                + target.encode_frame({'new_generation': 1})
+                + target.encode_doc_frame('i', 'r', enc_json, 3, 'T-sid')
+                + target.encode_doc_frame('d', 'r', None, 4, 'T-sid2')
+                + target.FRAMES_END)
+        res = tgt._parse_sync_frames(
+            data, lambda doc, gen, trans_id: received.append(
+                (doc, gen, trans_id)))
+        self.assertEqual({'new_generation': 1}, res)
+        self.assertEqual(2, len(received))
+        doc, gen, trans_id = received[0]
+        self.assertEqual({'key': 'value'}, doc.content)
+        self.assertEqual((3, 'T-sid'), (gen, trans_id))
+        self.assertTrue(received[1][0].is_tombstone())
+        # the ciphertext is sent as raw bytes.
+        self.assertTrue(len(data) < len(enc_json))
+
+    def test_broken_framed_stream(self):
+        tgt = target.SoledadSyncTarget("http://foo/foo")
+        data = (target.FRAMES_MAGIC
+                + target.encode_frame({'new_generation': 1})
+                + target.FRAMES_END)
+        # wrong start
+        self.assertRaises(u1db.errors.BrokenSyncStream,
+                          tgt._parse_sync_frames, data[1:], None)
+        # truncated
+        self.assertRaises(u1db.errors.BrokenSyncStream,
+                          tgt._parse_sync_frames, data[:-1], None)
+        # no frames
+        self.assertRaises(u1db.errors.BrokenSyncStream,
+                          tgt._parse_sync_frames,
+                          target.FRAMES_MAGIC + target.FRAMES_END, None)
+        # error
+        self.assertRaises(u1db.errors.Unavailable,
+                          tgt._parse_sync_frames,
+                          target.FRAMES_MAGIC
+                          + target.encode_frame({'error': 'unavailable'}),
+                          None)
+
 
 #
 # functions for TestRemoteSyncTargets
@@ -493,6 +598,498 @@ class TestSoledadSyncTarget(
             db, 'doc-here', 'replica:1', '{"value": "here"}', False)
 
 
+class ETagMiddleware(object):
+    """
+    A stand-in for a server that answers conditional sync info requests.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.not_modified = 0
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] != 'GET' \
+                or '/sync-from/' not in environ['PATH_INFO']:
+            return self.app(environ, start_response)
+        status_box = []
+
+        def buffer_response(status, headers, exc_info=None):
+            status_box.append((status, headers))
+
+        body = ''.join(self.app(environ, buffer_response))
+        status, headers = status_box[0]
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if environ.get('HTTP_IF_NONE_MATCH') == etag:
+            self.not_modified += 1
+            start_response('304 Not Modified', [('etag', etag)])
+            return []
+        start_response(status, headers + [('etag', etag)])
+        return [body]
+
+
+def make_etag_http_app(state):
+    return ETagMiddleware(http_app.HTTPApp(state))
+
+
+class MetadataOnlyMiddleware(object):
+    """
+    A stand-in for a server that sends only the metadata of documents that
+    have it when asked to.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        if '/sync-from/' not in environ['PATH_INFO']:
+            return self.app(environ, start_response)
+        if environ['REQUEST_METHOD'] == 'GET':
+            return self._sync_info(environ, start_response)
+        return self._sync_exchange(environ, start_response)
+
+    def _buffered(self, environ):
+        status_box = []
+
+        def buffer_response(status, headers, exc_info=None):
+            status_box.append((status, headers))
+
+        body = ''.join(self.app(environ, buffer_response))
+        status, headers = status_box[0]
+        headers = [(name, value) for name, value in headers
+                   if name.lower() != 'content-length']
+        return status, headers, body
+
+    def _respond(self, start_response, status, headers, body):
+        start_response(status, headers + [('content-length', str(len(body)))])
+        return [body]
+
+    def _sync_info(self, environ, start_response):
+        status, headers, body = self._buffered(environ)
+        if status.startswith('200'):
+            info = json.loads(body)
+            info['features'] = info.get('features', []) + ['metadata_only']
+            body = json.dumps(info)
+        return self._respond(start_response, status, headers, body)
+
+    def _sync_exchange(self, environ, start_response):
+        body = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
+        args = json.loads(body.splitlines()[1].rstrip(','))
+        environ['wsgi.input'] = cStringIO.StringIO(body)
+        status, headers, body = self._buffered(environ)
+        if not status.startswith('200') or not args.get('metadata_only'):
+            return self._respond(start_response, status, headers, body)
+        lines = [line.rstrip(',') for line in body.splitlines()[1:-1]]
+        entries = [json.loads(line) for line in lines]
+        for entry in entries[1:]:
+            if entry['content'] is None:
+                continue
+            envelope = json.loads(entry['content'])
+            if target.ENC_META_KEY in envelope:
+                del envelope[target.ENC_JSON_KEY]
+                entry['content'] = json.dumps(envelope)
+        body = '[\r\n%s\r\n]\r\n' % ',\r\n'.join(
+            json.dumps(entry) for entry in entries)
+        return self._respond(start_response, status, headers, body)
+
+
+def make_metadata_only_http_app(state):
+    return MetadataOnlyMiddleware(make_token_soledad_app(state))
+
+
+class DeltaMiddleware(object):
+    """
+    A stand-in for a server that accepts changes sent as deltas.
+
+    It can not decrypt deltas, so it stores them in a chain after the
+    revision of the document they are based on.
+    """
+
+    def __init__(self, app, state):
+        self.app = app
+        self.state = state
+
+    def __call__(self, environ, start_response):
+        if '/sync-from/' not in environ['PATH_INFO']:
+            return self.app(environ, start_response)
+        if environ['REQUEST_METHOD'] == 'GET':
+            return self._sync_info(environ, start_response)
+        return self._sync_exchange(environ, start_response)
+
+    def _sync_info(self, environ, start_response):
+        status_box = []
+
+        def buffer_response(status, headers, exc_info=None):
+            status_box.append((status, headers))
+
+        body = ''.join(self.app(environ, buffer_response))
+        status, headers = status_box[0]
+        if status.startswith('200'):
+            info = json.loads(body)
+            info['features'] = ['delta']
+            body = json.dumps(info)
+        headers = [(name, value) for name, value in headers
+                   if name.lower() != 'content-length']
+        start_response(status, headers + [('content-length', str(len(body)))])
+        return [body]
+
+    def _sync_exchange(self, environ, start_response):
+        body = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
+        lines = [line.rstrip(',') for line in body.splitlines()[1:-1]]
+        entries = [json.loads(line) for line in lines]
+        dbname = environ['PATH_INFO'][1:].split('/sync-from/')[0]
+        db = self.state.open_database(dbname)
+        for entry in entries[1:]:
+            if entry['content'] is None:
+                continue
+            envelope = json.loads(entry['content'])
+            if target.ENC_DELTA_BASE_KEY not in envelope:
+                continue
+            stored = db.get_doc(entry['id'])
+            if stored is None \
+                    or stored.rev != envelope[target.ENC_DELTA_BASE_KEY]:
+                error = json.dumps({'error': target.DELTA_BASE_MISSING})
+                start_response('409 Conflict', [
+                    ('content-type', 'application/json'),
+                    ('content-length', str(len(error)))])
+                return [error]
+            chain = stored.content.get(
+                target.ENC_CHAIN_KEY, [stored.content])
+            entry['content'] = json.dumps({
+                target.ENC_SCHEME_KEY: target.EncryptionSchemes.SYMKEY,
+                target.ENC_CHAIN_KEY: chain + [envelope],
+            })
+        body = '[\r\n%s\r\n]' % ',\r\n'.join(
+            json.dumps(entry) for entry in entries)
+        environ['wsgi.input'] = cStringIO.StringIO(body)
+        environ['CONTENT_LENGTH'] = str(len(body))
+        return self.app(environ, start_response)
+
+
+def make_delta_http_app(state):
+    return DeltaMiddleware(make_token_soledad_app(state), state)
+
+
+class FramesMiddleware(object):
+    """
+    A stand-in for a server that exchanges framed sync streams, translating
+    them to and from JSON sync streams.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.framed = 0
+
+    def __call__(self, environ, start_response):
+        if '/sync-from/' not in environ['PATH_INFO']:
+            return self.app(environ, start_response)
+        if environ['REQUEST_METHOD'] == 'GET':
+            return self._sync_info(environ, start_response)
+        if environ.get('CONTENT_TYPE') != target.FRAMED_CONTENT_TYPE:
+            return self.app(environ, start_response)
+        self.framed += 1
+        data = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
+        frames = target.iter_frames(data)
+        args, _ = frames.next()
+        lines = [json.dumps(args)]
+        for header, payload in frames:
+            doc_id, rev, content, gen, trans_id = target.decode_doc_frame(
+                header, payload)
+            lines.append(json.dumps({
+                'id': doc_id, 'rev': rev, 'content': content, 'gen': gen,
+                'trans_id': trans_id}))
+        body = '[\r\n%s\r\n]' % ',\r\n'.join(lines)
+        environ['wsgi.input'] = cStringIO.StringIO(body)
+        environ['CONTENT_LENGTH'] = str(len(body))
+        environ['CONTENT_TYPE'] = 'application/x-u1db-sync-stream'
+        status, headers, body = self._buffer(environ)
+        if not status.startswith('200'):
+            start_response(status, headers)
+            return [body]
+        lines = [line.rstrip(',') for line in body.splitlines()[1:-1]]
+        frames = [target.FRAMES_MAGIC, target.encode_frame(
+            json.loads(lines[0]))]
+        for line in lines[1:]:
+            entry = json.loads(line)
+            frames.append(target.encode_doc_frame(
+                entry['id'], entry['rev'], entry['content'], entry['gen'],
+                entry['trans_id']))
+        frames.append(target.FRAMES_END)
+        body = ''.join(frames)
+        start_response(status, [
+            ('content-type', target.FRAMED_CONTENT_TYPE),
+            ('content-length', str(len(body)))])
+        return [body]
+
+    def _buffer(self, environ):
+        status_box = []
+
+        def buffer_response(status, headers, exc_info=None):
+            status_box.append((status, headers))
+
+        body = ''.join(self.app(environ, buffer_response))
+        status, headers = status_box[0]
+        return status, headers, body
+
+    def _sync_info(self, environ, start_response):
+        status, headers, body = self._buffer(environ)
+        if status.startswith('200'):
+            info = json.loads(body)
+            info['features'] = info.get('features', []) + ['frames']
+            body = json.dumps(info)
+        headers = [(name, value) for name, value in headers
+                   if name.lower() != 'content-length']
+        start_response(status, headers + [('content-length', str(len(body)))])
+        return [body]
+
+
+def make_frames_http_app(state):
+    return FramesMiddleware(make_token_soledad_app(state))
+
+
+class ParallelUploadMiddleware(object):
+    """
+    A stand-in for a server that accepts batches of changes uploaded
+    concurrently, through separate connections.
+
+    Each upload waits for the others to arrive, so that it can be told how
+    many were handled at the same time.
+    """
+
+    def __init__(self, app, state, connections=3):
+        self.app = app
+        self.state = state
+        self.connections = connections
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.concurrent = 0
+        self.uploads = 0
+        self.declined = 0
+        self.decline = False
+
+    def __call__(self, environ, start_response):
+        if '/sync-from/' not in environ['PATH_INFO']:
+            return self.app(environ, start_response)
+        if environ['REQUEST_METHOD'] == 'GET':
+            return self._sync_info(environ, start_response)
+        if environ['REQUEST_METHOD'] != 'POST':
+            return self.app(environ, start_response)
+        body = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
+        lines = [line.rstrip(',') for line in body.splitlines()[1:-1]]
+        entries = [json.loads(line) for line in lines]
+        args = entries[0]
+        if args.pop('upload_only', False):
+            return self._upload(environ, start_response, args, entries[1:])
+        uploaded = dict(args.pop('uploaded', []))
+        body = '[\r\n%s\r\n]' % ',\r\n'.join(
+            json.dumps(entry) for entry in entries)
+        environ['wsgi.input'] = cStringIO.StringIO(body)
+        environ['CONTENT_LENGTH'] = str(len(body))
+        status, headers, body = self._buffer(environ)
+        if status.startswith('200'):
+            lines = [line.rstrip(',') for line in body.splitlines()[1:-1]]
+            entries = [json.loads(line) for line in lines]
+            # the documents stored by the uploads are not sent back.
+            entries = entries[:1] + [
+                entry for entry in entries[1:]
+                if uploaded.get(entry['id'], -1) < entry['gen']]
+            body = '[\r\n%s\r\n]' % ',\r\n'.join(
+                json.dumps(entry) for entry in entries)
+        return self._respond(start_response, status, headers, body)
+
+    def _upload(self, environ, start_response, args, entries):
+        if self.decline:
+            self.declined += 1
+            error = json.dumps({'error': 'unavailable'})
+            start_response('503 Service Unavailable', [
+                ('content-type', 'application/json'),
+                ('content-length', str(len(error)))])
+            return [error]
+        dbname, source_replica_uid = \
+            environ['PATH_INFO'][1:].split('/sync-from/')
+        with self.condition:
+            self.uploads += 1
+            self.in_flight += 1
+            self.concurrent = max(self.concurrent, self.in_flight)
+            self.condition.notify_all()
+            deadline = time.time() + 5
+            while self.in_flight < self.connections \
+                    and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            try:
+                db = self.state.open_database(dbname)
+                exchange = SyncExchange(
+                    db, source_replica_uid, args['last_known_generation'])
+                for entry in entries:
+                    exchange.insert_doc_from_source(
+                        u1db.Document(
+                            entry['id'], entry['rev'], entry['content']),
+                        entry['gen'], entry['trans_id'])
+                gen, trans_id = db._get_generation_info()
+            finally:
+                self.in_flight -= 1
+        body = '[\r\n%s\r\n]' % json.dumps({
+            'new_generation': gen,
+            'new_transaction_id': trans_id,
+            'uploaded': sorted(
+                [doc_id, at_gen]
+                for doc_id, at_gen in exchange.seen_ids.items()),
+        })
+        return self._respond(start_response, '200 OK', [
+            ('content-type', 'application/x-u1db-sync-stream')], body)
+
+    def _buffer(self, environ):
+        status_box = []
+
+        def buffer_response(status, headers, exc_info=None):
+            status_box.append((status, headers))
+
+        body = ''.join(self.app(environ, buffer_response))
+        status, headers = status_box[0]
+        return status, headers, body
+
+    def _respond(self, start_response, status, headers, body):
+        headers = [(name, value) for name, value in headers
+                   if name.lower() != 'content-length']
+        start_response(status, headers + [('content-length', str(len(body)))])
+        return [body]
+
+    def _sync_info(self, environ, start_response):
+        status, headers, body = self._buffer(environ)
+        if status.startswith('200'):
+            info = json.loads(body)
+            info['features'] = info.get('features', []) + ['parallel_upload']
+            body = json.dumps(info)
+        return self._respond(start_response, status, headers, body)
+
+
+def make_parallel_upload_http_app(state):
+    return ParallelUploadMiddleware(make_token_soledad_app(state), state)
+
+
+class BlobMiddleware(object):
+    """
+    A stand-in for a server that stores blobs, see
+    leap.soledad.blobs.SoledadBlobTarget.
+
+    If C{fail_after} is set, only that many chunk requests succeed, as if
+    the connection was lost afterwards.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.chunks = {}
+        self.fail_after = None
+
+    def __call__(self, environ, start_response):
+        if '/blobs/' not in environ['PATH_INFO']:
+            return self.app(environ, start_response)
+        path = environ['PATH_INFO'].split('/blobs/', 1)[1].split('/')
+        if len(path) == 1:
+            body = json.dumps({'chunks': sorted(
+                index for remote_id, index in self.chunks
+                if remote_id == path[0])})
+            return self._respond(start_response, '200 OK', body)
+        if self.fail_after is not None:
+            if not self.fail_after:
+                return self._respond(
+                    start_response, '500 Internal Server Error', 'lost',
+                    content_type='text/plain')
+            self.fail_after -= 1
+        key = (path[0], int(path[1]))
+        if environ['REQUEST_METHOD'] == 'PUT':
+            self.chunks[key] = environ['wsgi.input'].read(
+                int(environ['CONTENT_LENGTH']))
+            return self._respond(start_response, '200 OK', '{}')
+        return self._respond(
+            start_response, '200 OK', self.chunks[key],
+            content_type='application/octet-stream')
+
+    def _respond(self, start_response, status, body,
+                 content_type='application/json'):
+        start_response(status, [
+            ('content-type', content_type),
+            ('content-length', str(len(body)))])
+        return [body]
+
+
+def make_blob_http_app(state):
+    return BlobMiddleware(make_token_soledad_app(state))
+
+
+class _ThreadingWSGIServer(SocketServer.ThreadingMixIn,
+                           simple_server.WSGIServer):
+    daemon_threads = True
+
+
+def threading_server_def():
+    """
+    Return the definition of a server that handles each request in a thread
+    of its own, see C{tests.TestCaseWithServer.server_def}.
+    """
+    class _RequestHandler(simple_server.WSGIRequestHandler):
+        def log_request(*args):
+            pass  # suppress
+
+    def make_server(host_port, application):
+        srv = _ThreadingWSGIServer(host_port, _RequestHandler)
+        srv.set_app(application)
+        return srv
+
+    return make_server, "shutdown", "http"
+
+
+class TestSoledadConditionalSyncInfo(tests.TestCaseWithServer):
+
+    def make_app(self):
+        self.request_state = tests.ServerStateForTests()
+        self.app = make_etag_http_app(self.request_state)
+        return self.app
+
+    def test_get_sync_info_if_changed(self):
+        self.startServer()
+        db = self.request_state._create_database('test')
+        db._set_replica_gen_and_trans_id('other-id', 1, 'T-transid')
+        remote_target = target.SoledadSyncTarget(self.getURL('test'))
+        remote_target.set_token_credentials('user-uuid', 'auth-token')
+        info, etag = remote_target.get_sync_info_if_changed('other-id')
+        self.assertEqual(('test', 0, '', 1, 'T-transid'), info)
+        self.assertNotEqual(None, etag)
+        # nothing changed, so the server answers without a body.
+        self.assertEqual(
+            (None, etag),
+            remote_target.get_sync_info_if_changed('other-id', etag=etag))
+        self.assertEqual(1, self.app.not_modified)
+        # a change in the target is noticed.
+        db.create_doc_from_json('{}')
+        info, new_etag = remote_target.get_sync_info_if_changed(
+            'other-id', etag=etag)
+        self.assertEqual(1, info[1])
+        self.assertNotEqual(etag, new_etag)
+        self.assertEqual(1, self.app.not_modified)
+
+
+class TestSoledadConnectionPool(tests.TestCaseWithServer):
+
+    make_app_with_state = staticmethod(test_remote_sync_target.make_http_app)
+
+    def test_connections_are_reused(self):
+        self.startServer()
+        db = self.request_state._create_database('test')
+        pool = connection.HTTPConnectionPool()
+        for i in range(3):
+            remote_target = target.SoledadSyncTarget(
+                self.getURL('test'), connection_pool=pool)
+            remote_target.set_token_credentials('user-uuid', 'auth-token')
+            remote_target.record_sync_info('other-id', i + 1, 'T-id')
+            remote_target.close()
+        self.assertEqual(
+            (3, 'T-id'), db._get_replica_gen_and_trans_id('other-id'))
+        self.assertEqual(
+            {'created': 1, 'reused': 2, 'idle': 1}, pool.stats())
+        pool.close()
+        self.assertEqual(0, pool.stats()['idle'])
+
+
 #-----------------------------------------------------------------------------
 # The following tests come from `u1db.tests.test_https`.
 #-----------------------------------------------------------------------------
@@ -556,6 +1153,22 @@ class TestSoledadSyncTargetHttpsSupport(test_https.TestHttpSyncTargetHttpsSuppor
             http_client.CertificateError, remote_target.record_sync_info,
             'other-id', 2, 'T-id')
 
+    def test_per_instance_certificate(self):
+        """
+        Test that a target verifies the server with its own certificate,
+        whatever the certificate configured for the whole process.
+        """
+        self.startServer()
+        db = self.request_state._create_database('test')
+        self.patch(soledad, 'SOLEDAD_CERT', None)
+        _, port = self.server.server_address
+        remote_target = target.SoledadSyncTarget(
+            'https://localhost:%d/test' % port, cert_file=self.cacert_pem)
+        remote_target.set_token_credentials('user-uuid', 'auth-token')
+        remote_target.record_sync_info('other-id', 2, 'T-id')
+        self.assertEqual(
+            (2, 'T-id'), db._get_replica_gen_and_trans_id('other-id'))
+
 
 #-----------------------------------------------------------------------------
 # The following tests come from `u1db.tests.test_http_database`.
@@ -780,5 +1393,643 @@ class TestSoledadDbSync(test_sync.TestDbSync, BaseSoledadTest):
         self.assertEqual(1, t_gen)
         self.assertEqual(1, s_gen)
 
+    def test_db_sync_report(self):
+        """
+        Test that a sync from a SQLCipher database is reported and the
+        report is stored in the local database.
+        """
+        db = sqlcipher.open(
+            os.path.join(self.tempdir, 'report.u1db'), 'secret',
+            create=True, crypto=self._soledad._crypto)
+        self.addCleanup(db.close)
+        db.create_doc_from_json(tests.simple_doc, doc_id='mine')
+        db.create_doc_from_json(tests.simple_doc, doc_id='conflicted')
+        self.db2.create_doc_from_json(tests.nested_doc, doc_id='theirs')
+        self.db2.create_doc_from_json(tests.nested_doc, doc_id='conflicted')
+        report = target.SyncReport()
+        local_gen = db.sync(
+            self.getURL('test2.db'), creds={'token': {
+                'uuid': 'user-uuid',
+                'token': 'auth-token',
+            }}, report=report)
+        self.assertEqual(local_gen, report.local_gen)
+        self.assertEqual(2, report.docs_sent)
+        self.assertEqual(2, report.docs_received)
+        self.assertEqual(1, report.conflicts)
+        self.assertTrue(report.bytes_sent > 0)
+        self.assertTrue(report.bytes_received > 0)
+        self.assertEqual(set(target.SyncReport.PHASES), set(report.timings))
+        self.assertTrue(report.timings['encrypt'] > 0)
+        self.assertTrue(report.timings['insert'] > 0)
+        stored = db.get_sync_reports()
+        self.assertEqual(1, len(stored))
+        self.assertEqual(report.as_dict(), stored[0])
+
+    def _scoped_db(self, scope):
+        db = sqlcipher.open(
+            os.path.join(self.tempdir, 'scoped.u1db'), 'secret',
+            create=True, crypto=self._soledad._crypto)
+        self.addCleanup(db.close)
+        db.set_sync_scope(scope)
+        return db
+
+    def _sync_scoped_db(self, db):
+        report = target.SyncReport()
+        db.sync(
+            self.getURL('test2.db'), creds={'token': {
+                'uuid': 'user-uuid',
+                'token': 'auth-token',
+            }}, report=report)
+        return report
+
+    def test_db_sync_scope(self):
+        """
+        Test that documents out of the sync scope are neither sent nor
+        stored, unless they are stored locally.
+        """
+        db = self._scoped_db(SyncScope(
+            doc_id_prefixes=['keep-'], index_expressions=['folder'],
+            index_values=['INBOX']))
+        self.assertEqual(
+            SyncScope(doc_id_prefixes=['keep-'], index_expressions=['folder'],
+                      index_values=['INBOX']),
+            db.get_sync_scope())
+        db.create_doc_from_json('{"folder": "INBOX"}', doc_id='inbox')
+        db.create_doc_from_json('{"folder": "Sent"}', doc_id='sent')
+        db.create_doc_from_json('{"folder": "Sent"}', doc_id='shared')
+        self.db2.create_doc_from_json('{"folder": "INBOX"}', doc_id='new')
+        self.db2.create_doc_from_json('{"folder": "Trash"}', doc_id='keep-1')
+        self.db2.create_doc_from_json('{"folder": "Trash"}', doc_id='trash')
+        self.db2.create_doc_from_json('{"folder": "Trash"}', doc_id='shared')
+        report = self._sync_scoped_db(db)
+        self.assertEqual(1, report.docs_sent)
+        self.assertEqual(3, report.docs_skipped)
+        self.assertIsNotNone(self.db2.get_doc('inbox'))
+        self.assertIsNone(self.db2.get_doc('sent'))
+        for doc_id in ('new', 'keep-1', 'shared'):
+            self.assertIsNotNone(db.get_doc(doc_id))
+        self.assertIsNone(db.get_doc('trash'))
+
+    def test_db_sync_scope_non_string_values(self):
+        """
+        Test that numbers and booleans in the content of documents match
+        the sync scope as they match an index with the same expressions.
+        """
+        db = self._scoped_db(SyncScope(
+            index_expressions=['priority', 'flagged'],
+            index_values=['5', '1']))
+        db.create_index('by-priority', 'priority', 'flagged')
+        db.create_doc_from_json(
+            '{"priority": 5, "flagged": true}', doc_id='number')
+        db.create_doc_from_json(
+            '{"priority": "5", "flagged": true}', doc_id='string')
+        db.create_doc_from_json(
+            '{"priority": 5, "flagged": false}', doc_id='unflagged')
+        db.create_doc_from_json(
+            '{"priority": 5.5, "flagged": true}', doc_id='float')
+        in_scope = sorted(
+            doc.doc_id for doc in db.get_from_index('by-priority', '5', '1'))
+        self.assertEqual(['number', 'string'], in_scope)
+        self._sync_scoped_db(db)
+        for doc_id in in_scope:
+            self.assertIsNotNone(self.db2.get_doc(doc_id))
+        for doc_id in ('unflagged', 'float'):
+            self.assertIsNone(self.db2.get_doc(doc_id))
+
+    def test_db_sync_scope_change(self):
+        """
+        Test that widening the sync scope sends and receives the documents
+        that were out of it.
+        """
+        db = self._scoped_db(SyncScope(doc_id_prefixes=['a-']))
+        db.create_doc_from_json(tests.simple_doc, doc_id='a-mine')
+        db.create_doc_from_json(tests.simple_doc, doc_id='b-mine')
+        self.db2.create_doc_from_json(tests.simple_doc, doc_id='b-theirs')
+        self._sync_scoped_db(db)
+        self.assertIsNone(self.db2.get_doc('b-mine'))
+        self.assertIsNone(db.get_doc('b-theirs'))
+        db.set_sync_scope(None)
+        self.assertIsNone(db.get_sync_scope())
+        self._sync_scoped_db(db)
+        self.assertIsNotNone(self.db2.get_doc('b-mine'))
+        self.assertIsNotNone(db.get_doc('b-theirs'))
+        # the changes were sent again only once.
+        report = self._sync_scoped_db(db)
+        self.assertEqual(0, report.docs_sent)
+        self.assertEqual(0, report.docs_received)
+
+    def test_db_sync_metadata_only_fallback(self):
+        """
+        Test that a metadata only sync with a server that does not support
+        it receives the full content of documents.
+        """
+        db = sqlcipher.open(
+            os.path.join(self.tempdir, 'metadata.u1db'), 'secret',
+            create=True, crypto=self._soledad._crypto)
+        self.addCleanup(db.close)
+        self.db2.create_doc_from_json(tests.nested_doc, doc_id='theirs')
+        report = target.SyncReport()
+        db.sync(
+            self.getURL('test2.db'), creds={'token': {
+                'uuid': 'user-uuid',
+                'token': 'auth-token',
+            }}, report=report, metadata_only=True)
+        self.assertEqual(1, report.docs_received)
+        self.assertEqual(0, report.docs_pending)
+        self.assertEqual(0, db.get_pending_content_count())
+        self.assertGetDoc(
+            db, 'theirs', self.db2.get_doc('theirs').rev, tests.nested_doc,
+            False)
+
+    def test_db_sync_lazy_decrypt(self):
+        """
+        Test that documents received with lazy decryption are indexed by
+        their metadata and decrypted when first read.
+        """
+        creds = {'token': {'uuid': 'user-uuid', 'token': 'auth-token'}}
+        source = sqlcipher.open(
+            os.path.join(self.tempdir, 'source.u1db'), 'secret',
+            create=True, crypto=self._soledad._crypto)
+        self.addCleanup(source.close)
+        source.create_doc_from_json(
+            '{"folder": "INBOX", "body": "hello"}', doc_id='mail')
+        source.sync(
+            self.getURL('test2.db'), creds=creds, metadata_fields=['folder'])
+        db = sqlcipher.open(
+            os.path.join(self.tempdir, 'lazy.u1db'), 'secret',
+            create=True, crypto=self._soledad._crypto)
+        self.addCleanup(db.close)
+        db.create_index('by-folder', 'folder')
+        report = target.SyncReport()
+        db.sync(
+            self.getURL('test2.db'), creds=creds, report=report,
+            lazy_decrypt=True)
+        self.assertEqual(1, report.docs_encrypted)
+        self.assertEqual(0, report.docs_pending)
+        # there is nothing to fetch from the server.
+        self.assertEqual(0, db.get_pending_content_count())
+        [doc] = db.get_from_index('by-folder', 'INBOX')
+        self.assertEqual({'folder': 'INBOX'}, doc.content)
+        gen = db._get_generation()
+        doc = db.get_doc('mail')
+        self.assertFalse(doc.content_pending)
+        self.assertEqual({'folder': 'INBOX', 'body': 'hello'}, doc.content)
+        # the decrypted content was stored without changing the generation.
+        self.assertEqual(gen, db._get_generation())
+        [doc] = db.get_from_index('by-folder', 'INBOX')
+        self.assertEqual({'folder': 'INBOX', 'body': 'hello'}, doc.content)
+        # so it is not sent back to the server.
+        report = target.SyncReport()
+        db.sync(
+            self.getURL('test2.db'), creds=creds, report=report,
+            lazy_decrypt=True)
+        self.assertEqual(0, report.docs_sent)
+
+    def test_db_sync_lazy_decrypt_conflict(self):
+        """
+        Test that a conflicting change received with lazy decryption is
+        decrypted, so neither revision loses its content.
+        """
+        creds = {'token': {'uuid': 'user-uuid', 'token': 'auth-token'}}
+        source = sqlcipher.open(
+            os.path.join(self.tempdir, 'source.u1db'), 'secret',
+            create=True, crypto=self._soledad._crypto)
+        self.addCleanup(source.close)
+        doc = source.create_doc_from_json(
+            '{"folder": "INBOX", "body": "hello"}', doc_id='mail')
+        source.sync(
+            self.getURL('test2.db'), creds=creds, metadata_fields=['folder'])
+        db = sqlcipher.open(
+            os.path.join(self.tempdir, 'lazy.u1db'), 'secret',
+            create=True, crypto=self._soledad._crypto)
+        self.addCleanup(db.close)
+        db.sync(self.getURL('test2.db'), creds=creds, lazy_decrypt=True)
+        # both replicas change the document.
+        local = db.get_doc('mail')
+        local.content = {'folder': 'INBOX', 'body': 'mine'}
+        db.put_doc(local)
+        doc.content = {'folder': 'Trash', 'body': 'theirs'}
+        source.put_doc(doc)
+        source.sync(
+            self.getURL('test2.db'), creds=creds, metadata_fields=['folder'])
+        report = target.SyncReport()
+        db.sync(
+            self.getURL('test2.db'), creds=creds, report=report,
+            lazy_decrypt=True)
+        self.assertEqual(0, report.docs_encrypted)
+        self.assertEqual(1, report.conflicts)
+        doc = db.get_doc('mail')
+        self.assertTrue(doc.has_conflicts)
+        self.assertFalse(doc.content_pending)
+        self.assertEqual({'folder': 'Trash', 'body': 'theirs'}, doc.content)
+        self.assertEqual(
+            [{'folder': 'Trash', 'body': 'theirs'},
+             {'folder': 'INBOX', 'body': 'mine'}],
+            [conflict.content for conflict in db.get_doc_conflicts('mail')])
+
+
+class BaseSoledadSyncTest(tests.TestCaseWithServer, BaseSoledadTest):
+    """
+    Base class for tests of syncs of local databases with a server that
+    supports some feature, given by the scenarios of each subclass.
+    """
+
+    creds = {'token': {
+        'uuid': 'user-uuid',
+        'token': 'auth-token',
+    }}
+
+    def setUp(self):
+        super(BaseSoledadSyncTest, self).setUp()
+        self.startServer()
+        self.db2 = self.request_state._create_database('test2.db')
+
+    def _open_db(self, name, create=True):
+        db = sqlcipher.open(
+            os.path.join(self.tempdir, name), 'secret',
+            create=create, crypto=self._soledad._crypto)
+        self.addCleanup(db.close)
+        return db
+
+    def _sync_db(self, db, **kwargs):
+        report = target.SyncReport()
+        db.sync(
+            self.getURL('test2.db'), creds=self.creds, report=report,
+            **kwargs)
+        return report
+
+    def _target(self):
+        remote_target = target.SoledadSyncTarget(
+            self.getURL('test2.db'), creds=self.creds,
+            crypto=self._soledad._crypto)
+        self.addCleanup(remote_target.close)
+        return remote_target
+
+
+class TestSoledadMetadataOnlySync(BaseSoledadSyncTest):
+    """Test syncs that receive only the metadata of documents."""
+
+    scenarios = [
+        ('py-token-metadata-only-http', {
+            'make_app_with_state': make_metadata_only_http_app,
+        }),
+    ]
+
+    def _fetch_content(self, doc_ids):
+        return self._target().get_docs_content(doc_ids)
+
+    def test_db_sync_metadata_only(self):
+        """
+        Test that documents received without their content are indexed by
+        their metadata, and that their content is fetched when first read or
+        prefetched by another connection.
+        """
+        source = self._open_db('source.u1db')
+        source.create_doc_from_json(
+            '{"folder": "INBOX", "body": "hello"}', doc_id='read')
+        source.create_doc_from_json(
+            '{"folder": "INBOX", "body": "later"}', doc_id='prefetched')
+        self._sync_db(source, metadata_fields=['folder'])
+        db = self._open_db('metadata.u1db')
+        db.set_document_cache_size(10)
+        db.create_index('by-folder', 'folder')
+        report = self._sync_db(db, metadata_only=True)
+        self.assertEqual(2, report.docs_received)
+        self.assertEqual(2, report.docs_pending)
+        self.assertEqual(2, db.get_pending_content_count())
+        # the metadata is indexed.
+        docs = db.get_from_index('by-folder', 'INBOX')
+        self.assertEqual(
+            ['prefetched', 'read'], sorted(doc.doc_id for doc in docs))
+        self.assertEqual(
+            [{'folder': 'INBOX'}] * 2, [doc.content for doc in docs])
+        self.assertTrue(db.get_doc('prefetched').content_pending)
+        # reading a document fetches its content.
+        db.set_content_fetcher(self._fetch_content)
+        gen = db._get_generation()
+        doc = db.get_doc('read')
+        self.assertFalse(doc.content_pending)
+        self.assertEqual({'folder': 'INBOX', 'body': 'hello'}, doc.content)
+        self.assertEqual(1, db.get_pending_content_count())
+        # the rest is prefetched through another connection.
+        prefetch = self._open_db('metadata.u1db', create=False)
+        prefetch.set_content_fetcher(self._fetch_content)
+        prefetch.set_foreign_cache(db.document_cache)
+        self.assertEqual(1, prefetch.fetch_pending_content())
+        prefetch.invalidate_written_docs()
+        self.assertEqual(0, db.get_pending_content_count())
+        doc = db.get_doc('prefetched')
+        self.assertFalse(doc.content_pending)
+        self.assertEqual({'folder': 'INBOX', 'body': 'later'}, doc.content)
+        # filling in the content is not a change to sync.
+        self.assertEqual(gen, db._get_generation())
+        self.assertEqual(0, self._sync_db(db, metadata_only=True).docs_sent)
+
+
+class TestSoledadDeltaSync(BaseSoledadSyncTest):
+    """Test syncs with a server that accepts changes sent as deltas."""
+
+    scenarios = [
+        ('py-token-delta-http', {
+            'make_app_with_state': make_delta_http_app,
+        }),
+    ]
+
+    def _sync_delta_db(self, db):
+        return self._sync_db(db, deltas=True)
+
+    def test_db_sync_deltas(self):
+        """
+        Test that a small change to a big document is sent as a delta, and
+        that other replicas receive the full document.
+        """
+        db = self._open_db('delta.u1db')
+        content = {'flags': [], 'body': 'x' * 10000}
+        doc = db.create_doc_from_json(json.dumps(content), doc_id='mail')
+        full = self._sync_delta_db(db)
+        self.assertEqual(0, full.deltas_sent)
+        for flag in ('seen', 'flagged'):
+            content['flags'].append(flag)
+            doc.content = content
+            db.put_doc(doc)
+            report = self._sync_delta_db(db)
+            self.assertEqual(1, report.docs_sent)
+            self.assertEqual(1, report.deltas_sent)
+            self.assertTrue(report.bytes_sent * 10 < full.bytes_sent)
+        stored = self.db2.get_doc('mail')
+        self.assertEqual(3, len(stored.content[target.ENC_CHAIN_KEY]))
+        other = self._open_db('other.u1db')
+        report = self._sync_delta_db(other)
+        self.assertEqual(1, report.docs_received)
+        self.assertGetDoc(
+            other, 'mail', doc.rev, json.dumps(content), False)
+        # changes based on a received chain are sent as deltas too.
+        doc = other.get_doc('mail')
+        content['flags'] = []
+        doc.content = content
+        other.put_doc(doc)
+        self.assertEqual(1, self._sync_delta_db(other).deltas_sent)
+        self._sync_delta_db(db)
+        self.assertGetDoc(db, 'mail', doc.rev, json.dumps(content), False)
+
+    def test_db_sync_deltas_base_missing(self):
+        """
+        Test that a change is sent in full if the server does not hold the
+        revision its delta is based on.
+        """
+        db = self._open_db('delta.u1db')
+        content = {'flags': [], 'body': 'x' * 10000}
+        doc = db.create_doc_from_json(json.dumps(content), doc_id='mail')
+        self._sync_delta_db(db)
+        # another replica changes the document in the server.
+        stored = self.db2.get_doc('mail')
+        stored.content = {'replaced': True}
+        self.db2.put_doc(stored)
+        content['flags'].append('seen')
+        doc.content = content
+        db.put_doc(doc)
+        report = self._sync_delta_db(db)
+        self.assertEqual(1, report.docs_sent)
+        self.assertEqual(0, report.deltas_sent)
+        self.assertEqual(1, report.conflicts)
+
+
+class TestSoledadFramedSync(BaseSoledadSyncTest):
+    """Test syncs with a server that exchanges framed sync streams."""
+
+    scenarios = [
+        ('py-token-frames-http', {
+            'make_app_with_state': make_frames_http_app,
+        }),
+    ]
+
+    def make_app(self):
+        self.app = BaseSoledadSyncTest.make_app(self)
+        return self.app
+
+    def _sync(self, db, framed):
+        report = target.SyncReport()
+        url = self.getURL('test2.db')
+        remote_target = target.SoledadSyncTarget(
+            url, creds=self.creds, crypto=self._soledad._crypto,
+            report=report, framed=framed)
+        try:
+            Synchronizer(db, remote_target).sync(autocreate=True)
+        finally:
+            remote_target.close()
+        return report
+
+    def test_db_sync_framed(self):
+        """
+        Test that documents are exchanged in framed sync streams, which are
+        smaller than JSON sync streams.
+        """
+        body = 'x' * 10000
+        for index in xrange(3):
+            self.db2.create_doc_from_json(
+                json.dumps({'body': body}), doc_id='theirs-%d' % index)
+        db = self._open_db('framed.u1db')
+        json_db = self._open_db('json.u1db')
+        for index in xrange(3):
+            for local_db in (db, json_db):
+                local_db.create_doc_from_json(
+                    json.dumps({'body': body}), doc_id='mine-%d' % index)
+        framed = self._sync(db, True)
+        self.assertEqual(1, self.app.framed)
+        self.assertEqual(3, framed.docs_sent)
+        self.assertEqual(3, framed.docs_received)
+        for index in xrange(3):
+            self.assertGetDoc(
+                db, 'theirs-%d' % index,
+                self.db2.get_doc('theirs-%d' % index).rev,
+                json.dumps({'body': body}), False)
+        plain = self._sync(json_db, False)
+        self.assertEqual(1, self.app.framed)
+        self.assertEqual(3, plain.docs_sent)
+        self.assertEqual(6, plain.docs_received)
+        # encrypted content is hex encoded in JSON streams.
+        self.assertTrue(framed.bytes_sent * 1.5 < plain.bytes_sent)
+
+    def test_db_sync_is_profiled(self):
+        """
+        Test that the encryption of the documents a sync sends is part of
+        the profile of the sync.
+        """
+        profile_dir = os.path.join(self.tempdir, 'profiles')
+        self.addCleanup(profiling.disable_profiling)
+        db = self._open_db('framed.u1db')
+        db.create_doc_from_json(tests.simple_doc)
+        with profiling.profiling(profile_dir):
+            self._sync(db, True)
+        [name] = os.listdir(profile_dir)
+        self.assertTrue(name.endswith('-sync_exchange.prof'))
+        stats = pstats.Stats(os.path.join(profile_dir, name))
+        self.assertIn(
+            '_encrypt_doc_envelope',
+            [function for _, _, function in stats.stats])
+        db.create_doc_from_json(tests.simple_doc)
+        with profiling.profiling(profile_dir, profiler='sampling'):
+            self._sync(db, True)
+        self.assertEqual(
+            1, len([name for name in os.listdir(profile_dir)
+                    if name.endswith('-sync_exchange.stacks')]))
+
+
+class TestSoledadParallelUpload(BaseSoledadSyncTest):
+    """Test syncs with a server that accepts parallel uploads."""
+
+    scenarios = [
+        ('py-token-parallel-http', {
+            'make_app_with_state': make_parallel_upload_http_app,
+            'server_def': threading_server_def,
+        }),
+    ]
+
+    def setUp(self):
+        super(TestSoledadParallelUpload, self).setUp()
+        self.db = tests.make_memory_database_for_test(self, 'test1')
+
+    def make_app(self):
+        self.app = BaseSoledadSyncTest.make_app(self)
+        return self.app
+
+    def _sync(self, upload_connections):
+        report = target.SyncReport()
+        url = self.getURL('test2.db')
+        remote_target = target.SoledadSyncTarget(
+            url, creds=self.creds, crypto=self._soledad._crypto,
+            report=report, upload_connections=upload_connections)
+        try:
+            Synchronizer(self.db, remote_target).sync(autocreate=True)
+        finally:
+            remote_target.close()
+        return report
+
+    def _create_docs(self, count):
+        self.patch(target.SoledadSyncTarget, 'MIN_UPLOAD_BATCH', 3)
+        return [
+            self.db.create_doc_from_json(json.dumps({'index': index}))
+            for index in xrange(count)]
+
+    def test_db_sync_parallel_upload(self):
+        """
+        Test that a backlog of local changes is uploaded through concurrent
+        connections, and that the uploaded documents are not sent back.
+        """
+        docs = self._create_docs(10)
+        theirs = self.db2.create_doc_from_json(tests.nested_doc)
+        report = self._sync(3)
+        self.assertEqual(3, self.app.uploads)
+        self.assertEqual(3, self.app.concurrent)
+        self.assertEqual(10, report.docs_sent)
+        self.assertEqual(1, report.docs_received)
+        for index, doc in enumerate(docs):
+            self.assertGetEncryptedDoc(
+                self.db2, doc.doc_id, doc.rev,
+                json.dumps({'index': index}), False)
+        self.assertGetEncryptedDoc(
+            self.db, theirs.doc_id, theirs.rev, tests.nested_doc, False)
+        # the server knows the last generation of the source.
+        self.assertEqual(
+            self.db._get_generation_info(),
+            self.db2._get_replica_gen_and_trans_id(self.db._replica_uid))
+        report = self._sync(3)
+        self.assertEqual(0, report.docs_sent)
+        self.assertEqual(0, report.docs_received)
+
+    def test_db_sync_parallel_upload_declined(self):
+        """
+        Test that local changes are sent through a single connection if the
+        server declines parallel uploads.
+        """
+        self.app.decline = True
+        docs = self._create_docs(10)
+        report = self._sync(3)
+        self.assertEqual(3, self.app.declined)
+        self.assertEqual(0, self.app.uploads)
+        self.assertEqual(10, report.docs_sent)
+        for index, doc in enumerate(docs):
+            self.assertGetEncryptedDoc(
+                self.db2, doc.doc_id, doc.rev,
+                json.dumps({'index': index}), False)
+
+
+class TestSoledadBlobSync(BaseSoledadSyncTest):
+    """Test uploading and downloading blobs."""
+
+    scenarios = [
+        ('py-token-blob-http', {
+            'make_app_with_state': make_blob_http_app,
+        }),
+    ]
+
+    def make_app(self):
+        self.app = BaseSoledadSyncTest.make_app(self)
+        return self.app
+
+    def _blob_target(self):
+        remote_target = blobs.SoledadBlobTarget(
+            self.getURL('test2.db'), creds=self.creds,
+            crypto=self._soledad._crypto)
+        self.addCleanup(remote_target.close)
+        return remote_target
+
+    def test_blob_sync_resumes(self):
+        """
+        Test that interrupted uploads and downloads of blobs resume from the
+        chunks already transferred, and that the server only stores
+        encrypted chunks.
+        """
+        content = ''.join(chr(index % 256) for index in xrange(10 * 16))
+        db = self._open_db('local.db')
+        with db.create_blob(chunk_size=16) as writer:
+            writer.write(content)
+        blob_id = writer.reference[blobs.BLOB_ID_KEY]
+        remote_target = self._blob_target()
+        self.app.fail_after = 4
+        self.assertRaises(
+            u1db.errors.HTTPError, remote_target.upload_blob, db, blob_id)
+        self.assertEqual([blob_id], db._get_unsynced_blobs())
+        self.app.fail_after = None
+        self.assertEqual(6, remote_target.upload_blob(db, blob_id))
+        self.assertEqual([], db._get_unsynced_blobs())
+        self.assertEqual(10, len(self.app.chunks))
+        for (remote_id, index), data in self.app.chunks.items():
+            self.assertNotEqual(blob_id, remote_id)
+            self.assertTrue(content[index * 16:(index + 1) * 16] not in data)
+        # another replica downloads the blob.
+        other = self._open_db('other.db')
+        self.app.fail_after = 3
+        self.assertRaises(
+            u1db.errors.HTTPError,
+            remote_target.download_blob, other, writer.reference)
+        self.assertRaises(blobs.BlobNotFound, other.open_blob, blob_id)
+        self.assertEqual(3, other.get_blob_info(blob_id)['stored_chunks'])
+        self.app.fail_after = None
+        self.assertEqual(
+            7, remote_target.download_blob(other, writer.reference))
+        self.assertEqual(content, other.open_blob(blob_id).read())
+        self.assertEqual([], other._get_unsynced_blobs())
+
+    def test_blob_not_uploaded(self):
+        """
+        Test that downloading a blob the server does not store yet fails
+        without recording it, and succeeds once it is uploaded.
+        """
+        db = self._open_db('local.db')
+        with db.create_blob(chunk_size=16) as writer:
+            writer.write('x' * 40)
+        blob_id = writer.reference[blobs.BLOB_ID_KEY]
+        remote_target = self._blob_target()
+        other = self._open_db('other.db')
+        self.assertRaises(
+            blobs.BlobNotFound,
+            remote_target.download_blob, other, writer.reference)
+        self.assertIsNone(other.get_blob_info(blob_id))
+        self.assertEqual(3, remote_target.upload_blob(db, blob_id))
+        self.assertEqual(
+            3, remote_target.download_blob(other, writer.reference))
+        self.assertEqual('x' * 40, other.open_blob(blob_id).read())
+
 
 load_tests = tests.load_with_scenarios